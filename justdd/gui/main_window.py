@@ -84,6 +84,7 @@ class JustDDApp(QMainWindow):
             try:
                 self.flash_worker.progress.disconnect()
                 self.flash_worker.status_update.disconnect()
+                self.flash_worker.telemetry.disconnect()
                 self.flash_worker.log_message.disconnect()
                 self.flash_worker.finished.disconnect()
                 self.flash_worker.requestInterruption()
@@ -306,10 +307,16 @@ class JustDDApp(QMainWindow):
             from ..logic.flash_worker import FlashWorker
 
             self.flash_worker = FlashWorker(
-                self.iso_path, self.drive_path, mode, self.partition_scheme
+                self.iso_path,
+                self.drive_path,
+                mode,
+                self.partition_scheme,
+                audit_algorithms=("sha256",),
+                trim=True,
             )
             self.flash_worker.progress.connect(self.flash_page.update_progress)
             self.flash_worker.status_update.connect(self.flash_page.update_status)
+            self.flash_worker.telemetry.connect(self.flash_page.update_telemetry)
             self.flash_worker.log_message.connect(self.log_message_safe)
             self.flash_worker.finished.connect(self.on_flash_finished)
             self.flash_worker.start()
@@ -363,10 +370,13 @@ class JustDDApp(QMainWindow):
         except Exception:
             pass
 
-    def on_flash_finished(self, success, message):
+    def on_flash_finished(self, success, message, digests=None):
         if self._shutdown_in_progress:
             return
 
+        for name, digest in (digests or {}).items():
+            self.log_message_safe(f"Image {name.upper()}: {digest}")
+
         try:
             self.flash_page.flash_completed(success, message)
 
@@ -374,6 +384,7 @@ class JustDDApp(QMainWindow):
                 try:
                     self.flash_worker.progress.disconnect()
                     self.flash_worker.status_update.disconnect()
+                    self.flash_worker.telemetry.disconnect()
                     self.flash_worker.log_message.disconnect()
                     self.flash_worker.finished.disconnect()
                 except Exception:
@@ -20,6 +20,8 @@ from PySide6.QtWidgets import (
     QWidget,
 )
 
+from ..logic.telemetry import describe_telemetry
+
 
 class PartitionSchemeSelectionPage(QWidget):
     selection_changed = Signal()
@@ -286,6 +288,8 @@ class SelectionPage(QWidget):
         self.iso_path = None
         self.iso_type = "unknown"
         self.iso_details = {}
+        # Partition table of raw images, see partition_table.PartitionLayout
+        self.partition_layout = None
         self.selected_drive = None
         self.partition_scheme = "gpt"
         self._screen_handle = None
@@ -936,6 +940,12 @@ class SelectionPage(QWidget):
                 except Exception:
                     self.iso_type = "unknown"
                     self.iso_details = {}
+                try:
+                    from ..logic.partition_table import read_partition_layout
+
+                    self.partition_layout = read_partition_layout(file_path)
+                except Exception:
+                    self.partition_layout = None
                 if self.iso_type == "windows":
                     try:
                         from shutil import which
@@ -975,6 +985,9 @@ class SelectionPage(QWidget):
                     meta = name if name else ""
                     if size:
                         meta = f"{meta} • {size}" if meta else size
+                    # Partition layout and the slack the flash will skip
+                    if self.partition_layout is not None:
+                        meta = f"{meta} • {self.partition_layout.describe()}"
                     self.file_label.setText(meta)
                     try:
                         self.file_label.show()
@@ -1105,6 +1118,9 @@ class SelectionPage(QWidget):
     def get_iso_details(self):
         return self.iso_details
 
+    def get_partition_layout(self):
+        return self.partition_layout
+
     def get_selected_scheme(self):
         try:
             if (
@@ -1125,6 +1141,7 @@ class SelectionPage(QWidget):
         self.iso_path = None
         self.iso_type = "unknown"
         self.iso_details = {}
+        self.partition_layout = None
         self.selected_drive = None
 
         self.file_label.setText("Please select an ISO")
@@ -1815,6 +1832,11 @@ class FlashPage(QWidget):
         self.progress_bar.setMinimumWidth(400)
         self.progress_bar.setMinimumHeight(30)
 
+        # Throughput, elapsed time and ETA of the write phase
+        self.telemetry_label = QLabel("")
+        self.telemetry_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.telemetry_label.setMinimumWidth(400)
+
         container_layout.addStretch(1)
         container_layout.addWidget(icon_widget, alignment=Qt.AlignmentFlag.AlignCenter)
         container_layout.addWidget(
@@ -1826,6 +1848,9 @@ class FlashPage(QWidget):
         container_layout.addWidget(
             self.progress_bar, alignment=Qt.AlignmentFlag.AlignCenter
         )
+        container_layout.addWidget(
+            self.telemetry_label, alignment=Qt.AlignmentFlag.AlignCenter
+        )
         container_layout.addStretch(1)
 
         main_layout.addWidget(container, alignment=Qt.AlignmentFlag.AlignCenter)
@@ -1844,6 +1869,7 @@ class FlashPage(QWidget):
         if not iso_path:
             self.flashing = False
             self.progress_bar.setValue(0)
+            self.telemetry_label.setText("")
             self.status_label.setText("Ready to flash...")
             f = QFont()
             f.setPointSize(12)
@@ -1853,6 +1879,7 @@ class FlashPage(QWidget):
 
         self.flashing = False
         self.progress_bar.setValue(0)
+        self.telemetry_label.setText("")
         self.status_label.setText("Ready to flash...")
         font = QFont()
         font.setPointSize(12)
@@ -1867,6 +1894,7 @@ class FlashPage(QWidget):
         self.flashing = True
 
         self.progress_bar.setValue(0)
+        self.telemetry_label.setText("")
         self.status_label.setText("Preparing to flash...")
         f = QFont()
         f.setPointSize(12)
@@ -1879,6 +1907,9 @@ class FlashPage(QWidget):
     def update_status(self, message):
         self.status_label.setText(message)
 
+    def update_telemetry(self, snapshot):
+        self.telemetry_label.setText(describe_telemetry(snapshot))
+
     def flash_completed(self, success, message):
         self.flashing = False
 
@@ -0,0 +1,334 @@
+"""
+Block device helpers for the flash engine.
+
+Small, best-effort wrappers around sysfs and a few Linux-only syscalls (called
+through ctypes) for the target device. The sysfs helpers return an
+empty/neutral value instead of raising when the information is not available
+(regular files, loop devices without a queue, missing sysfs, ...); the syscall
+wrappers raise `OSError` so callers can pick a fallback.
+
+`BdiDirtyLimit` caps the dirty page cache of one backing device (BDI)
+through `/sys/class/bdi/<major:minor>` while a flash runs, so a slow stick
+cannot fill the global dirty budget and stall writeback for the other disks.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import fcntl
+import os
+import stat
+import struct
+from typing import Dict, Optional
+
+_SYS_CLASS_BLOCK = "/sys/class/block"
+_SYS_CLASS_BDI = "/sys/class/bdi"
+_PROC_VMSTAT = "/proc/vmstat"
+_UDEV_DATA = "/run/udev/data"
+
+# Flags for sync_file_range(2), see <linux/fs.h>.
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# Block device ioctls, see <linux/fs.h>.
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+
+# fallocate(2) modes, see <linux/falloc.h>.
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc or None
+
+
+def _libc_function(name: str, restype, argtypes):
+    libc = _get_libc()
+    func = getattr(libc, name, None) if libc is not None else None
+    if func is not None:
+        func.restype = restype
+        func.argtypes = argtypes
+    return func
+
+
+def sysfs_block_name(path: str) -> Optional[str]:
+    """
+    Return the sysfs name of the whole disk backing `path` (e.g. "sdb" for
+    "/dev/sdb1"), or None when `path` is not a block device.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+
+    dev = f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+    try:
+        link = os.path.realpath(os.path.join("/sys/dev/block", dev))
+    except OSError:
+        return None
+    if not os.path.isdir(link):
+        return None
+
+    # Partitions live below their parent disk and carry a "partition" file.
+    if os.path.exists(os.path.join(link, "partition")):
+        link = os.path.dirname(link)
+    return os.path.basename(link)
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_queue_hints(path: str) -> Dict[str, int]:
+    """
+    Read the I/O hints of the device backing `path` from
+    `/sys/class/block/<dev>/queue`. Values are in bytes; missing or zero
+    values are left out.
+    """
+    name = sysfs_block_name(path)
+    if not name:
+        return {}
+
+    queue = os.path.join(_SYS_CLASS_BLOCK, name, "queue")
+    hints: Dict[str, int] = {}
+    for key, scale in (
+        ("optimal_io_size", 1),
+        ("minimum_io_size", 1),
+        ("logical_block_size", 1),
+        ("physical_block_size", 1),
+        ("max_sectors_kb", 1024),
+        ("max_hw_sectors_kb", 1024),
+        ("discard_max_bytes", 1),
+        ("write_zeroes_max_bytes", 1),
+    ):
+        value = _read_int(os.path.join(queue, key))
+        if value:
+            hints[key] = value * scale
+    return hints
+
+
+def _read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def device_serial(path: str) -> Optional[str]:
+    """
+    Best-effort stable identifier of the disk backing `path`: the udev
+    ID_SERIAL, the sysfs serial/wwid, or the backing file of a loop device.
+    """
+    name = sysfs_block_name(path)
+    if not name:
+        return None
+
+    dev = _read_text(os.path.join(_SYS_CLASS_BLOCK, name, "dev"))
+    if dev:
+        try:
+            with open(os.path.join(_UDEV_DATA, f"b{dev}"), "r") as f:
+                props = dict(
+                    line[2:].strip().split("=", 1)
+                    for line in f
+                    if line.startswith("E:") and "=" in line
+                )
+            serial = props.get("ID_SERIAL_SHORT") or props.get("ID_SERIAL")
+            if serial:
+                return serial
+        except OSError:
+            pass
+
+    for rel in ("device/serial", "device/wwid", "wwid"):
+        value = _read_text(os.path.join(_SYS_CLASS_BLOCK, name, rel))
+        if value:
+            return value
+
+    backing = _read_text(os.path.join(_SYS_CLASS_BLOCK, name, "loop", "backing_file"))
+    return f"loop:{backing}" if backing else None
+
+
+def bdi_name(path: str) -> Optional[str]:
+    """
+    Return the "major:minor" name of the backing device info (BDI) that
+    writes to `path` go through: the whole disk for a block device, the disk
+    holding the filesystem for a regular file. None when there is none.
+    """
+    try:
+        st = os.stat(path if os.path.exists(path) else os.path.dirname(path) or ".")
+    except OSError:
+        return None
+    dev = st.st_rdev if stat.S_ISBLK(st.st_mode) else st.st_dev
+    link = os.path.realpath(
+        os.path.join("/sys/dev/block", f"{os.major(dev)}:{os.minor(dev)}")
+    )
+    if not os.path.isdir(link):
+        return None
+    if os.path.exists(os.path.join(link, "partition")):
+        link = os.path.dirname(link)
+    name = _read_text(os.path.join(link, "dev"))
+    if not name or not os.path.isdir(os.path.join(_SYS_CLASS_BDI, name)):
+        return None
+    return name
+
+
+def dirty_threshold_bytes() -> Optional[int]:
+    """The global dirty page threshold (vm.dirty_ratio/dirty_bytes) in bytes."""
+    try:
+        with open(_PROC_VMSTAT, "r") as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                if key == "nr_dirty_threshold":
+                    return int(value) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class BdiDirtyLimit:
+    """
+    Temporarily caps the dirty pages of one BDI: `max_ratio` (percent of the
+    global dirty threshold) and, with `strict`, `strict_limit` so that the
+    cap holds even while the system is below its global threshold. `apply()`
+    remembers the current values and raises OSError when they cannot be
+    changed (e.g. without root); `restore()` puts them back.
+    """
+
+    def __init__(self, name: str, max_ratio: int, strict: bool = True):
+        if not 0 < max_ratio <= 100:
+            raise ValueError("max_ratio must be between 1 and 100")
+        self.name = name
+        self.max_ratio = int(max_ratio)
+        self.strict = strict
+        self._saved: Dict[str, str] = {}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(_SYS_CLASS_BDI, self.name, key)
+
+    def _write(self, key: str, value: str) -> None:
+        with open(self._path(key), "w") as f:
+            f.write(value)
+
+    def apply(self) -> None:
+        settings = [("max_ratio", str(self.max_ratio))]
+        if self.strict and os.path.exists(self._path("strict_limit")):
+            settings.append(("strict_limit", "1"))
+        for key, value in settings:
+            current = _read_text(self._path(key))
+            if current is None:
+                raise OSError(f"{self._path(key)} is not readable")
+            self._write(key, value)
+            self._saved.setdefault(key, current)
+
+    def restore(self) -> None:
+        # strict_limit first: max_ratio may still be capped while it is lifted.
+        for key in sorted(self._saved, reverse=True):
+            try:
+                self._write(key, self._saved[key])
+            except OSError:
+                pass
+        self._saved = {}
+
+    @property
+    def cap_bytes(self) -> Optional[int]:
+        """The cap in bytes at the current global dirty threshold."""
+        threshold = dirty_threshold_bytes()
+        return threshold * self.max_ratio // 100 if threshold is not None else None
+
+    def __enter__(self) -> "BdiDirtyLimit":
+        self.apply()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.restore()
+
+
+def open_readonly(path: str, direct: bool = False) -> int:
+    """Open `path` read-only (with O_DIRECT when `direct`); raises OSError."""
+    flags = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+    if direct:
+        if not hasattr(os, "O_DIRECT"):
+            raise OSError("O_DIRECT is not available")
+        flags |= os.O_DIRECT
+    return os.open(path, flags)
+
+
+def has_sync_file_range() -> bool:
+    return _sync_file_range() is not None
+
+
+def _sync_file_range():
+    return _libc_function(
+        "sync_file_range",
+        ctypes.c_int,
+        [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint],
+    )
+
+
+def sync_file_range(fd: int, offset: int, nbytes: int, flags: int) -> None:
+    """Call sync_file_range(2); raises OSError on failure or when unavailable."""
+    func = _sync_file_range()
+    if func is None:
+        raise OSError("sync_file_range is not available")
+    if func(fd, offset, nbytes, flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def zero_out_range(fd: int, offset: int, length: int) -> None:
+    """Zero a byte range of a block device with BLKZEROOUT (kernel-side)."""
+    fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+
+
+def discard_range(fd: int, offset: int, length: int) -> None:
+    """Discard (TRIM) a byte range of a block device with BLKDISCARD."""
+    fcntl.ioctl(fd, BLKDISCARD, struct.pack("QQ", offset, length))
+
+
+def punch_hole(fd: int, offset: int, length: int) -> None:
+    """Deallocate a byte range of a regular file; it reads back as zeros."""
+    func = _libc_function(
+        "fallocate",
+        ctypes.c_int,
+        [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong],
+    )
+    if func is None:
+        raise OSError("fallocate is not available")
+    if func(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+__all__ = [
+    "sysfs_block_name",
+    "read_queue_hints",
+    "device_serial",
+    "bdi_name",
+    "dirty_threshold_bytes",
+    "BdiDirtyLimit",
+    "has_sync_file_range",
+    "sync_file_range",
+    "SYNC_FILE_RANGE_WAIT_BEFORE",
+    "SYNC_FILE_RANGE_WRITE",
+    "SYNC_FILE_RANGE_WAIT_AFTER",
+    "zero_out_range",
+    "discard_range",
+    "punch_hole",
+]
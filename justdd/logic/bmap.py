@@ -0,0 +1,202 @@
+"""
+Block maps: which blocks of an image hold data.
+
+A block map is an XML sidecar in the format of bmaptool (version 2.0) that
+lists the mapped block ranges of an image, each with a SHA-256 checksum of
+its data; the blocks in between (free filesystem space) are don't-care and
+need not be written. `BackupEngine(skip_free=True)` writes one next to the
+image (see `fs_allocation`) and `FlashEngine(trim=True)` picks it up, so a
+restore only writes the blocks the backup read. bmaptool reads these files
+as well.
+
+The sidecar of `stick.img` or `stick.img.zst` is `stick.img.bmap`
+(`bmap_path_for()`); `find_bmap()` also accepts `stick.img.zst.bmap`.
+
+Usage (example):
+    path = find_bmap('/backups/stick.img.zst')
+    if path is not None:
+        print(read_bmap(path).unmapped_ranges)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import xml.etree.ElementTree as ElementTree
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from .image_source import _COMPRESSED_SUFFIXES
+
+BMAP_VERSION = "2.0"
+BMAP_SUFFIX = ".bmap"
+BMAP_BLOCK_SIZE = 4096
+BMAP_CHECKSUM_TYPE = "sha256"
+
+# Placeholder of the file checksum while it is being computed.
+_CHECKSUM_PLACEHOLDER = "0" * 64
+
+
+class BmapError(Exception):
+    """Raised when a block map cannot be read or does not fit its image."""
+
+
+@dataclass
+class Bmap:
+    """A block map; ranges are in bytes, the last one may end mid-block."""
+
+    image_size: int
+    block_size: int = BMAP_BLOCK_SIZE
+    # Mapped (start, end) ranges, in order, starting on block boundaries.
+    ranges: List[Tuple[int, int]] = field(default_factory=list)
+    checksum_type: str = BMAP_CHECKSUM_TYPE
+    # Hex digest of every range's data, empty when not recorded.
+    checksums: List[str] = field(default_factory=list)
+
+    @property
+    def mapped_size(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def unmapped_ranges(self) -> List[Tuple[int, int]]:
+        """The (start, end) ranges between the mapped ones, in order."""
+        gaps = []
+        offset = 0
+        for start, end in self.ranges:
+            if start > offset:
+                gaps.append((offset, start))
+            offset = end
+        if offset < self.image_size:
+            gaps.append((offset, self.image_size))
+        return gaps
+
+
+def bmap_path_for(image_path: str) -> str:
+    """Sidecar name of an image: the compression suffix is replaced."""
+    base = image_path
+    for suffix in _COMPRESSED_SUFFIXES:
+        if base.lower().endswith(suffix):
+            base = base[: -len(suffix)]
+            break
+    return base + BMAP_SUFFIX
+
+
+def find_bmap(image_path: str) -> Optional[str]:
+    """Path of the sidecar block map of an image, None when there is none."""
+    for path in (bmap_path_for(image_path), image_path + BMAP_SUFFIX):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def read_bmap(path: str) -> Bmap:
+    """Parse the block map at `path`. Raises BmapError."""
+    try:
+        with open(path, "rb") as f:
+            text = f.read()
+        root = ElementTree.fromstring(text)
+    except (OSError, ElementTree.ParseError) as e:
+        raise BmapError(f"Cannot read block map {path}: {e}") from e
+    if root.tag != "bmap":
+        raise BmapError(f"{path} is not a block map")
+    major = root.get("version", "0").split(".")[0]
+    if major not in ("1", "2"):
+        raise BmapError(f"Unsupported block map version {root.get('version')}")
+
+    def number(tag: str) -> int:
+        element = root.find(tag)
+        try:
+            return int((element.text or "").strip())  # type: ignore[union-attr]
+        except (AttributeError, ValueError):
+            raise BmapError(f"Block map {path} has no valid {tag}") from None
+
+    image_size = number("ImageSize")
+    block_size = number("BlockSize")
+    if block_size <= 0:
+        raise BmapError(f"Block map {path} has no valid BlockSize")
+    checksum_type = (root.findtext("ChecksumType") or "sha1").strip()
+    stored = (root.findtext("BmapFileChecksum") or "").strip()
+    if stored:
+        body = text.replace(stored.encode(), b"0" * len(stored), 1)
+        try:
+            digest = hashlib.new(checksum_type, body).hexdigest()
+        except ValueError:
+            raise BmapError(f"Unknown block map checksum {checksum_type}") from None
+        if len(stored) == len(digest) and digest != stored:
+            raise BmapError(f"Block map {path} is corrupt (checksum mismatch)")
+
+    bmap = Bmap(image_size, block_size, checksum_type=checksum_type)
+    offset = 0
+    for element in root.iterfind("BlockMap/Range"):
+        first, _, last = (element.text or "").strip().partition("-")
+        try:
+            start = int(first) * block_size
+            end = min((int(last or first) + 1) * block_size, image_size)
+        except ValueError:
+            raise BmapError(f"Block map {path} has a bad range") from None
+        if start < offset or end <= start:
+            raise BmapError(f"Block map {path} has overlapping or empty ranges")
+        bmap.ranges.append((start, end))
+        checksum = element.get("chksum")
+        if checksum:
+            bmap.checksums.append(checksum)
+        offset = end
+    if bmap.checksums and len(bmap.checksums) != len(bmap.ranges):
+        bmap.checksums = []
+    return bmap
+
+
+def write_bmap(path: str, bmap: Bmap) -> None:
+    """Write `bmap` to `path` (atomically, through a temporary file)."""
+    blocks = -(-bmap.image_size // bmap.block_size)
+    mapped = -(-bmap.mapped_size // bmap.block_size)
+    percent = mapped * 100 / blocks if blocks else 0.0
+    lines = [
+        '<?xml version="1.0" ?>',
+        "<!-- Block map of the image: mapped ranges of BlockSize blocks and the",
+        "     checksums of their data. Unmapped blocks need not be written. -->",
+        f'<bmap version="{BMAP_VERSION}">',
+        f"    <ImageSize> {bmap.image_size} </ImageSize>",
+        f"    <BlockSize> {bmap.block_size} </BlockSize>",
+        f"    <BlocksCount> {blocks} </BlocksCount>",
+        f"    <!-- Mapped: {bmap.mapped_size} bytes or {percent:.1f}% -->",
+        f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+        f"    <ChecksumType> {bmap.checksum_type} </ChecksumType>",
+        f"    <BmapFileChecksum> {_CHECKSUM_PLACEHOLDER} </BmapFileChecksum>",
+        "    <BlockMap>",
+    ]
+    for index, (start, end) in enumerate(bmap.ranges):
+        first = start // bmap.block_size
+        last = -(-end // bmap.block_size) - 1
+        span = f"{first}-{last}" if last > first else f"{first}"
+        checksum = (
+            f' chksum="{bmap.checksums[index]}"'
+            if len(bmap.checksums) == len(bmap.ranges)
+            else ""
+        )
+        lines.append(f"        <Range{checksum}> {span} </Range>")
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    text = "\n".join(lines)
+    digest = hashlib.new(bmap.checksum_type, text.encode()).hexdigest()
+    text = text.replace(_CHECKSUM_PLACEHOLDER, digest, 1)
+
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="ascii") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+__all__ = [
+    "BMAP_BLOCK_SIZE",
+    "BMAP_CHECKSUM_TYPE",
+    "BMAP_SUFFIX",
+    "BMAP_VERSION",
+    "Bmap",
+    "BmapError",
+    "bmap_path_for",
+    "find_bmap",
+    "read_bmap",
+    "write_bmap",
+]
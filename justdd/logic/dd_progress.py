@@ -0,0 +1,144 @@
+"""
+dd progress parsing
+
+`dd status=progress` rewrites its progress line in place with carriage
+returns and only ends the final summary with a newline, so line-oriented
+reads (`readline()` in text mode) see the updates in bursts or only at the
+end. This module reads dd's output as raw bytes from a non-blocking file
+descriptor, splits it on both `\\r` and `\\n` and turns it into:
+
+- `DdProgress` records (bytes copied, seconds, bytes per second) for the
+  progress updates, which callers feed into their progress bar instead of
+  their log, and
+- plain message lines for everything else ("records in/out", errors, the
+  final summary), which are worth logging.
+
+Usage (example):
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    follow_dd_output(process.stdout.fileno(), on_progress=print, on_message=log)
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import select
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+# "1234567 bytes (1.2 MB, 1.2 MiB) copied, 2.00123 s, 617 kB/s"; older dd
+# versions omit "copied" and some locales use a decimal comma.
+_PROGRESS_LINE = re.compile(rb"^(\d+) bytes\b.*?, (\d+(?:[.,]\d+)?) s\b")
+_RECORDS_OUT = re.compile(rb"^\d+\+\d+ records out$")
+_LINE_END = re.compile(rb"[\r\n]")
+
+_READ_SIZE = 64 * 1024
+
+
+@dataclass
+class DdProgress:
+    """One progress update of dd."""
+
+    bytes_copied: int
+    seconds: float
+    # True for dd's closing summary (after "records out").
+    final: bool = False
+
+    @property
+    def rate(self) -> float:
+        """Average bytes per second since dd started."""
+        return self.bytes_copied / self.seconds if self.seconds > 0 else 0.0
+
+
+class DdProgressParser:
+    """Incremental parser for the raw output of `dd status=progress`."""
+
+    def __init__(self):
+        self._pending = b""
+        self._records_out = False
+        self.last: Optional[DdProgress] = None
+
+    def feed(self, data: bytes) -> Tuple[List[DdProgress], List[str]]:
+        """
+        Parse a chunk of output; returns the progress records and the other
+        lines it completed. Incomplete trailing data is kept for the next call.
+        """
+        parts = _LINE_END.split(self._pending + data)
+        self._pending = parts.pop()
+        return self._parse(parts)
+
+    def flush(self) -> Tuple[List[DdProgress], List[str]]:
+        """Parse whatever is left once the output ended."""
+        parts, self._pending = [self._pending], b""
+        return self._parse(parts)
+
+    def _parse(self, parts: List[bytes]) -> Tuple[List[DdProgress], List[str]]:
+        records: List[DdProgress] = []
+        messages: List[str] = []
+        for part in parts:
+            part = part.strip()
+            if not part:
+                continue
+            match = _PROGRESS_LINE.match(part)
+            if match:
+                record = DdProgress(
+                    int(match.group(1)),
+                    float(match.group(2).replace(b",", b".")),
+                    final=self._records_out,
+                )
+                records.append(record)
+                self.last = record
+                if record.final:
+                    messages.append(part.decode("utf-8", "replace"))
+                continue
+            if _RECORDS_OUT.match(part):
+                self._records_out = True
+            messages.append(part.decode("utf-8", "replace"))
+        return records, messages
+
+
+def follow_dd_output(
+    fd: int,
+    on_progress: Callable[[DdProgress], None],
+    on_message: Callable[[str], None],
+    should_stop: Optional[Callable[[], bool]] = None,
+    poll_interval: float = 0.1,
+) -> bool:
+    """
+    Read dd's output from `fd` until end of file, reporting the latest
+    progress record of every read and each message line. Returns False when
+    `should_stop()` returned True before the output ended.
+    """
+    os.set_blocking(fd, False)
+    parser = DdProgressParser()
+    while True:
+        if should_stop is not None and should_stop():
+            return False
+        ready, _, _ = select.select([fd], [], [], poll_interval)
+        if not ready:
+            continue
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except BlockingIOError:
+            continue
+        if not data:
+            break
+        _dispatch(parser.feed(data), on_progress, on_message)
+    _dispatch(parser.flush(), on_progress, on_message)
+    return True
+
+
+def _dispatch(
+    parsed: Tuple[List[DdProgress], List[str]],
+    on_progress: Callable[[DdProgress], None],
+    on_message: Callable[[str], None],
+) -> None:
+    records, messages = parsed
+    for message in messages:
+        on_message(message)
+    # Only the newest update of a burst matters.
+    if records:
+        on_progress(records[-1])
+
+
+__all__ = ["DdProgress", "DdProgressParser", "follow_dd_output"]
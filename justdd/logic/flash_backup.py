@@ -0,0 +1,708 @@
+"""
+BackupEngine
+
+The reverse of `FlashEngine`: reads a device (or any file) and produces an
+image of it. A reader thread fills a ring of page-aligned buffers from the
+device while the writer drains them into the output, so reads and the
+compression/writes overlap.
+
+The device is read with `O_DIRECT` when it allows it, so a backup of a large
+stick does not push the rest of the page cache out; otherwise the pages
+behind the reader are dropped with `POSIX_FADV_DONTNEED`.
+
+Output formats (`compression`):
+- "zstd": a zstd stream compressed by the `zstandard` module with one
+  worker per CPU (`threads`), falling back to the `zstd` command line tool
+  (`-T<threads>`) when the module is not installed. The frame records the
+  image size, so restoring reports progress against it.
+- "none": a raw image in which every all-zero run of `hole_granularity`
+  bytes becomes a hole, so the unused space of a stick costs no disk space.
+- "auto" (default): "zstd" when the output name ends in `.zst`/`.zstd`,
+  otherwise "none".
+
+With `hash_algorithms` the digests of the image are computed as the buffers
+pass through (see `StreamHasher`); they match the digests of the restored
+image, not of the compressed file.
+
+With `skip_free=True` the partition table and filesystems of the source are
+parsed (see `fs_allocation`) and only the allocated ranges are read; free
+clusters and the slack after the last partition come out as zeros (holes in
+raw output) and the mapped ranges are recorded, with their checksums, in a
+block map next to the image (see `bmap`), so restoring skips them too. A
+source without a usable table or known filesystem is read whole.
+
+The image is written to `<image>.partial` and renamed over `image_path`
+only once it is complete, so a failed or cancelled backup leaves an earlier
+image of the same name as it was; block maps of that earlier image are
+removed when the new one replaces it.
+
+`opener(path, direct)` opens the source read-only and returns the file
+descriptor (default `blockdev.open_readonly`); `PrivilegedHelper.open_read`
+backs up devices the user cannot read.
+
+Usage (example):
+    with BackupEngine('/dev/sdb', '/backups/stick.img.zst', on_progress=print) as engine:
+        engine.run()
+"""
+
+from __future__ import annotations
+
+import errno
+import hashlib
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .blockdev import open_readonly
+from .bmap import BMAP_SUFFIX, Bmap, bmap_path_for, write_bmap
+from .flash_engine import (
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_FLUSH_WINDOW,
+    DEFAULT_RING_DEPTH,
+    DIRECT_IO_ALIGN,
+    FlashCancelled,
+    FlashError,
+    WritebackFlusher,
+    alloc_aligned_buffer,
+)
+from .fs_allocation import AllocationMap, FilesystemError, read_allocation
+from .image_hash import StreamHasher
+from .partition_table import PartitionTableError
+
+MiB = 1024 * 1024
+
+COMPRESSION_AUTO = "auto"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_NONE = "none"
+COMPRESSIONS = (COMPRESSION_AUTO, COMPRESSION_ZSTD, COMPRESSION_NONE)
+_ZSTD_SUFFIXES = (".zst", ".zstd")
+
+DEFAULT_ZSTD_LEVEL = 3
+# Suffix of the image while it is being written.
+_PARTIAL_SUFFIX = ".partial"
+# Granularity at which zero runs of raw output become holes.
+DEFAULT_HOLE_GRANULARITY = 64 * 1024
+# Source pages dropped behind the reader at once (buffered reads only).
+_DROP_STEP = 8 * MiB
+
+# Marker put on the filled queue by the reader once the source is exhausted.
+_EOF = None
+# Buffer index of filled-queue items standing for an unallocated range.
+_GAP = -1
+# Interval (seconds) at which blocked pipeline stages re-check for cancellation.
+_POLL_INTERVAL = 0.1
+
+
+def _threads(count: int) -> str:
+    return f"{count} thread{'s' if count > 1 else ''}"
+
+
+class _SparseWriter:
+    """Raw image output; all-zero runs are left as holes."""
+
+    def __init__(self, path: str, granularity: int):
+        self.method = "raw, zero runs as holes"
+        self.granularity = granularity
+        self._zero_unit = bytes(granularity)
+        self.fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644
+        )
+        self.flusher = WritebackFlusher(self.fd, DEFAULT_FLUSH_WINDOW)
+        self.bytes_written = 0
+        self.bytes_sparse = 0
+
+    def write(self, data: memoryview, offset: int) -> None:
+        gran = self.granularity
+        run_start = 0
+        run_zero: Optional[bool] = None
+        for start in range(0, len(data), gran):
+            unit = data[start : start + gran]
+            is_zero = bytes(unit) == (
+                self._zero_unit if len(unit) == gran else bytes(len(unit))
+            )
+            if run_zero is None:
+                run_zero = is_zero
+            elif is_zero != run_zero:
+                self._write_run(data[run_start:start], offset + run_start, run_zero)
+                run_start = start
+                run_zero = is_zero
+        if run_zero is not None:
+            self._write_run(data[run_start:], offset + run_start, run_zero)
+        self.flusher.wrote(offset, len(data))
+
+    def write_zeros(self, zeros: memoryview, offset: int) -> None:
+        # Unallocated ranges stay holes.
+        pass
+
+    def _write_run(self, data: memoryview, offset: int, is_zero: bool) -> None:
+        if is_zero:
+            self.bytes_sparse += len(data)
+            return
+        done = 0
+        while done < len(data):
+            n = os.pwrite(self.fd, data[done:], offset + done)
+            if n <= 0:
+                raise FlashError("Short write on the image")
+            done += n
+        self.bytes_written += len(data)
+
+    def finish(self, size: int) -> None:
+        # Trailing holes still count towards the image size.
+        os.ftruncate(self.fd, size)
+        self.flusher.finish()
+
+    def close(self) -> None:
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class _ZstdWriter:
+    """zstd output, compressed by `zstandard` or the `zstd` CLI on all cores."""
+
+    def __init__(self, path: str, level: int, threads: int, size: int):
+        self._file: BinaryIO = open(path, "wb")
+        self._process: Optional[subprocess.Popen] = None
+        self._zstd = None
+        try:
+            import zstandard  # type: ignore
+
+            self._zstd = zstandard
+            compressor = zstandard.ZstdCompressor(
+                level=level, threads=threads, write_content_size=True
+            )
+            self._stream = compressor.stream_writer(self._file, size=size)
+            self.method = f"zstd level {level}, {_threads(threads)} (zstandard)"
+        except ImportError:
+            exe = shutil.which("zstd")
+            if exe is None:
+                self._file.close()
+                raise FlashError(
+                    "zstd output needs the 'zstandard' Python module "
+                    "or the 'zstd' command line tool"
+                )
+            self._process = subprocess.Popen(
+                [exe, f"-{level}", f"-T{threads}", "-q", "-c", f"--stream-size={size}"],
+                stdin=subprocess.PIPE,
+                stdout=self._file,
+            )
+            assert self._process.stdin is not None
+            self._stream = self._process.stdin
+            self.method = f"zstd level {level}, {_threads(threads)} (zstd CLI)"
+        self.bytes_sparse = 0
+        self._final_size = 0
+
+    @property
+    def bytes_written(self) -> int:
+        """Compressed bytes written so far."""
+        if self._file.closed:
+            return self._final_size
+        try:
+            return os.fstat(self._file.fileno()).st_size
+        except (OSError, ValueError):
+            return 0
+
+    def write(self, data: memoryview, offset: int) -> None:
+        self._stream.write(data)
+
+    def write_zeros(self, zeros: memoryview, offset: int) -> None:
+        self._stream.write(zeros)
+
+    def finish(self, size: int) -> None:
+        if self._process is not None:
+            self._stream.close()
+            code = self._process.wait()
+            if code != 0:
+                raise FlashError(f"zstd exited with code {code}")
+        else:
+            assert self._zstd is not None
+            self._stream.flush(self._zstd.FLUSH_FRAME)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._final_size = self.bytes_written
+        if self._process is not None and self._process.poll() is None:
+            try:
+                self._process.kill()
+                self._process.wait(timeout=3)
+            except Exception:
+                pass
+        try:
+            self._file.close()
+        except Exception:
+            pass
+
+
+class BackupEngine:
+    """
+    Reads a source device into an image file.
+
+    Callbacks:
+        on_progress(bytes_done, total_bytes) : called after every buffer
+        on_log(text) : informational messages
+        should_stop() -> bool : polled between buffers; True cancels the backup
+
+    `compression` is one of `COMPRESSIONS`; `threads` is the number of
+    compression workers (0 = one per CPU).
+
+    With `skip_free` only the allocated ranges of the source are read; after
+    `open()`, `allocation` holds the parsed map and `bmap_path` the block map
+    written by `run()` (None when the whole source is read).
+
+    Counters: `bytes_done` (image bytes processed), `bytes_written` (bytes
+    in the output file: compressed size, or data written around the holes),
+    `bytes_sparse` (zero bytes left as holes) and `bytes_unmapped` (free
+    bytes not read). After `run()`, `digests` maps each of `hash_algorithms`
+    to the hex digest of the image.
+    """
+
+    def __init__(
+        self,
+        source_path: str,
+        image_path: str,
+        compression: str = COMPRESSION_AUTO,
+        level: int = DEFAULT_ZSTD_LEVEL,
+        threads: int = 0,
+        hash_algorithms: Iterable[str] = (),
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+        ring_depth: int = DEFAULT_RING_DEPTH,
+        hole_granularity: int = DEFAULT_HOLE_GRANULARITY,
+        skip_free: bool = False,
+        opener: Callable[[str, bool], int] = open_readonly,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_log: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {', '.join(COMPRESSIONS)}")
+        if buffer_size <= 0 or buffer_size % DIRECT_IO_ALIGN:
+            raise ValueError(f"buffer_size must be a multiple of {DIRECT_IO_ALIGN}")
+        if ring_depth < 2:
+            raise ValueError("ring_depth must be at least 2")
+        if hole_granularity <= 0 or buffer_size % hole_granularity:
+            raise ValueError("hole_granularity must divide buffer_size")
+        if threads < 0:
+            raise ValueError("threads must not be negative")
+        hash_algorithms = [name.lower().replace("-", "") for name in hash_algorithms]
+        for name in hash_algorithms:
+            hashlib.new(name)  # raises ValueError for unknown algorithms
+
+        self.source_path = source_path
+        self.image_path = image_path
+        if compression == COMPRESSION_AUTO:
+            compression = (
+                COMPRESSION_ZSTD
+                if image_path.lower().endswith(_ZSTD_SUFFIXES)
+                else COMPRESSION_NONE
+            )
+        self.compression = compression
+        self.level = int(level)
+        self.threads = int(threads) or os.cpu_count() or 1
+        self.hash_algorithms = list(dict.fromkeys(hash_algorithms))
+        self.digests: Dict[str, str] = {}
+        self.buffer_size = int(buffer_size)
+        self.ring_depth = int(ring_depth)
+        self.hole_granularity = int(hole_granularity)
+        self.skip_free = bool(skip_free)
+        self.allocation: Optional[AllocationMap] = None
+        self.bmap_path: Optional[str] = None
+        # Ranges of the source that are read, in order.
+        self._ranges: List[Tuple[int, int]] = []
+        self._range_hashes: List = []
+        self._opener = opener
+
+        self._on_progress = on_progress
+        self._on_log = on_log
+        self._should_stop = should_stop
+
+        self._source_fd: Optional[int] = None
+        self.direct = False
+        self._writer = None
+        # Where the image is written until `run()` puts it in place.
+        self._partial_path: Optional[str] = None
+        self._buffers: List = []
+        self._abort = threading.Event()
+        self._reader_error: Optional[BaseException] = None
+        self._dropped = 0
+        self._zeros: Optional[memoryview] = None
+
+        self.source_size = 0
+        self.bytes_done = 0
+        self.bytes_unmapped = 0
+        self.seconds = 0.0
+
+    @property
+    def bytes_written(self) -> int:
+        return self._writer.bytes_written if self._writer is not None else 0
+
+    @property
+    def bytes_sparse(self) -> int:
+        return self._writer.bytes_sparse if self._writer is not None else 0
+
+    @property
+    def throughput(self) -> float:
+        """Backup speed in image bytes per second."""
+        return self.bytes_done / self.seconds if self.seconds > 0 else 0.0
+
+    # ---- Context management ----
+    def __enter__(self) -> "BackupEngine":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Open the source and create the image file."""
+        if self._source_fd is not None:
+            return
+        self._open_source()
+        self._ranges = [(0, self.source_size)]
+        if self.skip_free:
+            self._plan_ranges()
+        self._partial_path = self.image_path + _PARTIAL_SUFFIX
+        try:
+            if self.compression == COMPRESSION_ZSTD:
+                self._writer = _ZstdWriter(
+                    self._partial_path, self.level, self.threads, self.source_size
+                )
+            else:
+                self._writer = _SparseWriter(self._partial_path, self.hole_granularity)
+        except OSError as e:
+            self.close()
+            raise FlashError(f"Cannot create image {self.image_path}: {e}") from e
+        except FlashError:
+            self.close()
+            raise
+        self._buffers = [
+            alloc_aligned_buffer(self.buffer_size) for _ in range(self.ring_depth)
+        ]
+        self._log(
+            f"Backup: {self.source_size} bytes from {self.source_path} "
+            f"({'O_DIRECT reads' if self.direct else 'buffered reads'}) "
+            f"to {self.image_path} ({self._writer.method})"
+        )
+
+    def _open_source(self) -> None:
+        try:
+            try:
+                self._source_fd = self._opener(self.source_path, True)
+                self.direct = True
+            except OSError:
+                self._source_fd = self._opener(self.source_path, False)
+            self.source_size = os.lseek(self._source_fd, 0, os.SEEK_END)
+        except OSError as e:
+            self.close()
+            raise FlashError(f"Cannot open source {self.source_path}: {e}") from e
+        if not self.direct:
+            try:
+                os.posix_fadvise(self._source_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                pass
+
+    def _plan_ranges(self) -> None:
+        """Find the allocated ranges of the source that `skip_free` reads."""
+        try:
+            # The structures are small unaligned reads: no O_DIRECT here.
+            with os.fdopen(self._opener(self.source_path, False), "rb") as f:
+                self.allocation = read_allocation(self.source_path, f)
+        except OSError as e:
+            self._log(f"Cannot read the allocation map ({e}); reading the whole source")
+            return
+        except (PartitionTableError, FilesystemError) as e:
+            self._log(f"Allocation map not usable ({e}); reading the whole source")
+            return
+        if self.allocation is None:
+            self._log("No partition table or known filesystem; reading all of it")
+            return
+        self._ranges = self.allocation.ranges
+        self.bmap_path = bmap_path_for(self.image_path)
+        self._log(
+            f"Allocation: {self.allocation.describe()}; reading "
+            f"{len(self._ranges)} range{'' if len(self._ranges) == 1 else 's'}, "
+            f"block map in {self.bmap_path}"
+        )
+
+    def close(self) -> None:
+        if self._source_fd is not None:
+            try:
+                os.close(self._source_fd)
+            except Exception:
+                pass
+            self._source_fd = None
+        if self._writer is not None:
+            self._writer.close()
+        if self._partial_path is not None:
+            # Not put in place by `run()`: the image is incomplete.
+            try:
+                os.unlink(self._partial_path)
+            except OSError:
+                pass
+            self._partial_path = None
+        for buf in self._buffers:
+            try:
+                buf.close()
+            except Exception:
+                pass
+        self._buffers = []
+
+    # ---- Backup ----
+    def run(self) -> int:
+        """Read the whole source into the image. Returns the number of bytes read."""
+        if self._source_fd is None:
+            self.open()
+        assert self._writer is not None
+        views = [memoryview(buf)[: self.buffer_size] for buf in self._buffers]
+        free: "queue.Queue[int]" = queue.Queue()
+        filled: "queue.Queue[Optional[Tuple[int, int, int]]]" = queue.Queue()
+        for idx in range(len(views)):
+            free.put(idx)
+
+        self._abort.clear()
+        self._reader_error = None
+        # Checksums of the mapped ranges, for the block map.
+        self._range_hashes = (
+            [hashlib.sha256() for _ in self._ranges] if self.bmap_path else []
+        )
+        hasher = StreamHasher(self.hash_algorithms) if self.hash_algorithms else None
+        reader = threading.Thread(
+            target=self._reader_loop,
+            args=(views, free, filled),
+            name="justdd-backup-reader",
+            daemon=True,
+        )
+        started = time.monotonic()
+        reader.start()
+        try:
+            self._writer_loop(views, free, filled, hasher)
+            if hasher is not None:
+                self.digests = hasher.finish()
+                hasher = None
+            self._writer.finish(self.bytes_done)
+            self._commit_image()
+            if self.bmap_path is not None:
+                self._write_bmap()
+        finally:
+            self.seconds = time.monotonic() - started
+            self._abort.set()
+            if hasher is not None:
+                hasher.abort()
+            reader.join()
+            for view in views:
+                view.release()
+
+        self._log(
+            f"Read {self.bytes_done} bytes in {self.seconds:.1f} s "
+            f"({self.throughput / MiB:.1f} MB/s), image is {self.bytes_written} bytes"
+            + (
+                f", {self.bytes_sparse} zero bytes left as holes"
+                if self.bytes_sparse
+                else ""
+            )
+            + (
+                f", {self.bytes_unmapped} unallocated bytes not read"
+                if self.bytes_unmapped
+                else ""
+            )
+        )
+        for name, digest in self.digests.items():
+            self._log(f"{name.upper()}: {digest}")
+        return self.bytes_done
+
+    def _commit_image(self) -> None:
+        """Rename the finished image over `image_path`."""
+        assert self._partial_path is not None
+        try:
+            # A block map of an earlier image would not describe this one.
+            for path in {bmap_path_for(self.image_path), self.image_path + BMAP_SUFFIX}:
+                if os.path.isfile(path):
+                    os.unlink(path)
+            os.replace(self._partial_path, self.image_path)
+        except OSError as e:
+            raise FlashError(f"Cannot create image {self.image_path}: {e}") from e
+        self._partial_path = None
+
+    def _write_bmap(self) -> None:
+        assert self.bmap_path is not None
+        bmap = Bmap(
+            self.source_size,
+            ranges=list(self._ranges),
+            checksums=[h.hexdigest() for h in self._range_hashes],
+        )
+        try:
+            write_bmap(self.bmap_path, bmap)
+        except OSError as e:
+            raise FlashError(f"Cannot write block map {self.bmap_path}: {e}") from e
+
+    # ---- Pipeline stages ----
+    def _reader_loop(
+        self,
+        views: List[memoryview],
+        free: "queue.Queue[int]",
+        filled: "queue.Queue[Optional[Tuple[int, int, int]]]",
+    ) -> None:
+        offset = 0
+        try:
+            for number, (start, end) in enumerate(self._ranges):
+                if start > offset:
+                    # The writer stands zeros in for the unallocated range.
+                    filled.put((_GAP, offset, start - offset))
+                    offset = start
+                while offset < end and not self._abort.is_set():
+                    try:
+                        idx = free.get(timeout=_POLL_INTERVAL)
+                    except queue.Empty:
+                        continue
+                    want = min(len(views[idx]), end - offset)
+                    n = self._read(views[idx], offset, want)
+                    if not n:
+                        raise FlashError(f"Source ended at byte {offset}")
+                    if self._range_hashes:
+                        self._range_hashes[number].update(views[idx][:n])
+                    filled.put((idx, offset, n))
+                    offset += n
+                if self._abort.is_set():
+                    return
+            if offset < self.source_size:
+                filled.put((_GAP, offset, self.source_size - offset))
+        except BaseException as e:
+            self._reader_error = e
+        finally:
+            filled.put(_EOF)
+
+    def _read(self, view: memoryview, offset: int, want: int) -> int:
+        """Read `want` bytes at `offset` (whole aligned blocks with O_DIRECT)."""
+        assert self._source_fd is not None
+        size = want
+        if self.direct:
+            size = min(len(view), -(-want // DIRECT_IO_ALIGN) * DIRECT_IO_ALIGN)
+        got = 0
+        while got < want:
+            try:
+                n = os.preadv(self._source_fd, [view[got:size]], offset + got)
+            except OSError as e:
+                if not self.direct or e.errno != errno.EINVAL:
+                    raise
+                self._reopen_buffered()
+                size = want
+                continue
+            if n <= 0:
+                break
+            got += n
+        return min(got, want)
+
+    def _reopen_buffered(self) -> None:
+        assert self._source_fd is not None
+        fd = os.open(self.source_path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+        os.close(self._source_fd)
+        self._source_fd = fd
+        self.direct = False
+
+    def _writer_loop(
+        self,
+        views: List[memoryview],
+        free: "queue.Queue[int]",
+        filled: "queue.Queue[Optional[Tuple[int, int, int]]]",
+        hasher: Optional[StreamHasher],
+    ) -> None:
+        assert self._writer is not None
+        while True:
+            if self._stop_requested():
+                raise FlashCancelled("Backup cancelled")
+            try:
+                item = filled.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _EOF:
+                break
+            idx, offset, length = item
+            if idx == _GAP:
+                self._pass_unmapped(offset, length, hasher)
+                continue
+            self._writer.write(views[idx][:length], offset)
+            if hasher is not None:
+                # The buffer goes back to the ring once it has been hashed.
+                hasher.submit(views[idx][:length], lambda idx=idx: free.put(idx))
+            else:
+                free.put(idx)
+            self.bytes_done = offset + length
+            self._drop_behind()
+            self._report()
+
+        if self._reader_error is not None:
+            raise FlashError(f"Error reading source: {self._reader_error}")
+
+    def _pass_unmapped(
+        self, offset: int, length: int, hasher: Optional[StreamHasher]
+    ) -> None:
+        """Stand zeros in for `length` unallocated bytes at `offset`."""
+        assert self._writer is not None
+        if self._zeros is None:
+            self._zeros = memoryview(bytes(self.buffer_size))
+        end = offset + length
+        while offset < end:
+            if self._stop_requested():
+                raise FlashCancelled("Backup cancelled")
+            n = min(len(self._zeros), end - offset)
+            self._writer.write_zeros(self._zeros[:n], offset)
+            if hasher is not None:
+                hasher.submit(self._zeros[:n])
+            offset += n
+            self.bytes_unmapped += n
+            self.bytes_done = offset
+            self._report()
+
+    def _drop_behind(self) -> None:
+        """Keep buffered reads of the source out of the page cache."""
+        if self.direct or self.bytes_done - self._dropped < _DROP_STEP:
+            return
+        try:
+            os.posix_fadvise(
+                self._source_fd,
+                self._dropped,
+                self.bytes_done - self._dropped,
+                os.POSIX_FADV_DONTNEED,
+            )
+        except (AttributeError, OSError):
+            pass
+        self._dropped = self.bytes_done
+
+    # ---- Helpers ----
+    def _stop_requested(self) -> bool:
+        if self._should_stop is None:
+            return False
+        try:
+            return bool(self._should_stop())
+        except Exception:
+            return False
+
+    def _report(self) -> None:
+        if self._on_progress:
+            try:
+                self._on_progress(self.bytes_done, self.source_size)
+            except Exception:
+                pass
+
+    def _log(self, text: str) -> None:
+        if self._on_log:
+            try:
+                self._on_log(text)
+            except Exception:
+                pass
+
+
+__all__ = [
+    "BackupEngine",
+    "COMPRESSIONS",
+    "COMPRESSION_AUTO",
+    "COMPRESSION_ZSTD",
+    "COMPRESSION_NONE",
+    "DEFAULT_ZSTD_LEVEL",
+    "DEFAULT_HOLE_GRANULARITY",
+]
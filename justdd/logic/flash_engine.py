@@ -0,0 +1,1841 @@
+"""
+FlashEngine
+
+In-process block writer used by the Linux flash path instead of shelling out to
+`pkexec dd ... oflag=sync` and scraping its text output.
+
+The engine opens the source image and the target once and copies the data
+through a two-stage pipeline: a reader thread fills a ring of preallocated,
+page-aligned buffers with `readinto` while the writer drains them with
+`pwrite`, so source reads and device writes overlap. Buffers are handed around
+as `memoryview` slices and are never copied. Exact byte counts are reported
+through optional callbacks. The target may be a block device, a loop device or
+a regular file, which makes it possible to benchmark the engine without real
+USB hardware.
+
+The size of each `pwrite` (the block size) is either fixed or, with
+`block_size="auto"`, tuned at the start of the copy: the first few hundred MB
+are written at candidate sizes between 1 MiB and 64 MiB, each trial is timed
+including a `fdatasync` of the target, and the fastest size is kept for the
+rest of the copy. The target's `optimal_io_size` and `max_sectors_kb` queue
+hints narrow down the candidates. The first trial is timed from the first
+buffer written, not from the start of the read. The ring buffers only hold
+the largest candidate while tuning: afterwards they are filled up to
+`buffer_size` (or the chosen block size) and the rest of their pages is
+given back to the kernel.
+
+Instead of `oflag=sync` and a host-wide `sync`, writeback is flushed in
+windows: after every `flush_window` bytes the engine starts writeback of the
+window with `sync_file_range` and waits for the previous one, so at most about
+two windows of dirty data for the target sit in RAM. Without
+`sync_file_range` it falls back to `fdatasync` per window. The final flush is
+an `fsync` of the target only.
+
+With a `zero_mode` other than "off", all-zero runs of the source (common in
+sparse `.img` files) are not written: "zeroout" zeroes them on the device with
+BLKZEROOUT (or punches a hole in a regular file), "discard" issues BLKDISCARD,
+and "unclean" leaves whatever the target held. When the device does not
+support the ioctl the zeros are written normally. Skipped bytes still count
+towards progress.
+
+With `start_offset` the copy resumes an interrupted flash: the first
+`start_offset` bytes of the source are skipped (decoded and discarded for
+compressed images) and writing starts there. An optional `FlashJournal`
+records the durable offset after every flush window so that a later run
+can resume (see `flash_journal`).
+
+In delta mode (`delta=True`) the engine reads the target back in buffer-sized
+chunks before writing, compares it with the source and only rewrites the
+parts that differ. On USB flash reads are much faster than writes, so
+re-flashing a stick with a slightly newer build mostly costs a read pass.
+
+With `hash_algorithms` (e.g. `("sha256", "md5")`) the engine also computes
+the digests of the image as the buffers pass through: after a buffer is
+written it goes to one hashing thread per algorithm (see `StreamHasher`) and
+only returns to the ring once every digest has consumed it, so hashing runs
+alongside the writes instead of in a separate pass.
+
+With `io_backend="zerocopy"` raw images never enter Python: every block is
+moved from the image to the target inside the kernel with `copy_file_range`,
+or with `splice` through a pipe where that is not supported (e.g. block
+device targets), and with plain `pread`/`pwrite` as a last resort. Progress,
+writeback windows and cancellation are handled between blocks.
+
+With `io_backend="uring"` the copy goes through io_uring instead (see `uring`): the ring buffers are registered
+with the kernel and several reads of the source and writes to the target at
+different offsets are kept in flight, which lets UAS/NVMe enclosures see a
+queue depth above one. Each buffer holds exactly one block. Completed writes
+are accounted (progress, writeback windows, journal, hashing) in offset
+order. The io_uring backend does not combine with autotuning, zero skipping
+or delta mode; those copies, and kernels without io_uring, use the threaded
+`pwrite` backend. "auto" picks the zero-copy backend for raw images without
+hashing, then io_uring, then `pwrite`. The backend in use is logged.
+
+With `direct_io=True` the target is also opened with `O_DIRECT` and every
+write that is aligned to `DIRECT_IO_ALIGN` (or the device's logical block
+size, if larger) bypasses the page cache; the ring buffers come from
+anonymous `mmap` and are page-aligned. Only an unaligned tail (e.g. the end
+of an image whose size is not a multiple of 4 KiB) is written through the
+normal descriptor. Progress then tracks what has reached the device, no
+dirty backlog builds up on the host and the final flush is short. Targets
+that refuse `O_DIRECT` (e.g. tmpfs) fall back to buffered writes; the
+zero-copy backend is not used with direct I/O.
+
+The engine keeps its page-cache footprint bounded (`drop_cache=True`, see
+`PageCacheAdvisor`): the source is opened with `POSIX_FADV_SEQUENTIAL`,
+`WILLNEED` hints keep `readahead` bytes ahead of the writer, and source pages
+behind the writer as well as target pages behind the last flushed window
+are dropped with `DONTNEED`. Flashing a large ISO therefore no longer evicts
+the rest of the page cache; the estimated peak is kept in `cache_peak`.
+
+With `trim=True` the partition table of a raw image is parsed (see
+`partition_table`) and only the table, the partitions and the backup GPT at
+the end of the image are written; the slack after the last partition is
+neither read nor written (it is still read when hashing, so the digests
+cover the whole image) and counts towards progress as `bytes_trimmed`.
+Images without a usable table are written whole. When the image has a block
+map next to it (see `bmap`, e.g. from `BackupEngine(skip_free=True)`), it
+takes the place of the table: only the mapped ranges are written, for
+compressed images too. The io_uring backend does not trim.
+
+With `bandwidth_limit` (bytes per second) the writes are paced by a token
+bucket (see `throttle.BandwidthLimiter`) that is charged after every write,
+so a flash can be held to its share of a shared hub or disk.
+
+Compressed images (`.gz`, `.xz`, `.bz2`, `.zst`, `.zip`) are decompressed by the
+reader thread while the writer drains already decoded buffers (see
+`image_source`). Progress is reported against the uncompressed size when the
+container records it and against the compressed bytes consumed otherwise.
+
+Usage (example):
+    with FlashEngine('/path/to.iso', '/dev/sdb', on_progress=print) as engine:
+        engine.copy()
+        engine.sync()
+
+Note: writing to a block device requires write permission on the device node.
+Callers (see `FlashJob`) fall back to the external `dd` path when the current
+user cannot open the target for writing.
+"""
+
+from __future__ import annotations
+
+import bisect
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import queue
+import stat
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .blockdev import (
+    SYNC_FILE_RANGE_WAIT_AFTER,
+    SYNC_FILE_RANGE_WAIT_BEFORE,
+    SYNC_FILE_RANGE_WRITE,
+    discard_range,
+    has_sync_file_range,
+    punch_hole,
+    read_queue_hints,
+    sync_file_range,
+    zero_out_range,
+)
+from .bmap import Bmap, BmapError, find_bmap, read_bmap
+from .flash_journal import FlashJournal
+from .image_hash import StreamHasher
+from .image_source import ImageSource, ImageSourceError, open_image_source
+from .partition_table import (
+    PartitionLayout,
+    PartitionTableError,
+    read_partition_layout,
+)
+from .throttle import BandwidthLimiter, describe_rate
+from .uring import (
+    IORING_OP_READ,
+    IORING_OP_READ_FIXED,
+    IORING_OP_WRITE,
+    IORING_OP_WRITE_FIXED,
+    IoUring,
+    IoUringError,
+    buffer_address,
+    uring_available,
+)
+
+MiB = 1024 * 1024
+
+DEFAULT_BUFFER_SIZE = 4 * MiB
+DEFAULT_RING_DEPTH = 4
+DEFAULT_BLOCK_SIZE = 4 * MiB
+AUTO_BLOCK_SIZE = "auto"
+DEFAULT_FLUSH_WINDOW = 32 * MiB
+# Alignment of offsets and lengths written with O_DIRECT.
+DIRECT_IO_ALIGN = 4096
+# Source bytes hinted with WILLNEED ahead of the writer.
+DEFAULT_READAHEAD = 32 * MiB
+# Smallest range dropped from the page cache at once.
+_DROP_STEP = 8 * MiB
+
+ZERO_MODE_OFF = "off"
+ZERO_MODE_ZEROOUT = "zeroout"
+ZERO_MODE_DISCARD = "discard"
+ZERO_MODE_UNCLEAN = "unclean"
+ZERO_MODES = (ZERO_MODE_OFF, ZERO_MODE_ZEROOUT, ZERO_MODE_DISCARD, ZERO_MODE_UNCLEAN)
+# Granularity at which the source is scanned for all-zero runs.
+DEFAULT_ZERO_GRANULARITY = 256 * 1024
+# Device zeroing/discard needs sector-aligned ranges; stay page-aligned.
+_ZERO_ALIGN = 4096
+# Granularity at which delta mode compares source and target.
+DEFAULT_DELTA_GRANULARITY = 1 * MiB
+
+IO_BACKEND_AUTO = "auto"
+IO_BACKEND_URING = "uring"
+IO_BACKEND_ZEROCOPY = "zerocopy"
+IO_BACKEND_PWRITE = "pwrite"
+IO_BACKENDS = (
+    IO_BACKEND_AUTO,
+    IO_BACKEND_ZEROCOPY,
+    IO_BACKEND_URING,
+    IO_BACKEND_PWRITE,
+)
+# Minimum number of buffers (and so of requests in flight) with io_uring.
+DEFAULT_URING_DEPTH = 8
+# Errors meaning a kernel copy method does not work for this source/target pair.
+_COPY_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+# Size requested for the splice pipe (the default of 64 KiB costs many syscalls).
+_SPLICE_PIPE_SIZE = 1 * MiB
+
+# Block sizes tried by the autotuner, smallest first.
+TUNE_CANDIDATES = tuple(MiB << i for i in range(7))
+# Minimum number of bytes written per autotune trial.
+_TUNE_MIN_SAMPLE = 16 * MiB
+
+# Marker put on the filled queue by the reader once the source is exhausted.
+_EOF = None
+
+# Interval (seconds) at which blocked pipeline stages re-check for cancellation.
+_POLL_INTERVAL = 0.1
+
+
+class FlashError(Exception):
+    """Raised when the engine cannot complete a copy."""
+
+
+class FlashCancelled(FlashError):
+    """Raised when a copy is stopped through the `should_stop` hook."""
+
+
+def alloc_aligned_buffer(size: int) -> mmap.mmap:
+    """Return a zero-filled, page-aligned anonymous buffer of `size` bytes."""
+    page = mmap.PAGESIZE
+    size = max(page, (int(size) + page - 1) // page * page)
+    return mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+
+
+def release_buffer_tail(buf: mmap.mmap, keep: int) -> None:
+    """Give the pages of `buf` past its first `keep` bytes back to the kernel."""
+    start = -(-keep // mmap.PAGESIZE) * mmap.PAGESIZE
+    if start < len(buf) and hasattr(mmap, "MADV_DONTNEED"):
+        # Private anonymous pages read as zeros again when next touched.
+        buf.madvise(mmap.MADV_DONTNEED, start)
+
+
+def can_open_for_writing(path: str) -> bool:
+    """Best-effort check whether the current user may open `path` for writing."""
+    if os.path.exists(path):
+        return os.access(path, os.W_OK)
+    parent = os.path.dirname(os.path.abspath(path)) or "."
+    return os.access(parent, os.W_OK)
+
+
+def suggest_block_size(hints: Dict[str, int]) -> int:
+    """
+    Pick a fixed block size from the device queue hints, without measuring.
+    Used where no tuning is possible (e.g. the external dd path).
+    """
+    size = DEFAULT_BLOCK_SIZE
+    optimal = hints.get("optimal_io_size", 0)
+    if optimal > 0:
+        size = max(optimal, (size + optimal - 1) // optimal * optimal)
+    return min(size, TUNE_CANDIDATES[-1])
+
+
+def dd_block_size_operand(block_size: Union[int, str], target_path: str) -> str:
+    """Return the `bs=` operand for the external dd path."""
+    if block_size == AUTO_BLOCK_SIZE:
+        size = suggest_block_size(read_queue_hints(target_path))
+    else:
+        size = int(block_size)
+    return f"bs={size // MiB}M" if size % MiB == 0 else f"bs={size}"
+
+
+class BlockSizeTuner:
+    """
+    Measures write throughput for a list of candidate block sizes and settles
+    on the fastest one.
+
+    The writer calls `add()` after every chunk written at `current`; when it
+    returns True the trial is complete, the writer flushes the target and
+    calls `finish_trial()`. Once every candidate was measured (or the source
+    ran out, see `finish_early()`), `chosen` holds the selected size.
+    """
+
+    def __init__(
+        self,
+        candidates: Iterable[int] = TUNE_CANDIDATES,
+        hints: Optional[Dict[str, int]] = None,
+    ):
+        self.candidates = self._apply_hints(list(candidates), hints or {})
+        self.results: Dict[int, float] = {}
+        self.chosen: Optional[int] = None
+        self._index = 0
+        self._trial_bytes = 0
+        self._trial_start = 0.0
+
+    @staticmethod
+    def _apply_hints(candidates: List[int], hints: Dict[str, int]) -> List[int]:
+        optimal = hints.get("optimal_io_size", 0)
+        if optimal > 0:
+            candidates = [(c + optimal - 1) // optimal * optimal for c in candidates]
+
+        # Writes smaller than the largest request the queue accepts only add
+        # syscall overhead; keep at least the largest candidate.
+        max_request = hints.get("max_sectors_kb", 0)
+        if 0 < max_request <= candidates[-1]:
+            candidates = [c for c in candidates if c >= max_request] or candidates[-1:]
+
+        return sorted(set(candidates))
+
+    @property
+    def done(self) -> bool:
+        return self.chosen is not None
+
+    @property
+    def current(self) -> int:
+        if self.chosen is not None:
+            return self.chosen
+        return self.candidates[self._index]
+
+    @property
+    def largest(self) -> int:
+        return self.candidates[-1]
+
+    def start_trial(self, now: Optional[float] = None) -> None:
+        self._trial_bytes = 0
+        self._trial_start = time.monotonic() if now is None else now
+
+    def add(self, nbytes: int) -> bool:
+        """Account `nbytes` written at the current size; True when the trial is full."""
+        self._trial_bytes += nbytes
+        return self._trial_bytes >= max(2 * self.current, _TUNE_MIN_SAMPLE)
+
+    def finish_trial(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        elapsed = max(now - self._trial_start, 1e-6)
+        self.results[self.current] = self._trial_bytes / elapsed
+        self._index += 1
+        if self._index >= len(self.candidates):
+            self._choose()
+        else:
+            self.start_trial(now)
+
+    def finish_early(self) -> None:
+        """Settle on the best size measured so far (source smaller than the tuning budget)."""
+        if self.chosen is None:
+            self._choose()
+
+    def _choose(self) -> None:
+        if self.results:
+            self.chosen = max(self.results, key=lambda size: self.results[size])
+        else:
+            self.chosen = self.candidates[min(self._index, len(self.candidates) - 1)]
+
+
+class WritebackFlusher:
+    """
+    Keeps the target's dirty data bounded by flushing it in windows.
+
+    `wrote()` is called with every range written. Whenever the unflushed
+    range reaches `window` bytes, its writeback is started and the previous
+    window is waited for. `durable_offset` is the end of the last range known
+    to be on stable storage. A `window` of 0 disables windowed flushing.
+    """
+
+    def __init__(self, fd: int, window: int = DEFAULT_FLUSH_WINDOW, start: int = 0):
+        self.fd = fd
+        self.window = max(0, int(window))
+        self.method = "sync_file_range" if has_sync_file_range() else "fdatasync"
+        # `start`: offset up to which the target is already durable (resume).
+        self.durable_offset = start
+        self.flushes = 0
+        self._start = start
+        self._end = start
+        self._pending: Optional[Tuple[int, int]] = None
+
+    @property
+    def unflushed(self) -> int:
+        """Bytes written but not yet known to be on stable storage."""
+        return max(0, self._end - self.durable_offset)
+
+    def wrote(self, offset: int, length: int) -> None:
+        self._end = max(self._end, offset + length)
+        if not self.window:
+            return
+        if self._end - self._start >= self.window:
+            self._flush_window()
+
+    def _flush_window(self) -> None:
+        start, end = self._start, self._end
+        self._start = end
+        if self.method == "sync_file_range":
+            try:
+                sync_file_range(self.fd, start, end - start, SYNC_FILE_RANGE_WRITE)
+                if self._pending is not None:
+                    p_start, p_end = self._pending
+                    sync_file_range(
+                        self.fd,
+                        p_start,
+                        p_end - p_start,
+                        SYNC_FILE_RANGE_WAIT_BEFORE
+                        | SYNC_FILE_RANGE_WRITE
+                        | SYNC_FILE_RANGE_WAIT_AFTER,
+                    )
+                    self.durable_offset = p_end
+                self._pending = (start, end)
+                self.flushes += 1
+                return
+            except OSError:
+                self.method = "fdatasync"
+        os.fdatasync(self.fd)
+        self._pending = None
+        self.durable_offset = end
+        self.flushes += 1
+
+    def finish(self) -> None:
+        """Flush everything written to the target (and only the target)."""
+        os.fsync(self.fd)
+        self._pending = None
+        self.durable_offset = max(self.durable_offset, self._end)
+
+
+class PageCacheAdvisor:
+    """
+    Bounds the page cache used by a copy with posix_fadvise hints.
+
+    `source_read(position)` is called as the writer passes a position of the
+    source file: source pages up to there are dropped (in `_DROP_STEP`
+    ranges) and the next `readahead` bytes are requested. `target_wrote(end)`
+    and `target_durable(offset)` track the target; its pages are dropped once
+    they are on stable storage (dirty pages cannot be dropped). `peak` is the
+    largest estimated footprint: the source from the last drop to the end of
+    the readahead plus the target from the last drop to the end written.
+    """
+
+    def __init__(
+        self,
+        source_fd: Optional[int],
+        target_fd: int,
+        readahead: int = DEFAULT_READAHEAD,
+    ):
+        self.source_fd = source_fd
+        self.target_fd = target_fd
+        self.readahead = max(0, int(readahead))
+        self.enabled = hasattr(os, "posix_fadvise")
+        self.peak = 0
+        self._source_dropped: Optional[int] = None
+        self._source_ahead = 0
+        self._target_dropped: Optional[int] = None
+        self._target_end = 0
+        self._source_end = 0
+        if source_fd is not None:
+            self._source_end = os.fstat(source_fd).st_size
+            self._advise(source_fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+    def _advise(self, fd: int, offset: int, length: int, advice: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except (AttributeError, OSError):
+            pass
+
+    def source_read(self, position: int) -> None:
+        if self.source_fd is None:
+            return
+        if self._source_dropped is None:
+            self._source_dropped = position
+        elif position - self._source_dropped >= _DROP_STEP:
+            self._advise(
+                self.source_fd,
+                self._source_dropped,
+                position - self._source_dropped,
+                "POSIX_FADV_DONTNEED",
+            )
+            self._source_dropped = position
+        if self.readahead and position + self.readahead // 2 >= self._source_ahead:
+            start = max(position, self._source_ahead)
+            self._source_ahead = min(position + self.readahead, self._source_end)
+            self._advise(
+                self.source_fd,
+                start,
+                self._source_ahead - start,
+                "POSIX_FADV_WILLNEED",
+            )
+        self._update_peak()
+
+    def target_wrote(self, end: int, durable: int) -> None:
+        self._target_end = max(self._target_end, end)
+        if self._target_dropped is None:
+            self._target_dropped = durable
+        elif durable - self._target_dropped >= _DROP_STEP:
+            self._advise(
+                self.target_fd,
+                self._target_dropped,
+                durable - self._target_dropped,
+                "POSIX_FADV_DONTNEED",
+            )
+            self._target_dropped = durable
+        self._update_peak()
+
+    def _update_peak(self) -> None:
+        source = (
+            max(0, self._source_ahead - self._source_dropped)
+            if self._source_dropped is not None
+            else 0
+        )
+        target = (
+            max(0, self._target_end - self._target_dropped)
+            if self._target_dropped is not None
+            else 0
+        )
+        self.peak = max(self.peak, source + target)
+
+    def finish(self) -> None:
+        """Drop everything the copy left in the cache (after the final flush)."""
+        if self.source_fd is not None:
+            self._advise(self.source_fd, 0, 0, "POSIX_FADV_DONTNEED")
+        self._advise(self.target_fd, 0, 0, "POSIX_FADV_DONTNEED")
+        self._source_dropped = self._source_ahead
+        self._target_dropped = self._target_end
+
+
+@dataclass
+class TrimPlan:
+    """The ranges of an image that `trim` skips, and where they come from."""
+
+    ranges: List[Tuple[int, int]] = field(default_factory=list)
+    layout: Optional[PartitionLayout] = None
+    bmap: Optional[Bmap] = None
+
+
+def plan_trim(source: ImageSource, log: Callable[[str], None]) -> TrimPlan:
+    """
+    Find the ranges of the image opened as `source` that need not be written:
+    the unmapped ranges of its block map or, for raw images, the slack after
+    the last partition. Every writer that honours `trim` uses this.
+    """
+    bmap_path = find_bmap(source.path)
+    if bmap_path is not None:
+        try:
+            bmap = read_bmap(bmap_path)
+        except BmapError as e:
+            log(f"{e}; ignoring it")
+        else:
+            if source.size is not None and bmap.image_size != source.size:
+                log(
+                    f"Block map {bmap_path} is for a {bmap.image_size} byte image, "
+                    f"not this one ({source.size} bytes); ignoring it"
+                )
+            else:
+                count = len(bmap.ranges)
+                log(
+                    f"Block map {bmap_path}: writing {bmap.mapped_size} of "
+                    f"{bmap.image_size} bytes in {count} range{'' if count == 1 else 's'}"
+                )
+                return TrimPlan(bmap.unmapped_ranges, bmap=bmap)
+    if source.compressed:
+        log("Partition trimming needs a raw image; writing all of it")
+        return TrimPlan()
+    try:
+        layout = read_partition_layout(source.path)
+    except PartitionTableError as e:
+        log(f"Partition table not usable ({e}); writing the whole image")
+        return TrimPlan()
+    if layout is None:
+        log("No partition table found; writing the whole image")
+        return TrimPlan()
+    slack = layout.slack
+    if slack is None:
+        log(f"Partition table: {layout.describe()}, no slack")
+        return TrimPlan(layout=layout)
+    log(
+        f"Partition table: {layout.describe()}; writing "
+        + ", ".join(f"bytes {a}-{b}" for a, b in layout.write_ranges)
+    )
+    return TrimPlan([slack], layout=layout)
+
+
+class FlashEngine:
+    """
+    Copies a source image onto a target device or file.
+
+    Callbacks:
+        on_progress(bytes_done, total_bytes) : called after every block
+        on_log(text) : informational messages
+        should_stop() -> bool : polled between blocks; True cancels the copy
+
+    `block_size` is the size of each write to the target, either a number of
+    bytes or `AUTO_BLOCK_SIZE`. Buffers are grown to hold at least one block.
+    `flush_window` is the number of bytes written between writeback flushes
+    (0 flushes only at the end). `zero_mode` is one of `ZERO_MODES`.
+    `io_backend` is one of `IO_BACKENDS`; after `open()`, `backend` holds the
+    one actually used ("zerocopy", "uring" or "pwrite").
+    `bandwidth_limit` caps the write rate in bytes per second (0 = no cap).
+    With `direct_io` aligned writes bypass the page cache (`O_DIRECT`).
+    With `drop_cache` the page cache used by the copy is bounded (see
+    `PageCacheAdvisor`); `cache_peak` is its estimated peak in bytes.
+    With `trim` the slack after the image's last partition, or the ranges
+    its block map leaves unmapped, are skipped; after `open()`, `layout`
+    holds the parsed table, `bmap` the block map and `trim_ranges` the
+    skipped `(start, end)` ranges.
+
+    Counters: `bytes_done` (source bytes processed, used for progress),
+    `bytes_written` (bytes actually written) and `bytes_skipped` (all-zero
+    bytes that were zeroed, discarded or left alone instead of written).
+    `bytes_trimmed` counts the bytes skipped by `trim`.
+    In delta mode `bytes_compared` counts bytes checked against the target and
+    `bytes_rewritten` the differing bytes that had to be written again.
+    When resuming, `bytes_done` starts at `start_offset`.
+    After `copy()`, `digests` maps each of `hash_algorithms` to the hex
+    digest of the image.
+    """
+
+    def __init__(
+        self,
+        source_path: str,
+        target_path: str,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+        ring_depth: int = DEFAULT_RING_DEPTH,
+        block_size: Union[int, str] = DEFAULT_BLOCK_SIZE,
+        flush_window: int = DEFAULT_FLUSH_WINDOW,
+        zero_mode: str = ZERO_MODE_OFF,
+        zero_granularity: int = DEFAULT_ZERO_GRANULARITY,
+        delta: bool = False,
+        delta_granularity: int = DEFAULT_DELTA_GRANULARITY,
+        hash_algorithms: Iterable[str] = (),
+        start_offset: int = 0,
+        journal: Optional[FlashJournal] = None,
+        io_backend: str = IO_BACKEND_PWRITE,
+        bandwidth_limit: int = 0,
+        drop_cache: bool = True,
+        readahead: int = DEFAULT_READAHEAD,
+        direct_io: bool = False,
+        trim: bool = False,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_log: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        if buffer_size <= 0:
+            raise ValueError("buffer_size must be positive")
+        if ring_depth < 2:
+            raise ValueError("ring_depth must be at least 2")
+        if block_size != AUTO_BLOCK_SIZE and int(block_size) <= 0:
+            raise ValueError("block_size must be positive or 'auto'")
+        if zero_mode not in ZERO_MODES:
+            raise ValueError(f"zero_mode must be one of {', '.join(ZERO_MODES)}")
+        if zero_granularity <= 0 or zero_granularity % _ZERO_ALIGN:
+            raise ValueError(f"zero_granularity must be a multiple of {_ZERO_ALIGN}")
+        if delta_granularity <= 0:
+            raise ValueError("delta_granularity must be positive")
+        if start_offset < 0:
+            raise ValueError("start_offset must not be negative")
+        if io_backend not in IO_BACKENDS:
+            raise ValueError(f"io_backend must be one of {', '.join(IO_BACKENDS)}")
+        if bandwidth_limit < 0:
+            raise ValueError("bandwidth_limit must not be negative")
+        hash_algorithms = [name.lower().replace("-", "") for name in hash_algorithms]
+        for name in hash_algorithms:
+            hashlib.new(name)  # raises ValueError for unknown algorithms
+
+        self.source_path = source_path
+        self.target_path = target_path
+        self.buffer_size = int(buffer_size)
+        self.ring_depth = int(ring_depth)
+        self.autotune = block_size == AUTO_BLOCK_SIZE
+        self.block_size = DEFAULT_BLOCK_SIZE if self.autotune else int(block_size)
+        self.tuner: Optional[BlockSizeTuner] = None
+        # Buffer size asked for, which the buffers shrink back to after tuning.
+        self._base_buffer_size = self.buffer_size
+        # The first trial starts with the first buffer written.
+        self._trial_pending = False
+        self.flush_window = max(0, int(flush_window))
+        self.flusher: Optional[WritebackFlusher] = None
+        self.zero_mode = zero_mode
+        self.zero_granularity = int(zero_granularity)
+        self._zero_unit = bytes(self.zero_granularity)
+        self._zero_ranges_supported = True
+        self.delta = bool(delta)
+        self.delta_granularity = int(delta_granularity)
+        self._delta_buffer: Optional[mmap.mmap] = None
+        self.hash_algorithms = list(dict.fromkeys(hash_algorithms))
+        self.digests: Dict[str, str] = {}
+        self.start_offset = int(start_offset)
+        self.journal = journal
+        self.io_backend = io_backend
+        self.backend = IO_BACKEND_PWRITE
+        self.bandwidth_limit = int(bandwidth_limit)
+        self.limiter = (
+            BandwidthLimiter(self.bandwidth_limit) if self.bandwidth_limit else None
+        )
+        # bytes_written already charged to the limiter.
+        self._charged = 0
+        self.drop_cache = bool(drop_cache)
+        self.readahead = int(readahead)
+        self.cache_advisor: Optional[PageCacheAdvisor] = None
+        self.direct_io = bool(direct_io)
+        # Second descriptor of the target opened with O_DIRECT (aligned writes).
+        self._direct_fd: Optional[int] = None
+        self._direct_align = DIRECT_IO_ALIGN
+        self.trim = bool(trim)
+        self.layout: Optional[PartitionLayout] = None
+        self.bmap: Optional[Bmap] = None
+        self.trim_ranges: List[Tuple[int, int]] = []
+        # End of every trim range, for bisecting.
+        self._trim_ends: List[int] = []
+
+        self._on_progress = on_progress
+        self._on_log = on_log
+        self._should_stop = should_stop
+
+        self._source: Optional[ImageSource] = None
+        self._target_fd: Optional[int] = None
+        self._target_is_file = False
+        self._buffers: List[mmap.mmap] = []
+        # Bytes of each buffer still backed by memory (see `_fill_view`).
+        self._buffer_kept: List[int] = []
+        self._abort = threading.Event()
+        self._reader_error: Optional[BaseException] = None
+        # Addresses of the ring buffers and the views pinning them (io_uring).
+        self._uring_addrs: List[int] = []
+        self._uring_pins: List[object] = []
+        # Kernel copy method of the zero-copy backend and its splice pipe.
+        self.copy_method = "copy_file_range"
+        self._pipe: Optional[Tuple[int, int]] = None
+        self._pipe_size = 0
+
+        # Uncompressed image size, None when a compressed container does not record it.
+        self.source_size: Optional[int] = 0
+        self.target_size = 0
+        self.bytes_done = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.bytes_trimmed = 0
+        self.bytes_compared = 0
+        self.bytes_rewritten = 0
+
+    @property
+    def dirty_bytes(self) -> int:
+        """Estimated dirty page cache of the target (0 with direct I/O)."""
+        if self.flusher is None or self._direct_fd is not None:
+            return 0
+        return self.flusher.unflushed
+
+    @property
+    def cache_peak(self) -> int:
+        """Estimated peak page cache used by the copy, in bytes (0 = not tracked)."""
+        return self.cache_advisor.peak if self.cache_advisor is not None else 0
+
+    # ---- Context management ----
+    def __enter__(self) -> "FlashEngine":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Open the source and the target and validate their sizes."""
+        if self._target_fd is not None:
+            return
+
+        self._open_source()
+        if self.trim:
+            self._plan_trim()
+        self.open_target()
+        self.backend = self._select_backend()
+        if self.backend == IO_BACKEND_URING:
+            # One block per buffer, one request per buffer.
+            self.buffer_size = self.block_size
+            self.ring_depth = max(self.ring_depth, DEFAULT_URING_DEPTH)
+        elif self.backend == IO_BACKEND_ZEROCOPY:
+            # Data stays in the kernel; one buffer for the pread/pwrite fallback.
+            self.ring_depth = 1
+            # copy_file_range only works between regular files.
+            methods = (
+                ("copy_file_range", "splice") if self._target_is_file else ("splice",)
+            )
+            self.copy_method = next(
+                (name for name in methods if hasattr(os, name)), "pwrite"
+            )
+        self._buffers = [
+            alloc_aligned_buffer(self.buffer_size) for _ in range(self.ring_depth)
+        ]
+        self._buffer_kept = [len(buf) for buf in self._buffers]
+        if self.cache_advisor is not None:
+            # Stay ahead of everything the reader may hold in the ring.
+            self.cache_advisor.readahead = max(
+                self.readahead, 2 * self.ring_depth * self.buffer_size
+            )
+        self._log(
+            f"Engine: {self.ring_depth} x {self.buffer_size // 1024} KiB buffers, "
+            f"block size {'auto' if self.autotune else f'{self.block_size // 1024} KiB'}, "
+            f"target is a {'regular file' if self._target_is_file else 'device'}"
+        )
+        if self.backend == IO_BACKEND_URING:
+            self._log(
+                f"I/O backend: io_uring, up to {self.ring_depth} requests in flight"
+            )
+        elif self.backend == IO_BACKEND_ZEROCOPY:
+            self._log(f"I/O backend: zero-copy ({self.copy_method})")
+        else:
+            self._log("I/O backend: pwrite (reader thread + writer)")
+        if self.limiter is not None:
+            self._log(f"Bandwidth cap: {describe_rate(self.bandwidth_limit)}")
+
+    def _select_backend(self) -> str:
+        """Resolve `io_backend` to the backend this copy can use."""
+        if self.io_backend == IO_BACKEND_PWRITE:
+            return IO_BACKEND_PWRITE
+        if self.io_backend == IO_BACKEND_AUTO:
+            candidates = [IO_BACKEND_ZEROCOPY, IO_BACKEND_URING]
+        else:
+            candidates = [self.io_backend]
+
+        reason = ""
+        for backend in candidates:
+            features = [
+                ("block size autotuning", self.autotune),
+                ("zero skipping", self.zero_mode != ZERO_MODE_OFF),
+                ("delta mode", self.delta),
+            ]
+            if backend == IO_BACKEND_URING:
+                features.append(("partition trimming", bool(self.trim_ranges)))
+            if backend == IO_BACKEND_ZEROCOPY:
+                compressed = self._source is not None and self._source.compressed
+                features += [
+                    ("compressed images", compressed),
+                    ("hashing", bool(self.hash_algorithms)),
+                    ("direct I/O", self._direct_fd is not None),
+                ]
+            unsupported = [name for name, used in features if used]
+            label = "io_uring" if backend == IO_BACKEND_URING else "zero-copy"
+            if unsupported:
+                reason = f"{label} does not support {', '.join(unsupported)}"
+            elif backend == IO_BACKEND_URING and not uring_available():
+                reason = "io_uring is not available on this system"
+            else:
+                return backend
+        if self.io_backend != IO_BACKEND_AUTO:
+            self._log(f"{reason}; using pwrite")
+        return IO_BACKEND_PWRITE
+
+    def _open_source(self) -> None:
+        try:
+            self._source = open_image_source(self.source_path)
+        except (OSError, ImageSourceError) as e:
+            raise FlashError(f"Cannot open source {self.source_path}: {e}") from e
+        self.source_size = self._source.size
+        if self._source.compressed:
+            size = (
+                f"{self.source_size} bytes uncompressed"
+                if self.source_size is not None
+                else "uncompressed size not recorded"
+            )
+            member = self._source.member
+            self._log(
+                f"Source is a {self._source.kind} image"
+                f"{f' ({member})' if member else ''} ({size}), "
+                "decompressing while writing"
+            )
+
+    def _plan_trim(self) -> None:
+        """Find the ranges of the image that `trim` may skip."""
+        assert self._source is not None
+        plan = plan_trim(self._source, self._log)
+        self.layout, self.bmap = plan.layout, plan.bmap
+        if plan.bmap is not None:
+            self.source_size = plan.bmap.image_size
+        self._set_trim_ranges(plan.ranges)
+
+    def _set_trim_ranges(self, ranges: List[Tuple[int, int]]) -> None:
+        self.trim_ranges = list(ranges)
+        self._trim_ends = [end for _, end in self.trim_ranges]
+
+    def _next_trim(self, offset: int) -> Optional[Tuple[int, int]]:
+        """The first trim range ending after `offset`, None when there is none."""
+        index = bisect.bisect_right(self._trim_ends, offset)
+        return self.trim_ranges[index] if index < len(self.trim_ranges) else None
+
+    def open_target(self) -> None:
+        """
+        Open and set up only the target. `copy()` does this through `open()`;
+        callers that feed buffers themselves (see `FanOutEngine`) set
+        `source_size` first and then use `write_buffer()`.
+        """
+        flags = (os.O_RDWR if self.delta else os.O_WRONLY) | getattr(os, "O_CLOEXEC", 0)
+        if not os.path.exists(self.target_path):
+            flags |= os.O_CREAT
+        try:
+            self._target_fd = os.open(self.target_path, flags, 0o644)
+        except OSError as e:
+            self.close()
+            raise FlashError(f"Cannot open target {self.target_path}: {e}") from e
+
+        st = os.fstat(self._target_fd)
+        self._target_is_file = stat.S_ISREG(st.st_mode)
+        if self._target_is_file:
+            self.target_size = 0
+        else:
+            try:
+                self.target_size = os.lseek(self._target_fd, 0, os.SEEK_END)
+                os.lseek(self._target_fd, 0, os.SEEK_SET)
+            except OSError:
+                self.target_size = 0
+            if (
+                self.target_size
+                and self.source_size
+                and self.source_size > self.target_size
+            ):
+                self.close()
+                raise FlashError(
+                    f"Image ({self.source_size} bytes) is larger than target "
+                    f"({self.target_size} bytes)"
+                )
+
+        if self.direct_io:
+            self._open_direct()
+
+        if self.autotune:
+            hints = read_queue_hints(self.target_path)
+            if hints:
+                self._log(
+                    "Device queue hints: "
+                    + ", ".join(f"{k}={v}" for k, v in sorted(hints.items()))
+                )
+            self.tuner = BlockSizeTuner(TUNE_CANDIDATES, hints)
+            self.block_size = self.tuner.current
+            self.buffer_size = max(self.buffer_size, self.tuner.largest)
+            self._log(
+                "Block size autotune candidates: "
+                + ", ".join(f"{c // MiB}M" for c in self.tuner.candidates)
+            )
+        else:
+            self.buffer_size = max(self.buffer_size, self.block_size)
+
+        if self.delta:
+            self._delta_buffer = alloc_aligned_buffer(self.buffer_size)
+            self._log(
+                f"Delta mode: comparing target in {self.delta_granularity // 1024} KiB "
+                "units, rewriting only differences"
+            )
+        self.flusher = WritebackFlusher(
+            self._target_fd, self.flush_window, start=self.start_offset
+        )
+        if self.drop_cache:
+            self.cache_advisor = PageCacheAdvisor(
+                self._source.fileno() if self._source is not None else None,
+                self._target_fd,
+                self.readahead,
+            )
+        if self.start_offset:
+            self._log(f"Resuming at byte {self.start_offset}")
+        if self.flush_window:
+            self._log(
+                f"Writeback: {self.flusher.method} every {self.flush_window // MiB} MiB"
+            )
+        else:
+            self._log("Writeback: single flush at the end")
+
+    def _open_direct(self) -> None:
+        """Open the O_DIRECT descriptor for aligned writes, if the target allows it."""
+        flag = getattr(os, "O_DIRECT", 0)
+        if not flag:
+            self._log("O_DIRECT is not available; using buffered writes")
+            return
+        try:
+            self._direct_fd = os.open(
+                self.target_path, os.O_WRONLY | flag | getattr(os, "O_CLOEXEC", 0)
+            )
+        except OSError as e:
+            self._log(f"Target does not support O_DIRECT ({e}); using buffered writes")
+            return
+        logical = read_queue_hints(self.target_path).get("logical_block_size", 0)
+        self._direct_align = max(DIRECT_IO_ALIGN, logical)
+        self._log(
+            f"Direct I/O: O_DIRECT writes in {self._direct_align}-byte units, "
+            "unaligned tail buffered"
+        )
+
+    def _write_fd(self, fd: int, offset: int, length: int) -> int:
+        """The descriptor to write a range with: O_DIRECT when it is aligned."""
+        if self._direct_fd is not None and not (offset | length) % self._direct_align:
+            return self._direct_fd
+        return fd
+
+    def _disable_direct(
+        self, error: OSError, retired: Optional[List[int]] = None
+    ) -> None:
+        """
+        Write buffered from now on. The O_DIRECT descriptor is closed, or put
+        in `retired` for the caller to close once nothing refers to it.
+        """
+        self._log(f"O_DIRECT write rejected ({error}); using buffered writes")
+        if self._direct_fd is not None:
+            if retired is not None:
+                retired.append(self._direct_fd)
+            else:
+                try:
+                    os.close(self._direct_fd)
+                except OSError:
+                    pass
+            self._direct_fd = None
+
+    def close(self) -> None:
+        if self._direct_fd is not None:
+            try:
+                os.close(self._direct_fd)
+            except Exception:
+                pass
+            self._direct_fd = None
+        if self._source is not None:
+            try:
+                self._source.close()
+            except Exception:
+                pass
+            self._source = None
+        if self._target_fd is not None:
+            try:
+                os.close(self._target_fd)
+            except Exception:
+                pass
+            self._target_fd = None
+        for buf in self._buffers:
+            try:
+                buf.close()
+            except Exception:
+                pass
+        self._buffers = []
+        if self._delta_buffer is not None:
+            try:
+                self._delta_buffer.close()
+            except Exception:
+                pass
+            self._delta_buffer = None
+
+    # ---- Copy ----
+    def copy(self) -> int:
+        """Copy the whole source to the target. Returns the number of source bytes processed."""
+        if self._target_fd is None:
+            self.open()
+
+        if self.backend == IO_BACKEND_ZEROCOPY:
+            if self.start_offset and self.bytes_done < self.start_offset:
+                self._skip_source(self.start_offset, None)
+            self._copy_zerocopy()
+        else:
+            self._copy_buffered()
+
+        self.end_writes()
+        for name, digest in self.digests.items():
+            self._log(f"{name.upper()}: {digest}")
+        return self.bytes_done
+
+    def _copy_buffered(self) -> None:
+        """Copy through the ring buffers (pwrite or io_uring backend)."""
+        views = [memoryview(buf)[: self.buffer_size] for buf in self._buffers]
+        free: "queue.Queue[int]" = queue.Queue()
+        filled: "queue.Queue[Optional[Tuple[int, int, int]]]" = queue.Queue()
+        for idx in range(len(views)):
+            free.put(idx)
+
+        self._abort.clear()
+        self._reader_error = None
+        hasher = StreamHasher(self.hash_algorithms) if self.hash_algorithms else None
+        if self.start_offset and self.bytes_done < self.start_offset:
+            self._skip_source(self.start_offset, hasher)
+        ring = (
+            self._open_uring(len(views)) if self.backend == IO_BACKEND_URING else None
+        )
+        reader: Optional[threading.Thread] = None
+        if ring is None:
+            reader = threading.Thread(
+                target=self._reader_loop,
+                # The digests need the trimmed ranges, so they are only skipped
+                # without hashing.
+                args=(views, free, filled, self.bytes_done, hasher is None),
+                name="justdd-reader",
+                daemon=True,
+            )
+            reader.start()
+        try:
+            if ring is not None:
+                self._copy_uring(ring, views, hasher)
+            else:
+                self._writer_loop(views, free, filled, hasher)
+            if hasher is not None:
+                # Waits for the last buffers before their views are released.
+                self.digests = hasher.finish()
+                hasher = None
+        finally:
+            self._abort.set()
+            if hasher is not None:
+                hasher.abort()
+            if reader is not None:
+                reader.join()
+            for view in views:
+                view.release()
+
+    def begin_writes(self) -> None:
+        """
+        Start the write phase. The first autotune trial starts with the first
+        buffer written, so filling that buffer does not count against it.
+        """
+        self._trial_pending = self.tuner is not None and not self.tuner.done
+
+    def write_buffer(self, data: memoryview, offset: int) -> None:
+        """Write one buffer of source data at `offset` and account for it."""
+        fd = self._target_fd
+        assert fd is not None
+        if self._trial_pending:
+            assert self.tuner is not None
+            self._trial_pending = False
+            self.tuner.start_trial()
+        length = len(data)
+        if not self.trim_ranges:
+            self._write_chunk(fd, data, offset)
+        else:
+            for start, end in self._untrimmed(offset, length):
+                self._write_chunk(fd, data[start:end], offset + start)
+        self._wrote(offset, length)
+        if self.tuner is not None and not self.tuner.done:
+            self._tune_step(fd, length)
+
+    def _untrimmed(self, offset: int, length: int) -> List[Tuple[int, int]]:
+        """
+        The parts of `length` bytes at `offset` outside `trim_ranges`,
+        relative to `offset`; the rest is counted as trimmed.
+        """
+        end = offset + length
+        parts = []
+        position = offset
+        index = bisect.bisect_right(self._trim_ends, offset)
+        while position < end:
+            if index >= len(self.trim_ranges) or self.trim_ranges[index][0] >= end:
+                parts.append((position - offset, length))
+                break
+            low, high = self.trim_ranges[index]
+            if low > position:
+                parts.append((position - offset, low - offset))
+            position = high
+            index += 1
+        self.bytes_trimmed += length - sum(b - a for a, b in parts)
+        return parts
+
+    def _pass_trimmed(self, upto: int) -> None:
+        """Account for the slack between `bytes_done` and `upto` without writing it."""
+        if not self.trim_ranges or upto <= self.bytes_done:
+            return
+        offset = self.bytes_done
+        self.bytes_trimmed += upto - offset
+        self._wrote(offset, upto - offset)
+        self._report()
+
+    def _wrote(self, offset: int, length: int) -> None:
+        """Account for source bytes written at `offset` (in offset order)."""
+        self.bytes_done += length
+        if self.flusher is not None:
+            self.flusher.wrote(offset, length)
+            if self.journal is not None:
+                self.journal.update(self.flusher.durable_offset)
+        if self.cache_advisor is not None and self._source is not None:
+            self.cache_advisor.source_read(
+                self._source.consumed() if self._source.compressed else offset + length
+            )
+        if self.cache_advisor is not None and self.flusher is not None:
+            self.cache_advisor.target_wrote(
+                offset + length, self.flusher.durable_offset
+            )
+        if self.limiter is not None:
+            # Only bytes that reached the target count against the cap.
+            self.limiter.consume(
+                self.bytes_written - self._charged, self._stop_requested
+            )
+            self._charged = self.bytes_written
+
+    def end_writes(self) -> None:
+        """Finish the write phase once the whole source has been written."""
+        if self.tuner is not None and not self.tuner.done:
+            self.tuner.finish_early()
+            self._apply_tuning()
+        if self._target_is_file and self._target_fd is not None:
+            os.ftruncate(self._target_fd, self.bytes_done)
+        if self.delta:
+            self._log(
+                f"Delta: compared {self.bytes_compared} bytes, "
+                f"rewrote {self.bytes_rewritten} bytes"
+            )
+        if self.zero_mode != ZERO_MODE_OFF:
+            self._log(
+                f"Zero blocks ({self.zero_mode}): skipped {self.bytes_skipped} bytes, "
+                f"wrote {self.bytes_written} bytes"
+            )
+        if self.trim_ranges:
+            self._log(
+                f"{'Block map' if self.bmap is not None else 'Partition trimming'}: "
+                f"skipped {self.bytes_trimmed} bytes"
+            )
+
+    def sync(self) -> None:
+        """Flush the target's dirty data to stable storage (target only, not the host)."""
+        if self.flusher is not None:
+            self.flusher.finish()
+        elif self._target_fd is not None:
+            os.fsync(self._target_fd)
+        if self.cache_advisor is not None:
+            self.cache_advisor.finish()
+
+    # ---- Pipeline stages ----
+    def _reader_loop(
+        self,
+        views: List[memoryview],
+        free: "queue.Queue[int]",
+        filled: "queue.Queue[Optional[Tuple[int, int, int]]]",
+        offset: int = 0,
+        skip_trimmed: bool = False,
+    ) -> None:
+        assert self._source is not None
+        try:
+            while not self._abort.is_set():
+                trim = self._next_trim(offset) if skip_trimmed else None
+                if trim is not None and trim[0] <= offset:
+                    # The writer accounts for the gap in the offsets.
+                    skipped = self._source.skip(trim[1] - offset)
+                    offset += skipped
+                    if not skipped:
+                        break
+                    continue
+                try:
+                    idx = free.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                view = self._fill_view(views, idx)
+                if trim is not None and offset < trim[0]:
+                    view = view[: trim[0] - offset]
+                n = self._fill(view)
+                if not n:
+                    break
+                filled.put((idx, offset, n))
+                offset += n
+                if n < len(view):
+                    break
+        except BaseException as e:
+            self._reader_error = e
+        finally:
+            filled.put(_EOF)
+
+    def _fill_view(self, views: List[memoryview], idx: int) -> memoryview:
+        """
+        The part of a free buffer to fill: all of it while tuning, then
+        `buffer_size` bytes, the pages past them given back once.
+        """
+        view = views[idx]
+        size = self.buffer_size
+        if size >= len(view):
+            return view
+        if size < self._buffer_kept[idx]:
+            release_buffer_tail(self._buffers[idx], size)
+            self._buffer_kept[idx] = size
+        return view[:size]
+
+    def _skip_source(self, nbytes: int, hasher: Optional[StreamHasher]) -> None:
+        """Advance the source to `nbytes` without writing (resume)."""
+        assert self._source is not None
+        if hasher is None:
+            skipped = self._source.skip(nbytes)
+        else:
+            # The digests must still cover the whole image.
+            skipped = 0
+            with memoryview(self._buffers[0]) as view:
+                while skipped < nbytes:
+                    if self._stop_requested():
+                        raise FlashCancelled("Flash cancelled")
+                    n = self._fill(view[: min(len(view), nbytes - skipped)])
+                    if not n:
+                        break
+                    hasher.submit(bytes(view[:n]))
+                    skipped += n
+        if skipped < nbytes:
+            raise FlashError(
+                f"Cannot resume at byte {nbytes}: the image is only {skipped} bytes"
+            )
+        self.bytes_done = nbytes
+
+    def _fill(self, view: memoryview) -> int:
+        """Read until `view` is full or the source is exhausted."""
+        assert self._source is not None
+        total = 0
+        size = len(view)
+        while total < size:
+            n = self._source.readinto(view[total:])
+            if not n:
+                break
+            total += n
+        return total
+
+    def _writer_loop(
+        self,
+        views: List[memoryview],
+        free: "queue.Queue[int]",
+        filled: "queue.Queue[Optional[Tuple[int, int, int]]]",
+        hasher: Optional[StreamHasher] = None,
+    ) -> None:
+        self.begin_writes()
+        while True:
+            if self._stop_requested():
+                raise FlashCancelled("Flash cancelled")
+            try:
+                item = filled.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is _EOF:
+                break
+            idx, offset, length = item
+            self._pass_trimmed(offset)
+            self.write_buffer(views[idx][:length], offset)
+            if hasher is not None:
+                # The buffer goes back to the ring once it has been hashed.
+                hasher.submit(views[idx][:length], lambda idx=idx: free.put(idx))
+            else:
+                free.put(idx)
+            self._report()
+
+        if self._reader_error is not None:
+            raise FlashError(f"Error reading source: {self._reader_error}")
+        self._pass_trimmed(self.source_size or 0)
+
+    # ---- io_uring backend ----
+    def _open_uring(self, depth: int) -> Optional[IoUring]:
+        """Create a ring and register the buffers; None falls back to pwrite."""
+        try:
+            ring = IoUring(2 * depth)
+        except IoUringError as e:
+            self.backend = IO_BACKEND_PWRITE
+            self._log(f"Cannot set up io_uring ({e}); using pwrite")
+            return None
+        self._uring_addrs = []
+        self._uring_pins = []
+        for buf in self._buffers:
+            addr, pin = buffer_address(buf)
+            self._uring_addrs.append(addr)
+            self._uring_pins.append(pin)
+        try:
+            ring.register_buffers(
+                [
+                    (addr, len(buf))
+                    for addr, buf in zip(self._uring_addrs, self._buffers)
+                ]
+            )
+        except IoUringError as e:
+            self._log(f"io_uring: cannot register buffers ({e}); using plain requests")
+        return ring
+
+    def _copy_uring(
+        self,
+        ring: IoUring,
+        views: List[memoryview],
+        hasher: Optional[StreamHasher] = None,
+    ) -> None:
+        """
+        Copy with several requests in flight. Every buffer cycles through a
+        read (an io_uring read for raw images, the decoder otherwise), a
+        write and, when hashing, the hasher before it is filled again.
+        """
+        assert self._source is not None
+        raw = not self._source.compressed
+        end = self.source_size or 0
+        free = list(range(len(views)))
+        # Buffers given back by the hasher threads.
+        released: "queue.Queue[int]" = queue.Queue()
+        # Per buffer: [offset, length, bytes transferred by the current request,
+        # whether its write went to the O_DIRECT descriptor].
+        chunks = [[0, 0, 0, False] for _ in views]
+        # Writes completed out of order, by offset, waiting for earlier ones.
+        written: Dict[int, Tuple[int, int]] = {}
+        # O_DIRECT descriptor given up while queued requests may still name it.
+        retired: List[int] = []
+        read_offset = self.bytes_done
+        eof = False
+        inflight = 0
+
+        try:
+            self.begin_writes()
+            while True:
+                if self._stop_requested():
+                    raise FlashCancelled("Flash cancelled")
+                while not released.empty():
+                    free.append(released.get_nowait())
+
+                while free and not eof:
+                    idx = free.pop()
+                    if raw:
+                        length = min(len(views[idx]), end - read_offset)
+                    else:
+                        length = self._fill(views[idx])
+                        eof = length < len(views[idx])
+                    if length <= 0:
+                        free.append(idx)
+                        eof = True
+                        break
+                    chunks[idx] = [read_offset, length, 0, False]
+                    self._uring_submit(ring, idx, not raw, chunks[idx])
+                    read_offset += length
+                    inflight += 1
+
+                if not inflight:
+                    if eof:
+                        break
+                    try:
+                        free.append(released.get(timeout=_POLL_INTERVAL))
+                    except queue.Empty:
+                        pass
+                    continue
+
+                self._uring_wait(ring)
+                for user_data, result in list(ring.completions()):
+                    inflight -= 1
+                    idx, is_write = user_data >> 1, bool(user_data & 1)
+                    chunk = chunks[idx]
+                    if result == -errno.EINVAL and is_write and chunk[3]:
+                        # As in _write_blocks: the target refused O_DIRECT, so
+                        # this (and every later) write goes to the buffered fd.
+                        if self._direct_fd is not None:
+                            self._disable_direct(
+                                OSError(-result, os.strerror(-result)), retired
+                            )
+                        self._uring_submit(ring, idx, True, chunk)
+                        inflight += 1
+                        continue
+                    if result <= 0:
+                        position = chunk[0] + chunk[2]
+                        if result == 0:
+                            raise FlashError(
+                                f"Short write on target at byte {position}"
+                                if is_write
+                                else f"Source ended at byte {position}"
+                            )
+                        action = "write target" if is_write else "read source"
+                        raise FlashError(
+                            f"Cannot {action} at byte {position}: {os.strerror(-result)}"
+                        )
+                    chunk[2] += result
+                    if chunk[2] < chunk[1]:
+                        # Partial transfer: queue the rest of the buffer.
+                        self._uring_submit(ring, idx, is_write, chunk)
+                    elif not is_write:
+                        chunk[2] = 0
+                        self._uring_submit(ring, idx, True, chunk)
+                    else:
+                        written[chunk[0]] = (idx, chunk[1])
+                        continue
+                    inflight += 1
+
+                while self.bytes_done in written:
+                    offset = self.bytes_done
+                    idx, length = written.pop(offset)
+                    self.bytes_written += length
+                    self._wrote(offset, length)
+                    if hasher is not None:
+                        hasher.submit(
+                            views[idx][:length], lambda idx=idx: released.put(idx)
+                        )
+                    else:
+                        free.append(idx)
+                    self._report()
+        finally:
+            # The kernel may still be using the buffers; wait for it.
+            while inflight:
+                try:
+                    self._uring_wait(ring)
+                except OSError:
+                    break
+                inflight -= len(list(ring.completions()))
+            ring.close()
+            self._uring_pins = []
+            for fd in retired:
+                os.close(fd)
+
+        if raw and self.bytes_done < end:
+            raise FlashError(f"Source ended at byte {self.bytes_done}")
+
+    def _uring_submit(
+        self, ring: IoUring, idx: int, is_write: bool, chunk: List[int]
+    ) -> None:
+        """Queue the untransferred part of buffer `idx` for reading or writing."""
+        assert self._source is not None and self._target_fd is not None
+        offset, length, done = chunk[:3]
+        if is_write:
+            fd = self._write_fd(self._target_fd, offset + done, length - done)
+            chunk[3] = fd != self._target_fd
+            opcode = IORING_OP_WRITE_FIXED if ring.fixed_buffers else IORING_OP_WRITE
+        else:
+            fd = self._source.fileno()
+            opcode = IORING_OP_READ_FIXED if ring.fixed_buffers else IORING_OP_READ
+        ring.prep_rw(
+            opcode,
+            fd,
+            self._uring_addrs[idx] + done,
+            length - done,
+            offset + done,
+            idx << 1 | int(is_write),
+            idx,
+        )
+
+    @staticmethod
+    def _uring_wait(ring: IoUring) -> None:
+        """Submit queued requests and wait for at least one completion."""
+        while True:
+            try:
+                ring.submit(wait_for=1)
+                return
+            except IoUringError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    # ---- Zero-copy backend ----
+    def _copy_zerocopy(self) -> None:
+        """Copy a raw image block by block without reading it into Python."""
+        assert self._source is not None and self._target_fd is not None
+        src_fd = self._source.fileno()
+        end = self.source_size or 0
+        offset = self.bytes_done
+        self.begin_writes()
+        try:
+            while offset < end:
+                if self._stop_requested():
+                    raise FlashCancelled("Flash cancelled")
+                length = min(self.block_size, end - offset)
+                trim = self._next_trim(offset)
+                if trim is not None and trim[0] <= offset:
+                    self._pass_trimmed(trim[1])
+                    offset = trim[1]
+                    continue
+                if trim is not None and offset < trim[0]:
+                    length = min(length, trim[0] - offset)
+                n = self._kernel_copy(src_fd, self._target_fd, offset, length)
+                if not n:
+                    raise FlashError(f"Source ended at byte {offset}")
+                self.bytes_written += n
+                self._wrote(offset, n)
+                offset += n
+                self._report()
+        finally:
+            if self._pipe is not None:
+                for pipe_fd in self._pipe:
+                    os.close(pipe_fd)
+                self._pipe = None
+
+    def _kernel_copy(self, src_fd: int, fd: int, offset: int, length: int) -> int:
+        """Copy one block with the current method, degrading when it is unsupported."""
+        while True:
+            method = self.copy_method
+            try:
+                if method == "copy_file_range":
+                    return self._copy_range(src_fd, fd, offset, length)
+                if method == "splice":
+                    return self._splice_range(src_fd, fd, offset, length)
+                return self._pread_pwrite(src_fd, fd, offset, length)
+            except OSError as e:
+                if method == "pwrite" or e.errno not in _COPY_UNSUPPORTED:
+                    raise
+                # Blocks are copied at explicit offsets, so a partly copied
+                # block is simply copied again with the next method.
+                self.copy_method = (
+                    "splice"
+                    if method == "copy_file_range" and hasattr(os, "splice")
+                    else "pwrite"
+                )
+                self._log(f"{method} not supported ({e}); using {self.copy_method}")
+
+    @staticmethod
+    def _copy_range(src_fd: int, fd: int, offset: int, length: int) -> int:
+        done = 0
+        while done < length:
+            n = os.copy_file_range(
+                src_fd, fd, length - done, offset + done, offset + done
+            )
+            if not n:
+                break
+            done += n
+        return done
+
+    def _splice_range(self, src_fd: int, fd: int, offset: int, length: int) -> int:
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            try:
+                self._pipe_size = fcntl.fcntl(
+                    self._pipe[1],
+                    getattr(fcntl, "F_SETPIPE_SZ", 1031),
+                    _SPLICE_PIPE_SIZE,
+                )
+            except OSError:
+                self._pipe_size = 64 * 1024
+        read_end, write_end = self._pipe
+        done = 0
+        while done < length:
+            n = os.splice(
+                src_fd,
+                write_end,
+                min(self._pipe_size, length - done),
+                offset_src=offset + done,
+            )
+            if not n:
+                break
+            moved = 0
+            while moved < n:
+                m = os.splice(read_end, fd, n - moved, offset_dst=offset + done + moved)
+                if not m:
+                    raise FlashError("Short write on target")
+                moved += m
+            done += n
+        return done
+
+    def _pread_pwrite(self, src_fd: int, fd: int, offset: int, length: int) -> int:
+        with memoryview(self._buffers[0]) as view:
+            n = self._pread_into(src_fd, view[: min(length, len(view))], offset)
+            self._pwrite_all(fd, view[:n], offset)
+        return n
+
+    def _tune_step(self, fd: int, nbytes: int) -> None:
+        tuner = self.tuner
+        assert tuner is not None
+        if not tuner.add(nbytes):
+            return
+        # Time the trial until the data really reached the device.
+        os.fdatasync(fd)
+        tuner.finish_trial()
+        rate = tuner.results.get(self.block_size, 0.0)
+        self._log(f"Autotune: {self.block_size // MiB}M -> {rate / MiB:.1f} MB/s")
+        if tuner.done:
+            self._apply_tuning()
+        else:
+            self.block_size = tuner.current
+
+    def _apply_tuning(self) -> None:
+        assert self.tuner is not None and self.tuner.chosen is not None
+        self.block_size = self.tuner.chosen
+        self._log(f"Block size tuned to {self.block_size // MiB}M")
+        # The buffers only had to hold the largest candidate while tuning.
+        self.buffer_size = min(
+            self.buffer_size, max(self._base_buffer_size, self.block_size)
+        )
+
+    # ---- Internal helpers ----
+    def _write_chunk(self, fd: int, data: memoryview, offset: int) -> None:
+        """Write one filled buffer, honouring delta mode and zero skipping."""
+        if self.delta:
+            self._write_delta(fd, data, offset)
+        else:
+            self._write_data(fd, data, offset)
+
+    def _write_delta(self, fd: int, data: memoryview, offset: int) -> None:
+        assert self._delta_buffer is not None
+        with memoryview(self._delta_buffer) as scratch:
+            current = scratch[: len(data)]
+            available = self._pread_into(fd, current, offset)
+            self.bytes_compared += len(data)
+
+            gran = self.delta_granularity
+            diff_start: Optional[int] = None
+            for start in range(0, len(data), gran):
+                end = min(start + gran, len(data))
+                same = end <= available and bytes(data[start:end]) == bytes(
+                    current[start:end]
+                )
+                if not same and diff_start is None:
+                    diff_start = start
+                elif same and diff_start is not None:
+                    self._rewrite(fd, data[diff_start:start], offset + diff_start)
+                    diff_start = None
+            if diff_start is not None:
+                self._rewrite(fd, data[diff_start:], offset + diff_start)
+            current.release()
+
+        # The compared target pages are not needed again; keep them out of the cache.
+        try:
+            os.posix_fadvise(fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+        except (AttributeError, OSError):
+            pass
+
+    def _rewrite(self, fd: int, data: memoryview, offset: int) -> None:
+        self._write_data(fd, data, offset)
+        self.bytes_rewritten += len(data)
+
+    @staticmethod
+    def _pread_into(fd: int, view: memoryview, offset: int) -> int:
+        """Read from the target until `view` is full or its end is reached."""
+        total = 0
+        while total < len(view):
+            n = os.preadv(fd, [view[total:]], offset + total)
+            if not n:
+                break
+            total += n
+        return total
+
+    def _write_data(self, fd: int, data: memoryview, offset: int) -> None:
+        """Write a range of source data, skipping all-zero runs when enabled."""
+        if self.zero_mode == ZERO_MODE_OFF:
+            self._write_blocks(fd, data, offset)
+            self.bytes_written += len(data)
+            return
+
+        gran = self.zero_granularity
+        run_start = 0
+        run_zero: Optional[bool] = None
+        for start in range(0, len(data), gran):
+            unit = data[start : start + gran]
+            is_zero = bytes(unit) == (
+                self._zero_unit if len(unit) == gran else bytes(len(unit))
+            )
+            if run_zero is None:
+                run_zero = is_zero
+            elif is_zero != run_zero:
+                self._write_run(fd, data[run_start:start], offset + run_start, run_zero)
+                run_start = start
+                run_zero = is_zero
+        if run_zero is not None:
+            self._write_run(fd, data[run_start:], offset + run_start, run_zero)
+
+    def _write_run(self, fd: int, data: memoryview, offset: int, is_zero: bool) -> None:
+        if is_zero and self._skip_zero_range(fd, offset, len(data)):
+            self.bytes_skipped += len(data)
+            return
+        self._write_blocks(fd, data, offset)
+        self.bytes_written += len(data)
+
+    def _skip_zero_range(self, fd: int, offset: int, length: int) -> bool:
+        """Make the target range read as zeros without writing it. False = write it."""
+        if self.zero_mode == ZERO_MODE_UNCLEAN:
+            return True
+        if not self._zero_ranges_supported:
+            return False
+        if not self._target_is_file and (offset % _ZERO_ALIGN or length % 512):
+            return False
+        try:
+            if self._target_is_file:
+                punch_hole(fd, offset, length)
+            elif self.zero_mode == ZERO_MODE_DISCARD:
+                discard_range(fd, offset, length)
+            else:
+                zero_out_range(fd, offset, length)
+            return True
+        except OSError as e:
+            self._zero_ranges_supported = False
+            self._log(f"Target cannot {self.zero_mode} ranges ({e}); writing zeros")
+            return False
+
+    def _write_blocks(self, fd: int, data: memoryview, offset: int) -> None:
+        block = self.block_size
+        for start in range(0, len(data), block):
+            chunk = data[start : start + block]
+            write_fd = self._write_fd(fd, offset + start, len(chunk))
+            if write_fd == fd:
+                self._pwrite_all(fd, chunk, offset + start)
+                continue
+            try:
+                self._pwrite_all(write_fd, chunk, offset + start)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self._disable_direct(e)
+                self._pwrite_all(fd, chunk, offset + start)
+
+    @staticmethod
+    def _pwrite_all(fd: int, data: memoryview, offset: int) -> None:
+        done = 0
+        total = len(data)
+        while done < total:
+            written = os.pwrite(fd, data[done:], offset + done)
+            if written <= 0:
+                raise FlashError("Short write on target")
+            done += written
+
+    def _stop_requested(self) -> bool:
+        if self._should_stop is None:
+            return False
+        try:
+            return bool(self._should_stop())
+        except Exception:
+            return False
+
+    def _report(self) -> None:
+        if self._on_progress:
+            try:
+                done, total = (
+                    self._source.progress(self.bytes_done)
+                    if self._source is not None
+                    else (self.bytes_done, self.bytes_done)
+                )
+                self._on_progress(done, total)
+            except Exception:
+                pass
+
+    def _log(self, text: str) -> None:
+        if self._on_log:
+            try:
+                self._on_log(text)
+            except Exception:
+                pass
+
+
+__all__ = [
+    "FlashEngine",
+    "TrimPlan",
+    "plan_trim",
+    "FlashError",
+    "FlashCancelled",
+    "DEFAULT_BUFFER_SIZE",
+    "DEFAULT_RING_DEPTH",
+    "DEFAULT_BLOCK_SIZE",
+    "AUTO_BLOCK_SIZE",
+    "DEFAULT_FLUSH_WINDOW",
+    "IO_BACKENDS",
+    "IO_BACKEND_AUTO",
+    "IO_BACKEND_URING",
+    "IO_BACKEND_ZEROCOPY",
+    "IO_BACKEND_PWRITE",
+    "WritebackFlusher",
+    "PageCacheAdvisor",
+    "DEFAULT_READAHEAD",
+    "DIRECT_IO_ALIGN",
+    "ZERO_MODES",
+    "ZERO_MODE_OFF",
+    "ZERO_MODE_ZEROOUT",
+    "ZERO_MODE_DISCARD",
+    "ZERO_MODE_UNCLEAN",
+    "DEFAULT_DELTA_GRANULARITY",
+    "TUNE_CANDIDATES",
+    "BlockSizeTuner",
+    "suggest_block_size",
+    "dd_block_size_operand",
+    "alloc_aligned_buffer",
+    "can_open_for_writing",
+    "release_buffer_tail",
+]
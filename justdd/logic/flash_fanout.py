@@ -0,0 +1,446 @@
+"""
+FanOutEngine
+
+Duplicator mode for the in-process flash path: one source image written to
+many targets at once, with the source read (and decompressed) only once.
+
+A reader thread fills buffers from a shared pool and hands every filled
+buffer to all targets. Each target has its own writer thread, which writes
+the buffer through a per-target `FlashEngine` (so block size, writeback
+windows, zero skipping and delta mode work as for a single target) and then
+releases it. A buffer returns to the pool once every target (and the hasher,
+when digests are requested) has released it.
+
+The pool size bounds the lag between the fastest and the slowest target: a
+slow stick only slows itself down until it is `pool_depth` buffers behind,
+after which the reader waits for it. A target that fails (I/O error, stick
+unplugged) is marked as failed and keeps releasing buffers without writing,
+so it never holds up the others. Progress and throughput are tracked per
+target, and a `bandwidth_limit` caps the write rate of each target.
+
+With `block_size="auto"` the buffers must hold the largest candidate while
+the targets tune; only as many of them as fit in 256 MiB are used until
+then, and afterwards they are filled up to the largest chosen size (see
+`release_buffer_tail`).
+
+Usage (example):
+    with FanOutEngine('/path/to.iso', ['/dev/sdb', '/dev/sdc']) as fan_out:
+        fan_out.run()
+        for target in fan_out.targets:
+            print(target.path, target.state, target.throughput)
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .flash_engine import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_FLUSH_WINDOW,
+    ZERO_MODE_OFF,
+    FlashCancelled,
+    FlashEngine,
+    FlashError,
+    alloc_aligned_buffer,
+    release_buffer_tail,
+)
+from .image_hash import StreamHasher
+from .image_source import ImageSource, ImageSourceError, open_image_source
+from .throttle import describe_rate
+
+# Buffers in the shared pool; also the maximum lag of the slowest target.
+DEFAULT_POOL_DEPTH = 16
+# Memory the pool may use while its buffers hold the largest tuning candidate.
+_TUNING_POOL_BYTES = 256 * 1024 * 1024
+
+TARGET_PENDING = "pending"
+TARGET_WRITING = "writing"
+TARGET_SYNCING = "syncing"
+TARGET_DONE = "done"
+TARGET_FAILED = "failed"
+
+_EOF = None
+_POLL_INTERVAL = 0.1
+
+
+class FanOutTarget:
+    """State of one target of a fan-out copy."""
+
+    def __init__(self, index: int, path: str, engine: FlashEngine):
+        self.index = index
+        self.path = path
+        self.engine = engine
+        self.state = TARGET_PENDING
+        self.error: Optional[str] = None
+        self.started = 0.0
+        self.seconds = 0.0
+        self.queue: "queue.Queue[Optional[Tuple[int, int, int]]]" = queue.Queue()
+
+    @property
+    def bytes_done(self) -> int:
+        return self.engine.bytes_done
+
+    @property
+    def failed(self) -> bool:
+        return self.state == TARGET_FAILED
+
+    @property
+    def throughput(self) -> float:
+        """Write speed of this target in bytes per second."""
+        elapsed = self.seconds or (
+            time.monotonic() - self.started if self.started else 0.0
+        )
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+
+class FanOutEngine:
+    """
+    Copies one source image onto several targets, reading the source once.
+
+    Callbacks:
+        on_progress(target_index, bytes_done, total_bytes) : per target, after every buffer
+        on_log(text) : informational messages, prefixed with the target path
+        should_stop() -> bool : polled between buffers; True cancels every target
+
+    `run()` returns the number of targets that were written successfully and
+    raises FlashError only when none was.
+    """
+
+    def __init__(
+        self,
+        source_path: str,
+        target_paths: Iterable[str],
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+        pool_depth: int = DEFAULT_POOL_DEPTH,
+        block_size: Union[int, str] = DEFAULT_BLOCK_SIZE,
+        flush_window: int = DEFAULT_FLUSH_WINDOW,
+        zero_mode: str = ZERO_MODE_OFF,
+        delta: bool = False,
+        hash_algorithms: Iterable[str] = (),
+        bandwidth_limit: int = 0,
+        on_progress: Optional[Callable[[int, int, int], None]] = None,
+        on_log: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        paths = list(dict.fromkeys(target_paths))
+        if not paths:
+            raise ValueError("at least one target is required")
+        if pool_depth < 2:
+            raise ValueError("pool_depth must be at least 2")
+
+        self.source_path = source_path
+        self.buffer_size = int(buffer_size)
+        self.pool_depth = int(pool_depth)
+        self.hash_algorithms = list(hash_algorithms)
+        self.bandwidth_limit = int(bandwidth_limit)
+        self.digests: Dict[str, str] = {}
+        self._on_progress = on_progress
+        self._on_log = on_log
+        self._should_stop = should_stop
+
+        self.targets: List[FanOutTarget] = []
+        for index, path in enumerate(paths):
+            engine = FlashEngine(
+                source_path,
+                path,
+                buffer_size=buffer_size,
+                block_size=block_size,
+                flush_window=flush_window,
+                zero_mode=zero_mode,
+                delta=delta,
+                bandwidth_limit=bandwidth_limit,
+                on_log=lambda text, path=path: self._log(f"[{path}] {text}"),
+                should_stop=should_stop,
+            )
+            self.targets.append(FanOutTarget(index, path, engine))
+
+        self.source_size: Optional[int] = 0
+        self.bytes_read = 0
+        self._source: Optional[ImageSource] = None
+        self._buffers = []
+        # Buffer size asked for, which the buffers shrink back to after tuning.
+        self._base_buffer_size = self.buffer_size
+        # Bytes of each buffer still backed by memory.
+        self._buffer_kept: List[int] = []
+        # Buffers kept out of the pool while the targets tune.
+        self._held: List[int] = []
+        self._refs: List[int] = []
+        self._refs_lock = threading.Lock()
+        self._free: "queue.Queue[int]" = queue.Queue()
+        self._reader_error: Optional[BaseException] = None
+
+    # ---- Context management ----
+    def __enter__(self) -> "FanOutEngine":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Open the source and every target; targets that cannot be opened are marked failed."""
+        if self._source is not None:
+            return
+        try:
+            self._source = open_image_source(self.source_path)
+        except (OSError, ImageSourceError) as e:
+            raise FlashError(f"Cannot open source {self.source_path}: {e}") from e
+        self.source_size = self._source.size
+
+        for target in self.targets:
+            target.engine.source_size = self.source_size
+            try:
+                target.engine.open_target()
+            except (FlashError, OSError) as e:
+                self._fail(target, str(e))
+        if all(target.failed for target in self.targets):
+            self.close()
+            raise FlashError("No target could be opened")
+
+        # Per-target engines grow their buffer size for autotuning.
+        self.buffer_size = max(
+            [self.buffer_size]
+            + [t.engine.buffer_size for t in self.targets if not t.failed]
+        )
+        self._buffers = [
+            alloc_aligned_buffer(self.buffer_size) for _ in range(self.pool_depth)
+        ]
+        self._buffer_kept = [len(buf) for buf in self._buffers]
+        self._refs = [0] * self.pool_depth
+        self._log(
+            f"Fan-out: {len(self.targets)} targets, {self.pool_depth} x "
+            f"{self.buffer_size // 1024} KiB shared buffers"
+        )
+        if self.bandwidth_limit:
+            self._log(
+                f"Bandwidth cap: {describe_rate(self.bandwidth_limit)} per target"
+            )
+
+    def close(self) -> None:
+        if self._source is not None:
+            try:
+                self._source.close()
+            except Exception:
+                pass
+            self._source = None
+        for target in self.targets:
+            target.engine.close()
+        for buf in self._buffers:
+            try:
+                buf.close()
+            except Exception:
+                pass
+        self._buffers = []
+
+    # ---- Copy ----
+    def run(self) -> int:
+        """Write the source to every target; returns the number of targets written."""
+        if self._source is None:
+            self.open()
+
+        views = [memoryview(buf)[: self.buffer_size] for buf in self._buffers]
+        self._free = queue.Queue()
+        active = len(views)
+        if any(t.engine.tuner is not None for t in self.targets if not t.failed):
+            active = max(2, min(active, _TUNING_POOL_BYTES // self.buffer_size))
+        for idx in range(active):
+            self._free.put(idx)
+        self._held = list(range(active, len(views)))
+        self._reader_error = None
+        hasher = StreamHasher(self.hash_algorithms) if self.hash_algorithms else None
+
+        writers = []
+        for target in self.targets:
+            if target.failed:
+                continue
+            writer = threading.Thread(
+                target=self._writer_loop,
+                args=(target, views),
+                name=f"justdd-writer-{target.index}",
+                daemon=True,
+            )
+            writers.append(writer)
+            writer.start()
+
+        try:
+            self._reader_loop(views, hasher)
+            if hasher is not None and self._reader_error is None:
+                self.digests = hasher.finish()
+                hasher = None
+        finally:
+            if hasher is not None:
+                hasher.abort()
+            for writer in writers:
+                writer.join()
+            for view in views:
+                view.release()
+
+        if self._stop_requested():
+            raise FlashCancelled("Flash cancelled")
+        if self._reader_error is not None:
+            raise FlashError(f"Error reading source: {self._reader_error}")
+
+        for name, digest in self.digests.items():
+            self._log(f"{name.upper()}: {digest}")
+        succeeded = sum(1 for target in self.targets if target.state == TARGET_DONE)
+        if not succeeded:
+            raise FlashError("Every target failed")
+        return succeeded
+
+    # ---- Pipeline stages ----
+    def _reader_loop(self, views: List[memoryview], hasher) -> None:
+        assert self._source is not None
+        offset = 0
+        try:
+            while True:
+                live = [t for t in self.targets if not t.failed]
+                if not live or self._stop_requested():
+                    break
+                size = max(
+                    [self._base_buffer_size] + [t.engine.buffer_size for t in live]
+                )
+                if self._held and size < self.buffer_size:
+                    # Tuning is over: the held back buffers join the pool.
+                    for idx in self._held:
+                        self._free.put(idx)
+                    self._held = []
+                try:
+                    idx = self._free.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                view = views[idx]
+                if size < len(view):
+                    if size < self._buffer_kept[idx]:
+                        release_buffer_tail(self._buffers[idx], size)
+                        self._buffer_kept[idx] = size
+                    view = view[:size]
+                n = self._fill(view)
+                if not n:
+                    self._free.put(idx)
+                    break
+
+                # One reference per live target, plus one for the hasher.
+                with self._refs_lock:
+                    self._refs[idx] = len(live) + (1 if hasher is not None else 0)
+                for target in live:
+                    target.queue.put((idx, offset, n))
+                if hasher is not None:
+                    hasher.submit(views[idx][:n], lambda idx=idx: self._release(idx))
+                offset += n
+                self.bytes_read = offset
+                if n < len(view):
+                    break
+        except BaseException as e:
+            self._reader_error = e
+        finally:
+            for target in self.targets:
+                target.queue.put(_EOF)
+
+    def _fill(self, view: memoryview) -> int:
+        assert self._source is not None
+        total = 0
+        while total < len(view):
+            n = self._source.readinto(view[total:])
+            if not n:
+                break
+            total += n
+        return total
+
+    def _writer_loop(self, target: FanOutTarget, views: List[memoryview]) -> None:
+        engine = target.engine
+        target.state = TARGET_WRITING
+        target.started = time.monotonic()
+        engine.begin_writes()
+        while True:
+            item = target.queue.get()
+            if item is _EOF:
+                break
+            idx, offset, length = item
+            try:
+                if not target.failed and not self._stop_requested():
+                    engine.write_buffer(views[idx][:length], offset)
+                    self._report(target)
+            except Exception as e:
+                self._fail(target, f"Write failed at byte {offset}: {e}")
+            finally:
+                # Failed targets keep draining their queue so that the
+                # shared buffers are released.
+                self._release(idx)
+
+        if target.failed or self._stop_requested() or self._reader_error:
+            return
+        try:
+            engine.end_writes()
+            target.state = TARGET_SYNCING
+            engine.sync()
+        except (FlashError, OSError) as e:
+            self._fail(target, f"Flush failed: {e}")
+            return
+        target.seconds = time.monotonic() - target.started
+        target.state = TARGET_DONE
+        self._log(
+            f"[{target.path}] Wrote {target.bytes_done} bytes in "
+            f"{target.seconds:.1f} s ({target.throughput / (1024**2):.1f} MB/s)"
+        )
+
+    def _release(self, idx: int) -> None:
+        with self._refs_lock:
+            self._refs[idx] -= 1
+            free = self._refs[idx] == 0
+        if free:
+            self._free.put(idx)
+
+    def _fail(self, target: FanOutTarget, message: str) -> None:
+        target.state = TARGET_FAILED
+        target.error = message
+        if target.started:
+            target.seconds = time.monotonic() - target.started
+        self._log(f"[{target.path}] {message}")
+
+    # ---- Helpers ----
+    def _stop_requested(self) -> bool:
+        if self._should_stop is None:
+            return False
+        try:
+            return bool(self._should_stop())
+        except Exception:
+            return False
+
+    def _report(self, target: FanOutTarget) -> None:
+        if self._on_progress and self._source is not None:
+            try:
+                done, total = self._source.progress(target.bytes_done)
+                if done != target.bytes_done and self.bytes_read > 0:
+                    # Size unknown: `done` is where the reader is in the
+                    # compressed file; scale it to how far this target got.
+                    done = (
+                        done
+                        * min(target.bytes_done, self.bytes_read)
+                        // self.bytes_read
+                    )
+                self._on_progress(target.index, done, total)
+            except Exception:
+                pass
+
+    def _log(self, text: str) -> None:
+        if self._on_log:
+            try:
+                self._on_log(text)
+            except Exception:
+                pass
+
+
+__all__ = [
+    "FanOutEngine",
+    "FanOutTarget",
+    "DEFAULT_POOL_DEPTH",
+    "TARGET_PENDING",
+    "TARGET_WRITING",
+    "TARGET_SYNCING",
+    "TARGET_DONE",
+    "TARGET_FAILED",
+]
@@ -5,9 +5,50 @@ A NiceGUI-friendly, polling-oriented replacement for the Qt-based `FlashWorker`.
 This module provides a background worker implemented with `threading.Thread`
 that performs the same high-level tasks as the original FlashWorker:
 
-- Linux flashing using `dd` (via `pkexec dd ... status=progress`) and parsing
-  dd progress output to infer progress percentage.
-- Windows USB creation by generating a bash script and running it via `pkexec`.
+- Linux flashing using the in-process `FlashEngine` when the target is
+  writable by the current user, otherwise through the session's privileged
+  helper (see `priv_helper`; authenticated once, then reused by every job),
+  or using `dd` (via `pkexec dd ... status=progress`) when the helper cannot
+  be started, parsing dd progress output to infer progress percentage.
+- Choosing the in-process I/O backend (`io_backend="zerocopy"` copies raw
+  images inside the kernel, "uring" keeps several writes in flight through
+  io_uring, "pwrite" uses the threaded pipeline); the backend in use is
+  logged, so runs can be compared on one device.
+- Optionally (`hash_algorithms=("sha256", ...)`) computing digests of the
+  image while it is written, and checking SHA-256 against a `SHA256SUMS` or
+  `*.sha256` file found next to the image.
+- Optionally (`verify=True`) reading the target back after the write and
+  comparing it with the image (see `FlashVerifier`).
+- Resuming an interrupted in-process flash (`resume=True`) from the offset
+  recorded in its journal (see `flash_journal`), once the first and last
+  chunks already on the target are confirmed to match the image.
+- Running in the background without hurting other work on the machine:
+  an I/O scheduling class and level (`io_class="idle"`, like `ionice`), a
+  CPU nice level and a write bandwidth cap (`bandwidth_limit`, bytes per
+  second) can be set per job (see `throttle`); the settings in effect are
+  logged.
+- Capping the dirty page cache of the target's disk while a job runs
+  (`dirty_limit_ratio`, see `BdiDirtyLimit`, set by the privileged helper
+  when the job writes through it); the original limits are restored
+  afterwards and the job logs when it holds more dirty data than the cap.
+- Skipping the slack after the last partition of padded raw images
+  (`trim=True`, see `partition_table`); only the partition table, the
+  partitions and the backup GPT are written and verified. Images with a
+  block map next to them (see `bmap`) get only their mapped blocks written.
+- Sampling throughput during the write phase (see `FlashTelemetry`):
+  instantaneous and smoothed rate, elapsed time and ETA.
+- Duplicating one image onto many targets with `MultiFlashJob`, which reads
+  the source once and writes every target in its own thread.
+- Reading a device back into an image with `BackupJob` (see
+  `BackupEngine`): multi-threaded zstd or a sparse raw image, hashed while
+  it is read. With `skip_free=True` only the blocks the filesystems use are
+  read (see `fs_allocation`) and a block map is written next to the image.
+- Erasing a device with `WipeJob` (see `WipeEngine`): BLKZEROOUT when the
+  device offloads it, multi-threaded zero writes otherwise (BLKDISCARD only
+  on request), and `blkdiscard` in the privileged helper for devices the
+  user cannot open.
+- Windows USB creation by generating a bash script and running it in the
+  privileged helper (or via `pkexec` when the helper cannot be started).
   The generated script prints step markers like "Step X/Y: <desc>" which we
   parse to update progress & status.
 
@@ -21,7 +62,8 @@ Usage (example):
     job = FlashJob('/path/to.iso', '/dev/sdb', mode='linux', partition_scheme='gpt')
     job.start()
     # Option 1: Poll job.get_progress(), job.get_status(), job.get_logs() periodically
-    # Option 2: Provide callbacks on init: on_progress, on_status, on_log, on_finished
+    # Option 2: Provide callbacks on init: on_progress, on_status, on_log, on_finished,
+    #           on_telemetry (throughput/ETA, also polled with job.get_telemetry())
 
 Note: This worker runs shell tools that generally require elevated privileges
 (e.g. `pkexec dd ...`, `parted`, `mkfs.*`). Running these will prompt for
@@ -36,9 +78,64 @@ import subprocess
 import tempfile
 import threading
 import time
-from typing import Callable, List, Optional, Tuple
-
-__all__ = ["FlashJob"]
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .blockdev import BdiDirtyLimit, bdi_name, open_readonly
+from .dd_progress import DdProgress, follow_dd_output
+from .flash_backup import COMPRESSION_AUTO, DEFAULT_ZSTD_LEVEL, BackupEngine
+from .flash_engine import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_BUFFER_SIZE,
+    DEFAULT_FLUSH_WINDOW,
+    DEFAULT_RING_DEPTH,
+    IO_BACKEND_PWRITE,
+    ZERO_MODE_OFF,
+    ZERO_MODE_UNCLEAN,
+    FlashCancelled,
+    FlashEngine,
+    FlashError,
+    can_open_for_writing,
+    dd_block_size_operand,
+    plan_trim,
+)
+from .flash_fanout import DEFAULT_POOL_DEPTH, TARGET_FAILED, FanOutEngine
+from .flash_journal import FlashJournal
+from .flash_verify import FlashVerifier, VerifyMismatch
+from .flash_wipe import (
+    DEFAULT_WIPE_CHUNK,
+    DEFAULT_WIPE_THREADS,
+    WIPE_AUTO,
+    WIPE_DISCARD,
+    WipeEngine,
+)
+from .image_hash import StreamHasher, find_expected_digest
+from .image_source import (
+    COMPRESSED_KINDS,
+    ImageSource,
+    ImageSourceError,
+    detect_image_kind,
+    open_image_source,
+    pump_to_pipe,
+    unpack_image,
+)
+from .priv_helper import (
+    HelperAuthError,
+    HelperDirtyLimit,
+    HelperError,
+    PrivilegedHelper,
+    shared_helper,
+    write_image,
+)
+from .telemetry import FlashTelemetry
+from .throttle import set_io_priority, set_nice
+
+__all__ = ["BackupJob", "FlashJob", "MultiFlashJob", "WipeJob"]
+
+# "/dev/sdb: Zero-filled 67108864 bytes from the offset 0"; `blkdiscard
+# --verbose` prints one such line per interval with the bytes done since.
+_BLKDISCARD_PROGRESS = re.compile(
+    r"(?:Zero-filled|Discarded) (\d+) bytes from the offset"
+)
 
 
 class FlashJob:
@@ -60,19 +157,97 @@ class FlashJob:
         target_drive: str,
         mode: str = "linux",
         partition_scheme: str = "gpt",
+        engine: str = "auto",
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+        ring_depth: int = DEFAULT_RING_DEPTH,
+        block_size: Union[int, str] = DEFAULT_BLOCK_SIZE,
+        flush_window: int = DEFAULT_FLUSH_WINDOW,
+        zero_mode: str = ZERO_MODE_OFF,
+        delta: bool = False,
+        verify: bool = False,
+        hash_algorithms: Iterable[str] = (),
+        resume: bool = False,
+        io_backend: str = IO_BACKEND_PWRITE,
+        helper: Optional[PrivilegedHelper] = None,
+        io_class: Optional[str] = None,
+        io_level: int = 4,
+        nice: Optional[int] = None,
+        bandwidth_limit: int = 0,
+        drop_cache: bool = True,
+        direct_io: bool = False,
+        dirty_limit_ratio: int = 0,
+        trim: bool = False,
         on_progress: Optional[Callable[[int], None]] = None,
         on_status: Optional[Callable[[str], None]] = None,
         on_log: Optional[Callable[[str], None]] = None,
         on_finished: Optional[Callable[[bool, str], None]] = None,
+        on_telemetry: Optional[Callable[[Dict[str, float]], None]] = None,
     ):
         self.iso_path = iso_path
         self.target_drive = target_drive
         self.mode = mode
         self.partition_scheme = partition_scheme
+        # "auto" uses the in-process engine when the target is writable and
+        # the privileged helper otherwise, "native" always uses the engine,
+        # "helper" always uses the helper and "dd" always uses `pkexec dd`.
+        self.engine = engine
+        # Size of each pipeline buffer and number of buffers in the ring
+        # shared by the engine's reader and writer threads.
+        self.buffer_size = buffer_size
+        self.ring_depth = ring_depth
+        # Bytes per write, or "auto" to tune it on the target device.
+        self.block_size = block_size
+        # Bytes written between writeback flushes of the target (0 = only at the end).
+        self.flush_window = flush_window
+        # How all-zero source blocks are handled: "off" writes them,
+        # "zeroout"/"discard" use device ioctls, "unclean" leaves them alone.
+        self.zero_mode = zero_mode
+        # Re-flash mode: compare with the target and only rewrite differences.
+        self.delta = delta
+        # Read the target back after writing and compare it with the image.
+        self.verify = verify
+        # With verification the write phase ends at 60% instead of 90%.
+        self._write_progress_end = 60 if verify else 90
+        # Digests computed while writing (e.g. "sha256", "sha1", "md5").
+        # SHA-256 is added when a checksum file for the image is found.
+        self.hash_algorithms = [a.lower().replace("-", "") for a in hash_algorithms]
+        # (algorithm, expected digest, checksum file) found next to the image.
+        self._expected_digest: Optional[Tuple[str, str, str]] = None
+        # Continue an interrupted in-process flash from its journal.
+        self.resume = resume
+        # In-process I/O backend: "pwrite", "uring", "zerocopy" or "auto"
+        # (the first of zerocopy/uring that suits the image and the system).
+        self.io_backend = io_backend
+        # Privileged helper to use instead of the session's shared one.
+        self.helper = helper
+        # Scheduling of the job's thread (and the threads/processes it starts):
+        # I/O class ("idle", "best-effort", "realtime") and level (0-7), CPU
+        # nice level, and a cap on the write rate in bytes/s (0 = no cap).
+        self.io_class = io_class
+        self.io_level = io_level
+        self.nice = nice
+        self.bandwidth_limit = bandwidth_limit
+        # Keep the page cache used by the in-process engine bounded.
+        self.drop_cache = drop_cache
+        # Write aligned blocks with O_DIRECT: progress follows the device and
+        # there is no dirty backlog left for the final flush.
+        self.direct_io = direct_io
+        # Cap on the target disk's dirty pages while the job runs, in percent
+        # of the global dirty threshold (0 = leave the limits alone).
+        self.dirty_limit_ratio = dirty_limit_ratio
+        # Write only the partition table, the partitions and the backup GPT
+        # of raw images (in-process engine only).
+        self.trim = trim
+        self._dirty_limits: List[BdiDirtyLimit] = []
+        self._dirty_cap: Optional[int] = None
+        self._over_dirty_cap = False
 
         self._thread: Optional[threading.Thread] = None
         self._stop_event = threading.Event()
         self._process: Optional[subprocess.Popen] = None
+        self._engine: Optional[FlashEngine] = None
+        # Ranges the helper path skipped with `trim` (the engine keeps its own).
+        self._trim_ranges: List[Tuple[int, int]] = []
 
         # Internal state (protected by _lock)
         self._lock = threading.Lock()
@@ -82,12 +257,20 @@ class FlashJob:
         self._finished: bool = False
         self._success: bool = False
         self._finished_message: Optional[str] = None
+        self._byte_counts: Dict[str, int] = {}
+        self._verify_result: Dict[str, object] = {}
+        self._digests: Dict[str, str] = {}
+        self._checksum_result: Dict[str, object] = {}
+        # Throughput/ETA of the write phase; sampled from the progress callbacks.
+        self._telemetry = FlashTelemetry()
+        self._telemetry_snapshot: Dict[str, float] = {}
 
         # Optional callbacks (invoked under the lock when set)
         self._on_progress = on_progress
         self._on_status = on_status
         self._on_log = on_log
         self._on_finished = on_finished
+        self._on_telemetry = on_telemetry
 
     # ---- Public / Polling-friendly getters ----
     def get_progress(self) -> int:
@@ -114,6 +297,61 @@ class FlashJob:
         with self._lock:
             return self._finished_message
 
+    def get_byte_counts(self) -> Dict[str, int]:
+        """
+        Byte counters of the in-process engine: "done", "written", "skipped",
+        "trimmed" (slack or unmapped blocks not written), "cache_peak" (estimated peak
+        page cache use) and, in delta mode, "compared" and "rewritten".
+        Empty for other paths.
+        """
+        with self._lock:
+            return dict(self._byte_counts)
+
+    def get_digests(self) -> Dict[str, str]:
+        """Hex digests of the image by algorithm; empty until the write completed."""
+        with self._lock:
+            return dict(self._digests)
+
+    def get_checksum_result(self) -> Dict[str, object]:
+        """
+        Outcome of the checksum file check: "algorithm", "expected", "actual",
+        "file" and "match". Empty when no checksum file was found.
+        """
+        with self._lock:
+            return dict(self._checksum_result)
+
+    def get_telemetry(self) -> Dict[str, float]:
+        """
+        Write-phase telemetry (see `FlashTelemetry.snapshot`): "rate" and
+        "avg_rate" (instantaneous and smoothed bytes/s), "mean_rate",
+        "elapsed" and "eta" (seconds), "written", "done" and "total". Empty
+        until the write phase started.
+        """
+        with self._lock:
+            return dict(self._telemetry_snapshot)
+
+    def get_verify_result(self) -> Dict[str, object]:
+        """
+        Outcome of the verify phase: "verified" (bytes), "seconds",
+        "throughput" (bytes/s), "direct" (O_DIRECT reads) and
+        "mismatch_offset" (None when the target matches), or only "skipped"
+        (the reason) when verification was asked for but could not run.
+        Empty when no verification ran.
+        """
+        with self._lock:
+            return dict(self._verify_result)
+
+    def find_resume_offset(self) -> int:
+        """
+        Offset from which an interrupted flash of this image onto this target
+        can be resumed, or 0. Requires a matching journal and that the first
+        and the last chunk already written on the target match the image.
+        """
+        journal = self._open_journal()
+        if journal is None:
+            return 0
+        return self._resume_offset(journal)
+
     # ---- Control methods ----
     def start(self) -> None:
         """Start the job in a background thread."""
@@ -151,6 +389,26 @@ class FlashJob:
             except Exception:
                 pass
 
+    def _start_telemetry(self) -> None:
+        self._telemetry.start()
+        with self._lock:
+            self._telemetry_snapshot = {}
+
+    def _update_telemetry(
+        self, done: int, total: int, written: Optional[int] = None
+    ) -> None:
+        if not self._telemetry.update(done, total, written):
+            return
+        snapshot = self._telemetry.snapshot()
+        with self._lock:
+            self._telemetry_snapshot = snapshot
+            cb = self._on_telemetry
+        if cb:
+            try:
+                cb(dict(snapshot))
+            except Exception:
+                pass
+
     def _set_status(self, text: str) -> None:
         with self._lock:
             self._status = text
@@ -192,9 +450,25 @@ class FlashJob:
     def _should_stop(self) -> bool:
         return self._stop_event.is_set()
 
+    def _is_busy(self, path: str) -> bool:
+        # `fuser -m` on a regular file lists every process on its filesystem.
+        if os.path.isfile(path):
+            return False
+        try:
+            result = subprocess.run(
+                ["fuser", "-m", path], capture_output=True, text=True, timeout=3
+            )
+        except Exception:
+            return False
+        if result.returncode == 0 and result.stdout.strip():
+            self._log(f"{path} busy - PIDs: {result.stdout.strip()}")
+            return True
+        return False
+
     # ---- Run logic ----
     def _run(self) -> None:
         try:
+            self._apply_scheduling()
             if self.mode == "windows":
                 self._flash_windows()
             else:
@@ -204,6 +478,7 @@ class FlashJob:
             self._log(f"Unexpected error: {e}")
             self._finish(False, f"Flash failed: {e}")
         finally:
+            self._restore_dirty_limits()
             # Ensure subprocess is terminated if stop requested
             if self._process:
                 try:
@@ -213,6 +488,75 @@ class FlashJob:
                     pass
                 self._process = None
 
+    def _apply_scheduling(self) -> None:
+        """Apply the I/O priority and nice level to the job's thread."""
+        if self.io_class:
+            try:
+                set_io_priority(self.io_class, self.io_level)
+                level = "" if self.io_class == "idle" else f", level {self.io_level}"
+                self._log(f"I/O priority: {self.io_class}{level}")
+            except (OSError, ValueError) as e:
+                self._log(f"Could not set I/O priority: {e}")
+        if self.nice is not None:
+            try:
+                set_nice(self.nice)
+                self._log(f"CPU nice level: {self.nice}")
+            except (OSError, ValueError) as e:
+                self._log(f"Could not set nice level: {e}")
+
+    def _target_paths(self) -> List[str]:
+        return [self.target_drive]
+
+    def _apply_dirty_limits(self, helper: Optional[PrivilegedHelper] = None) -> None:
+        """
+        Cap the dirty pages of the targets' disks (see `BdiDirtyLimit`),
+        through `helper` when the job writes through it (the sysfs files
+        need root).
+        """
+        if not self.dirty_limit_ratio:
+            return
+        names = dict.fromkeys(filter(None, map(bdi_name, self._target_paths())))
+        if not names:
+            self._log("Dirty limit: no backing device found for the target")
+        for name in names:
+            limit = (
+                BdiDirtyLimit(name, self.dirty_limit_ratio)
+                if helper is None
+                else HelperDirtyLimit(helper, name, self.dirty_limit_ratio)
+            )
+            try:
+                limit.apply()
+            except (OSError, ValueError) as e:
+                limit.restore()
+                self._log(f"Could not cap dirty pages of BDI {name}: {e}")
+                continue
+            self._dirty_limits.append(limit)
+            cap = limit.cap_bytes
+            self._dirty_cap = cap
+            self._log(
+                f"Dirty limit: BDI {name} capped at {self.dirty_limit_ratio}% "
+                "of the dirty threshold"
+                + (f" ({cap / (1024**2):.0f} MiB)" if cap is not None else "")
+            )
+
+    def _restore_dirty_limits(self) -> None:
+        for limit in self._dirty_limits:
+            limit.restore()
+            self._log(f"Dirty limit: restored the limits of BDI {limit.name}")
+        self._dirty_limits = []
+
+    def _check_dirty_cap(self, dirty: int) -> None:
+        """Log when the job holds more dirty data than the BDI cap allows."""
+        if self._dirty_cap is None:
+            return
+        over = dirty > self._dirty_cap
+        if over and not self._over_dirty_cap:
+            self._log(
+                f"Dirty data for the target ({dirty / (1024**2):.0f} MiB) exceeds "
+                f"the cap ({self._dirty_cap / (1024**2):.0f} MiB)"
+            )
+        self._over_dirty_cap = over
+
     # ---- Linux (dd) flow ----
     def _flash_linux(self) -> None:
         self._set_status("Preparing to flash...")
@@ -230,33 +574,65 @@ class FlashJob:
         self._set_progress(5)
         time.sleep(0.5)
 
-        # Check device busy via fuser (best-effort)
-        try:
-            result = subprocess.run(
-                ["fuser", "-m", self.target_drive],
-                capture_output=True,
-                text=True,
-                timeout=3,
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                self._log(f"Device busy - PIDs: {result.stdout.strip()}")
-                self._finish(False, "Device is busy or mounted")
-                return
-        except Exception:
-            # If fuser isn't available or fails, continue
-            pass
+        if self._is_busy(self.target_drive):
+            self._finish(False, "Device is busy or mounted")
+            return
 
+        self._find_checksum()
         self._set_progress(10)
+
+        if self._use_native_engine():
+            self._apply_dirty_limits()
+            self._flash_linux_native()
+            return
+
+        try:
+            helper = self._get_helper()
+        except HelperAuthError as e:
+            self._log(f"Privileged helper: {e}")
+            self._finish(False, "Authentication failed")
+            return
+        if helper is not None:
+            self._apply_dirty_limits(helper)
+            self._flash_linux_helper(helper)
+            return
+
+        self._apply_dirty_limits()
         self._set_status("Starting dd operation...")
+        if self.bandwidth_limit:
+            self._log("The bandwidth cap does not apply to dd")
+
+        # dd cannot decompress or hash: in those cases it reads the image
+        # from its stdin, fed by a thread that decodes and hashes it.
+        source: Optional[ImageSource] = None
+        hasher: Optional[StreamHasher] = None
+        feeder: Optional[threading.Thread] = None
+        compressed = detect_image_kind(self.iso_path) in COMPRESSED_KINDS
+        if compressed or self.hash_algorithms:
+            try:
+                source = open_image_source(self.iso_path)
+            except (OSError, ImageSourceError) as e:
+                self._log(f"Cannot open image: {e}")
+                self._finish(False, f"Cannot open image: {e}")
+                return
+            if compressed:
+                self._log(f"Decompressing {source.kind} image into dd")
+            if self.hash_algorithms:
+                hasher = StreamHasher(self.hash_algorithms)
 
         cmd = [
             "pkexec",
             "dd",
-            f"if={self.iso_path}",
+            *(
+                [f"if={self.iso_path}"]
+                if source is None
+                else ["iflag=fullblock"]  # reading from a pipe
+            ),
             f"of={self.target_drive}",
-            "bs=4M",
+            dd_block_size_operand(self.block_size, self.target_drive),
             "status=progress",
-            "oflag=sync",
+            "oflag=direct",
+            "conv=fsync",
         ]
 
         self._log(f"Command: {' '.join(cmd)}")
@@ -264,82 +640,62 @@ class FlashJob:
         try:
             process = subprocess.Popen(
                 cmd,
+                stdin=subprocess.PIPE if source is not None else None,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True,
             )
             self._process = process
+            self._start_telemetry()
+            if source is not None:
+                feeder = threading.Thread(
+                    target=pump_to_pipe,
+                    args=(source, process.stdin, self._should_stop),
+                    kwargs={"hasher": hasher},
+                    daemon=True,
+                )
+                feeder.start()
             stdout = process.stdout
             if stdout is None:
                 self._log("Flash process started without stdout - aborting")
                 self._finish(False, "Flash process started without stdout")
                 return
 
-            progress_value = 10
-            while True:
-                if self._should_stop():
-                    try:
-                        process.terminate()
-                        process.wait(timeout=3)
-                    except Exception:
-                        pass
-                    self._log("Flash operation cancelled")
-                    self._finish(False, "Flash cancelled")
-                    return
-
-                line = stdout.readline()
-                if line:
-                    line = line.strip()
-                    self._log(line)
-
-                    # Parse dd progress output for 'bytes' copied
-                    if "bytes" in line.lower() and iso_size > 0:
-                        try:
-                            match = re.search(r"(\d+)\s+bytes", line)
-                            if match:
-                                bytes_copied = int(match.group(1))
-                                percentage = (bytes_copied / iso_size) * 80 + 10
-                                progress_value = min(int(percentage), 90)
-                                self._set_progress(progress_value)
-
-                                if "copied" in line.lower():
-                                    self._set_status(
-                                        f"Copying... {bytes_copied / (1024**3):.2f} GB / {iso_size / (1024**3):.2f} GB"
-                                    )
-                        except Exception:
-                            # parsing problem: fallback to incremental updates
-                            if "copied" in line.lower():
-                                progress_value = min(progress_value + 2, 90)
-                                self._set_progress(progress_value)
-                    elif "copied" in line.lower():
-                        # fallback
-                        progress_value = min(progress_value + 2, 90)
-                        self._set_progress(progress_value)
-
-                elif process.poll() is not None:
-                    break
-
-                # Throttle loop to yield CPU
-                time.sleep(0.1)
+            # Progress updates go to the progress bar, everything else to the log.
+            completed = follow_dd_output(
+                stdout.fileno(),
+                on_progress=lambda record: self._on_dd_progress(
+                    record, source, iso_size
+                ),
+                on_message=self._log,
+                should_stop=self._should_stop,
+            )
+            if not completed:
+                try:
+                    process.terminate()
+                    process.wait(timeout=3)
+                except Exception:
+                    pass
+                self._log("Flash operation cancelled")
+                self._finish(False, "Flash cancelled")
+                return
 
             return_code = process.wait()
 
             if return_code == 0:
-                self._set_progress(95)
-                self._set_status("Syncing filesystem...")
-                self._log("Running final sync...")
-
-                try:
-                    subprocess.run(["sync"], timeout=30, check=True)
-                    time.sleep(1)
-                except Exception as e:
-                    self._log(f"Sync warning: {e}")
-
-                self._set_progress(100)
-                self._set_status("Flash completed successfully!")
-                self._finish(True, "Flash completed successfully!")
+                # dd already flushed the target itself (conv=fsync); no
+                # host-wide sync that would stall every other disk.
+                self._log("Target flushed by dd (conv=fsync)")
+                if hasher is not None and feeder is not None:
+                    feeder.join()
+                    digests = hasher.finish()
+                    hasher = None
+                    for name, digest in digests.items():
+                        self._log(f"{name.upper()}: {digest}")
+                    if not self._check_digests(digests):
+                        return
+                if self.verify and not self._verify_target():
+                    return
+                self._complete_flash()
             else:
                 self._finish(False, f"dd command failed with exit code {return_code}")
 
@@ -349,6 +705,453 @@ class FlashJob:
             self._finish(False, f"Flash failed: {e}")
         finally:
             self._process = None
+            if feeder is not None:
+                feeder.join(timeout=5)
+            if hasher is not None:
+                hasher.abort()
+            if source is not None:
+                source.close()
+
+    def _on_dd_progress(
+        self, record: DdProgress, source: Optional[ImageSource], iso_size: int
+    ) -> None:
+        if iso_size <= 0:
+            return
+        copied = record.bytes_copied
+        done, total = (
+            source.progress(copied) if source is not None else (copied, iso_size)
+        )
+        if total <= 0:
+            return
+        self._update_telemetry(done, total, copied)
+        end = self._write_progress_end
+        self._set_progress(min(int((done / total) * (end - 10) + 10), end))
+        rate = f"{record.rate / (1024**2):.1f} MB/s"
+        self._set_status(
+            f"Copying... {copied / (1024**3):.2f} GB / {total / (1024**3):.2f} GB ({rate})"
+            if source is None or source.size
+            else f"Copying... {copied / (1024**3):.2f} GB written, "
+            f"{done * 100 // total}% of compressed image read ({rate})"
+        )
+
+    def _use_native_engine(self) -> bool:
+        if self.engine == "native":
+            return True
+        if self.engine in ("dd", "helper"):
+            return False
+        return can_open_for_writing(self.target_drive)
+
+    def _get_helper(self) -> Optional[PrivilegedHelper]:
+        """
+        The privileged helper for this job, or None when `pkexec` should be
+        used directly. Raises HelperAuthError when the user did not
+        authenticate.
+        """
+        if self.engine not in ("auto", "helper"):
+            return None
+        if self.helper is not None:
+            return self.helper
+        try:
+            return shared_helper()
+        except HelperAuthError:
+            raise
+        except HelperError as e:
+            self._log(f"Privileged helper unavailable ({e}), using pkexec")
+            return None
+
+    def _flash_linux_helper(self, helper: PrivilegedHelper) -> None:
+        self._set_status("Writing image...")
+        self._log("Using the privileged helper")
+        self._start_telemetry()
+        try:
+            if self.trim:
+                with open_image_source(self.iso_path) as source:
+                    self._trim_ranges = plan_trim(source, self._log).ranges
+            digests = write_image(
+                helper,
+                self.iso_path,
+                self.target_drive,
+                hash_algorithms=self.hash_algorithms,
+                flush_window=self.flush_window,
+                bandwidth_limit=self.bandwidth_limit,
+                skip_ranges=self._trim_ranges,
+                on_progress=self._on_helper_progress,
+                on_log=self._log,
+                should_stop=self._should_stop,
+            )
+        except InterruptedError:
+            self._log("Flash operation cancelled")
+            self._finish(False, "Flash cancelled")
+            return
+        except (HelperError, ImageSourceError, OSError) as e:
+            self._log(f"Privileged helper error: {e}")
+            self._finish(False, f"Flash failed: {e}")
+            return
+
+        self._log(f"Target {self.target_drive} flushed by the helper")
+        if self._trim_ranges:
+            with self._lock:
+                self._byte_counts = {
+                    "trimmed": sum(end - start for start, end in self._trim_ranges)
+                }
+        for name, digest in digests.items():
+            self._log(f"{name.upper()}: {digest}")
+        if not self._check_digests(digests):
+            return
+        if self.verify and not self._verify_target():
+            return
+        self._complete_flash()
+
+    def _on_helper_progress(self, done: int, total: int, written: int) -> None:
+        if total <= 0:
+            return
+        self._update_telemetry(done, total, written)
+        end = self._write_progress_end
+        self._set_progress(min(int((done / total) * (end - 10) + 10), end))
+        self._set_status(
+            f"Copying... {written / (1024**3):.2f} GB / {total / (1024**3):.2f} GB"
+            if done == written
+            else f"Copying... {written / (1024**3):.2f} GB written, "
+            f"{done * 100 // total}% of compressed image read"
+        )
+
+    def _flash_linux_native(self) -> None:
+        self._set_status("Writing image...")
+        self._log("Using in-process write engine")
+
+        journal = self._open_journal()
+        start_offset = 0
+        if self.resume and journal is not None:
+            start_offset = self._resume_offset(journal)
+            if not start_offset:
+                self._log("Nothing to resume, writing the whole image")
+
+        engine = FlashEngine(
+            self.iso_path,
+            self.target_drive,
+            buffer_size=self.buffer_size,
+            ring_depth=self.ring_depth,
+            block_size=self.block_size,
+            flush_window=self.flush_window,
+            zero_mode=self.zero_mode,
+            delta=self.delta,
+            hash_algorithms=self.hash_algorithms,
+            start_offset=start_offset,
+            journal=journal,
+            io_backend=self.io_backend,
+            bandwidth_limit=self.bandwidth_limit,
+            drop_cache=self.drop_cache,
+            direct_io=self.direct_io,
+            trim=self.trim,
+            on_progress=self._on_engine_progress,
+            on_log=self._log,
+            should_stop=self._should_stop,
+        )
+        self._engine = engine
+        self._start_telemetry()
+        try:
+            with engine:
+                engine.copy()
+                self._set_progress(self._write_progress_end + 5)
+                self._set_status("Syncing device...")
+                self._log("Flushing target device...")
+                engine.sync()
+        except FlashCancelled:
+            self._save_journal(journal, engine)
+            self._log("Flash operation cancelled")
+            self._finish(False, "Flash cancelled")
+            return
+        except (FlashError, OSError) as e:
+            self._save_journal(journal, engine)
+            self._log(f"Write engine error: {e}")
+            self._finish(False, f"Flash failed: {e}")
+            return
+
+        if journal is not None:
+            journal.remove()
+        self._log(
+            f"Wrote {engine.bytes_written} bytes to {self.target_drive}, "
+            f"skipped {engine.bytes_skipped} zero bytes"
+        )
+        if engine.cache_advisor is not None:
+            self._log(f"Peak page cache use: {engine.cache_peak / (1024**2):.1f} MiB")
+        if not self._check_digests(engine.digests):
+            return
+        if self.verify and not self._verify_target():
+            return
+        self._complete_flash()
+
+    def _on_engine_progress(self, bytes_done: int, total: int) -> None:
+        engine = self._engine
+        if engine is not None:
+            counts = {
+                "done": engine.bytes_done,
+                "written": engine.bytes_written,
+                "skipped": engine.bytes_skipped,
+                "trimmed": engine.bytes_trimmed,
+                "cache_peak": engine.cache_peak,
+            }
+            if engine.delta:
+                counts["compared"] = engine.bytes_compared
+                counts["rewritten"] = engine.bytes_rewritten
+            with self._lock:
+                self._byte_counts = counts
+            self._check_dirty_cap(engine.dirty_bytes)
+
+        if total <= 0:
+            return
+        self._update_telemetry(
+            bytes_done, total, engine.bytes_done if engine is not None else None
+        )
+        end = self._write_progress_end
+        self._set_progress(min(int((bytes_done / total) * (end - 10) + 10), end))
+        window = (
+            f"flush window {self.flush_window // (1024**2)} MB"
+            if self.flush_window
+            else "flush at end"
+        )
+        if engine is not None and engine.delta:
+            self._set_status(
+                f"Comparing... {engine.bytes_compared / (1024**3):.2f} GB / "
+                f"{total / (1024**3):.2f} GB compared, "
+                f"{engine.bytes_rewritten / (1024**2):.1f} MB rewritten ({window})"
+            )
+            return
+        self._set_status(
+            f"Copying... {bytes_done / (1024**3):.2f} GB / {total / (1024**3):.2f} GB"
+            f" ({window})"
+        )
+
+    # ---- Resume journal ----
+    def _open_journal(self) -> Optional[FlashJournal]:
+        try:
+            return FlashJournal.for_paths(self.iso_path, self.target_drive)
+        except OSError as e:
+            self._log(f"Flash journal disabled: {e}")
+            return None
+
+    def _save_journal(
+        self, journal: Optional[FlashJournal], engine: FlashEngine
+    ) -> None:
+        if journal is None or engine.flusher is None:
+            return
+        journal.update(engine.flusher.durable_offset, force=True)
+        if journal.durable_offset:
+            self._log(
+                f"Journal: {journal.durable_offset} bytes are on the target; "
+                "the flash can be resumed"
+            )
+
+    def _resume_offset(self, journal: FlashJournal) -> int:
+        offset = journal.load()
+        if not offset:
+            return 0
+        try:
+            ok = self._written_chunks_match(offset)
+        except (OSError, ImageSourceError, EOFError) as e:
+            self._log(f"Cannot check the target for resuming: {e}")
+            ok = False
+        if not ok:
+            self._log(
+                f"Journal offset {offset} does not match the target's contents; "
+                "not resuming"
+            )
+            return 0
+        self._log(f"Resuming from byte {offset} (first and last chunks match)")
+        return offset
+
+    def _written_chunks_match(self, offset: int) -> bool:
+        """Compare the first and the last chunk before `offset` on the target with the image."""
+        chunk = min(self.buffer_size, offset)
+        ranges = [(0, chunk)]
+        if offset > chunk:
+            ranges.append(
+                (max(chunk, offset - chunk), offset - max(chunk, offset - chunk))
+            )
+
+        fd = os.open(self.target_drive, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+        try:
+            # Read what is on the device, not what is still in the page cache.
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except (AttributeError, OSError):
+                pass
+            with open_image_source(self.iso_path) as source:
+                position = 0
+                for start, length in ranges:
+                    if source.skip(start - position) != start - position:
+                        return False
+                    expected = bytearray(length)
+                    got = 0
+                    with memoryview(expected) as view:
+                        while got < length:
+                            n = source.readinto(view[got:])
+                            if not n:
+                                return False
+                            got += n
+                    if os.pread(fd, length, start) != bytes(expected):
+                        return False
+                    position = start + length
+        finally:
+            os.close(fd)
+        return True
+
+    # ---- Checksums ----
+    def _find_checksum(self) -> None:
+        """Look for a checksum file next to the image and make sure its digest is computed."""
+        try:
+            with open_image_source(self.iso_path) as source:
+                name = source.name
+        except (OSError, ImageSourceError):
+            return
+        # SHA-256 first, then any other requested algorithm.
+        for algorithm in dict.fromkeys(["sha256"] + self.hash_algorithms):
+            try:
+                found = find_expected_digest(self.iso_path, algorithm, name=name)
+            except ValueError:
+                continue
+            if found is None:
+                continue
+            digest, path = found
+            self._expected_digest = (algorithm, digest, path)
+            if algorithm not in self.hash_algorithms:
+                self.hash_algorithms.append(algorithm)
+            self._log(
+                f"Found {algorithm.upper()} of {name} in {os.path.basename(path)}; "
+                "it will be checked while writing"
+            )
+            return
+
+    def _check_digests(self, digests: Dict[str, str]) -> bool:
+        """Store the digests and check them; returns False after finishing the job on a mismatch."""
+        with self._lock:
+            self._digests = dict(digests)
+        if self._expected_digest is None:
+            return True
+
+        algorithm, expected, path = self._expected_digest
+        actual = digests.get(algorithm)
+        if actual is None:
+            return True
+        match = actual == expected
+        with self._lock:
+            self._checksum_result = {
+                "algorithm": algorithm,
+                "expected": expected,
+                "actual": actual,
+                "file": path,
+                "match": match,
+            }
+        if match:
+            self._log(f"{algorithm.upper()} matches {os.path.basename(path)}")
+            return True
+        self._log(
+            f"{algorithm.upper()} mismatch: expected {expected}, image has {actual}"
+        )
+        self._finish(
+            False,
+            f"Checksum mismatch: the image does not match {os.path.basename(path)}",
+        )
+        return False
+
+    # ---- Verification ----
+    def _verify_target(self) -> bool:
+        """Run the verify phase (70-95%); returns False after finishing the job on failure."""
+        if self.zero_mode == ZERO_MODE_UNCLEAN and self._use_native_engine():
+            self._skip_verify(
+                "zero_mode 'unclean' leaves old data where the image has zeros"
+            )
+            return True
+        opener = open_readonly
+        if not os.access(self.target_drive, os.R_OK):
+            # The target is read back through a descriptor the helper opens.
+            try:
+                helper = self._get_helper()
+            except HelperAuthError as e:
+                self._log(f"Privileged helper: {e}")
+                helper = None
+            if helper is None:
+                self._skip_verify(
+                    f"{self.target_drive} is not readable without elevated privileges"
+                )
+                return True
+            self._log("Reading the target back through the privileged helper")
+            opener = helper.open_read
+
+        self._set_progress(70)
+        self._set_status("Verifying...")
+        verifier = FlashVerifier(
+            self.iso_path,
+            self.target_drive,
+            buffer_size=self.buffer_size,
+            skip_ranges=(
+                self._engine.trim_ranges
+                if self._engine is not None
+                else self._trim_ranges
+            ),
+            opener=opener,
+            on_progress=lambda done, total: self._on_verify_progress(
+                verifier, done, total
+            ),
+            on_log=self._log,
+            should_stop=self._should_stop,
+        )
+        try:
+            verifier.run()
+        except FlashCancelled:
+            self._log("Verification cancelled")
+            self._finish(False, "Verification cancelled")
+            return False
+        except VerifyMismatch as e:
+            self._store_verify_result(verifier)
+            self._log(f"Verification failed: {e}")
+            self._finish(False, f"Verification failed: {e}")
+            return False
+        except FlashError as e:
+            self._log(str(e))
+            self._finish(False, str(e))
+            return False
+
+        self._store_verify_result(verifier)
+        return True
+
+    def _skip_verify(self, reason: str) -> None:
+        self._log(f"Skipping verification: {reason}")
+        with self._lock:
+            self._verify_result = {"skipped": reason}
+
+    def _complete_flash(self) -> None:
+        """Finish a successful flash, saying so when the asked-for verify was skipped."""
+        skipped = self.get_verify_result().get("skipped")
+        message = (
+            f"Flash completed, but not verified: {skipped}"
+            if skipped
+            else "Flash completed successfully!"
+        )
+        self._set_progress(100)
+        self._set_status(message)
+        self._finish(True, message)
+
+    def _on_verify_progress(
+        self, verifier: FlashVerifier, bytes_done: int, total: int
+    ) -> None:
+        if total <= 0:
+            return
+        self._set_progress(min(int((bytes_done / total) * 25 + 70), 95))
+        self._set_status(
+            f"Verifying... {verifier.bytes_verified / (1024**3):.2f} GB "
+            f"({verifier.throughput / (1024**2):.1f} MB/s)"
+        )
+
+    def _store_verify_result(self, verifier: FlashVerifier) -> None:
+        with self._lock:
+            self._verify_result = {
+                "verified": verifier.bytes_verified,
+                "seconds": verifier.seconds,
+                "throughput": verifier.throughput,
+                "direct": verifier.direct,
+                "mismatch_offset": verifier.mismatch_offset,
+            }
 
     # ---- Windows flow (script-based) ----
     def _flash_windows(self) -> None:
@@ -363,34 +1166,51 @@ class FlashJob:
 
         self._set_progress(5)
 
-        try:
-            result = subprocess.run(
-                ["fuser", "-m", self.target_drive],
-                capture_output=True,
-                text=True,
-                timeout=3,
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                self._log(f"Device busy - PIDs: {result.stdout.strip()}")
-                self._finish(False, "Device is busy or mounted")
+        if self._is_busy(self.target_drive):
+            self._finish(False, "Device is busy or mounted")
+            return
+
+        # A loop mount needs a plain ISO file; packed images are unpacked first.
+        iso_path = self.iso_path
+        kind = detect_image_kind(iso_path)
+        if kind != "raw":
+            self._set_status("Unpacking ISO...")
+            self._log(f"Unpacking {kind} image before mounting")
+            try:
+                iso_path = unpack_image(
+                    iso_path,
+                    should_stop=self._should_stop,
+                    on_progress=lambda done, total: self._set_progress(
+                        5 + int(done * 5 / max(1, total))
+                    ),
+                )
+            except (OSError, ImageSourceError) as e:
+                self._log(f"Cannot unpack image: {e}")
+                self._finish(False, f"Cannot unpack image: {e}")
                 return
-        except Exception:
-            pass
+            self._log(f"Unpacked to {iso_path}")
 
         drive = self.target_drive
         iso_mount = "/mnt/justdd_iso"
 
         if self.partition_scheme == "mbr":
-            steps = self._windows_mbr_steps(drive, iso_mount)
+            steps = self._windows_mbr_steps(drive, iso_path, iso_mount)
             scheme_name = "MBR (BIOS)"
         else:
-            steps = self._windows_gpt_steps(drive, iso_mount)
+            steps = self._windows_gpt_steps(drive, iso_path, iso_mount)
             scheme_name = "GPT (UEFI)"
 
-        self._execute_windows_script(steps, drive, scheme_name)
+        try:
+            self._execute_windows_script(steps, drive, scheme_name)
+        finally:
+            if iso_path != self.iso_path:
+                try:
+                    os.unlink(iso_path)
+                except OSError:
+                    pass
 
     def _windows_gpt_steps(
-        self, drive: str, iso_mount: str
+        self, drive: str, iso_path: str, iso_mount: str
     ) -> List[Tuple[str, int, List[str]]]:
         p1, p2 = f"{drive}1", f"{drive}2"
         return [
@@ -433,7 +1253,7 @@ class FlashJob:
                 45,
                 ["mkdir", "-p", iso_mount, "/mnt/justdd_vfat", "/mnt/justdd_ntfs"],
             ),
-            ("Mounting ISO", 50, ["mount", "-o", "loop", self.iso_path, iso_mount]),
+            ("Mounting ISO", 50, ["mount", "-o", "loop", iso_path, iso_mount]),
             ("Mounting BOOT partition", 55, ["mount", p1, "/mnt/justdd_vfat"]),
             (
                 "Copying boot files",
@@ -488,7 +1308,7 @@ class FlashJob:
         ]
 
     def _windows_mbr_steps(
-        self, drive: str, iso_mount: str
+        self, drive: str, iso_path: str, iso_mount: str
     ) -> List[Tuple[str, int, List[str]]]:
         p1 = f"{drive}1"
         return [
@@ -525,7 +1345,7 @@ class FlashJob:
                 45,
                 ["mkdir", "-p", iso_mount, "/mnt/justdd_ntfs"],
             ),
-            ("Mounting ISO", 50, ["mount", "-o", "loop", self.iso_path, iso_mount]),
+            ("Mounting ISO", 50, ["mount", "-o", "loop", iso_path, iso_mount]),
             ("Mounting Windows partition", 55, ["mount", p1, "/mnt/justdd_ntfs"]),
             (
                 "Copying Windows files (this takes a long time)",
@@ -556,7 +1376,8 @@ class FlashJob:
         self, steps: List[Tuple[str, int, List[str]]], drive: str, scheme_name: str
     ) -> None:
         """
-        Create a temporary bash script that runs the ordered steps and run it via pkexec.
+        Create a temporary bash script that runs the ordered steps and run it in
+        the privileged helper (or via pkexec when the helper is unavailable).
         The script prints "Step i/N: Description" lines which we parse to update progress.
         """
         try:
@@ -742,6 +1563,19 @@ class FlashJob:
 
             cancel_file = f"/tmp/justdd_cancel_{os.getpid()}"
 
+            try:
+                helper = self._get_helper()
+            except HelperAuthError as e:
+                self._log(f"Privileged helper: {e}")
+                self._finish(False, "Authentication failed")
+                self._remove_script(script_path)
+                return
+            if helper is not None:
+                self._run_windows_script_in_helper(
+                    helper, script_path, steps, cancel_file, scheme_name
+                )
+                return
+
             # Launch via pkexec; capture combined stdout/stderr
             try:
                 self._process = subprocess.Popen(
@@ -793,20 +1627,7 @@ class FlashJob:
 
                 line = stdout.readline()
                 if line:
-                    line = line.strip()
-                    self._log(line)
-
-                    if line.startswith("Step "):
-                        try:
-                            step_info = line.split(": ", 1)
-                            if len(step_info) > 1:
-                                step_num = int(step_info[0].split()[1].split("/")[0])
-                                if 1 <= step_num <= len(steps):
-                                    progress_val = steps[step_num - 1][1]
-                                    self._set_progress(progress_val)
-                                    self._set_status(step_info[1])
-                        except Exception:
-                            pass
+                    self._on_script_line(line, steps)
                 elif self._process.poll() is not None:
                     break
 
@@ -845,3 +1666,529 @@ class FlashJob:
             self._finish(False, f"Error executing Windows USB script: {e}")
         finally:
             self._process = None
+
+    def _run_windows_script_in_helper(
+        self,
+        helper: PrivilegedHelper,
+        script_path: str,
+        steps: List[Tuple[str, int, List[str]]],
+        cancel_file: str,
+        scheme_name: str,
+    ) -> None:
+        def should_stop() -> bool:
+            if not self._should_stop():
+                return False
+            # Let the script stop at its next check before it is terminated.
+            try:
+                with open(cancel_file, "w") as f:
+                    f.write("cancel")
+            except Exception as e:
+                self._log(f"Failed to write cancel file: {e}")
+            return True
+
+        try:
+            return_code = helper.run(
+                ["bash", script_path],
+                on_output=lambda line: self._on_script_line(line, steps),
+                should_stop=should_stop,
+            )
+        except HelperError as e:
+            self._log(f"Privileged helper error: {e}")
+            self._finish(False, f"Failed to run Windows script: {e}")
+            return
+        finally:
+            self._remove_script(script_path)
+            try:
+                if os.path.exists(cancel_file):
+                    os.unlink(cancel_file)
+            except Exception:
+                pass
+
+        if self._should_stop() or return_code == 130:
+            self._log("Windows USB preparation cancelled")
+            self._finish(False, "Windows USB preparation cancelled")
+        elif return_code == 0:
+            self._set_progress(100)
+            self._set_status(f"Windows USB preparation completed ({scheme_name})!")
+            self._finish(True, f"Windows USB created successfully with {scheme_name}!")
+        else:
+            self._finish(False, f"Windows script failed with exit code {return_code}")
+
+    def _on_script_line(
+        self, line: str, steps: List[Tuple[str, int, List[str]]]
+    ) -> None:
+        line = line.strip()
+        self._log(line)
+
+        if line.startswith("Step "):
+            try:
+                step_info = line.split(": ", 1)
+                if len(step_info) > 1:
+                    step_num = int(step_info[0].split()[1].split("/")[0])
+                    if 1 <= step_num <= len(steps):
+                        progress_val = steps[step_num - 1][1]
+                        self._set_progress(progress_val)
+                        self._set_status(step_info[1])
+            except Exception:
+                pass
+
+    @staticmethod
+    def _remove_script(script_path: str) -> None:
+        try:
+            os.unlink(script_path)
+        except Exception:
+            pass
+
+
+class MultiFlashJob(FlashJob):
+    """
+    Duplicator variant of `FlashJob`: writes one image onto several targets
+    with the in-process `FanOutEngine`, reading the source only once.
+
+    Every target must be writable by the current user (there is no `dd`
+    fallback). Targets fail independently: a busy, unplugged or failing stick
+    is reported and the others carry on. The job succeeds only when every
+    target was written. Per-target progress is available through
+    `get_target_progress()`; `get_progress()` is the average over the targets
+    still being written.
+    """
+
+    def __init__(
+        self,
+        iso_path: str,
+        target_drives: Iterable[str],
+        pool_depth: int = DEFAULT_POOL_DEPTH,
+        **kwargs,
+    ):
+        self.target_drives = list(dict.fromkeys(target_drives))
+        super().__init__(
+            iso_path, ", ".join(self.target_drives), mode="linux", **kwargs
+        )
+        # Shared buffers; also the most a slow target may lag behind.
+        self.pool_depth = pool_depth
+        self._targets: Dict[str, Dict[str, object]] = {
+            path: {
+                "target": path,
+                "state": "pending",
+                "progress": 0,
+                "bytes_done": 0,
+                "throughput": 0.0,
+                "error": None,
+            }
+            for path in self.target_drives
+        }
+        self._fan_out: Optional[FanOutEngine] = None
+
+    def get_target_progress(self) -> List[Dict[str, object]]:
+        """
+        One entry per target: "target", "state" ("pending", "writing",
+        "syncing", "done" or "failed"), "progress" (0-100), "bytes_done",
+        "throughput" (bytes/s) and "error".
+        """
+        with self._lock:
+            return [dict(self._targets[path]) for path in self.target_drives]
+
+    def _run(self) -> None:
+        try:
+            self._apply_scheduling()
+            self._apply_dirty_limits()
+            self._flash_fan_out()
+        except Exception as e:
+            self._log(f"Unexpected error: {e}")
+            self._finish(False, f"Flash failed: {e}")
+        finally:
+            self._restore_dirty_limits()
+
+    def _target_paths(self) -> List[str]:
+        return list(self.target_drives)
+
+    def _flash_fan_out(self) -> None:
+        self._set_status("Preparing to flash...")
+        self._log(
+            f"Starting fan-out flash of {self.iso_path} to "
+            f"{len(self.target_drives)} targets"
+        )
+        if self.verify:
+            self._log("Verification is not available in fan-out mode; skipping it")
+
+        targets = []
+        for path in self.target_drives:
+            if self._is_busy(path):
+                self._set_target(path, state=TARGET_FAILED, error="Device is busy")
+            elif not can_open_for_writing(path):
+                self._set_target(path, state=TARGET_FAILED, error="Not writable")
+            else:
+                targets.append(path)
+        if not targets:
+            self._finish(False, "No target can be written")
+            return
+
+        self._find_checksum()
+        self._set_progress(5)
+        self._set_status("Writing image...")
+
+        fan_out = FanOutEngine(
+            self.iso_path,
+            targets,
+            buffer_size=self.buffer_size,
+            pool_depth=self.pool_depth,
+            block_size=self.block_size,
+            flush_window=self.flush_window,
+            zero_mode=self.zero_mode,
+            delta=self.delta,
+            hash_algorithms=self.hash_algorithms,
+            bandwidth_limit=self.bandwidth_limit,
+            on_progress=self._on_target_progress,
+            on_log=self._log,
+            should_stop=self._should_stop,
+        )
+        self._fan_out = fan_out
+        self._start_telemetry()
+        try:
+            with fan_out:
+                fan_out.run()
+        except FlashCancelled:
+            self._update_targets(fan_out)
+            self._log("Flash operation cancelled")
+            self._finish(False, "Flash cancelled")
+            return
+        except FlashError as e:
+            self._update_targets(fan_out)
+            self._log(f"Write engine error: {e}")
+            self._finish(False, f"Flash failed: {e}")
+            return
+        finally:
+            self._fan_out = None
+
+        self._update_targets(fan_out)
+        if not self._check_digests(fan_out.digests):
+            return
+
+        results = self.get_target_progress()
+        failed = [t for t in results if t["state"] == TARGET_FAILED]
+        self._set_progress(100)
+        if failed:
+            details = "; ".join(f"{t['target']}: {t['error']}" for t in failed)
+            message = (
+                f"{len(results) - len(failed)} of {len(results)} targets written "
+                f"(failed: {details})"
+            )
+            self._set_status(message)
+            self._finish(False, message)
+            return
+        message = f"Flash completed successfully on {len(results)} targets!"
+        self._set_status(message)
+        self._finish(True, message)
+
+    def _on_target_progress(self, index: int, bytes_done: int, total: int) -> None:
+        fan_out = self._fan_out
+        if fan_out is None or total <= 0:
+            return
+        target = fan_out.targets[index]
+        self._set_target(
+            target.path,
+            state=target.state,
+            progress=min(int(bytes_done * 100 / total), 100),
+            bytes_done=target.bytes_done,
+            throughput=target.throughput,
+        )
+        with self._lock:
+            live = [
+                t["progress"]
+                for t in self._targets.values()
+                if t["state"] != TARGET_FAILED
+            ]
+        if live:
+            self._set_progress(5 + int(sum(live) / len(live) * 0.9))  # type: ignore[arg-type]
+        # The batch is done when its slowest target is.
+        slowest = min(
+            (t for t in fan_out.targets if not t.failed),
+            key=lambda t: t.bytes_done,
+            default=None,
+        )
+        if slowest is not None and slowest.index == index:
+            self._update_telemetry(bytes_done, total, target.bytes_done)
+
+    def _update_targets(self, fan_out: FanOutEngine) -> None:
+        for target in fan_out.targets:
+            self._set_target(
+                target.path,
+                state=target.state,
+                bytes_done=target.bytes_done,
+                throughput=target.throughput,
+                error=target.error,
+            )
+            if target.state != TARGET_FAILED:
+                self._log(
+                    f"{target.path}: {target.state}, {target.bytes_done} bytes, "
+                    f"{target.throughput / (1024**2):.1f} MB/s"
+                )
+
+    def _set_target(self, path: str, **values: object) -> None:
+        with self._lock:
+            self._targets[path].update(values)
+
+
+class WipeJob(FlashJob):
+    """
+    Background job that erases a whole device (see `WipeEngine`), with the
+    same getters and callbacks as `FlashJob`. `method` is one of
+    `WIPE_METHODS`; "done" in `get_byte_counts()` counts the bytes wiped.
+    Targets the user cannot open are wiped by `blkdiscard` running in the
+    privileged helper.
+    """
+
+    def __init__(
+        self,
+        target_drive: str,
+        method: str = WIPE_AUTO,
+        threads: int = DEFAULT_WIPE_THREADS,
+        **kwargs,
+    ):
+        super().__init__("", target_drive, mode="linux", **kwargs)
+        self.method = method
+        self.threads = threads
+
+    def _run(self) -> None:
+        try:
+            self._apply_scheduling()
+            self._wipe()
+        except Exception as e:
+            self._log(f"Unexpected error: {e}")
+            self._finish(False, f"Wipe failed: {e}")
+        finally:
+            self._restore_dirty_limits()
+
+    def _wipe(self) -> None:
+        self._set_status("Preparing to wipe...")
+        self._log(f"Starting wipe of {self.target_drive} (method: {self.method})")
+        if self._is_busy(self.target_drive):
+            self._finish(False, "Device is busy or mounted")
+            return
+        self._set_progress(5)
+
+        if self.engine != "helper" and can_open_for_writing(self.target_drive):
+            self._apply_dirty_limits()
+            self._wipe_native()
+            return
+        try:
+            helper = self._get_helper()
+        except HelperAuthError as e:
+            self._log(f"Privileged helper: {e}")
+            self._finish(False, "Authentication failed")
+            return
+        if helper is None:
+            self._finish(False, f"Cannot open {self.target_drive} for writing")
+            return
+        self._apply_dirty_limits(helper)
+        self._wipe_in_helper(helper)
+
+    def _wipe_native(self) -> None:
+        self._set_status("Wiping...")
+        engine = WipeEngine(
+            self.target_drive,
+            method=self.method,
+            threads=self.threads,
+            block_size=(
+                self.block_size
+                if isinstance(self.block_size, int)
+                else DEFAULT_BLOCK_SIZE
+            ),
+            on_progress=self._on_wipe_progress,
+            on_log=self._log,
+            should_stop=self._should_stop,
+        )
+        self._start_telemetry()
+        try:
+            with engine:
+                engine.wipe()
+                self._set_status("Syncing device...")
+                engine.sync()
+        except FlashCancelled:
+            self._log("Wipe cancelled")
+            self._finish(False, "Wipe cancelled")
+            return
+        except (FlashError, OSError) as e:
+            self._log(f"Wipe error: {e}")
+            self._finish(False, f"Wipe failed: {e}")
+            return
+        self._wiped()
+
+    def _wipe_in_helper(self, helper: PrivilegedHelper) -> None:
+        self._set_status("Wiping...")
+        self._log("Using blkdiscard in the privileged helper")
+        argv = ["blkdiscard", "--verbose", "--step", str(DEFAULT_WIPE_CHUNK)]
+        if self.method != WIPE_DISCARD:
+            # The kernel writes zeros itself when the device cannot offload it.
+            argv.append("--zeroout")
+        argv.append(self.target_drive)
+        try:
+            handle = helper.open(self.target_drive)
+            helper.close(handle["handle"])
+        except HelperError as e:
+            self._log(f"Privileged helper error: {e}")
+            self._finish(False, f"Wipe failed: {e}")
+            return
+        total = int(handle.get("size") or 0)
+        done = [0]
+
+        def on_output(line: str) -> None:
+            match = _BLKDISCARD_PROGRESS.search(line)
+            if match is None:
+                self._log(line)
+                return
+            done[0] += int(match.group(1))
+            self._on_wipe_progress(done[0], total)
+
+        self._start_telemetry()
+        try:
+            returncode = helper.run(
+                argv, on_output=on_output, should_stop=self._should_stop
+            )
+        except HelperError as e:
+            self._log(f"Privileged helper error: {e}")
+            self._finish(False, f"Wipe failed: {e}")
+            return
+        if self._should_stop():
+            self._log("Wipe cancelled")
+            self._finish(False, "Wipe cancelled")
+            return
+        if returncode != 0:
+            self._finish(False, f"blkdiscard failed with exit code {returncode}")
+            return
+        self._wiped()
+
+    def _wiped(self) -> None:
+        self._set_progress(100)
+        self._set_status("Wipe completed successfully!")
+        self._finish(True, "Wipe completed successfully!")
+
+    def _on_wipe_progress(self, bytes_done: int, total: int) -> None:
+        with self._lock:
+            self._byte_counts = {"done": bytes_done}
+        if total <= 0:
+            return
+        self._update_telemetry(bytes_done, total)
+        self._set_progress(5 + bytes_done * 90 // total)
+        self._set_status(
+            f"Wiping... {bytes_done / (1024**3):.2f} GB / {total / (1024**3):.2f} GB"
+        )
+
+
+class BackupJob(FlashJob):
+    """
+    Background job that reads a device into an image file (see
+    `BackupEngine`), with the same getters and callbacks as `FlashJob`.
+    `get_byte_counts()` holds "done" (bytes read), "written" (bytes in the
+    image file), "sparse" (zero bytes left as holes) and "unmapped" (free
+    bytes not read with `skip_free`); `get_digests()` the digests of the
+    image. A failed or cancelled backup leaves an existing image at
+    `image_path` untouched.
+    """
+
+    def __init__(
+        self,
+        source_drive: str,
+        image_path: str,
+        compression: str = COMPRESSION_AUTO,
+        level: int = DEFAULT_ZSTD_LEVEL,
+        threads: int = 0,
+        skip_free: bool = False,
+        **kwargs,
+    ):
+        super().__init__(image_path, source_drive, mode="linux", **kwargs)
+        self.source_drive = source_drive
+        self.image_path = image_path
+        self.compression = compression
+        self.level = level
+        # Compression workers, 0 = one per CPU.
+        self.threads = threads
+        self.skip_free = skip_free
+        self._backup: Optional[BackupEngine] = None
+
+    def _run(self) -> None:
+        try:
+            self._apply_scheduling()
+            self._back_up()
+        except Exception as e:
+            self._log(f"Unexpected error: {e}")
+            self._finish(False, f"Backup failed: {e}")
+
+    def _back_up(self) -> None:
+        self._set_status("Preparing backup...")
+        self._log(f"Starting backup of {self.source_drive} to {self.image_path}")
+        opener = open_readonly
+        if not os.access(self.source_drive, os.R_OK):
+            # The device is read through a descriptor the helper opens.
+            try:
+                helper = self._get_helper()
+            except HelperAuthError as e:
+                self._log(f"Privileged helper: {e}")
+                self._finish(False, "Authentication failed")
+                return
+            if helper is None:
+                self._finish(False, f"Cannot read {self.source_drive}")
+                return
+            self._log("Reading the device through the privileged helper")
+            opener = helper.open_read
+        self._set_progress(5)
+        self._set_status("Reading device...")
+
+        engine = BackupEngine(
+            self.source_drive,
+            self.image_path,
+            compression=self.compression,
+            level=self.level,
+            threads=self.threads,
+            hash_algorithms=self.hash_algorithms,
+            buffer_size=self.buffer_size,
+            ring_depth=self.ring_depth,
+            skip_free=self.skip_free,
+            opener=opener,
+            on_progress=self._on_backup_progress,
+            on_log=self._log,
+            should_stop=self._should_stop,
+        )
+        self._backup = engine
+        self._start_telemetry()
+        try:
+            with engine:
+                engine.run()
+        except FlashCancelled:
+            self._log("Backup cancelled")
+            self._finish(False, "Backup cancelled")
+            return
+        except (FlashError, OSError) as e:
+            self._log(f"Backup error: {e}")
+            self._finish(False, f"Backup failed: {e}")
+            return
+        finally:
+            self._update_backup_counts(engine)
+            self._backup = None
+
+        with self._lock:
+            self._digests = dict(engine.digests)
+        self._set_progress(100)
+        self._set_status("Backup completed successfully!")
+        self._finish(True, "Backup completed successfully!")
+
+    def _update_backup_counts(self, engine: BackupEngine) -> None:
+        with self._lock:
+            self._byte_counts = {
+                "done": engine.bytes_done,
+                "written": engine.bytes_written,
+                "sparse": engine.bytes_sparse,
+                "unmapped": engine.bytes_unmapped,
+            }
+
+    def _on_backup_progress(self, bytes_done: int, total: int) -> None:
+        engine = self._backup
+        if engine is not None:
+            self._update_backup_counts(engine)
+        if total <= 0:
+            return
+        self._update_telemetry(bytes_done, total)
+        self._set_progress(5 + bytes_done * 90 // total)
+        self._set_status(
+            f"Reading... {bytes_done / (1024**3):.2f} GB / {total / (1024**3):.2f} GB"
+        )
@@ -0,0 +1,197 @@
+"""
+Flash journal
+
+Small JSON records that make an interrupted flash resumable. While writing,
+the flash engine periodically stores the last offset known to be on stable
+storage (see `WritebackFlusher.durable_offset`) together with the identity
+of the source and of the target:
+
+- source: absolute path, size, mtime and SHA-256 of its first and last MiB
+- target: path, size and, for block devices, the disk serial
+
+Journals live under `$XDG_STATE_HOME/justdd/journals` (default
+`~/.local/state/justdd/journals`), one file per source/target pair, and are
+removed once a flash completes. `FlashJob` only resumes from a journal whose
+identities still match and after checking that the first and the last
+already written chunks on the target match the source.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import stat
+import time
+from typing import Any, Dict, Optional
+
+from .blockdev import device_serial
+
+JOURNAL_VERSION = 1
+# Bytes hashed at each end of the source for its identity.
+_IDENTITY_SAMPLE = 1024 * 1024
+# Minimum interval (seconds) between two journal writes.
+DEFAULT_SAVE_INTERVAL = 2.0
+
+
+def journal_dir() -> str:
+    """Directory holding the flash journals (XDG state directory)."""
+    base = os.environ.get("XDG_STATE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".local", "state"
+    )
+    return os.path.join(base, "justdd", "journals")
+
+
+def _hash_range(f, offset: int, length: int) -> str:
+    f.seek(offset)
+    return hashlib.sha256(f.read(length)).hexdigest()
+
+
+def source_identity(path: str) -> Dict[str, Any]:
+    """Identify an image file by path, size, mtime and hashes of both ends."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        head = _hash_range(f, 0, _IDENTITY_SAMPLE)
+        tail = _hash_range(f, max(0, st.st_size - _IDENTITY_SAMPLE), _IDENTITY_SAMPLE)
+    return {
+        "path": path,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "head_sha256": head,
+        "tail_sha256": tail,
+    }
+
+
+def target_identity(path: str) -> Dict[str, Any]:
+    """Identify a target by path, size and (for block devices) disk serial."""
+    path = os.path.abspath(path)
+    size = 0
+    serial = None
+    try:
+        st = os.stat(path)
+        if stat.S_ISBLK(st.st_mode):
+            fd = os.open(path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+            try:
+                size = os.lseek(fd, 0, os.SEEK_END)
+            finally:
+                os.close(fd)
+            serial = device_serial(path)
+    except OSError:
+        pass
+    # Regular-file targets grow while being written, so their size is not
+    # part of the identity.
+    return {"path": path, "size": size, "serial": serial}
+
+
+class FlashJournal:
+    """The journal of one source/target pair."""
+
+    def __init__(
+        self,
+        source: Dict[str, Any],
+        target: Dict[str, Any],
+        directory: Optional[str] = None,
+        save_interval: float = DEFAULT_SAVE_INTERVAL,
+    ):
+        self.source = source
+        self.target = target
+        self.directory = directory or journal_dir()
+        self.save_interval = save_interval
+        self.durable_offset = 0
+        self._saved_offset = -1
+        self._saved_at = 0.0
+
+    @classmethod
+    def for_paths(
+        cls, source_path: str, target_path: str, directory: Optional[str] = None
+    ) -> "FlashJournal":
+        return cls(
+            source_identity(source_path), target_identity(target_path), directory
+        )
+
+    @property
+    def path(self) -> str:
+        # Keyed by the target's serial when known, so a stick that comes back
+        # under another /dev name still finds its journal.
+        target_key = self.target.get("serial") or self.target["path"]
+        key = hashlib.sha1(
+            f"{self.source['path']}\0{target_key}".encode("utf-8", "surrogateescape")
+        ).hexdigest()[:16]
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self) -> int:
+        """
+        Read a previous journal for this pair; returns its durable offset, or 0
+        when there is none or the source or target no longer match.
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if (
+            data.get("version") != JOURNAL_VERSION
+            or data.get("source") != self.source
+            or not self._same_target(data.get("target") or {})
+        ):
+            return 0
+        try:
+            offset = int(data.get("durable_offset", 0))
+        except (TypeError, ValueError):
+            return 0
+        self.durable_offset = max(0, offset)
+        return self.durable_offset
+
+    def _same_target(self, other: Dict[str, Any]) -> bool:
+        if self.target.get("size") != other.get("size"):
+            return False
+        if self.target.get("serial") or other.get("serial"):
+            return self.target.get("serial") == other.get("serial")
+        return self.target.get("path") == other.get("path")
+
+    def update(self, durable_offset: int, force: bool = False) -> None:
+        """Record progress; written at most every `save_interval` seconds unless forced."""
+        self.durable_offset = durable_offset
+        if durable_offset == self._saved_offset:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at < self.save_interval:
+            return
+        self.save()
+        self._saved_at = now
+
+    def save(self) -> None:
+        data = {
+            "version": JOURNAL_VERSION,
+            "source": self.source,
+            "target": self.target,
+            "durable_offset": self.durable_offset,
+            "updated": time.time(),
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._saved_offset = self.durable_offset
+        except OSError:
+            pass
+
+    def remove(self) -> None:
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+__all__ = [
+    "FlashJournal",
+    "journal_dir",
+    "source_identity",
+    "target_identity",
+    "JOURNAL_VERSION",
+]
@@ -0,0 +1,285 @@
+"""
+FlashVerifier
+
+Read-back verification of a flashed target. The target is read with O_DIRECT
+so the data comes from the device and not from the page cache that still holds
+what was just written. When O_DIRECT is not available (e.g. tmpfs, some FUSE
+filesystems) the target's cached pages are dropped with
+`posix_fadvise(DONTNEED)` before reading instead.
+
+The source is decoded again through `open_image_source`, so compressed and
+zipped images are verified against their contents. Source and target are
+compared buffer by buffer as they stream in, which pinpoints the first
+differing byte without keeping either side in memory. Verification throughput
+is measured separately from the write.
+
+`skip_ranges` leaves out the `(start, end)` byte ranges that the write did not
+touch, i.e. the slack after the last partition or the unmapped blocks of a
+block map skipped by `FlashEngine(trim=True)`.
+
+`opener(path, direct)` opens the target read-only and returns the file
+descriptor (default `blockdev.open_readonly`); `PrivilegedHelper.open_read`
+verifies devices the user cannot read.
+
+Usage (example):
+    verifier = FlashVerifier('/path/to.iso', '/dev/sdb', on_progress=print)
+    try:
+        verifier.run()
+    except VerifyMismatch as e:
+        print(e.offset)
+"""
+
+from __future__ import annotations
+
+import bisect
+import os
+import time
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from .blockdev import open_readonly
+from .flash_engine import (
+    DEFAULT_BUFFER_SIZE,
+    FlashCancelled,
+    FlashError,
+    alloc_aligned_buffer,
+)
+from .image_source import ImageSourceError, open_image_source
+
+# O_DIRECT requires offsets, lengths and buffers aligned to the logical block
+# size; page alignment covers every common device.
+_DIRECT_ALIGN = 4096
+# Granularity of the search for the first differing byte inside a buffer.
+_SEARCH_STEP = 64 * 1024
+
+
+class VerifyMismatch(FlashError):
+    """Raised when the target does not hold the image."""
+
+    def __init__(self, offset: int, message: Optional[str] = None):
+        self.offset = offset
+        super().__init__(message or f"Target differs from the image at byte {offset}")
+
+
+def first_difference(a: memoryview, b: memoryview) -> int:
+    """
+    Return the index of the first differing byte of `a` and `b`, the length
+    of the shorter one when it is a prefix of the other, or -1 when equal.
+    """
+    length = min(len(a), len(b))
+    # memoryview comparison goes element by element; bytes() uses memcmp.
+    if len(a) == len(b) and bytes(a) == bytes(b):
+        return -1
+    for start in range(0, length, _SEARCH_STEP):
+        end = min(start + _SEARCH_STEP, length)
+        if bytes(a[start:end]) != bytes(b[start:end]):
+            for i in range(start, end):
+                if a[i] != b[i]:
+                    return i
+    return length
+
+
+class FlashVerifier:
+    """Compare a target with its source image by reading the target back."""
+
+    def __init__(
+        self,
+        source_path: str,
+        target_path: str,
+        buffer_size: int = DEFAULT_BUFFER_SIZE,
+        skip_ranges: Sequence[Tuple[int, int]] = (),
+        opener: Callable[[str, bool], int] = open_readonly,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_log: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        self.source_path = source_path
+        self.target_path = target_path
+        # Keep buffers a multiple of the O_DIRECT alignment.
+        self.buffer_size = max(
+            _DIRECT_ALIGN, buffer_size // _DIRECT_ALIGN * _DIRECT_ALIGN
+        )
+        self.skip_ranges: List[Tuple[int, int]] = sorted(skip_ranges)
+        self._opener = opener
+        self._on_progress = on_progress
+        self._on_log = on_log
+        self._should_stop = should_stop
+
+        # True when the target was read with O_DIRECT, False after a cache drop.
+        self.direct = False
+        self.bytes_verified = 0
+        self.seconds = 0.0
+        self._started = 0.0
+        # Offset of the first differing byte, None when the target matches.
+        self.mismatch_offset: Optional[int] = None
+
+    @property
+    def throughput(self) -> float:
+        """Verification speed in bytes per second."""
+        return self.bytes_verified / self.seconds if self.seconds > 0 else 0.0
+
+    def run(self) -> int:
+        """
+        Verify the whole image; returns the number of bytes verified.
+        Raises VerifyMismatch, FlashCancelled or FlashError.
+        """
+        try:
+            source = open_image_source(self.source_path)
+        except (OSError, ImageSourceError) as e:
+            raise FlashError(f"Cannot open source {self.source_path}: {e}") from e
+
+        try:
+            fd = self._open_target()
+        except OSError as e:
+            source.close()
+            raise FlashError(f"Cannot open target {self.target_path}: {e}") from e
+
+        self._log(
+            "Verifying with O_DIRECT reads"
+            if self.direct
+            else "Verifying after dropping the target's page cache"
+        )
+        if len(self.skip_ranges) == 1:
+            low, high = self.skip_ranges[0]
+            self._log(f"Not verifying bytes {low}-{high} (not written)")
+        elif self.skip_ranges:
+            skipped = sum(high - low for low, high in self.skip_ranges)
+            self._log(
+                f"Not verifying {skipped} bytes in {len(self.skip_ranges)} "
+                "ranges (not written)"
+            )
+        src_buf = alloc_aligned_buffer(self.buffer_size)
+        dst_buf = alloc_aligned_buffer(self.buffer_size)
+        src_view = memoryview(src_buf)[: self.buffer_size]
+        dst_view = memoryview(dst_buf)[: self.buffer_size]
+        self._started = time.monotonic()
+        try:
+            self._compare(source, fd, src_view, dst_view)
+        except (OSError, ImageSourceError, EOFError) as e:
+            raise FlashError(f"Verification failed: {e}") from e
+        finally:
+            self.seconds = time.monotonic() - self._started
+            src_view.release()
+            dst_view.release()
+            src_buf.close()
+            dst_buf.close()
+            os.close(fd)
+            source.close()
+
+        self._log(
+            f"Verified {self.bytes_verified} bytes in {self.seconds:.1f} s "
+            f"({self.throughput / (1024**2):.1f} MB/s)"
+        )
+        return self.bytes_verified
+
+    def _open_target(self) -> int:
+        try:
+            fd = self._opener(self.target_path, True)
+            self.direct = True
+            return fd
+        except OSError:
+            pass
+
+        fd = self._opener(self.target_path, False)
+        # Clean pages are dropped, so the reads below go to the device.
+        try:
+            os.fdatasync(fd)
+        except OSError:
+            pass
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except (AttributeError, OSError):
+            self._log("Could not drop the target's page cache; reads may be cached")
+        return fd
+
+    def _compare(
+        self, source, fd: int, src_view: memoryview, dst_view: memoryview
+    ) -> None:
+        offset = 0
+        ends = [high for _, high in self.skip_ranges]
+        while True:
+            if self._stop_requested():
+                raise FlashCancelled("Verification cancelled")
+
+            index = bisect.bisect_right(ends, offset)
+            skip = self.skip_ranges[index] if index < len(ends) else None
+            if skip is not None and skip[0] <= offset:
+                skipped = source.skip(skip[1] - offset)
+                if not skipped:
+                    return
+                offset += skipped
+                self.bytes_verified = offset
+                continue
+            view = src_view
+            if skip is not None and offset < skip[0]:
+                view = src_view[: skip[0] - offset]
+            need = self._fill(source, view)
+            if need == 0:
+                return
+
+            got = self._read_target(fd, dst_view, offset, need)
+            diff = first_difference(src_view[:need], dst_view[:got])
+            if diff >= 0:
+                self.mismatch_offset = offset + diff
+                if diff >= got:
+                    raise VerifyMismatch(
+                        self.mismatch_offset,
+                        f"Target ends at byte {self.mismatch_offset}, "
+                        "before the end of the image",
+                    )
+                raise VerifyMismatch(self.mismatch_offset)
+
+            offset += need
+            self.bytes_verified = offset
+            self.seconds = time.monotonic() - self._started
+            self._report(source)
+
+    def _read_target(self, fd: int, view: memoryview, offset: int, need: int) -> int:
+        # O_DIRECT reads must cover whole aligned blocks; the extra bytes read
+        # past `need` are ignored.
+        want = need
+        if self.direct:
+            want = min(len(view), -(-need // _DIRECT_ALIGN) * _DIRECT_ALIGN)
+        got = 0
+        while got < need:
+            n = os.preadv(fd, [view[got:want]], offset + got)
+            if n <= 0:
+                break
+            got += n
+        return min(got, need)
+
+    def _fill(self, source, view: memoryview) -> int:
+        total = 0
+        while total < len(view):
+            n = source.readinto(view[total:])
+            if not n:
+                break
+            total += n
+        return total
+
+    # ---- Helpers ----
+
+    def _stop_requested(self) -> bool:
+        if self._should_stop is None:
+            return False
+        try:
+            return bool(self._should_stop())
+        except Exception:
+            return False
+
+    def _report(self, source) -> None:
+        if self._on_progress:
+            try:
+                done, total = source.progress(self.bytes_verified)
+                self._on_progress(done, total)
+            except Exception:
+                pass
+
+    def _log(self, text: str) -> None:
+        if self._on_log:
+            try:
+                self._on_log(text)
+            except Exception:
+                pass
+
+
+__all__ = ["FlashVerifier", "VerifyMismatch", "first_difference"]
@@ -0,0 +1,366 @@
+"""
+WipeEngine
+
+Erases a whole device (or a regular file standing in for one) so it reads
+back as zeros, as fast as the device allows:
+
+- "zeroout": BLKZEROOUT, which devices with a WRITE ZEROES command (see
+  `write_zeroes_max_bytes` in the queue hints) handle without any data
+  crossing the bus.
+- "discard": BLKDISCARD, which unmaps the blocks on flash media. Discarded
+  blocks are not guaranteed to read back as zeros on every device.
+- "write": zeros are written by several threads at once, each with its own
+  range of the device, through `O_DIRECT` when the target allows it, so no
+  page cache fills up and the device queue sees more than one write.
+
+"auto" picks "zeroout" when the device offloads it, else "write"; it never
+picks "discard", which has to be asked for. Regular files are wiped by punching a hole
+for "zeroout" and "discard". When an ioctl is refused part way, the rest is
+wiped by the writer threads. Ranges are processed in `chunk_size` pieces so
+progress and cancellation work the same way as for `FlashEngine`.
+
+Usage (example):
+    with WipeEngine('/dev/sdb', on_progress=print) as engine:
+        engine.wipe()
+        engine.sync()
+"""
+
+from __future__ import annotations
+
+import errno
+import os
+import stat
+import threading
+import time
+from typing import Callable, List, Optional
+
+from .blockdev import discard_range, punch_hole, read_queue_hints, zero_out_range
+from .flash_engine import (
+    DEFAULT_BLOCK_SIZE,
+    DIRECT_IO_ALIGN,
+    FlashCancelled,
+    FlashError,
+    alloc_aligned_buffer,
+)
+
+MiB = 1024 * 1024
+
+WIPE_AUTO = "auto"
+WIPE_ZEROOUT = "zeroout"
+WIPE_DISCARD = "discard"
+WIPE_WRITE = "write"
+WIPE_METHODS = (WIPE_AUTO, WIPE_ZEROOUT, WIPE_DISCARD, WIPE_WRITE)
+
+# Bytes per ioctl and per range taken by a writer thread.
+DEFAULT_WIPE_CHUNK = 64 * MiB
+DEFAULT_WIPE_THREADS = 4
+
+# Errors meaning the device does not support the ioctl.
+_IOCTL_UNSUPPORTED = {
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.ENOSYS,
+}
+# Interval (seconds) at which the writer threads' progress is reported.
+_POLL_INTERVAL = 0.1
+
+
+class WipeEngine:
+    """
+    Wipes a target device or file.
+
+    Callbacks:
+        on_progress(bytes_done, total_bytes) : called after every chunk
+        on_log(text) : informational messages
+        should_stop() -> bool : polled between chunks; True cancels the wipe
+
+    `method` is one of `WIPE_METHODS`; after `wipe()`, `methods_used` lists
+    the methods that actually ran, in order. `threads` is the number of
+    writer threads of the "write" method.
+    """
+
+    def __init__(
+        self,
+        target_path: str,
+        method: str = WIPE_AUTO,
+        threads: int = DEFAULT_WIPE_THREADS,
+        chunk_size: int = DEFAULT_WIPE_CHUNK,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_log: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        if method not in WIPE_METHODS:
+            raise ValueError(f"method must be one of {', '.join(WIPE_METHODS)}")
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        if chunk_size <= 0 or chunk_size % DIRECT_IO_ALIGN:
+            raise ValueError(f"chunk_size must be a multiple of {DIRECT_IO_ALIGN}")
+        if block_size <= 0 or block_size % DIRECT_IO_ALIGN:
+            raise ValueError(f"block_size must be a multiple of {DIRECT_IO_ALIGN}")
+
+        self.target_path = target_path
+        self.method = method
+        self.threads = int(threads)
+        self.chunk_size = int(chunk_size)
+        self.block_size = min(int(block_size), self.chunk_size)
+        self.methods_used: List[str] = []
+
+        self._on_progress = on_progress
+        self._on_log = on_log
+        self._should_stop = should_stop
+
+        self._fd: Optional[int] = None
+        self._direct_fd: Optional[int] = None
+        self._target_is_file = False
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._next_offset = 0
+        self._writer_chunk = self.chunk_size
+        self._writer_error: Optional[BaseException] = None
+
+        self.target_size = 0
+        self.bytes_done = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Wipe speed in bytes per second."""
+        return self.bytes_done / self.seconds if self.seconds > 0 else 0.0
+
+    # ---- Context management ----
+    def __enter__(self) -> "WipeEngine":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Open the target and find its size."""
+        if self._fd is not None:
+            return
+        try:
+            self._fd = os.open(
+                self.target_path, os.O_WRONLY | getattr(os, "O_CLOEXEC", 0)
+            )
+        except OSError as e:
+            raise FlashError(f"Cannot open target {self.target_path}: {e}") from e
+        self._target_is_file = stat.S_ISREG(os.fstat(self._fd).st_mode)
+        try:
+            self.target_size = os.lseek(self._fd, 0, os.SEEK_END)
+        except OSError as e:
+            self.close()
+            raise FlashError(f"Cannot size target {self.target_path}: {e}") from e
+        if not self.target_size:
+            self.close()
+            raise FlashError(f"Target {self.target_path} is empty")
+
+    def close(self) -> None:
+        for fd in (self._direct_fd, self._fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except Exception:
+                    pass
+        self._direct_fd = None
+        self._fd = None
+
+    # ---- Wipe ----
+    def wipe(self) -> int:
+        """Wipe the whole target. Returns the number of bytes wiped."""
+        if self._fd is None:
+            self.open()
+        method = self._choose_method()
+        self._log(
+            f"Wiping {self.target_size} bytes of {self.target_path} with {method}"
+        )
+        started = time.monotonic()
+        try:
+            if method != WIPE_WRITE:
+                self._wipe_ioctl(method)
+            if self.bytes_done < self.target_size:
+                self._wipe_write()
+        finally:
+            self.seconds = time.monotonic() - started
+        self._log(
+            f"Wiped {self.bytes_done} bytes in {self.seconds:.1f} s "
+            f"({self.throughput / MiB:.1f} MB/s, {' + '.join(self.methods_used)})"
+        )
+        return self.bytes_done
+
+    def sync(self) -> None:
+        """Flush the target's dirty data to stable storage."""
+        if self._fd is not None:
+            os.fsync(self._fd)
+
+    def _choose_method(self) -> str:
+        if self.method != WIPE_AUTO:
+            return self.method
+        if self._target_is_file:
+            return WIPE_ZEROOUT
+        hints = read_queue_hints(self.target_path)
+        if hints.get("write_zeroes_max_bytes"):
+            return WIPE_ZEROOUT
+        return WIPE_WRITE
+
+    def _wipe_ioctl(self, method: str) -> None:
+        """Wipe chunk by chunk with BLKZEROOUT/BLKDISCARD (holes for files)."""
+        assert self._fd is not None
+        self.methods_used.append(method)
+        if method == WIPE_DISCARD and not self._target_is_file:
+            self._log("Discarded blocks may not read back as zeros on every device")
+        while self.bytes_done < self.target_size:
+            if self._stop_requested():
+                raise FlashCancelled("Wipe cancelled")
+            offset = self.bytes_done
+            length = min(self.chunk_size, self.target_size - offset)
+            try:
+                if self._target_is_file:
+                    punch_hole(self._fd, offset, length)
+                elif method == WIPE_DISCARD:
+                    discard_range(self._fd, offset, length)
+                else:
+                    zero_out_range(self._fd, offset, length)
+            except OSError as e:
+                if e.errno not in _IOCTL_UNSUPPORTED:
+                    raise FlashError(f"{method} failed at byte {offset}: {e}") from e
+                self._log(f"Target cannot {method} ({e}); writing zeros")
+                return
+            self.bytes_done += length
+            self._report()
+
+    # ---- Zero writer ----
+    def _wipe_write(self) -> None:
+        """Write zeros from `threads` threads, each taking the next free chunk."""
+        self.methods_used.append(WIPE_WRITE)
+        self._open_direct()
+        self._next_offset = self.bytes_done
+        self._abort.clear()
+        self._writer_error = None
+        # Small targets are still split between all threads.
+        share = -(-(self.target_size - self.bytes_done) // self.threads)
+        share = -(-share // self.block_size) * self.block_size
+        self._writer_chunk = min(self.chunk_size, share)
+        count = min(
+            self.threads,
+            -(-(self.target_size - self.bytes_done) // self._writer_chunk),
+        )
+        self._log(
+            f"Zero writer: {count} thread{'s' if count > 1 else ''}, "
+            f"{self.block_size // 1024} KiB writes"
+            f"{' with O_DIRECT' if self._direct_fd is not None else ''}"
+        )
+        workers = [
+            threading.Thread(
+                target=self._writer_loop, name=f"justdd-wipe-{i}", daemon=True
+            )
+            for i in range(count)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                if self._stop_requested():
+                    self._abort.set()
+                workers[0].join(_POLL_INTERVAL)
+                self._report()
+        finally:
+            self._abort.set()
+            for worker in workers:
+                worker.join()
+        if self._writer_error is not None:
+            raise FlashError(f"Error writing zeros: {self._writer_error}")
+        self._report()
+        if self.bytes_done < self.target_size:
+            raise FlashCancelled("Wipe cancelled")
+
+    def _open_direct(self) -> None:
+        flag = getattr(os, "O_DIRECT", 0)
+        if not flag or self._direct_fd is not None:
+            return
+        try:
+            self._direct_fd = os.open(
+                self.target_path, os.O_WRONLY | flag | getattr(os, "O_CLOEXEC", 0)
+            )
+        except OSError:
+            self._direct_fd = None
+
+    def _writer_loop(self) -> None:
+        buf = alloc_aligned_buffer(self.block_size)
+        try:
+            with memoryview(buf) as zeros:
+                while not self._abort.is_set():
+                    with self._lock:
+                        offset = self._next_offset
+                        if offset >= self.target_size:
+                            return
+                        end = min(offset + self._writer_chunk, self.target_size)
+                        self._next_offset = end
+                    while offset < end and not self._abort.is_set():
+                        length = min(self.block_size, end - offset)
+                        self._write_zeros(zeros[:length], offset)
+                        offset += length
+                        with self._lock:
+                            self.bytes_done += length
+        except BaseException as e:
+            self._writer_error = e
+            self._abort.set()
+        finally:
+            buf.close()
+
+    def _write_zeros(self, zeros: memoryview, offset: int) -> None:
+        assert self._fd is not None
+        fd = self._fd
+        direct = self._direct_fd
+        if direct is not None and not (offset | len(zeros)) % DIRECT_IO_ALIGN:
+            fd = direct
+        done = 0
+        while done < len(zeros):
+            try:
+                n = os.pwrite(fd, zeros[done:], offset + done)
+            except OSError as e:
+                if fd != direct or e.errno != errno.EINVAL:
+                    raise
+                # Target refused O_DIRECT for this write; stay buffered.
+                fd = self._fd
+                continue
+            if n <= 0:
+                raise FlashError("Short write on target")
+            done += n
+
+    # ---- Helpers ----
+    def _stop_requested(self) -> bool:
+        if self._should_stop is None:
+            return False
+        try:
+            return bool(self._should_stop())
+        except Exception:
+            return False
+
+    def _report(self) -> None:
+        if self._on_progress:
+            try:
+                self._on_progress(self.bytes_done, self.target_size)
+            except Exception:
+                pass
+
+    def _log(self, text: str) -> None:
+        if self._on_log:
+            try:
+                self._on_log(text)
+            except Exception:
+                pass
+
+
+__all__ = [
+    "WipeEngine",
+    "WIPE_METHODS",
+    "WIPE_AUTO",
+    "WIPE_ZEROOUT",
+    "WIPE_DISCARD",
+    "WIPE_WRITE",
+    "DEFAULT_WIPE_CHUNK",
+    "DEFAULT_WIPE_THREADS",
+]
@@ -8,26 +8,81 @@ the `logic` package as a copy-only change (no behavior changes).
 """
 
 import os
-import re
 import subprocess
 import tempfile
+import threading
 
 from PySide6.QtCore import QThread, Signal
 
+from .dd_progress import follow_dd_output
+from .flash_engine import (
+    DEFAULT_BLOCK_SIZE,
+    FlashCancelled,
+    FlashEngine,
+    FlashError,
+    can_open_for_writing,
+    dd_block_size_operand,
+    plan_trim,
+)
+from .image_hash import StreamHasher, find_expected_digest
+from .image_source import (
+    COMPRESSED_KINDS,
+    ImageSourceError,
+    detect_image_kind,
+    open_image_source,
+    pump_to_pipe,
+    unpack_image,
+)
+from .priv_helper import (
+    HelperAuthError,
+    HelperError,
+    shared_helper,
+    write_image,
+)
+from .telemetry import FlashTelemetry
+
 
 class FlashWorker(QThread):
     progress = Signal(int)
     status_update = Signal(str)
     log_message = Signal(str)
-    finished = Signal(bool, str)
+    # success, message, image digests ({algorithm: hex digest}, may be empty)
+    finished = Signal(bool, str, dict)
+    # Write-phase throughput/ETA, see FlashTelemetry.snapshot()
+    telemetry = Signal(dict)
 
-    def __init__(self, iso_path, target_drive, mode="linux", partition_scheme="gpt"):
+    def __init__(
+        self,
+        iso_path,
+        target_drive,
+        mode="linux",
+        partition_scheme="gpt",
+        engine="auto",
+        block_size=DEFAULT_BLOCK_SIZE,
+        hash_algorithms=(),
+        audit_algorithms=(),
+        trim=False,
+    ):
         super().__init__()
         self.iso_path = iso_path
         self.target_drive = target_drive
         self.mode = mode
         self.partition_scheme = partition_scheme
+        self.engine = engine
+        self.block_size = block_size
+        # SHA-256 is added when a checksum file for the image is found.
+        self.hash_algorithms = [a.lower().replace("-", "") for a in hash_algorithms]
+        # Digests for the records, computed whenever the image passes through
+        # Python anyway: raw images the helper or dd copy in the kernel are
+        # not slowed down for them.
+        self.audit_algorithms = [a.lower().replace("-", "") for a in audit_algorithms]
+        self.digests = {}
+        # Skip the slack after the last partition of raw images.
+        self.trim = trim
+        self._expected_digest = None
         self._process = None
+        self._engine = None
+        self._telemetry = FlashTelemetry()
 
     def run(self):
         try:
@@ -38,7 +93,7 @@ class FlashWorker(QThread):
         except Exception as e:
             if not self.isInterruptionRequested():
                 self.log_message.emit(f"Error: {str(e)}")
-                self.finished.emit(False, f"Flash failed: {str(e)}")
+                self._emit_finished(False, f"Flash failed: {str(e)}")
         finally:
             if self._process:
                 try:
@@ -53,6 +108,9 @@ class FlashWorker(QThread):
                         pass
                 self._process = None
 
+    def _emit_finished(self, success, message):
+        self.finished.emit(success, message, dict(self.digests))
+
     def _flash_linux(self):
         self.status_update.emit("Preparing to flash...")
         self.log_message.emit("Starting Linux flash process")
@@ -80,9 +138,15 @@ class FlashWorker(QThread):
                 text=True,
                 timeout=3,
             )
-            if result.returncode == 0 and result.stdout.strip():
+            # `fuser -m` on a regular file lists every process on its
+            # filesystem, so it only means "busy" for device targets.
+            if (
+                result.returncode == 0
+                and result.stdout.strip()
+                and not os.path.isfile(self.target_drive)
+            ):
                 self.log_message.emit(f"Device busy - PIDs: {result.stdout.strip()}")
-                self.finished.emit(False, "Device is busy or mounted")
+                self._emit_finished(False, "Device is busy or mounted")
                 return
         except subprocess.TimeoutExpired:
             self.log_message.emit("fuser check timed out, proceeding...")
@@ -92,108 +156,331 @@ class FlashWorker(QThread):
             self.log_message.emit(f"fuser check failed: {e}, proceeding...")
 
         self.progress.emit(10)
+
+        self._find_checksum()
+
+        if self._use_native_engine():
+            self._add_audit_hashes(True)
+            self._flash_linux_native()
+            return
+        self._add_audit_hashes(detect_image_kind(self.iso_path) in COMPRESSED_KINDS)
+
+        try:
+            helper = self._get_helper()
+        except HelperAuthError as e:
+            self.log_message.emit(f"Privileged helper: {e}")
+            self._emit_finished(False, "Authentication failed")
+            return
+        if helper is not None:
+            self._flash_linux_helper(helper)
+            return
+
         self.status_update.emit("Starting dd operation...")
 
+        # dd cannot decompress or hash: in those cases it reads the image
+        # from its stdin, fed by a thread that decodes and hashes it.
+        source = None
+        hasher = None
+        feeder = None
+        compressed = detect_image_kind(self.iso_path) in COMPRESSED_KINDS
+        if compressed or self.hash_algorithms:
+            try:
+                source = open_image_source(self.iso_path)
+            except (OSError, ImageSourceError) as e:
+                self._emit_finished(False, f"Cannot open image: {e}")
+                return
+            if compressed:
+                self.log_message.emit(f"Decompressing {source.kind} image into dd")
+            if self.hash_algorithms:
+                hasher = StreamHasher(self.hash_algorithms)
+
         cmd = [
             "pkexec",
             "dd",
-            f"if={self.iso_path}",
+            *(
+                [f"if={self.iso_path}"]
+                if source is None
+                else ["iflag=fullblock"]  # reading from a pipe
+            ),
             f"of={self.target_drive}",
-            "bs=4M",
+            dd_block_size_operand(self.block_size, self.target_drive),
             "status=progress",
-            "oflag=sync",
+            "oflag=direct",
+            "conv=fsync",
         ]
 
         self.log_message.emit(f"Command: {' '.join(cmd)}")
 
+        self._telemetry.start()
         try:
             process = subprocess.Popen(
                 cmd,
+                stdin=subprocess.PIPE if source is not None else None,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True,
             )
+            if source is not None:
+                feeder = threading.Thread(
+                    target=pump_to_pipe,
+                    args=(source, process.stdin, self.isInterruptionRequested),
+                    kwargs={"hasher": hasher},
+                    daemon=True,
+                )
+                feeder.start()
 
             # Ensure stdout exists (stubs may show it as Optional[IO])
             stdout = process.stdout
             if stdout is None:
                 self.log_message.emit("Flash process has no stdout - aborting")
-                self.finished.emit(False, "Flash process started without stdout")
+                self._emit_finished(False, "Flash process started without stdout")
                 return
 
-            progress_value = 10
-            while True:
-                if self.isInterruptionRequested():
+            # Progress updates go to the progress bar, everything else to the log.
+            completed = follow_dd_output(
+                stdout.fileno(),
+                on_progress=lambda record: self._on_dd_progress(
+                    record, source, iso_size
+                ),
+                on_message=self.log_message.emit,
+                should_stop=self.isInterruptionRequested,
+            )
+            if not completed:
+                try:
+                    process.terminate()
+                    process.wait(timeout=3)
+                except Exception as e:
                     try:
-                        process.terminate()
-                        process.wait(timeout=3)
-                    except Exception as e:
-                        try:
-                            self.log_message.emit(f"Error terminating dd process: {e}")
-                        except Exception:
-                            pass
-                    self.log_message.emit("Flash operation cancelled")
-                    return
-
-                output = stdout.readline()
-                if output:
-                    self.log_message.emit(output.strip())
-
-                    # Parse dd progress output to calculate percentage
-                    if "bytes" in output.lower() and iso_size > 0:
-                        try:
-                            # Extract bytes copied from dd output
-                            match = re.search(r"(\d+)\s+bytes", output)
-                            if match:
-                                bytes_copied = int(match.group(1))
-                                percentage = (bytes_copied / iso_size) * 80 + 10
-                                progress_value = min(int(percentage), 90)
-                                self.progress.emit(progress_value)
-
-                                if "copied" in output.lower():
-                                    self.status_update.emit(
-                                        f"Copying... {bytes_copied / (1024**3):.2f} GB / {iso_size / (1024**3):.2f} GB"
-                                    )
-                        except (ValueError, AttributeError):
-                            if "copied" in output.lower():
-                                progress_value = min(progress_value + 2, 90)
-                                self.progress.emit(progress_value)
-                    elif "copied" in output.lower():
-                        progress_value = min(progress_value + 2, 90)
-                        self.progress.emit(progress_value)
-
-                elif process.poll() is not None:
-                    break
-
-                self.msleep(100)
+                        self.log_message.emit(f"Error terminating dd process: {e}")
+                    except Exception:
+                        pass
+                self.log_message.emit("Flash operation cancelled")
+                return
 
             return_code = process.wait()
 
             if return_code == 0:
-                self.progress.emit(95)
-                self.status_update.emit("Syncing filesystem...")
-                self.log_message.emit("Running final sync...")
-
-                try:
-                    subprocess.run(["sync"], timeout=30, check=True)
-                    self.msleep(1000)
-                except Exception as e:
-                    self.log_message.emit(f"Sync warning: {e}")
-
+                # dd already flushed the target itself (conv=fsync); no
+                # host-wide sync that would stall every other disk.
+                self.log_message.emit("Target flushed by dd (conv=fsync)")
+                if hasher is not None and feeder is not None:
+                    feeder.join()
+                    self.digests = hasher.finish()
+                    hasher = None
+                    for name, digest in self.digests.items():
+                        self.log_message.emit(f"{name.upper()}: {digest}")
+                    if not self._check_digests():
+                        return
                 self.progress.emit(100)
                 self.status_update.emit("Flash completed successfully!")
-                self.finished.emit(True, "Flash completed successfully!")
+                self._emit_finished(True, "Flash completed successfully!")
             else:
-                self.finished.emit(
+                self._emit_finished(
                     False, f"dd command failed with exit code {return_code}"
                 )
 
         except subprocess.TimeoutExpired:
-            self.finished.emit(False, "Flash operation timed out")
+            self._emit_finished(False, "Flash operation timed out")
         except Exception as e:
-            self.finished.emit(False, f"Flash failed: {str(e)}")
+            self._emit_finished(False, f"Flash failed: {str(e)}")
+        finally:
+            if feeder is not None:
+                feeder.join(timeout=5)
+            if hasher is not None:
+                hasher.abort()
+            if source is not None:
+                source.close()
+
+    def _on_dd_progress(self, record, source, iso_size):
+        if iso_size <= 0:
+            return
+        copied = record.bytes_copied
+        done, total = (
+            source.progress(copied) if source is not None else (copied, iso_size)
+        )
+        if total <= 0:
+            return
+        self._update_telemetry(done, total, copied)
+        self.progress.emit(min(int((done / total) * 80 + 10), 90))
+        rate = f"{record.rate / (1024**2):.1f} MB/s"
+        self.status_update.emit(
+            f"Copying... {copied / (1024**3):.2f} GB / {total / (1024**3):.2f} GB ({rate})"
+            if source is None or source.size
+            else f"Copying... {copied / (1024**3):.2f} GB written, "
+            f"{done * 100 // total}% of compressed image read ({rate})"
+        )
+
+    def _use_native_engine(self):
+        if self.engine == "native":
+            return True
+        if self.engine in ("dd", "helper"):
+            return False
+        return can_open_for_writing(self.target_drive)
+
+    def _get_helper(self):
+        # The session's privileged helper, or None to use pkexec directly.
+        if self.engine not in ("auto", "helper"):
+            return None
+        try:
+            return shared_helper()
+        except HelperAuthError:
+            raise
+        except HelperError as e:
+            self.log_message.emit(f"Privileged helper unavailable ({e}), using pkexec")
+            return None
+
+    def _flash_linux_helper(self, helper):
+        self.status_update.emit("Writing image...")
+        self.log_message.emit("Using the privileged helper")
+        self._telemetry.start()
+        try:
+            skip_ranges = []
+            if self.trim:
+                with open_image_source(self.iso_path) as source:
+                    skip_ranges = plan_trim(source, self.log_message.emit).ranges
+            self.digests = write_image(
+                helper,
+                self.iso_path,
+                self.target_drive,
+                hash_algorithms=self.hash_algorithms,
+                skip_ranges=skip_ranges,
+                on_progress=self._on_helper_progress,
+                on_log=self.log_message.emit,
+                should_stop=self.isInterruptionRequested,
+            )
+        except InterruptedError:
+            self.log_message.emit("Flash operation cancelled")
+            return
+        except (HelperError, ImageSourceError, OSError) as e:
+            self.log_message.emit(f"Privileged helper error: {e}")
+            self._emit_finished(False, f"Flash failed: {str(e)}")
+            return
+
+        self.log_message.emit(f"Target {self.target_drive} flushed by the helper")
+        if not self._check_digests():
+            return
+        self.progress.emit(100)
+        self.status_update.emit("Flash completed successfully!")
+        self._emit_finished(True, "Flash completed successfully!")
+
+    def _on_helper_progress(self, done, total, written):
+        if total <= 0:
+            return
+        self._update_telemetry(done, total, written)
+        self.progress.emit(min(int((done / total) * 80 + 10), 90))
+        self.status_update.emit(
+            f"Copying... {written / (1024**3):.2f} GB / {total / (1024**3):.2f} GB"
+            if done == written
+            else f"Copying... {written / (1024**3):.2f} GB written, "
+            f"{done * 100 // total}% of compressed image read"
+        )
+
+    def _flash_linux_native(self):
+        self.status_update.emit("Writing image...")
+        self.log_message.emit("Using in-process write engine")
+
+        engine = FlashEngine(
+            self.iso_path,
+            self.target_drive,
+            block_size=self.block_size,
+            hash_algorithms=self.hash_algorithms,
+            trim=self.trim,
+            on_progress=self._on_engine_progress,
+            on_log=self.log_message.emit,
+            should_stop=self.isInterruptionRequested,
+        )
+        self._engine = engine
+        self._telemetry.start()
+        try:
+            with engine:
+                engine.copy()
+                self.progress.emit(95)
+                self.status_update.emit("Syncing device...")
+                self.log_message.emit("Flushing target device...")
+                engine.sync()
+        except FlashCancelled:
+            self.log_message.emit("Flash operation cancelled")
+            return
+        except (FlashError, OSError) as e:
+            self.log_message.emit(f"Write engine error: {e}")
+            self._emit_finished(False, f"Flash failed: {str(e)}")
+            return
+
+        self.log_message.emit(
+            f"Wrote {engine.bytes_written} bytes to {self.target_drive}"
+        )
+        self.digests = engine.digests
+        if not self._check_digests():
+            return
+        self.progress.emit(100)
+        self.status_update.emit("Flash completed successfully!")
+        self._emit_finished(True, "Flash completed successfully!")
+
+    def _add_audit_hashes(self, streamed):
+        # `streamed`: the chosen path reads the image through Python.
+        if not (streamed or self.hash_algorithms):
+            return
+        for algorithm in self.audit_algorithms:
+            if algorithm not in self.hash_algorithms:
+                self.hash_algorithms.append(algorithm)
+
+    def _find_checksum(self):
+        try:
+            with open_image_source(self.iso_path) as source:
+                name = source.name
+        except (OSError, ImageSourceError):
+            return
+        for algorithm in dict.fromkeys(["sha256"] + self.hash_algorithms):
+            try:
+                found = find_expected_digest(self.iso_path, algorithm, name=name)
+            except ValueError:
+                continue
+            if found is None:
+                continue
+            digest, path = found
+            self._expected_digest = (algorithm, digest, path)
+            if algorithm not in self.hash_algorithms:
+                self.hash_algorithms.append(algorithm)
+            self.log_message.emit(
+                f"Found {algorithm.upper()} of {name} in {os.path.basename(path)}; "
+                "it will be checked while writing"
+            )
+            return
+
+    def _check_digests(self):
+        if self._expected_digest is None:
+            return True
+        algorithm, expected, path = self._expected_digest
+        actual = self.digests.get(algorithm)
+        if actual is None or actual == expected:
+            if actual is not None:
+                self.log_message.emit(
+                    f"{algorithm.upper()} matches {os.path.basename(path)}"
+                )
+            return True
+        self.log_message.emit(
+            f"{algorithm.upper()} mismatch: expected {expected}, image has {actual}"
+        )
+        self._emit_finished(
+            False,
+            f"Checksum mismatch: the image does not match {os.path.basename(path)}",
+        )
+        return False
+
+    def _update_telemetry(self, done, total, written=None):
+        if self._telemetry.update(done, total, written):
+            self.telemetry.emit(self._telemetry.snapshot())
+
+    def _on_engine_progress(self, bytes_done, total):
+        if total <= 0:
+            return
+        engine = self._engine
+        self._update_telemetry(
+            bytes_done, total, engine.bytes_done if engine is not None else None
+        )
+        self.progress.emit(min(int((bytes_done / total) * 80 + 10), 90))
+        self.status_update.emit(
+            f"Copying... {bytes_done / (1024**3):.2f} GB / {total / (1024**3):.2f} GB"
+        )
 
     def _flash_windows(self):
         if self.isInterruptionRequested():
@@ -217,20 +504,47 @@ class FlashWorker(QThread):
             )
             if result.returncode == 0 and result.stdout.strip():
                 self.log_message.emit(f"Device busy - PIDs: {result.stdout.strip()}")
-                self.finished.emit(False, "Device is busy or mounted")
+                self._emit_finished(False, "Device is busy or mounted")
                 return
         except Exception as e:
             self.log_message.emit(f"fuser check failed (windows): {e}")
 
+        # A loop mount needs a plain ISO file; packed images are unpacked first.
+        iso_path = self.iso_path
+        kind = detect_image_kind(iso_path)
+        if kind != "raw":
+            self.status_update.emit("Unpacking ISO...")
+            self.log_message.emit(f"Unpacking {kind} image before mounting")
+            try:
+                iso_path = unpack_image(
+                    iso_path,
+                    should_stop=self.isInterruptionRequested,
+                    on_progress=lambda done, total: self.progress.emit(
+                        5 + int(done * 5 / max(1, total))
+                    ),
+                )
+            except (OSError, ImageSourceError) as e:
+                self.log_message.emit(f"Cannot unpack image: {e}")
+                self._emit_finished(False, f"Cannot unpack image: {e}")
+                return
+            self.log_message.emit(f"Unpacked to {iso_path}")
+
         drive = self.target_drive
         iso_mount = "/mnt/justdd_iso"
 
-        if self.partition_scheme == "mbr":
-            self._flash_windows_mbr(drive, iso_mount)
-        else:
-            self._flash_windows_gpt(drive, iso_mount)
+        try:
+            if self.partition_scheme == "mbr":
+                self._flash_windows_mbr(drive, iso_path, iso_mount)
+            else:
+                self._flash_windows_gpt(drive, iso_path, iso_mount)
+        finally:
+            if iso_path != self.iso_path:
+                try:
+                    os.unlink(iso_path)
+                except OSError:
+                    pass
 
-    def _flash_windows_gpt(self, drive, iso_mount):
+    def _flash_windows_gpt(self, drive, iso_path, iso_mount):
         """Flash Windows using GPT partition scheme (UEFI)"""
         p1, p2 = f"{drive}1", f"{drive}2"
         vfat_mount, ntfs_mount = "/mnt/justdd_vfat", "/mnt/justdd_ntfs"
@@ -275,7 +589,7 @@ class FlashWorker(QThread):
                 45,
                 ["mkdir", "-p", iso_mount, vfat_mount, ntfs_mount],
             ),
-            ("Mounting ISO", 50, ["mount", "-o", "loop", self.iso_path, iso_mount]),
+            ("Mounting ISO", 50, ["mount", "-o", "loop", iso_path, iso_mount]),
             ("Mounting BOOT partition", 55, ["mount", p1, vfat_mount]),
             (
                 "Copying boot files",
@@ -331,7 +645,7 @@ class FlashWorker(QThread):
 
         self._execute_windows_script(steps, drive, "GPT (UEFI)")
 
-    def _flash_windows_mbr(self, drive, iso_mount):
+    def _flash_windows_mbr(self, drive, iso_path, iso_mount):
         p1 = f"{drive}1"
         ntfs_mount = "/mnt/justdd_ntfs"
 
@@ -369,7 +683,7 @@ class FlashWorker(QThread):
                 45,
                 ["mkdir", "-p", iso_mount, ntfs_mount],
             ),
-            ("Mounting ISO", 50, ["mount", "-o", "loop", self.iso_path, iso_mount]),
+            ("Mounting ISO", 50, ["mount", "-o", "loop", iso_path, iso_mount]),
             ("Mounting Windows partition", 55, ["mount", p1, ntfs_mount]),
             (
                 "Copying Windows files (this takes a long time)",
@@ -588,6 +902,13 @@ class FlashWorker(QThread):
 
                 cancel_file = f"/tmp/justdd_cancel_{os.getpid()}"
 
+                helper = self._get_helper()
+                if helper is not None:
+                    self._run_windows_script_in_helper(
+                        helper, script_path, steps, cancel_file, scheme_name
+                    )
+                    return
+
                 self._process = subprocess.Popen(
                     ["pkexec", "bash", script_path],
                     stdout=subprocess.PIPE,
@@ -605,7 +926,7 @@ class FlashWorker(QThread):
                         )
                     except Exception:
                         pass
-                    self.finished.emit(False, "Windows script has no stdout")
+                    self._emit_finished(False, "Windows script has no stdout")
                     return
 
                 while True:
@@ -674,14 +995,14 @@ class FlashWorker(QThread):
                     self.status_update.emit(
                         f"Windows USB preparation completed ({scheme_name})!"
                     )
-                    self.finished.emit(
+                    self._emit_finished(
                         True, f"Windows USB created successfully with {scheme_name}!"
                     )
                 elif return_code == 130:
                     self.log_message.emit("Operation cancelled by user")
                     return
                 else:
-                    self.finished.emit(
+                    self._emit_finished(
                         False,
                         f"Windows USB preparation failed with exit code {return_code}",
                     )
@@ -691,7 +1012,7 @@ class FlashWorker(QThread):
                     self.log_message.emit(
                         f"Error executing Windows USB script: {str(e)}"
                     )
-                    self.finished.emit(
+                    self._emit_finished(
                         False, f"Windows USB preparation failed: {str(e)}"
                     )
             finally:
@@ -707,4 +1028,57 @@ class FlashWorker(QThread):
         except Exception as e:
             if not self.isInterruptionRequested():
                 self.log_message.emit(f"Windows USB preparation failed: {str(e)}")
-                self.finished.emit(False, f"Windows USB preparation failed: {str(e)}")
+                self._emit_finished(False, f"Windows USB preparation failed: {str(e)}")
+
+    def _run_windows_script_in_helper(
+        self, helper, script_path, steps, cancel_file, scheme_name
+    ):
+        def should_stop():
+            if not self.isInterruptionRequested():
+                return False
+            try:
+                with open(cancel_file, "w") as f:
+                    f.write("cancel")
+            except Exception as e:
+                self.log_message.emit(f"Failed to write cancel file: {e}")
+            return True
+
+        def on_output(line):
+            line = line.strip()
+            self.log_message.emit(line)
+            if line.startswith("Step "):
+                try:
+                    step_info = line.split(": ", 1)
+                    if len(step_info) > 1:
+                        step_num = int(step_info[0].split()[1].split("/")[0])
+                        if step_num <= len(steps):
+                            self.progress.emit(steps[step_num - 1][1])
+                            self.status_update.emit(step_info[1])
+                except (ValueError, IndexError):
+                    pass
+
+        try:
+            return_code = helper.run(
+                ["bash", script_path], on_output=on_output, should_stop=should_stop
+            )
+        finally:
+            try:
+                if os.path.exists(cancel_file):
+                    os.unlink(cancel_file)
+            except Exception:
+                pass
+
+        if self.isInterruptionRequested() or return_code == 130:
+            self.log_message.emit("Windows USB preparation cancelled")
+        elif return_code == 0:
+            self.progress.emit(100)
+            self.status_update.emit(
+                f"Windows USB preparation completed ({scheme_name})!"
+            )
+            self._emit_finished(
+                True, f"Windows USB created successfully with {scheme_name}!"
+            )
+        else:
+            self._emit_finished(
+                False, f"Windows USB preparation failed with exit code {return_code}"
+            )
@@ -0,0 +1,527 @@
+"""
+Allocation maps of the filesystems on a disk image or device.
+
+`read_allocation()` parses the partition table (see `partition_table`) and,
+for every partition holding an ext2/3/4, FAT12/16/32 or exFAT filesystem,
+the filesystem's own record of which clusters are in use:
+
+- ext2/3/4: the block bitmap of every block group. Groups flagged
+  BLOCK_UNINIT have no bitmap on disk; only their metadata blocks are used.
+- FAT12/16/32: the first file allocation table; clusters whose entry is zero
+  are free.
+- exFAT: the allocation bitmap listed in the root directory.
+
+Everything not known to be free is kept: the partition table, gaps between
+partitions (boot loaders live there), filesystem metadata and partitions
+with any other filesystem. The slack after the last partition is free, apart
+from a backup GPT. A device with a FAT/exFAT boot sector at sector 0 or an
+ext superblock at byte 1024 is treated as one unpartitioned filesystem.
+
+Free runs shorter than `MIN_FREE_RUN` are kept as well, reading through them
+is cheaper than splitting the reads, and the mapped `ranges` are aligned to
+`ALLOCATION_ALIGN` so they can be read with `O_DIRECT`.
+`BackupEngine(skip_free=True)` reads only those ranges and records them in a
+block map next to the image (see `bmap`).
+
+Usage (example):
+    allocation = read_allocation('/dev/sdb')
+    if allocation is not None:
+        print(allocation.describe())
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import struct
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from .partition_table import (
+    LAYOUT_ALIGN,
+    PartitionLayout,
+    _format_size,
+    read_partition_layout,
+)
+
+ALLOCATION_ALIGN = LAYOUT_ALIGN
+# Free runs shorter than this are read anyway.
+MIN_FREE_RUN = 1024 * 1024
+
+_EXT_MAGIC = 0xEF53
+_EXT_SUPERBLOCK = 1024
+_EXT_COMPAT_HAS_JOURNAL = 0x4
+_EXT_COMPAT_SPARSE_SUPER2 = 0x200
+_EXT_INCOMPAT_META_BG = 0x10
+_EXT_INCOMPAT_EXTENTS = 0x40
+_EXT_INCOMPAT_64BIT = 0x80
+_EXT_INCOMPAT_FLEX_BG = 0x200
+_EXT_RO_COMPAT_SPARSE_SUPER = 0x1
+_EXT_RO_COMPAT_BIGALLOC = 0x200
+_EXT_BG_BLOCK_UNINIT = 0x2
+
+_EXFAT_NAME = b"EXFAT   "
+_EXFAT_BITMAP_ENTRY = 0x81
+_EXFAT_END_OF_CHAIN = 0xFFFFFFF7
+_FAT_SECTOR_SIZES = (512, 1024, 2048, 4096)
+# Cluster counts separating FAT12, FAT16 and FAT32 (Microsoft FAT spec).
+_FAT12_MAX_CLUSTERS = 4085
+_FAT16_MAX_CLUSTERS = 65525
+# Upper bound on clusters followed in a FAT chain, guards against loops.
+_MAX_CHAIN = 1 << 20
+
+
+class FilesystemError(Exception):
+    """Raised when a filesystem's allocation structures are inconsistent."""
+
+
+@dataclass
+class Filesystem:
+    """A filesystem whose free space is known; offsets are in bytes."""
+
+    # "ext2", "ext3", "ext4", "fat12", "fat16", "fat32" or "exfat".
+    kind: str
+    start: int
+    size: int
+    cluster_size: int
+    # Free (start, end) ranges from the image start, in order.
+    free: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def free_bytes(self) -> int:
+        return sum(end - start for start, end in self.free)
+
+
+@dataclass
+class AllocationMap:
+    """The parts of an image that hold data."""
+
+    image_size: int
+    filesystems: List[Filesystem] = field(default_factory=list)
+    layout: Optional[PartitionLayout] = None
+    # Mapped (start, end) ranges, in order; everything else is free.
+    ranges: List[Tuple[int, int]] = field(default_factory=list)
+
+    @property
+    def mapped_bytes(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def unmapped_bytes(self) -> int:
+        return self.image_size - self.mapped_bytes
+
+    def describe(self) -> str:
+        """Short summary, e.g. "ext4, fat32; 1.2 GB of 7.5 GB in use"."""
+        kinds = ", ".join(fs.kind for fs in self.filesystems) or "no known filesystem"
+        return (
+            f"{kinds}; {_format_size(self.mapped_bytes)} of "
+            f"{_format_size(self.image_size)} in use"
+        )
+
+
+def read_allocation(
+    path: str, fileobj: Optional[BinaryIO] = None
+) -> Optional[AllocationMap]:
+    """
+    Work out which parts of the image or device at `path` (read from
+    `fileobj` when given) hold data. Returns None when it has neither a
+    partition table nor a known filesystem, or cannot be read. Raises
+    PartitionTableError or FilesystemError for structures that do not fit.
+    """
+    try:
+        with open(path, "rb") if fileobj is None else nullcontext(fileobj) as f:
+            size = f.seek(0, os.SEEK_END)
+            layout: Optional[PartitionLayout] = None
+            fs = _probe(f, 0, size)
+            if fs is not None:
+                filesystems = [fs]
+            else:
+                layout = read_partition_layout(path, f)
+                if layout is None:
+                    return None
+                filesystems = []
+                for part in layout.partitions:
+                    fs = _probe(f, part.start, part.size)
+                    if fs is not None:
+                        filesystems.append(fs)
+    except OSError:
+        return None
+
+    free = [run for fs in filesystems for run in fs.free]
+    if layout is not None and layout.slack is not None:
+        free.append(layout.slack)
+    return AllocationMap(size, filesystems, layout, _mapped_ranges(size, free))
+
+
+def _mapped_ranges(size: int, free: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """The complement of the aligned, long enough `free` runs within `size`."""
+    ranges = []
+    offset = 0
+    for start, end in sorted(free):
+        start = -(-start // ALLOCATION_ALIGN) * ALLOCATION_ALIGN
+        end = end // ALLOCATION_ALIGN * ALLOCATION_ALIGN
+        if end - start < MIN_FREE_RUN or end <= offset:
+            continue
+        if start > offset:
+            ranges.append((offset, start))
+        offset = max(offset, end)
+    if offset < size:
+        ranges.append((offset, size))
+    return ranges
+
+
+def _probe(f: BinaryIO, start: int, size: int) -> Optional[Filesystem]:
+    """Parse the filesystem at `start`, None when it is not a known one."""
+    boot = _read_at(f, start, 512)
+    if len(boot) < 512:
+        return None
+    if boot[3:11] == _EXFAT_NAME:
+        return _read_exfat(f, start, size, boot)
+    if _is_fat_boot_sector(boot):
+        return _read_fat(f, start, size, boot)
+    superblock = _read_at(f, start + _EXT_SUPERBLOCK, 1024)
+    if len(superblock) == 1024 and _u16(superblock, 56) == _EXT_MAGIC:
+        return _read_ext(f, start, size, superblock)
+    return None
+
+
+def _read_at(f: BinaryIO, offset: int, length: int) -> bytes:
+    f.seek(offset)
+    return f.read(length)
+
+
+def _u8(data: bytes, offset: int) -> int:
+    return data[offset]
+
+
+def _u16(data: bytes, offset: int) -> int:
+    return struct.unpack_from("<H", data, offset)[0]
+
+
+def _u32(data: bytes, offset: int) -> int:
+    return struct.unpack_from("<I", data, offset)[0]
+
+
+def _u64(data: bytes, offset: int) -> int:
+    return struct.unpack_from("<Q", data, offset)[0]
+
+
+def _zero_runs(data: bytes, min_length: int) -> Iterator[Tuple[int, int]]:
+    """(start, end) of every run of at least `min_length` zero bytes."""
+    pattern = re.compile(b"\\x00{%d,}" % max(1, min_length))
+    for match in pattern.finditer(data):
+        yield match.start(), match.end()
+
+
+def _bitmap_free(
+    bitmap: bytes, unit: int, first_unit_offset: int, units: int
+) -> List[Tuple[int, int]]:
+    """
+    Free ranges of an allocation bitmap (bit set = used, LSB first) whose
+    bit 0 covers `unit` bytes at `first_unit_offset`. Only whole zero bytes
+    count, so runs are found 8 units at a time.
+    """
+    free = []
+    min_bytes = -(-MIN_FREE_RUN // (8 * unit))
+    for low, high in _zero_runs(bitmap, min_bytes):
+        first = low * 8
+        last = min(high * 8, units)
+        if last > first:
+            free.append(
+                (first_unit_offset + first * unit, first_unit_offset + last * unit)
+            )
+    return free
+
+
+# ---- ext2/3/4 ----
+
+
+def _ext_kind(compat: int, incompat: int) -> str:
+    if incompat & (_EXT_INCOMPAT_EXTENTS | _EXT_INCOMPAT_64BIT | _EXT_INCOMPAT_FLEX_BG):
+        return "ext4"
+    return "ext3" if compat & _EXT_COMPAT_HAS_JOURNAL else "ext2"
+
+
+def _ext_has_super(group: int, sparse: bool, backups: Tuple[int, int]) -> bool:
+    """Whether block group `group` carries a superblock backup."""
+    if group == 0:
+        return True
+    if backups != (0, 0):
+        return group in backups
+    if not sparse or group == 1:
+        return True
+    for base in (3, 5, 7):
+        power = base
+        while power < group:
+            power *= base
+        if power == group:
+            return True
+    return False
+
+
+def _read_ext(f: BinaryIO, start: int, size: int, sb: bytes) -> Optional[Filesystem]:
+    log_block = _u32(sb, 24)
+    if log_block > 6:
+        raise FilesystemError(f"ext superblock at byte {start} is corrupt")
+    block_size = 1024 << log_block
+    compat, incompat, ro_compat = struct.unpack_from("<III", sb, 92)
+    kind = _ext_kind(compat, incompat)
+    if ro_compat & _EXT_RO_COMPAT_BIGALLOC:
+        # The bitmaps count clusters, not blocks; keep the whole filesystem.
+        return None
+    blocks = _u32(sb, 4)
+    if incompat & _EXT_INCOMPAT_64BIT:
+        blocks |= _u32(sb, 0x150) << 32
+    first_data_block = _u32(sb, 20)
+    per_group = _u32(sb, 32)
+    inodes_per_group = _u32(sb, 40)
+    inode_size = _u16(sb, 88) if _u32(sb, 76) >= 1 else 128
+    if not per_group or per_group > 8 * block_size or blocks * block_size > size:
+        raise FilesystemError(f"{kind} at byte {start} does not fit its partition")
+    desc_size = 32
+    if incompat & _EXT_INCOMPAT_64BIT:
+        desc_size = max(64, _u16(sb, 254))
+    groups = -(-(blocks - first_data_block) // per_group)
+    gdt_blocks = -(-(groups * desc_size) // block_size)
+    reserved_gdt = _u16(sb, 0xCE)
+    sparse = bool(ro_compat & _EXT_RO_COMPAT_SPARSE_SUPER)
+    backups = (
+        struct.unpack_from("<II", sb, 0x24C)
+        if compat & _EXT_COMPAT_SPARSE_SUPER2
+        else (0, 0)
+    )
+    table_blocks = -(-(inodes_per_group * inode_size) // block_size)
+    # With META_BG the descriptors from meta group `first_meta_bg` on lie in
+    # their own meta group (one descriptor block per `per_block` groups).
+    per_block = block_size // desc_size
+    first_meta_bg = gdt_blocks
+    if incompat & _EXT_INCOMPAT_META_BG:
+        first_meta_bg = min(_u32(sb, 0x104), gdt_blocks)
+
+    def has_super(group: int) -> bool:
+        return _ext_has_super(group, sparse, backups)
+
+    def group_start(group: int) -> int:
+        return first_data_block + group * per_group
+
+    descriptors = _read_at(
+        f, start + (first_data_block + 1) * block_size, first_meta_bg * block_size
+    )
+    for meta_group in range(first_meta_bg, gdt_blocks):
+        group = meta_group * per_block
+        block = group_start(group) + has_super(group)
+        descriptors += _read_at(f, start + block * block_size, block_size)
+    if len(descriptors) < groups * desc_size:
+        raise FilesystemError(f"{kind} at byte {start}: group descriptors cut short")
+
+    # (first block, block count) of the bitmaps and inode tables, by the
+    # groups they lie in.
+    metadata: Dict[int, List[Tuple[int, int]]] = {}
+    flags: List[int] = []
+    bitmap_blocks: List[int] = []
+    for group in range(groups):
+        raw = descriptors[group * desc_size : (group + 1) * desc_size]
+        block_bitmap, inode_bitmap, inode_table = struct.unpack_from("<III", raw, 0)
+        if desc_size >= 64:
+            block_bitmap |= _u32(raw, 0x20) << 32
+            inode_bitmap |= _u32(raw, 0x24) << 32
+            inode_table |= _u32(raw, 0x28) << 32
+        flags.append(_u16(raw, 0x12))
+        bitmap_blocks.append(block_bitmap)
+        for block, count in (
+            (block_bitmap, 1),
+            (inode_bitmap, 1),
+            (inode_table, table_blocks),
+        ):
+            low = (block - first_data_block) // per_group
+            high = (block + count - 1 - first_data_block) // per_group
+            for owner in range(low, high + 1):
+                metadata.setdefault(owner, []).append((block, count))
+
+    # One bitmap for the whole filesystem: bit i is block first_data_block + i.
+    bitmap = bytearray()
+    group_bytes = per_group // 8
+    for group in range(groups):
+        first = group_start(group)
+        if flags[group] & _EXT_BG_BLOCK_UNINIT:
+            uninit = bytearray(group_bytes)
+            used = list(metadata.get(group, ()))
+            # Superblock backup and descriptors, as ext2fs_super_and_bgd_loc2().
+            if group // per_block < first_meta_bg:
+                if has_super(group):
+                    used.append((first, 1 + first_meta_bg + reserved_gdt))
+            else:
+                if has_super(group):
+                    used.append((first, 1))
+                if group % per_block in (0, 1, per_block - 1):
+                    used.append((first + has_super(group), 1))
+            for block, count in used:
+                for bit in range(
+                    max(block, first), min(block + count, first + per_group)
+                ):
+                    uninit[(bit - first) // 8] |= 1 << ((bit - first) % 8)
+            bitmap += uninit
+            continue
+        raw = _read_at(f, start + bitmap_blocks[group] * block_size, group_bytes)
+        if len(raw) < group_bytes:
+            raise FilesystemError(f"{kind} at byte {start}: block bitmap cut short")
+        bitmap += raw
+
+    free = _bitmap_free(
+        bytes(bitmap),
+        block_size,
+        start + first_data_block * block_size,
+        blocks - first_data_block,
+    )
+    return Filesystem(kind, start, blocks * block_size, block_size, free)
+
+
+# ---- FAT12/16/32 ----
+
+
+def _is_fat_boot_sector(boot: bytes) -> bool:
+    if boot[0] not in (0xEB, 0xE9) or boot[510:512] != b"\x55\xaa":
+        return False
+    sector_size = _u16(boot, 11)
+    per_cluster = _u8(boot, 13)
+    return (
+        sector_size in _FAT_SECTOR_SIZES
+        and per_cluster
+        and not per_cluster & (per_cluster - 1)
+        and _u16(boot, 14) > 0
+        and _u8(boot, 16) > 0
+    )
+
+
+def _read_fat(f: BinaryIO, start: int, size: int, boot: bytes) -> Filesystem:
+    sector_size = _u16(boot, 11)
+    per_cluster = _u8(boot, 13)
+    reserved = _u16(boot, 14)
+    fats = _u8(boot, 16)
+    root_entries = _u16(boot, 17)
+    sectors = _u16(boot, 19) or _u32(boot, 32)
+    fat_sectors = _u16(boot, 22) or _u32(boot, 36)
+    root_sectors = -(-(root_entries * 32) // sector_size)
+    data_sector = reserved + fats * fat_sectors + root_sectors
+    if sectors * sector_size > size or data_sector >= sectors:
+        raise FilesystemError(f"FAT at byte {start} does not fit its partition")
+    clusters = (sectors - data_sector) // per_cluster
+    if clusters < _FAT12_MAX_CLUSTERS:
+        kind, width = "fat12", 0
+    elif clusters < _FAT16_MAX_CLUSTERS:
+        kind, width = "fat16", 2
+    else:
+        kind, width = "fat32", 4
+    cluster_size = sector_size * per_cluster
+    heap = start + data_sector * sector_size
+
+    table = _read_at(f, start + reserved * sector_size, fat_sectors * sector_size)
+    entries = min(
+        clusters + 2, len(table) * 2 // 3 if not width else len(table) // width
+    )
+    if entries < clusters + 2:
+        raise FilesystemError(f"{kind} at byte {start}: allocation table too short")
+    free: List[Tuple[int, int]] = []
+    if not width:
+        # Small enough to check entry by entry.
+        run = None
+        for cluster in range(2, entries + 1):
+            is_free = cluster < entries and _fat12_entry(table, cluster) == 0
+            if is_free and run is None:
+                run = cluster
+            elif not is_free and run is not None:
+                free.append(
+                    (
+                        heap + (run - 2) * cluster_size,
+                        heap + (cluster - 2) * cluster_size,
+                    )
+                )
+                run = None
+    else:
+        min_bytes = max(width, -(-MIN_FREE_RUN // cluster_size) * width)
+        for low, high in _zero_runs(table[: entries * width], min_bytes):
+            # Entries lying wholly inside the zero run are free.
+            first = max(2, -(-low // width))
+            last = high // width
+            if last > first:
+                free.append(
+                    (
+                        heap + (first - 2) * cluster_size,
+                        heap + (last - 2) * cluster_size,
+                    )
+                )
+    return Filesystem(kind, start, sectors * sector_size, cluster_size, free)
+
+
+def _fat12_entry(table: bytes, cluster: int) -> int:
+    pos = cluster * 3 // 2
+    value = table[pos] | table[pos + 1] << 8
+    return value >> 4 if cluster & 1 else value & 0xFFF
+
+
+# ---- exFAT ----
+
+
+def _read_exfat(f: BinaryIO, start: int, size: int, boot: bytes) -> Filesystem:
+    sector_shift = _u8(boot, 108)
+    cluster_shift = _u8(boot, 109)
+    if not 9 <= sector_shift <= 12 or sector_shift + cluster_shift > 25:
+        raise FilesystemError(f"exFAT boot sector at byte {start} is corrupt")
+    sector_size = 1 << sector_shift
+    cluster_size = sector_size << cluster_shift
+    length = _u64(boot, 72) * sector_size
+    fat_offset = start + _u32(boot, 80) * sector_size
+    fat_length = _u32(boot, 84) * sector_size
+    heap = start + _u32(boot, 88) * sector_size
+    clusters = _u32(boot, 92)
+    root_cluster = _u32(boot, 96)
+    active_fat = _u16(boot, 106) & 1
+    if length > size or heap + clusters * cluster_size > start + size:
+        raise FilesystemError(f"exFAT at byte {start} does not fit its partition")
+    table = _read_at(f, fat_offset, fat_length)
+
+    def cluster_data(first: int, nbytes: int) -> bytes:
+        data = bytearray()
+        cluster = first
+        for _ in range(_MAX_CHAIN):
+            if not 2 <= cluster < clusters + 2 or len(data) >= nbytes:
+                break
+            data += _read_at(f, heap + (cluster - 2) * cluster_size, cluster_size)
+            if 4 * cluster + 4 > len(table):
+                break
+            following = _u32(table, 4 * cluster)
+            if following >= _EXFAT_END_OF_CHAIN:
+                break
+            # A zero entry means the chain was not recorded: it is contiguous.
+            cluster = following or cluster + 1
+        return bytes(data[:nbytes])
+
+    # The allocation bitmap is listed in the root directory.
+    bitmap_entry = None
+    root = cluster_data(root_cluster, _MAX_CHAIN)
+    for pos in range(0, len(root) - 31, 32):
+        entry_type = root[pos]
+        if entry_type == 0:
+            break
+        if entry_type == _EXFAT_BITMAP_ENTRY and (root[pos + 1] & 1) == active_fat:
+            bitmap_entry = root[pos : pos + 32]
+            break
+    if bitmap_entry is None:
+        raise FilesystemError(f"exFAT at byte {start} has no allocation bitmap")
+    nbytes = min(_u64(bitmap_entry, 24), -(-clusters // 8))
+    bitmap = cluster_data(_u32(bitmap_entry, 20), nbytes)
+    if len(bitmap) < -(-clusters // 8):
+        raise FilesystemError(f"exFAT at byte {start}: allocation bitmap cut short")
+    free = _bitmap_free(bitmap, cluster_size, heap, clusters)
+    return Filesystem("exfat", start, length, cluster_size, free)
+
+
+__all__ = [
+    "ALLOCATION_ALIGN",
+    "MIN_FREE_RUN",
+    "AllocationMap",
+    "Filesystem",
+    "FilesystemError",
+    "read_allocation",
+]
@@ -0,0 +1,499 @@
+"""
+Privileged helper (server side)
+
+A long-lived process that performs the operations needing root on behalf of
+the GUI, so a session authenticates once instead of spawning a new `pkexec`
+for every flash. `PrivilegedHelper` (see `priv_helper`) starts it with
+`pkexec python3 helper_server.py`, or without pkexec as a non-root stand-in
+that can only reach what the user can (e.g. file targets, used by the tests).
+
+pkexec clears the environment, so this file only uses the standard library and
+runs as a plain script.
+
+Protocol: the helper's stdin is one end of an AF_UNIX socketpair whose other
+end only the GUI process holds. Messages in both directions are a 4-byte
+big-endian length followed by a UTF-8 JSON object. Every request carries an
+"id" and a "cmd"; the helper answers it with one final message,
+{"id", "ok": true, ...} or {"id", "ok": false, "error": "..."}, and may send
+{"id", "progress": [done, total]} or {"id", "output": "line"} before that. Failed requests carry the "errno" of
+the OSError behind them. A reply with "fds": n is sent together with n file
+descriptors (SCM_RIGHTS) that now belong to the GUI.
+
+Commands:
+    hello                               -> uid, pid, version
+    open {path, create}                 -> handle (device opened for writing;
+                                           `create` makes missing files,
+                                           never paths under /dev)
+    open_read {path, direct}            -> fds: 1, the path opened read-only
+                                           (O_DIRECT if `direct`)
+    write {handle, offset, size}        -> followed by `size` raw bytes
+    copy {handle, offset, length, source_offset, flush_window, rate}
+                                        -> the source fd travels as SCM_RIGHTS;
+                                           copied in the kernel with progress,
+                                           paced to `rate` bytes/s if given
+    sync {handle} / close {handle}
+    bdi_limit {bdi, max_ratio, strict}  -> caps the dirty pages of a BDI (see
+                                           blockdev.BdiDirtyLimit)
+    bdi_restore {bdi}                   -> puts its previous limits back; also
+                                           done when the GUI goes away
+    mount {device, mountpoint, fstype, options} / umount {target}
+    format {device, fstype, label}      -> streams the mkfs output
+    run {argv}                          -> streams output, returns returncode
+    cancel {target}                     -> stops a running copy/run/format
+    quit
+
+Long operations run in their own thread so that "cancel" can be received
+while they are in progress.
+"""
+
+import array
+import errno
+import json
+import os
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+PROTOCOL_VERSION = 1
+
+_HEADER = struct.Struct(">I")
+# Largest JSON message accepted (payloads of "write" are not messages).
+_MAX_MESSAGE = 1024 * 1024
+_COPY_CHUNK = 4 * 1024 * 1024
+_PROGRESS_STEP = 8 * 1024 * 1024
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP}
+_SYS_CLASS_BDI = "/sys/class/bdi"
+
+# mkfs invocations per filesystem: (program, options..., label option).
+_MKFS = {
+    "vfat": ["mkfs.vfat", "-F", "32", "-n"],
+    "fat32": ["mkfs.vfat", "-F", "32", "-n"],
+    "exfat": ["mkfs.exfat", "-n"],
+    "ntfs": ["mkfs.ntfs", "-f", "-L"],
+    "ext4": ["mkfs.ext4", "-F", "-L"],
+}
+
+
+class HelperServer:
+    """Serves the requests arriving on `sock` until it is closed or "quit"."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._send_lock = threading.Lock()
+        self._handles = {}
+        self._next_handle = 1
+        self._fds = []
+        self._operations = {}
+        # Previous sysfs values of the BDIs capped by "bdi_limit".
+        self._bdi_saved = {}
+        self._running = True
+
+    # ---- Transport ----
+    def send(self, message, fds=()) -> None:
+        data = json.dumps(message).encode("utf-8")
+        frame = _HEADER.pack(len(data)) + data
+        with self._send_lock:
+            if fds:
+                ancillary = [
+                    (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))
+                ]
+                sent = self.sock.sendmsg([frame], ancillary)
+                self.sock.sendall(frame[sent:])
+            else:
+                self.sock.sendall(frame)
+
+    def _recv_exact(self, size: int) -> bytes:
+        chunks = []
+        fd_space = socket.CMSG_SPACE(16 * array.array("i").itemsize)
+        while size:
+            data, ancdata, _flags, _addr = self.sock.recvmsg(
+                min(size, 1024 * 1024), fd_space
+            )
+            if not data:
+                raise EOFError("client went away")
+            for level, kind, payload in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array("i")
+                    fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+                    self._fds.extend(fds)
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def _recv_message(self):
+        (size,) = _HEADER.unpack(self._recv_exact(_HEADER.size))
+        if size > _MAX_MESSAGE:
+            raise ValueError(f"message too large ({size} bytes)")
+        return json.loads(self._recv_exact(size).decode("utf-8"))
+
+    # ---- Main loop ----
+    def serve(self) -> None:
+        try:
+            while self._running:
+                request = self._recv_message()
+                try:
+                    self._dispatch(request)
+                finally:
+                    self._close_stray_fds()
+        except EOFError:
+            pass
+        finally:
+            self._close_stray_fds()
+            for op in list(self._operations.values()):
+                op.cancel()
+            for fd in self._handles.values():
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            for name in list(self._bdi_saved):
+                self._restore_bdi(name)
+
+    def _close_stray_fds(self) -> None:
+        # Only "copy" takes a descriptor; any other one the GUI sent (with
+        # another request, or more than one) must not stay open as root.
+        fds, self._fds = self._fds, []
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _dispatch(self, request) -> None:
+        req_id = request.get("id")
+        cmd = request.get("cmd")
+        handler = getattr(self, f"_cmd_{cmd}", None) if isinstance(cmd, str) else None
+        if handler is None:
+            self.send({"id": req_id, "ok": False, "error": f"unknown command {cmd!r}"})
+            return
+        if cmd in ("copy", "run", "format", "mount", "umount"):
+            op = _Operation()
+            self._operations[req_id] = op
+            # The source fd of "copy" arrived with this request.
+            fd = self._fds.pop(0) if cmd == "copy" and self._fds else None
+            threading.Thread(
+                target=self._run_operation,
+                args=(handler, request, op, fd),
+                daemon=True,
+            ).start()
+            return
+        self._reply(req_id, handler, request)
+
+    def _reply(self, req_id, handler, *args) -> None:
+        fds = []
+        try:
+            result = handler(*args) or {}
+            # Descriptors handed to the GUI travel with the reply.
+            fds = result.pop("pass_fds", [])
+            if fds:
+                result["fds"] = len(fds)
+            result.update({"id": req_id, "ok": True})
+        except Exception as e:
+            result = {"id": req_id, "ok": False, "error": str(e)}
+            if isinstance(e, OSError) and e.errno:
+                result["errno"] = e.errno
+        try:
+            self.send(result, fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _run_operation(self, handler, request, op, fd) -> None:
+        req_id = request.get("id")
+        try:
+            self._reply(req_id, handler, request, op, fd)
+        finally:
+            self._operations.pop(req_id, None)
+            if fd is not None:
+                os.close(fd)
+
+    # ---- Commands ----
+    def _cmd_hello(self, request):
+        return {"version": PROTOCOL_VERSION, "uid": os.geteuid(), "pid": os.getpid()}
+
+    def _cmd_quit(self, request):
+        self._running = False
+        return {}
+
+    def _cmd_open(self, request):
+        path = request["path"]
+        flags = os.O_WRONLY | os.O_CLOEXEC
+        # Never create anything under /dev: a missing node is an unplugged
+        # device, not a file to make as root.
+        if (
+            request.get("create")
+            and not os.path.abspath(path).startswith("/dev/")
+            and not os.path.exists(path)
+        ):
+            flags |= os.O_CREAT
+        fd = os.open(path, flags, 0o644)
+        handle = self._next_handle
+        self._next_handle += 1
+        self._handles[handle] = fd
+        st = os.fstat(fd)
+        size = os.lseek(fd, 0, os.SEEK_END) if stat.S_ISBLK(st.st_mode) else 0
+        return {"handle": handle, "size": size, "is_file": stat.S_ISREG(st.st_mode)}
+
+    def _cmd_open_read(self, request):
+        flags = os.O_RDONLY | os.O_CLOEXEC
+        if request.get("direct"):
+            flags |= getattr(os, "O_DIRECT", 0)
+        return {"pass_fds": [os.open(request["path"], flags)]}
+
+    def _fd(self, request) -> int:
+        try:
+            return self._handles[request["handle"]]
+        except KeyError:
+            raise ValueError("unknown handle") from None
+
+    def _cmd_write(self, request):
+        # The payload must be consumed even when the handle is invalid.
+        data = self._recv_exact(int(request["size"]))
+        fd = self._fd(request)
+        view = memoryview(data)
+        offset = int(request["offset"])
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+        return {"written": len(data)}
+
+    def _cmd_sync(self, request):
+        os.fsync(self._fd(request))
+        return {}
+
+    def _cmd_close(self, request):
+        fd = self._handles.pop(request["handle"], None)
+        if fd is not None:
+            os.close(fd)
+        return {}
+
+    def _cmd_truncate(self, request):
+        os.ftruncate(self._fd(request), int(request["length"]))
+        return {}
+
+    def _cmd_bdi_limit(self, request):
+        name = request["bdi"]
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError(f"bad BDI name {name!r}")
+        max_ratio = int(request["max_ratio"])
+        if not 0 < max_ratio <= 100:
+            raise ValueError("max_ratio must be between 1 and 100")
+        directory = os.path.join(_SYS_CLASS_BDI, name)
+        settings = [("max_ratio", str(max_ratio))]
+        if request.get("strict", True) and os.path.exists(
+            os.path.join(directory, "strict_limit")
+        ):
+            settings.append(("strict_limit", "1"))
+        saved = self._bdi_saved.setdefault(name, {})
+        try:
+            for key, value in settings:
+                path = os.path.join(directory, key)
+                with open(path) as f:
+                    current = f.read().strip()
+                with open(path, "w") as f:
+                    f.write(value)
+                saved.setdefault(key, current)
+        except OSError:
+            self._restore_bdi(name)
+            raise
+        return {}
+
+    def _cmd_bdi_restore(self, request):
+        self._restore_bdi(request["bdi"])
+        return {}
+
+    def _restore_bdi(self, name) -> None:
+        saved = self._bdi_saved.pop(name, {})
+        # strict_limit first: max_ratio may still be capped while it is lifted.
+        for key in sorted(saved, reverse=True):
+            try:
+                with open(os.path.join(_SYS_CLASS_BDI, name, key), "w") as f:
+                    f.write(saved[key])
+            except OSError:
+                pass
+
+    def _cmd_cancel(self, request):
+        op = self._operations.get(request.get("target"))
+        if op is not None:
+            op.cancel()
+        return {"cancelled": op is not None}
+
+    def _cmd_copy(self, request, op, src_fd):
+        if src_fd is None:
+            raise ValueError("copy needs the source file descriptor")
+        fd = self._fd(request)
+        offset = int(request.get("offset", 0))
+        src_offset = int(request.get("source_offset", 0))
+        length = int(request["length"])
+        flush_window = int(request.get("flush_window", 0))
+        rate = int(request.get("rate", 0))
+        started = time.monotonic()
+        copier = _KernelCopy(src_fd, fd)
+        done = 0
+        reported = 0
+        flushed = 0
+        while done < length:
+            if op.cancelled:
+                raise InterruptedError("cancelled")
+            n = copier.copy(
+                src_offset + done, offset + done, min(_COPY_CHUNK, length - done)
+            )
+            if not n:
+                raise EOFError(f"source ended after {done} bytes")
+            done += n
+            if rate:
+                # Sleep until the average since the start is back at `rate`.
+                ahead = done / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+            if flush_window and done - flushed >= flush_window:
+                os.fdatasync(fd)
+                flushed = done
+            if done - reported >= _PROGRESS_STEP or done == length:
+                self.send({"id": request["id"], "progress": [done, length]})
+                reported = done
+        return {"copied": done, "method": copier.method}
+
+    def _cmd_mount(self, request, op, _fd):
+        mountpoint = request["mountpoint"]
+        os.makedirs(mountpoint, exist_ok=True)
+        argv = ["mount"]
+        if request.get("fstype"):
+            argv += ["-t", request["fstype"]]
+        if request.get("options"):
+            argv += ["-o", request["options"]]
+        return self._cmd_run(
+            {
+                "id": request["id"],
+                "argv": argv + [request["device"], mountpoint],
+                "check": True,
+            },
+            op,
+            None,
+        )
+
+    def _cmd_umount(self, request, op, _fd):
+        return self._cmd_run(
+            {"id": request["id"], "argv": ["umount", request["target"]], "check": True},
+            op,
+            None,
+        )
+
+    def _cmd_format(self, request, op, _fd):
+        fstype = request["fstype"].lower()
+        if fstype not in _MKFS:
+            raise ValueError(f"unsupported filesystem {fstype!r}")
+        argv = _MKFS[fstype] + [request.get("label") or "JUSTDD", request["device"]]
+        return self._cmd_run(
+            {"id": request["id"], "argv": argv, "check": True}, op, None
+        )
+
+    def _cmd_run(self, request, op, _fd):
+        argv = [str(arg) for arg in request["argv"]]
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+        )
+        op.process = process
+        if op.cancelled:
+            process.terminate()
+        assert process.stdout is not None
+        for raw in iter(process.stdout.readline, b""):
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if line:
+                self.send({"id": request["id"], "output": line})
+        returncode = process.wait()
+        if request.get("check") and returncode != 0:
+            raise RuntimeError(f"{argv[0]} failed with exit code {returncode}")
+        return {"returncode": returncode}
+
+
+class _Operation:
+    """A running long operation that may be cancelled."""
+
+    def __init__(self):
+        self.cancelled = False
+        self.process = None
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+
+
+class _KernelCopy:
+    """Copies file ranges with copy_file_range, splice or pread/pwrite."""
+
+    def __init__(self, src_fd: int, dst_fd: int):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        dst_is_file = stat.S_ISREG(os.fstat(dst_fd).st_mode)
+        methods = ("copy_file_range", "splice") if dst_is_file else ("splice",)
+        self.method = next((m for m in methods if hasattr(os, m)), "pwrite")
+        self._pipe = None
+
+    def copy(self, src_offset: int, dst_offset: int, length: int) -> int:
+        while True:
+            try:
+                return getattr(self, f"_{self.method}")(src_offset, dst_offset, length)
+            except OSError as e:
+                if self.method == "pwrite" or e.errno not in _COPY_UNSUPPORTED:
+                    raise
+                self.method = (
+                    "splice"
+                    if self.method == "copy_file_range" and hasattr(os, "splice")
+                    else "pwrite"
+                )
+
+    def _copy_file_range(self, src_offset: int, dst_offset: int, length: int) -> int:
+        return os.copy_file_range(
+            self.src_fd, self.dst_fd, length, src_offset, dst_offset
+        )
+
+    def _splice(self, src_offset: int, dst_offset: int, length: int) -> int:
+        if self._pipe is None:
+            self._pipe = os.pipe()
+        read_end, write_end = self._pipe
+        n = os.splice(
+            self.src_fd, write_end, min(length, 64 * 1024), offset_src=src_offset
+        )
+        moved = 0
+        while moved < n:
+            moved += os.splice(
+                read_end, self.dst_fd, n - moved, offset_dst=dst_offset + moved
+            )
+        return n
+
+    def _pwrite(self, src_offset: int, dst_offset: int, length: int) -> int:
+        data = os.pread(self.src_fd, length, src_offset)
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.dst_fd, view, dst_offset)
+            view = view[n:]
+            dst_offset += n
+        return len(data)
+
+
+def main() -> int:
+    try:
+        sock = socket.socket(fileno=sys.stdin.fileno())
+    except OSError as e:
+        print(f"justdd helper: stdin is not a socket ({e})", file=sys.stderr)
+        return 2
+    HelperServer(sock).serve()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
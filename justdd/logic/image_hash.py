@@ -0,0 +1,206 @@
+"""
+Image hashing for the flash paths.
+
+`StreamHasher` computes several digests (e.g. SHA-256, SHA-1, MD5) of a byte
+stream in one pass. Every algorithm runs in its own worker thread; `hashlib`
+releases the GIL while hashing large buffers, so the digests are computed in
+parallel with each other and with the device writes. Chunks are handed over
+by reference: the optional `on_done` callback of `submit()` fires once every
+algorithm has consumed the chunk, which lets the flash engine return the
+buffer to its ring only then.
+
+`find_expected_digest()` looks for a checksum file next to an image
+(`SHA256SUMS`, `<image>.sha256`, `*.sha256`, ...) and returns the digest it
+lists for the image, so the flash paths can check it automatically.
+"""
+
+from __future__ import annotations
+
+import glob
+import hashlib
+import os
+import queue
+import re
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Checksum files looked up next to the image, per algorithm. Entries with a
+# wildcard are globbed; "{name}" is replaced by the image file name.
+_CHECKSUM_FILES = {
+    "sha256": (
+        "{name}.sha256",
+        "{name}.sha256sum",
+        "SHA256SUMS",
+        "SHA256SUMS.txt",
+        "sha256sum.txt",
+        "*.sha256",
+    ),
+    "sha512": ("{name}.sha512", "SHA512SUMS", "*.sha512"),
+    "sha1": ("{name}.sha1", "SHA1SUMS", "*.sha1"),
+    "md5": ("{name}.md5", "MD5SUMS", "*.md5"),
+}
+
+# "<digest> <name>", "<digest> *<name>" (GNU) or "SHA256 (<name>) = <digest>" (BSD).
+_GNU_LINE = re.compile(r"^\\?([0-9a-fA-F]{32,128})\s+[ *]?(.+?)\s*$")
+_BSD_LINE = re.compile(r"^(\w+)\s*\((.+)\)\s*=\s*([0-9a-fA-F]{32,128})\s*$")
+
+# Chunks queued per algorithm before `submit()` blocks.
+_QUEUE_DEPTH = 8
+
+_STOP = None
+
+
+class _Pending:
+    """Counts the workers that still have to consume a chunk."""
+
+    __slots__ = ("remaining", "on_done", "lock")
+
+    def __init__(self, count: int, on_done: Optional[Callable[[], None]]):
+        self.remaining = count
+        self.on_done = on_done
+        self.lock = threading.Lock()
+
+    def release(self) -> None:
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last and self.on_done is not None:
+            self.on_done()
+
+
+class StreamHasher:
+    """Compute the digests of a stream in one worker thread per algorithm."""
+
+    def __init__(self, algorithms: Iterable[str]):
+        self.algorithms: List[str] = []
+        for name in algorithms:
+            name = name.lower().replace("-", "")
+            if name not in self.algorithms:
+                hashlib.new(name)  # raises ValueError for unknown algorithms
+                self.algorithms.append(name)
+
+        self.bytes_hashed = 0
+        self._hashes = {name: hashlib.new(name) for name in self.algorithms}
+        self._queues: Dict[str, "queue.Queue"] = {}
+        self._threads: List[threading.Thread] = []
+        self._error: Optional[BaseException] = None
+        for name in self.algorithms:
+            q: "queue.Queue" = queue.Queue(maxsize=_QUEUE_DEPTH)
+            thread = threading.Thread(
+                target=self._work,
+                args=(self._hashes[name], q),
+                name=f"justdd-hash-{name}",
+                daemon=True,
+            )
+            self._queues[name] = q
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, data, on_done: Optional[Callable[[], None]] = None) -> None:
+        """
+        Queue `data` (bytes or a memoryview) for every algorithm. `data` must
+        stay unchanged until `on_done()` is called.
+        """
+        if not self.algorithms:
+            if on_done is not None:
+                on_done()
+            return
+        pending = _Pending(len(self.algorithms), on_done)
+        self.bytes_hashed += len(data)
+        for q in self._queues.values():
+            q.put((data, pending))
+
+    def finish(self) -> Dict[str, str]:
+        """Wait for the queued chunks and return {algorithm: hex digest}."""
+        self._stop()
+        if self._error is not None:
+            raise self._error
+        return {name: h.hexdigest() for name, h in self._hashes.items()}
+
+    def abort(self) -> None:
+        """Stop the workers; queued chunks are still released, digests are invalid."""
+        self._stop()
+
+    def _stop(self) -> None:
+        for q in self._queues.values():
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._queues = {}
+
+    def _work(self, hasher, q: "queue.Queue") -> None:
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            data, pending = item
+            del item
+            try:
+                if self._error is None:
+                    hasher.update(data)
+            except BaseException as e:
+                self._error = e
+            finally:
+                del data
+                pending.release()
+
+
+# ---- Checksum files ----
+def _parse_checksum_file(path: str, algorithm: str) -> List[Tuple[str, str]]:
+    """Return the (file name, digest) entries of a checksum file."""
+    entries: List[Tuple[str, str]] = []
+    try:
+        with open(path, "r", errors="replace") as f:
+            lines = f.read(1024 * 1024).splitlines()
+    except OSError:
+        return entries
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        bsd = _BSD_LINE.match(line)
+        if bsd:
+            if bsd.group(1).lower().replace("-", "") == algorithm:
+                entries.append((bsd.group(2), bsd.group(3).lower()))
+            continue
+        gnu = _GNU_LINE.match(line)
+        if gnu:
+            entries.append((gnu.group(2), gnu.group(1).lower()))
+        elif re.fullmatch(r"[0-9a-fA-F]{32,128}", line):
+            # Bare digest, as in single-file "<image>.sha256" files.
+            entries.append(("", line.lower()))
+    return entries
+
+
+def find_expected_digest(
+    image_path: str, algorithm: str = "sha256", name: Optional[str] = None
+) -> Optional[Tuple[str, str]]:
+    """
+    Look for a checksum file next to `image_path` that lists `name` (default:
+    the image's file name). Returns (digest, checksum file path) or None.
+    """
+    algorithm = algorithm.lower().replace("-", "")
+    directory = os.path.dirname(os.path.abspath(image_path))
+    name = name or os.path.basename(image_path)
+    digest_len = hashlib.new(algorithm).digest_size * 2
+
+    candidates: List[str] = []
+    for pattern in _CHECKSUM_FILES.get(algorithm, ()):
+        pattern = os.path.join(directory, pattern.replace("{name}", glob.escape(name)))
+        for path in sorted(glob.glob(pattern)):
+            if path not in candidates and os.path.isfile(path):
+                candidates.append(path)
+
+    for path in candidates:
+        own_file = os.path.basename(path).startswith(name + ".")
+        for listed, digest in _parse_checksum_file(path, algorithm):
+            if len(digest) != digest_len:
+                continue
+            if os.path.basename(listed) == name or (not listed and own_file):
+                return digest, path
+    return None
+
+
+__all__ = ["StreamHasher", "find_expected_digest"]
@@ -0,0 +1,484 @@
+"""
+Image sources for the flash engine.
+
+`open_image_source()` opens an image file and, based on its magic bytes,
+returns a reader that yields the raw disk image: plain images are read as-is,
+`.gz`, `.xz`, `.bz2` and `.zst` images are decompressed on the fly, so they
+stream to the device without a temporary file. For `.zip` archives the disk
+image member is picked (see `zip_image_member()`) and inflated the same way.
+`unpack_image()` decodes to a temporary file where a plain file is needed.
+
+Every source exposes `readinto()` plus enough information for progress:
+- `size` : uncompressed size when the container records it, else None
+- `compressed_size` / `consumed()` : container size and bytes read from it
+
+`progress(bytes_out)` turns the number of image bytes produced into a
+`(done, total)` pair: against the uncompressed size when it is known and
+against the compressed bytes consumed otherwise.
+
+`.zst` images use the optional `zstandard` module and fall back to the
+`zstd` command line tool when it is not installed.
+"""
+
+from __future__ import annotations
+
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zipfile
+from typing import BinaryIO, Callable, Optional, Tuple
+
+_MAGIC_GZIP = b"\x1f\x8b"
+_MAGIC_XZ = b"\xfd7zXZ\x00"
+_MAGIC_BZIP2 = b"BZh"
+_MAGIC_ZSTD = b"\x28\xb5\x2f\xfd"
+_MAGIC_ZIP = b"PK\x03\x04"
+
+COMPRESSED_KINDS = ("gzip", "xz", "bzip2", "zstd", "zip")
+
+# Member names preferred when a zip archive holds more than one file.
+IMAGE_EXTENSIONS = (".iso", ".img", ".raw", ".bin", ".dd")
+# Container suffixes stripped to get the name of the decompressed image.
+_COMPRESSED_SUFFIXES = (".gz", ".xz", ".bz2", ".zst", ".zstd")
+
+
+class ImageSourceError(Exception):
+    """Raised when an image cannot be opened or decoded."""
+
+
+def detect_image_kind(path: str) -> str:
+    """
+    Return "raw", "gzip", "xz", "bzip2", "zstd" or "zip" based on the file's
+    magic bytes.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(8)
+    except OSError:
+        return "raw"
+    if head.startswith(_MAGIC_XZ):
+        return "xz"
+    if head.startswith(_MAGIC_ZSTD):
+        return "zstd"
+    if head.startswith(_MAGIC_GZIP):
+        return "gzip"
+    if head.startswith(_MAGIC_BZIP2) and head[3:4].isdigit():
+        return "bzip2"
+    if head.startswith(_MAGIC_ZIP):
+        return "zip"
+    return "raw"
+
+
+class ImageSource:
+    """A readable disk image (plain or decompressed from a container)."""
+
+    kind = "raw"
+    # Name of the archive member being read, for archive formats.
+    member: Optional[str] = None
+
+    def __init__(self, path: str):
+        self.path = path
+        self._raw = open(path, "rb", buffering=0)
+        self.compressed_size = os.fstat(self._raw.fileno()).st_size
+        self.size: Optional[int] = self.compressed_size
+        self._stream: BinaryIO = self._raw  # type: ignore[assignment]
+
+    @property
+    def compressed(self) -> bool:
+        return self.kind != "raw"
+
+    @property
+    def name(self) -> str:
+        """File name of the decoded image (e.g. "disk.img" for "disk.img.xz")."""
+        if self.member:
+            return os.path.basename(self.member)
+        name = os.path.basename(self.path)
+        if self.compressed and name.lower().endswith(_COMPRESSED_SUFFIXES):
+            return os.path.splitext(name)[0]
+        return name
+
+    def readinto(self, view: memoryview) -> int:
+        return self._stream.readinto(view) or 0
+
+    def skip(self, nbytes: int) -> int:
+        """Advance the decoded stream by up to `nbytes`; returns the bytes skipped."""
+        if self._stream is self._raw:
+            start = self._raw.tell()
+            end = min(start + nbytes, self.compressed_size)
+            self._raw.seek(end)
+            return end - start
+        skipped = 0
+        buf = bytearray(min(nbytes, 1024 * 1024) or 1)
+        with memoryview(buf) as view:
+            while skipped < nbytes:
+                n = self.readinto(view[: min(len(view), nbytes - skipped)])
+                if not n:
+                    break
+                skipped += n
+        return skipped
+
+    def consumed(self) -> int:
+        """Bytes read from the container file so far."""
+        try:
+            return self._raw.tell()
+        except (OSError, ValueError):
+            return 0
+
+    def progress(self, bytes_out: int) -> Tuple[int, int]:
+        if self.size and bytes_out <= self.size:
+            return bytes_out, self.size
+        return self.consumed(), self.compressed_size
+
+    def close(self) -> None:
+        for stream in (self._stream, self._raw):
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def fileno(self) -> int:
+        return self._raw.fileno()
+
+    def __enter__(self) -> "ImageSource":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class GzipImageSource(ImageSource):
+    # ISIZE in the gzip trailer is only the size modulo 4 GiB (and only of the
+    # last member), so it is not trusted; progress follows the compressed input.
+    kind = "gzip"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.size = None
+        self._stream = gzip.GzipFile(fileobj=self._raw, mode="rb")
+
+
+class Bzip2ImageSource(ImageSource):
+    kind = "bzip2"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.size = None
+        self._stream = bz2.BZ2File(self._raw, mode="rb")
+
+
+class XzImageSource(ImageSource):
+    kind = "xz"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.size = xz_uncompressed_size(path)
+        self._stream = lzma.LZMAFile(self._raw, mode="rb")
+
+
+class ZstdImageSource(ImageSource):
+    kind = "zstd"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.size = zstd_content_size(path)
+        self._process: Optional[subprocess.Popen] = None
+        try:
+            import zstandard  # type: ignore
+
+            self._stream = zstandard.ZstdDecompressor().stream_reader(
+                self._raw, read_across_frames=True
+            )
+        except ImportError:
+            self._stream = self._spawn_cli()
+
+    def _spawn_cli(self) -> BinaryIO:
+        exe = shutil.which("zstd")
+        if exe is None:
+            super().close()
+            raise ImageSourceError(
+                "Reading .zst images needs the 'zstandard' Python module "
+                "or the 'zstd' command line tool"
+            )
+        self._process = subprocess.Popen(
+            [exe, "-dc"], stdin=self._raw, stdout=subprocess.PIPE, bufsize=0
+        )
+        assert self._process.stdout is not None
+        return self._process.stdout  # type: ignore[return-value]
+
+    def consumed(self) -> int:
+        if self._process is None:
+            return super().consumed()
+        # The CLI reads the shared file descriptor directly.
+        try:
+            return os.lseek(self._raw.fileno(), 0, os.SEEK_CUR)
+        except OSError:
+            return 0
+
+    def readinto(self, view: memoryview) -> int:
+        n = super().readinto(view)
+        if not n and self._process is not None:
+            code = self._process.wait()
+            if code != 0:
+                raise ImageSourceError(f"zstd exited with code {code}")
+        return n
+
+    def close(self) -> None:
+        super().close()
+        if self._process is not None:
+            try:
+                self._process.kill()
+                self._process.wait(timeout=3)
+            except Exception:
+                pass
+            self._process = None
+
+
+class ZipImageSource(ImageSource):
+    # The uncompressed size comes from the central directory, so progress is
+    # exact even though the member is inflated on the fly.
+    kind = "zip"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        try:
+            self._archive = zipfile.ZipFile(self._raw)
+        except zipfile.BadZipFile as e:
+            super().close()
+            raise ImageSourceError(f"Invalid zip archive: {e}") from e
+
+        info = zip_image_member(self._archive)
+        if info is None:
+            self.close()
+            raise ImageSourceError("Zip archive does not contain a disk image")
+        self.member = info.filename
+        self.size = info.file_size
+        try:
+            self._stream = self._archive.open(info)  # type: ignore[assignment]
+        except (NotImplementedError, RuntimeError) as e:
+            # Unsupported compression method or encrypted member.
+            self.close()
+            raise ImageSourceError(f"Cannot read {info.filename}: {e}") from e
+
+    def close(self) -> None:
+        super().close()
+        try:
+            self._archive.close()
+        except Exception:
+            pass
+
+
+_SOURCES = {
+    "raw": ImageSource,
+    "gzip": GzipImageSource,
+    "xz": XzImageSource,
+    "bzip2": Bzip2ImageSource,
+    "zstd": ZstdImageSource,
+    "zip": ZipImageSource,
+}
+
+
+def open_image_source(path: str) -> ImageSource:
+    """Open `path` as a (possibly compressed) disk image."""
+    return _SOURCES[detect_image_kind(path)](path)
+
+
+def pump_to_pipe(
+    source: ImageSource,
+    pipe,
+    should_stop: Optional[Callable[[], bool]] = None,
+    chunk_size: int = 1024 * 1024,
+    hasher=None,
+) -> None:
+    """
+    Copy the decoded image into `pipe` (e.g. the stdin of an external `dd`)
+    and close it. Stops early when `should_stop()` returns True or the reader
+    of the pipe goes away. Each chunk is also passed to `hasher` (a
+    `StreamHasher`) when given.
+    """
+    out = getattr(pipe, "buffer", pipe)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    try:
+        while not (should_stop and should_stop()):
+            n = source.readinto(view)
+            if not n:
+                break
+            if hasher is not None:
+                hasher.submit(bytes(view[:n]))
+            out.write(view[:n])
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        view.release()
+        try:
+            pipe.close()
+        except Exception:
+            pass
+
+
+def unpack_image(
+    path: str,
+    directory: Optional[str] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    chunk_size: int = 1024 * 1024,
+) -> str:
+    """
+    Decode a compressed image or archive member to a temporary file and
+    return its path; the caller removes it. Needed where a plain file is
+    required (e.g. `mount -o loop`). The file goes to `directory`, else next
+    to the image when that is writable, else the system temporary directory.
+    `on_progress(done, total)` is called per chunk. Raises ImageSourceError,
+    also when `should_stop()` returns True (the partial file is removed).
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.access(directory, os.W_OK):
+            directory = tempfile.gettempdir()
+    with open_image_source(path) as source:
+        stem, ext = os.path.splitext(source.name)
+        fd, out_path = tempfile.mkstemp(
+            prefix=f".{stem}.", suffix=ext or ".img", dir=directory
+        )
+        buf = bytearray(chunk_size)
+        done = 0
+        try:
+            with os.fdopen(fd, "wb") as out, memoryview(buf) as view:
+                while True:
+                    if should_stop and should_stop():
+                        raise ImageSourceError("Unpacking cancelled")
+                    n = source.readinto(view)
+                    if not n:
+                        break
+                    out.write(view[:n])
+                    done += n
+                    if on_progress is not None:
+                        on_progress(*source.progress(done))
+        except BaseException as e:
+            try:
+                os.unlink(out_path)
+            except OSError:
+                pass
+            if isinstance(e, OSError):
+                raise ImageSourceError(f"Cannot unpack {path}: {e}") from e
+            raise
+    return out_path
+
+
+def zip_image_member(archive: zipfile.ZipFile) -> Optional[zipfile.ZipInfo]:
+    """
+    Pick the disk image inside a zip archive: the largest file with a known
+    image extension, or the largest file when none has one.
+    """
+    files = [i for i in archive.infolist() if not i.is_dir() and i.file_size > 0]
+    if not files:
+        return None
+    images = [i for i in files if i.filename.lower().endswith(IMAGE_EXTENSIONS)]
+    return max(images or files, key=lambda i: i.file_size)
+
+
+# ---- Container size probes ----
+def _read_multibyte(buf: bytes, pos: int) -> Tuple[int, int]:
+    """Decode an xz variable-length integer; returns (value, new_pos)."""
+    value = 0
+    for i in range(9):
+        byte = buf[pos + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise ValueError("Invalid xz multibyte integer")
+
+
+def xz_uncompressed_size(path: str) -> Optional[int]:
+    """
+    Sum the uncompressed sizes recorded in the index of every stream of an
+    `.xz` file. Returns None when the file cannot be parsed.
+    """
+    try:
+        with open(path, "rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            total = 0
+            while end > 0:
+                # Skip stream padding (multiples of four NUL bytes).
+                f.seek(end - 4)
+                if f.read(4) == b"\x00\x00\x00\x00":
+                    end -= 4
+                    continue
+
+                f.seek(end - 12)
+                footer = f.read(12)
+                if footer[10:12] != b"YZ":
+                    return None
+                backward_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+                index_start = end - 12 - backward_size
+                f.seek(index_start)
+                index = f.read(backward_size)
+                if not index or index[0] != 0:
+                    return None
+
+                count, pos = _read_multibyte(index, 1)
+                blocks = 0
+                for _ in range(count):
+                    unpadded, pos = _read_multibyte(index, pos)
+                    size, pos = _read_multibyte(index, pos)
+                    total += size
+                    blocks += unpadded + (-unpadded % 4)
+
+                # Stream header (12) + blocks + index + footer (12).
+                end = index_start - blocks - 12
+                if end < 0:
+                    return None
+            return total
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+
+def zstd_content_size(path: str) -> Optional[int]:
+    """
+    Return the content size recorded in the header of the first zstd frame.
+    `zstd` writes a single frame, so this is usually the image size; for
+    multi-frame files it is too small and `ImageSource.progress()` switches
+    to compressed progress once the output exceeds it.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(18)
+    except OSError:
+        return None
+    if len(header) < 6 or not header.startswith(_MAGIC_ZSTD):
+        return None
+
+    descriptor = header[4]
+    fcs_flag = descriptor >> 6
+    single_segment = bool(descriptor & 0x20)
+    dict_id_size = (0, 1, 2, 4)[descriptor & 0x03]
+    fcs_size = (1 if single_segment else 0, 2, 4, 8)[fcs_flag]
+    if fcs_size == 0:
+        return None
+
+    pos = 5 + (0 if single_segment else 1) + dict_id_size
+    field = header[pos : pos + fcs_size]
+    if len(field) != fcs_size:
+        return None
+    value = int.from_bytes(field, "little")
+    return value + 256 if fcs_size == 2 else value
+
+
+__all__ = [
+    "ImageSource",
+    "ImageSourceError",
+    "COMPRESSED_KINDS",
+    "IMAGE_EXTENSIONS",
+    "detect_image_kind",
+    "open_image_source",
+    "pump_to_pipe",
+    "unpack_image",
+    "zip_image_member",
+    "xz_uncompressed_size",
+    "zstd_content_size",
+]
@@ -1,28 +1,55 @@
 import os
 import subprocess
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
+
+from .image_source import ImageSourceError, detect_image_kind, open_image_source
+
+# ISO 9660 volume descriptors start at sector 16 (2048-byte sectors).
+_ISO_SECTOR = 2048
+_ISO_PVD_OFFSET = 16 * _ISO_SECTOR
+
+_WINDOWS_TERMS = ["microsoft", "windows", "win32", "winnt"]
+_LINUX_TERMS = ["linux", "ubuntu", "debian", "fedora", "gnu"]
+# Volume labels of Microsoft media, e.g. "CCCOMA_X64FRE_EN-US_DV9".
+_WINDOWS_LABEL_TERMS = ["x64fre", "x86fre", "a64fre", "cccoma_", "cpba_"]
 
 
 class ISODetector:
     @staticmethod
     def detect_iso_type(iso_path: str) -> Tuple[str, Dict[str, str]]:
         try:
-            try:
-                result = subprocess.run(
-                    ["file", iso_path], capture_output=True, text=True, timeout=5
-                )
-                file_output = result.stdout.lower()
-            except Exception:
+            # `file` and iso-info only see the container of compressed or
+            # zipped images, so those are inspected through the decoded stream.
+            packed = detect_image_kind(iso_path) != "raw"
+            member: Optional[str] = None
+            head = b""
+            packed_size: Optional[int] = None
+            if packed:
                 file_output = ""
+                member, packed_size, head = ISODetector._read_packed_head(iso_path)
+            else:
+                try:
+                    result = subprocess.run(
+                        ["file", iso_path], capture_output=True, text=True, timeout=5
+                    )
+                    file_output = result.stdout.lower()
+                except Exception:
+                    file_output = ""
 
             details = {
                 "name": "Unknown",
                 "version": "Unknown",
                 "architecture": "Unknown",
-                "size": ISODetector._get_file_size(iso_path),
+                "size": (
+                    ISODetector._format_size(packed_size)
+                    if packed_size
+                    else ISODetector._get_file_size(iso_path)
+                ),
             }
+            if member:
+                details["member"] = member
 
-            filename = os.path.basename(iso_path).lower()
+            filename = os.path.basename(member or iso_path).lower()
 
             windows_patterns = [
                 "windows",
@@ -67,7 +94,10 @@ class ISODetector:
                     details["name"] = ISODetector._extract_linux_info(filename)
                     return ("linux", details)
 
-            iso_type, iso_details = ISODetector._examine_iso_contents(iso_path)
+            if packed:
+                iso_type, iso_details = ISODetector._examine_pvd(head)
+            else:
+                iso_type, iso_details = ISODetector._examine_iso_contents(iso_path)
             if iso_type != "unknown":
                 details.update(iso_details)
                 return (iso_type, details)
@@ -95,15 +125,65 @@ class ISODetector:
     @staticmethod
     def _get_file_size(file_path: str) -> str:
         try:
-            size_bytes = os.path.getsize(file_path)
-            for unit in ["B", "KB", "MB", "GB"]:
-                if size_bytes < 1024:
-                    return f"{size_bytes:.1f} {unit}"
-                size_bytes /= 1024
-            return f"{size_bytes:.1f} TB"
+            return ISODetector._format_size(os.path.getsize(file_path))
         except Exception:
             return "Unknown"
 
+    @staticmethod
+    def _format_size(size_bytes: float) -> str:
+        for unit in ["B", "KB", "MB", "GB"]:
+            if size_bytes < 1024:
+                return f"{size_bytes:.1f} {unit}"
+            size_bytes /= 1024
+        return f"{size_bytes:.1f} TB"
+
+    @staticmethod
+    def _read_packed_head(iso_path: str) -> Tuple[Optional[str], Optional[int], bytes]:
+        """
+        Decode the start of a compressed or zipped image, far enough to cover
+        the ISO 9660 primary volume descriptor. Returns (member name, image
+        size, head); the head is empty when the image cannot be decoded.
+        """
+        try:
+            with open_image_source(iso_path) as source:
+                head = bytearray(_ISO_PVD_OFFSET + _ISO_SECTOR)
+                view = memoryview(head)
+                total = 0
+                while total < len(head):
+                    n = source.readinto(view[total:])
+                    if not n:
+                        break
+                    total += n
+                view.release()
+                return source.member, source.size, bytes(head[:total])
+        except (OSError, EOFError, ImageSourceError, ValueError):
+            return None, None, b""
+
+    @staticmethod
+    def _examine_pvd(head: bytes) -> Tuple[str, Dict[str, str]]:
+        """Classify an image from the identifiers in its ISO 9660 primary volume descriptor."""
+        pvd = head[_ISO_PVD_OFFSET : _ISO_PVD_OFFSET + _ISO_SECTOR]
+        if len(pvd) < _ISO_SECTOR or pvd[0] != 1 or pvd[1:6] != b"CD001":
+            return ("unknown", {})
+
+        def field(start: int, end: int) -> str:
+            return pvd[start:end].decode("ascii", "replace").strip()
+
+        volume = field(40, 72)
+        # System, volume, publisher, data preparer and application identifiers.
+        text = " ".join(
+            (field(8, 40), volume, field(318, 446), field(446, 574), field(574, 702))
+        ).lower()
+
+        details = {"volume": volume} if volume else {}
+        if any(term in text for term in _WINDOWS_TERMS + _WINDOWS_LABEL_TERMS):
+            details["name"] = "Windows (ISO analysis)"
+            return ("windows", details)
+        if any(term in text for term in _LINUX_TERMS):
+            details["name"] = "Linux (ISO analysis)"
+            return ("linux", details)
+        return ("unknown", {})
+
     @staticmethod
     def _extract_windows_info(filename: str) -> str:
         if "win11" in filename or "windows11" in filename:
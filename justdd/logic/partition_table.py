@@ -0,0 +1,306 @@
+"""
+Partition table parsing for raw disk images.
+
+`read_partition_layout()` parses the MBR (including logical partitions in the
+extended partition's EBR chain) or the GPT of an image and works out which
+part of it actually matters: the partition table plus every partition, and,
+for GPT, the backup header and entry array at the end of the image. Many
+`.img` files are padded to a nominal size (e.g. 8 GB) while their partitions
+end much earlier; the flash engine (`FlashEngine(trim=True)`) writes only
+`write_ranges` and skips the slack in between.
+
+Images carrying an ISO 9660 filesystem (hybrid ISOs) are never trimmed: their
+filesystem starts at sector 0 and is not necessarily described by the table.
+
+Usage (example):
+    layout = read_partition_layout('/path/to.img')
+    if layout is not None and layout.bytes_saved:
+        print(layout.describe())
+"""
+
+from __future__ import annotations
+
+import binascii
+import os
+import struct
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import BinaryIO, List, Optional, Tuple
+
+SCHEME_MBR = "mbr"
+SCHEME_GPT = "gpt"
+
+# Written ranges stay aligned for O_DIRECT writes and reads.
+LAYOUT_ALIGN = 4096
+
+_MBR_SIGNATURE = b"\x55\xaa"
+_MBR_ENTRIES = 446
+_GPT_SIGNATURE = b"EFI PART"
+_GPT_PROTECTIVE = 0xEE
+_EXTENDED_TYPES = (0x05, 0x0F, 0x85)
+_ISO9660_MAGIC = b"CD001"
+_ISO9660_OFFSET = 0x8001
+# Logical sector sizes tried when looking for a GPT header at LBA 1.
+_GPT_SECTOR_SIZES = (512, 4096)
+# Upper bound on EBRs followed, guards against loops in corrupt chains.
+_MAX_LOGICAL = 128
+
+
+class PartitionTableError(Exception):
+    """Raised when an image's partition table is present but inconsistent."""
+
+
+@dataclass
+class Partition:
+    """One partition; offsets are in bytes from the start of the image."""
+
+    number: int
+    start: int
+    size: int
+    # MBR type byte as "0x83", or the GPT type GUID.
+    type: str
+    name: str = ""
+
+    @property
+    def end(self) -> int:
+        return self.start + self.size
+
+
+@dataclass
+class PartitionLayout:
+    """The partition table of an image and the ranges worth writing."""
+
+    scheme: str
+    sector_size: int
+    image_size: int
+    partitions: List[Partition] = field(default_factory=list)
+    # End of the table and all partitions, rounded up to LAYOUT_ALIGN.
+    used_end: int = 0
+    # Backup GPT (entries + header) at the end of the image, if any.
+    backup: Optional[Tuple[int, int]] = None
+
+    @property
+    def write_ranges(self) -> List[Tuple[int, int]]:
+        """`(start, end)` byte ranges that must be written, in order."""
+        ranges = [(0, self.used_end)]
+        if self.backup is not None and self.backup[0] > self.used_end:
+            ranges.append(self.backup)
+        elif self.backup is not None:
+            ranges = [(0, max(self.used_end, self.backup[1]))]
+        return ranges
+
+    @property
+    def slack(self) -> Optional[Tuple[int, int]]:
+        """The `(start, end)` range that can be skipped, None when there is none."""
+        ranges = self.write_ranges
+        end = ranges[1][0] if len(ranges) > 1 else self.image_size
+        start = ranges[0][1]
+        return (start, end) if end > start else None
+
+    @property
+    def bytes_saved(self) -> int:
+        slack = self.slack
+        return slack[1] - slack[0] if slack is not None else 0
+
+    def describe(self) -> str:
+        """Short summary, e.g. "GPT, 2 partitions, 6.2 GB of slack skipped"."""
+        count = len(self.partitions)
+        text = f"{self.scheme.upper()}, {count} partition{'' if count == 1 else 's'}"
+        if self.bytes_saved:
+            text += f", {_format_size(self.bytes_saved)} of slack skipped"
+        return text
+
+
+def _format_size(nbytes: int) -> str:
+    if nbytes >= 1024**3:
+        return f"{nbytes / 1024**3:.1f} GB"
+    return f"{nbytes / 1024**2:.1f} MB"
+
+
+def _align_up(value: int) -> int:
+    return -(-value // LAYOUT_ALIGN) * LAYOUT_ALIGN
+
+
+def _align_down(value: int) -> int:
+    return value // LAYOUT_ALIGN * LAYOUT_ALIGN
+
+
+def _read_at(f: BinaryIO, offset: int, length: int) -> bytes:
+    f.seek(offset)
+    return f.read(length)
+
+
+def read_partition_layout(
+    path: str, fileobj: Optional[BinaryIO] = None
+) -> Optional[PartitionLayout]:
+    """
+    Parse the partition table of the raw image or device at `path` (read
+    from `fileobj` when given). Returns None when the image has no MBR/GPT,
+    is a hybrid ISO or cannot be read.
+    Raises PartitionTableError for tables that do not fit the image.
+    """
+    try:
+        with open(path, "rb") if fileobj is None else nullcontext(fileobj) as f:
+            # st_size is 0 for block devices.
+            size = f.seek(0, os.SEEK_END)
+            if _read_at(f, _ISO9660_OFFSET, 5) == _ISO9660_MAGIC:
+                return None
+            mbr = _read_at(f, 0, 512)
+            if len(mbr) < 512 or mbr[510:512] != _MBR_SIGNATURE:
+                return None
+            entries = _mbr_entries(mbr)
+            if any(entry[1] == _GPT_PROTECTIVE for entry in entries):
+                layout = _read_gpt(f, size)
+                if layout is not None:
+                    return layout
+            return _read_mbr(f, size, entries)
+    except OSError:
+        return None
+
+
+# ---- MBR ----
+
+
+def _mbr_entries(sector: bytes) -> List[Tuple[int, int, int, int]]:
+    """(slot, type, first LBA, sector count) of the used entries of an MBR/EBR."""
+    entries = []
+    for slot in range(4):
+        raw = sector[_MBR_ENTRIES + 16 * slot : _MBR_ENTRIES + 16 * (slot + 1)]
+        ptype = raw[4]
+        first, count = struct.unpack_from("<II", raw, 8)
+        if ptype and count:
+            entries.append((slot, ptype, first, count))
+    return entries
+
+
+def _read_mbr(
+    f: BinaryIO, size: int, entries: List[Tuple[int, int, int, int]]
+) -> Optional[PartitionLayout]:
+    if not entries:
+        return None
+    layout = PartitionLayout(SCHEME_MBR, 512, size)
+    end = 512
+    for slot, ptype, first, count in entries:
+        end = max(end, (first + count) * 512)
+        if ptype in _EXTENDED_TYPES:
+            end = max(end, _read_logical(f, first, layout))
+        else:
+            layout.partitions.append(
+                Partition(slot + 1, first * 512, count * 512, f"0x{ptype:02x}")
+            )
+    layout.partitions.sort(key=lambda part: part.number)
+    return _finish(layout, end)
+
+
+def _read_logical(f: BinaryIO, extended_lba: int, layout: PartitionLayout) -> int:
+    """Follow the EBR chain of the extended partition; returns the furthest end."""
+    end = 0
+    ebr_lba = extended_lba
+    for number in range(5, 5 + _MAX_LOGICAL):
+        ebr = _read_at(f, ebr_lba * 512, 512)
+        if len(ebr) < 512 or ebr[510:512] != _MBR_SIGNATURE:
+            break
+        end = max(end, (ebr_lba + 1) * 512)
+        next_lba = 0
+        for _, ptype, first, count in _mbr_entries(ebr)[:2]:
+            if ptype in _EXTENDED_TYPES:
+                # Links are relative to the start of the extended partition.
+                next_lba = extended_lba + first
+            else:
+                start = (ebr_lba + first) * 512
+                layout.partitions.append(
+                    Partition(number, start, count * 512, f"0x{ptype:02x}")
+                )
+                end = max(end, start + count * 512)
+        if not next_lba or next_lba == ebr_lba:
+            break
+        ebr_lba = next_lba
+    return end
+
+
+# ---- GPT ----
+
+
+def _read_gpt(f: BinaryIO, size: int) -> Optional[PartitionLayout]:
+    for sector in _GPT_SECTOR_SIZES:
+        header = _read_at(f, sector, 92)
+        if len(header) == 92 and header[:8] == _GPT_SIGNATURE:
+            return _parse_gpt(f, size, sector)
+    return None
+
+
+def _gpt_header_valid(header: bytes) -> bool:
+    header_size = struct.unpack_from("<I", header, 12)[0]
+    if header_size < 92 or len(header) < header_size:
+        return False
+    crc = struct.unpack_from("<I", header, 16)[0]
+    zeroed = header[:16] + b"\0\0\0\0" + header[20:header_size]
+    return binascii.crc32(zeroed) & 0xFFFFFFFF == crc
+
+
+def _parse_gpt(f: BinaryIO, size: int, sector: int) -> Optional[PartitionLayout]:
+    header = _read_at(f, sector, sector)
+    if not _gpt_header_valid(header):
+        raise PartitionTableError("GPT header checksum mismatch")
+    alternate_lba, first_usable = struct.unpack_from("<QQ", header, 32)
+    entries_lba, entry_count, entry_size = struct.unpack_from("<QII", header, 72)
+    if entry_size < 128 or entry_count > 4096:
+        raise PartitionTableError("Unsupported GPT entry array")
+    array_size = entry_count * entry_size
+    array_sectors = -(-array_size // sector)
+    array = _read_at(f, entries_lba * sector, array_size)
+    if len(array) < array_size:
+        raise PartitionTableError("GPT entry array extends past the image")
+
+    layout = PartitionLayout(SCHEME_GPT, sector, size)
+    end = max(first_usable * sector, (entries_lba + array_sectors) * sector)
+    for index in range(entry_count):
+        raw = array[index * entry_size : (index + 1) * entry_size]
+        if raw[:16] == bytes(16):
+            continue
+        first, last = struct.unpack_from("<QQ", raw, 32)
+        name = raw[56:128].decode("utf-16-le", "replace").split("\0", 1)[0]
+        type_guid = _format_guid(raw[:16])
+        part = Partition(
+            index + 1, first * sector, (last - first + 1) * sector, type_guid, name
+        )
+        layout.partitions.append(part)
+        end = max(end, part.end)
+
+    # The backup entries sit right before the backup header at the last LBA.
+    backup_end = (alternate_lba + 1) * sector
+    if alternate_lba > 1 and backup_end <= size:
+        backup_header = _read_at(f, alternate_lba * sector, 8)
+        if backup_header == _GPT_SIGNATURE:
+            layout.backup = (
+                _align_down((alternate_lba - array_sectors) * sector),
+                backup_end,
+            )
+    return _finish(layout, end)
+
+
+def _format_guid(raw: bytes) -> str:
+    a, b, c = struct.unpack_from("<IHH", raw)
+    tail = raw[8:].hex()
+    return f"{a:08x}-{b:04x}-{c:04x}-{tail[:4]}-{tail[4:]}".upper()
+
+
+def _finish(layout: PartitionLayout, end: int) -> PartitionLayout:
+    if end > layout.image_size:
+        raise PartitionTableError(
+            f"Partitions end at byte {end}, past the end of the image "
+            f"({layout.image_size} bytes)"
+        )
+    layout.used_end = min(_align_up(end), layout.image_size)
+    return layout
+
+
+__all__ = [
+    "LAYOUT_ALIGN",
+    "SCHEME_GPT",
+    "SCHEME_MBR",
+    "Partition",
+    "PartitionLayout",
+    "PartitionTableError",
+    "read_partition_layout",
+]
@@ -0,0 +1,664 @@
+"""
+PrivilegedHelper
+
+Client side of the long-lived root helper (see `helper_server`). The helper
+is started once per session through `pkexec`, so the user authenticates once
+instead of for every `pkexec dd` or Windows script, and the GUI keeps talking
+to it over a private socketpair:
+
+- `open()`, `write()`, `copy()`, `truncate()`, `sync()`, `close()` write a
+  target; `copy()` passes the image's file descriptor to the helper, which
+  copies it inside the kernel (copy_file_range/splice) and streams progress
+  back,
+- `open_read()` opens a device the user cannot read and passes the read-only
+  file descriptor back (for verification and backups),
+- `mount()`, `umount()` and `format()` manage filesystems,
+- `set_dirty_limit()` and `restore_dirty_limit()` change the root-only
+  sysfs limits of a BDI (`HelperDirtyLimit` wraps them),
+- `run()` executes a command (e.g. the generated Windows script) and streams
+  its output lines back.
+
+`PrivilegedHelper(privileged=False)` starts the same helper without pkexec,
+as the current user. It can only reach what the user can (e.g. file
+targets), which makes the protocol testable without root.
+
+`shared_helper()` returns the session's helper, starting it (and asking for
+authentication) on first use and restarting it if it died.
+`write_image()` flashes an image through a helper; raw images without
+hashing are copied by the helper itself, anything else is decoded and hashed
+here and streamed to it. `skip_ranges` (see `flash_engine.plan_trim`) are
+left out of the write in both cases.
+
+Usage (example):
+    helper = shared_helper()
+    handle = helper.open("/dev/sdb")
+    with open("image.iso", "rb") as f:
+        helper.copy(handle, f.fileno(), os.path.getsize("image.iso"))
+    helper.sync(handle)
+    helper.close(handle)
+"""
+
+from __future__ import annotations
+
+import array
+import bisect
+import errno
+import itertools
+import json
+import os
+import queue
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .blockdev import BdiDirtyLimit
+from .image_hash import StreamHasher
+from .image_source import COMPRESSED_KINDS, detect_image_kind, open_image_source
+from .throttle import BandwidthLimiter, describe_rate
+
+_HEADER = struct.Struct(">I")
+_SERVER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "helper_server.py"
+)
+# pkexec exit codes when the authentication dialog was dismissed or failed.
+_PKEXEC_AUTH_FAILED = (126, 127)
+# Bytes per "write" request when streaming decoded images.
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+# Seconds between checks of `should_stop` while waiting for a reply.
+_POLL_INTERVAL = 0.1
+
+
+class HelperError(Exception):
+    """Raised when the helper cannot be started or a request fails."""
+
+    # errno of the OSError that failed the request in the helper, if any.
+    errno: Optional[int] = None
+
+
+class HelperAuthError(HelperError):
+    """Raised when the user did not authenticate the helper."""
+
+
+class PrivilegedHelper:
+    """Connection to one helper process."""
+
+    def __init__(self, privileged: bool = True, python: str = sys.executable):
+        self.privileged = privileged
+        self.python = python
+        self.uid: Optional[int] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._sock: Optional[socket.socket] = None
+        self._send_lock = threading.Lock()
+        self._replies: Dict[int, "queue.Queue"] = {}
+        self._replies_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._reader: Optional[threading.Thread] = None
+        self._dead = threading.Event()
+        # Descriptors received (SCM_RIGHTS) for the reply being read.
+        self._received_fds: List[int] = []
+
+    # ---- Lifecycle ----
+    def start(self) -> None:
+        """Start the helper (prompting for authentication when privileged)."""
+        if self.alive:
+            return
+        argv = [self.python, _SERVER_SCRIPT]
+        if self.privileged and os.geteuid() != 0:
+            if shutil.which("pkexec") is None:
+                raise HelperError("pkexec is not available")
+            argv.insert(0, "pkexec")
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._process = subprocess.Popen(
+                argv, stdin=child.fileno(), stdout=subprocess.DEVNULL, close_fds=True
+            )
+        except OSError as e:
+            parent.close()
+            raise HelperError(f"Cannot start helper: {e}") from e
+        finally:
+            child.close()
+        self._sock = parent
+        self._dead.clear()
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+        try:
+            reply = self.request("hello")
+        except HelperError:
+            returncode = self._process.wait()
+            self.stop()
+            if argv[0] == "pkexec" and returncode in _PKEXEC_AUTH_FAILED:
+                raise HelperAuthError("Authentication failed or was cancelled")
+            raise HelperError(f"Helper exited with code {returncode}")
+        self.uid = reply.get("uid")
+
+    @property
+    def alive(self) -> bool:
+        return (
+            self._process is not None
+            and self._process.poll() is None
+            and not self._dead.is_set()
+        )
+
+    def stop(self) -> None:
+        """Ask the helper to exit and release the connection."""
+        if self.alive:
+            try:
+                self.request("quit")
+            except HelperError:
+                pass
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+        if self._process is not None:
+            try:
+                self._process.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                pass
+            self._process = None
+
+    # ---- Transport ----
+    def _send(self, message: dict, payload=None, fds: Sequence[int] = ()) -> None:
+        if self._sock is None:
+            raise HelperError("Helper is not running")
+        data = json.dumps(message).encode("utf-8")
+        frame = _HEADER.pack(len(data)) + data
+        with self._send_lock:
+            try:
+                if fds:
+                    ancillary = [
+                        (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))
+                    ]
+                    sent = self._sock.sendmsg([frame], ancillary)
+                    self._sock.sendall(frame[sent:])
+                else:
+                    self._sock.sendall(frame)
+                if payload is not None:
+                    self._sock.sendall(payload)
+            except OSError as e:
+                raise HelperError(f"Helper connection lost: {e}") from e
+
+    def _recv_exact(self, size: int) -> bytes:
+        assert self._sock is not None
+        chunks = []
+        fd_space = socket.CMSG_SPACE(4 * array.array("i").itemsize)
+        while size:
+            data, ancdata, _flags, _addr = self._sock.recvmsg(size, fd_space)
+            for level, kind, payload in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array("i")
+                    fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+                    self._received_fds.extend(fds)
+            if not data:
+                raise EOFError
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def _read_replies(self) -> None:
+        try:
+            while True:
+                (size,) = _HEADER.unpack(self._recv_exact(_HEADER.size))
+                message = json.loads(self._recv_exact(size).decode("utf-8"))
+                count = int(message.get("fds") or 0)
+                message["fds"] = self._received_fds[:count]
+                del self._received_fds[:count]
+                with self._replies_lock:
+                    replies = self._replies.get(message.get("id"))
+                if replies is not None:
+                    replies.put(message)
+                else:
+                    _close_fds(message["fds"])
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            _close_fds(self._received_fds)
+            self._received_fds = []
+            self._dead.set()
+            with self._replies_lock:
+                for replies in self._replies.values():
+                    replies.put(None)
+
+    def request(
+        self,
+        cmd: str,
+        payload=None,
+        fds: Sequence[int] = (),
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_output: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        **args,
+    ) -> dict:
+        """
+        Send one request and wait for its final reply. Progress and output
+        messages are passed to the callbacks; when `should_stop()` returns
+        True the helper is asked to cancel the request.
+        """
+        req_id = next(self._ids)
+        replies: "queue.Queue" = queue.Queue()
+        with self._replies_lock:
+            self._replies[req_id] = replies
+        try:
+            if self._dead.is_set():
+                raise HelperError("Helper is not running")
+            self._send(dict(args, id=req_id, cmd=cmd), payload, fds)
+            cancel_sent = False
+            while True:
+                if should_stop is not None and not cancel_sent and should_stop():
+                    self._send(
+                        {"id": next(self._ids), "cmd": "cancel", "target": req_id}
+                    )
+                    cancel_sent = True
+                try:
+                    message = replies.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if message is None:
+                    raise HelperError("Helper exited")
+                if "progress" in message:
+                    if on_progress is not None:
+                        on_progress(*message["progress"])
+                elif "output" in message:
+                    if on_output is not None:
+                        on_output(message["output"])
+                elif message.get("ok"):
+                    return message
+                else:
+                    error = HelperError(message.get("error") or f"{cmd} failed")
+                    error.errno = message.get("errno")
+                    raise error
+        finally:
+            with self._replies_lock:
+                self._replies.pop(req_id, None)
+
+    # ---- Commands ----
+    def open(self, path: str, create: bool = False) -> dict:
+        """Open `path` for writing; returns {"handle", "size", "is_file"}."""
+        return self.request("open", path=path, create=create)
+
+    def open_read(self, path: str, direct: bool = False) -> int:
+        """
+        Open `path` read-only in the helper (with O_DIRECT when `direct`) and
+        return the file descriptor, which the caller closes. Raises OSError,
+        also when the helper fails, so it can stand in for `os.open`.
+        """
+        try:
+            reply = self.request("open_read", path=path, direct=direct)
+        except HelperError as e:
+            raise OSError(e.errno or errno.EIO, f"{path}: {e}") from e
+        if not reply["fds"]:
+            raise OSError(errno.EIO, f"{path}: the helper passed no file descriptor")
+        return reply["fds"][0]
+
+    def set_dirty_limit(self, bdi: str, max_ratio: int, strict: bool = True) -> None:
+        """
+        Cap the dirty pages of BDI `bdi` (see `BdiDirtyLimit`) until
+        `restore_dirty_limit()`, or until the helper exits.
+        """
+        self.request("bdi_limit", bdi=bdi, max_ratio=max_ratio, strict=strict)
+
+    def restore_dirty_limit(self, bdi: str) -> None:
+        self.request("bdi_restore", bdi=bdi)
+
+    def write(self, handle: int, offset: int, data) -> int:
+        return self.request(
+            "write", payload=data, handle=handle, offset=offset, size=len(data)
+        )["written"]
+
+    def copy(
+        self,
+        handle: int,
+        source_fd: int,
+        length: int,
+        offset: int = 0,
+        source_offset: int = 0,
+        flush_window: int = 0,
+        rate: int = 0,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> dict:
+        """
+        Copy `length` bytes of `source_fd` to the target inside the helper,
+        at most `rate` bytes per second when given.
+        """
+        return self.request(
+            "copy",
+            fds=[source_fd],
+            on_progress=on_progress,
+            should_stop=should_stop,
+            handle=handle,
+            length=length,
+            offset=offset,
+            source_offset=source_offset,
+            flush_window=flush_window,
+            rate=rate,
+        )
+
+    def truncate(self, handle: int, length: int) -> None:
+        self.request("truncate", handle=handle, length=length)
+
+    def sync(self, handle: int) -> None:
+        self.request("sync", handle=handle)
+
+    def close(self, handle: int) -> None:
+        self.request("close", handle=handle)
+
+    def mount(
+        self, device: str, mountpoint: str, fstype: str = "", options: str = ""
+    ) -> None:
+        self.request(
+            "mount",
+            device=device,
+            mountpoint=mountpoint,
+            fstype=fstype,
+            options=options,
+        )
+
+    def umount(self, target: str) -> None:
+        self.request("umount", target=target)
+
+    def format(
+        self,
+        device: str,
+        fstype: str,
+        label: str = "",
+        on_output: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.request(
+            "format", on_output=on_output, device=device, fstype=fstype, label=label
+        )
+
+    def run(
+        self,
+        argv: List[str],
+        on_output: Optional[Callable[[str], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> int:
+        """Run `argv` in the helper; returns its exit code."""
+        return self.request(
+            "run", on_output=on_output, should_stop=should_stop, argv=list(argv)
+        )["returncode"]
+
+
+def _close_fds(fds: Iterable[int]) -> None:
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+_shared: Optional[PrivilegedHelper] = None
+_shared_lock = threading.Lock()
+
+
+def shared_helper(privileged: bool = True) -> PrivilegedHelper:
+    """The session's helper; started on first use and restarted if it died."""
+    global _shared
+    with _shared_lock:
+        if _shared is None or not _shared.alive or _shared.privileged != privileged:
+            if _shared is not None:
+                _shared.stop()
+            helper = PrivilegedHelper(privileged=privileged)
+            helper.start()
+            _shared = helper
+        return _shared
+
+
+class HelperDirtyLimit(BdiDirtyLimit):
+    """
+    `BdiDirtyLimit` set through the helper, for when the sysfs files need
+    root. `apply()` raises OSError like the original.
+    """
+
+    def __init__(
+        self, helper: PrivilegedHelper, name: str, max_ratio: int, strict: bool = True
+    ):
+        super().__init__(name, max_ratio, strict)
+        self.helper = helper
+        self._applied = False
+
+    def apply(self) -> None:
+        try:
+            self.helper.set_dirty_limit(self.name, self.max_ratio, self.strict)
+        except HelperError as e:
+            raise OSError(e.errno or errno.EIO, str(e)) from e
+        self._applied = True
+
+    def restore(self) -> None:
+        if not self._applied:
+            return
+        self._applied = False
+        try:
+            self.helper.restore_dirty_limit(self.name)
+        except HelperError:
+            pass
+
+
+def helper_available() -> bool:
+    """Whether a privileged helper can be started (or is running)."""
+    return (_shared is not None and _shared.alive) or shutil.which("pkexec") is not None
+
+
+def _is_device_path(path: str) -> bool:
+    return os.path.abspath(path).startswith("/dev/")
+
+
+def write_image(
+    helper: PrivilegedHelper,
+    image_path: str,
+    target: str,
+    hash_algorithms: Iterable[str] = (),
+    flush_window: int = 0,
+    bandwidth_limit: int = 0,
+    skip_ranges: Sequence[Tuple[int, int]] = (),
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    on_progress: Optional[Callable[[int, int, int], None]] = None,
+    on_log: Optional[Callable[[str], None]] = None,
+    should_stop: Optional[Callable[[], bool]] = None,
+) -> Dict[str, str]:
+    """
+    Write an image to `target` through `helper` and flush it. Progress is
+    reported as (done, total, image bytes passed), with done/total in
+    compressed bytes for compressed images of unknown size.
+    `bandwidth_limit` caps the write rate (bytes per second). The
+    `(start, end)` `skip_ranges` of the image are not written (but still
+    hashed). Returns the digests of `hash_algorithms`; raises
+    InterruptedError when stopped.
+    """
+    algorithms = list(hash_algorithms)
+    skip_ranges = sorted(skip_ranges)
+    log = on_log or (lambda _text: None)
+    if bandwidth_limit:
+        log(f"Bandwidth cap: {describe_rate(bandwidth_limit)}")
+    # Only an image file may be created; a missing /dev node means the
+    # device is gone, and the helper must not leave a file in its place.
+    opened = helper.open(target, create=not _is_device_path(target))
+    handle = opened["handle"]
+    try:
+        if detect_image_kind(image_path) not in COMPRESSED_KINDS and not algorithms:
+            size = os.path.getsize(image_path)
+            written = _copy_ranges(
+                helper,
+                handle,
+                image_path,
+                _write_ranges(size, skip_ranges),
+                size,
+                flush_window,
+                bandwidth_limit,
+                on_progress,
+                log,
+                should_stop,
+            )
+            digests: Dict[str, str] = {}
+        else:
+            limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+            size, written, digests = _stream_image(
+                helper,
+                handle,
+                image_path,
+                algorithms,
+                skip_ranges,
+                chunk_size,
+                limiter,
+                on_progress,
+                log,
+                should_stop,
+            )
+        if size > written:
+            log(f"Skipped {size - written} bytes that need not be written")
+        if opened.get("is_file"):
+            helper.truncate(handle, size)
+        if should_stop is not None and should_stop():
+            raise InterruptedError("cancelled")
+        helper.sync(handle)
+        return digests
+    except HelperError as e:
+        if should_stop is not None and should_stop():
+            raise InterruptedError("cancelled") from e
+        raise
+    finally:
+        try:
+            helper.close(handle)
+        except HelperError:
+            pass
+
+
+def _write_ranges(
+    size: int, skip_ranges: Sequence[Tuple[int, int]]
+) -> List[Tuple[int, int]]:
+    """The `(start, end)` ranges of `size` bytes outside `skip_ranges`."""
+    ranges = []
+    offset = 0
+    for start, end in skip_ranges:
+        if start > offset:
+            ranges.append((offset, min(start, size)))
+        offset = max(offset, end)
+    if offset < size:
+        ranges.append((offset, size))
+    return [(start, end) for start, end in ranges if end > start]
+
+
+def _copy_ranges(
+    helper: PrivilegedHelper,
+    handle: int,
+    image_path: str,
+    ranges: List[Tuple[int, int]],
+    size: int,
+    flush_window: int,
+    rate: int,
+    on_progress: Optional[Callable[[int, int, int], None]],
+    log: Callable[[str], None],
+    should_stop: Optional[Callable[[], bool]],
+) -> int:
+    """Have the helper copy `ranges` of a raw image in place; returns the bytes copied."""
+    written = 0
+    methods = set()
+    with open(image_path, "rb") as f:
+        for start, end in ranges:
+            if should_stop is not None and should_stop():
+                raise InterruptedError("cancelled")
+            result = helper.copy(
+                handle,
+                f.fileno(),
+                end - start,
+                offset=start,
+                source_offset=start,
+                flush_window=flush_window,
+                rate=rate,
+                on_progress=(
+                    (
+                        lambda done, _total, start=start: on_progress(
+                            start + done, size, start + done
+                        )
+                    )
+                    if on_progress is not None
+                    else None
+                ),
+                should_stop=should_stop,
+            )
+            written += result["copied"]
+            methods.add(result["method"])
+    log(f"Helper copied {written} bytes ({', '.join(sorted(methods)) or 'nothing'})")
+    if on_progress is not None and ranges:
+        on_progress(size, size, size)
+    return written
+
+
+def _stream_image(
+    helper: PrivilegedHelper,
+    handle: int,
+    image_path: str,
+    algorithms: List[str],
+    skip_ranges: List[Tuple[int, int]],
+    chunk_size: int,
+    limiter: Optional[BandwidthLimiter],
+    on_progress: Optional[Callable[[int, int, int], None]],
+    log: Callable[[str], None],
+    should_stop: Optional[Callable[[], bool]],
+):
+    hasher = StreamHasher(algorithms) if algorithms else None
+    source = open_image_source(image_path)
+    if source.compressed:
+        log(f"Decompressing {source.kind} image into the helper")
+    ends = [end for _, end in skip_ranges]
+    buf = bytearray(chunk_size)
+    offset = 0
+    written = 0
+    try:
+        with memoryview(buf) as view:
+            while True:
+                if should_stop is not None and should_stop():
+                    raise InterruptedError("cancelled")
+                index = bisect.bisect_right(ends, offset)
+                skip = skip_ranges[index] if index < len(ends) else None
+                skipping = skip is not None and skip[0] <= offset
+                if skipping and hasher is None:
+                    # Nothing needs these bytes: pass over them.
+                    n = source.skip(skip[1] - offset)
+                else:
+                    # Skipped bytes are still read when they are hashed.
+                    limit = len(view)
+                    if skip is not None:
+                        limit = min(limit, (skip[1] if skipping else skip[0]) - offset)
+                    n = source.readinto(view[:limit])
+                if not n:
+                    break
+                if not skipping or hasher is not None:
+                    data = bytes(view[:n])
+                    if hasher is not None:
+                        hasher.submit(data)
+                    if not skipping:
+                        helper.write(handle, offset, data)
+                        written += n
+                        if limiter is not None:
+                            limiter.consume(n, should_stop)
+                offset += n
+                if on_progress is not None:
+                    done, total = source.progress(offset)
+                    on_progress(done, total, offset)
+        digests = hasher.finish() if hasher is not None else {}
+        hasher = None
+        return offset, written, digests
+    finally:
+        if hasher is not None:
+            hasher.abort()
+        source.close()
+
+
+__all__ = [
+    "DEFAULT_CHUNK_SIZE",
+    "HelperAuthError",
+    "HelperDirtyLimit",
+    "HelperError",
+    "PrivilegedHelper",
+    "helper_available",
+    "shared_helper",
+    "write_image",
+]
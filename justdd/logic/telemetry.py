@@ -0,0 +1,164 @@
+"""
+FlashTelemetry
+
+Throughput and ETA estimation for the write phase of a flash.
+
+The flash paths feed `update()` with the progress they already report
+(progress units done/total, plus the image bytes written when those differ,
+e.g. for compressed images whose progress is measured in compressed bytes).
+Samples closer together than `min_interval` are ignored, except the final
+one. Each sample yields:
+
+- the instantaneous rate over the last sample interval,
+- an exponentially weighted moving average of the rate, weighted by time
+  (`half_life` seconds) rather than by sample, so bursty progress (dd output,
+  writeback stalls) does not swing it around,
+- the mean rate since the start, the elapsed time and the ETA, derived from
+  the smoothed rate of the progress units.
+
+The first sample only sets the baseline, so bytes skipped when resuming a
+flash do not count as written.
+
+Usage (example):
+    telemetry = FlashTelemetry()
+    telemetry.start()
+    if telemetry.update(done, total):
+        print(describe_telemetry(telemetry.snapshot()))
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Callable, Dict, Optional
+
+from .utils import format_time_display
+
+# Seconds after which a past rate weighs half as much in the moving average.
+DEFAULT_HALF_LIFE = 5.0
+# Minimum seconds between two samples.
+DEFAULT_MIN_INTERVAL = 0.25
+
+
+class FlashTelemetry:
+    """Samples write progress over time and estimates rates and ETA."""
+
+    def __init__(
+        self,
+        half_life: float = DEFAULT_HALF_LIFE,
+        min_interval: float = DEFAULT_MIN_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if half_life <= 0:
+            raise ValueError("half_life must be positive")
+        self.half_life = half_life
+        self.min_interval = max(0.0, min_interval)
+        self._clock = clock
+        self.start()
+
+    def start(self, now: Optional[float] = None) -> None:
+        """(Re)start timing; call when the write phase begins."""
+        self.started = self._clock() if now is None else now
+        self.elapsed = 0.0
+        self.done = 0
+        self.total = 0
+        self.written = 0
+        self.rate = 0.0
+        self.avg_rate = 0.0
+        self._progress_rate = 0.0
+        self._base_written: Optional[int] = None
+        self._last: Optional[float] = None
+        self._last_done = 0
+        self._last_written = 0
+
+    def update(
+        self,
+        done: int,
+        total: int,
+        written: Optional[int] = None,
+        now: Optional[float] = None,
+    ) -> bool:
+        """
+        Record progress; `written` defaults to `done`. Returns True when a new
+        sample was taken (and `snapshot()` changed).
+        """
+        now = self._clock() if now is None else now
+        written = done if written is None else written
+        self.done, self.total, self.written = done, total, written
+        self.elapsed = max(0.0, now - self.started)
+
+        if self._last is None:
+            self._base_written = written
+            self._last, self._last_done, self._last_written = now, done, written
+            return True
+        dt = now - self._last
+        finished = bool(total) and done >= total
+        if dt <= 0 or (dt < self.min_interval and not finished):
+            return False
+
+        self.rate = max(0, written - self._last_written) / dt
+        progress_rate = max(0, done - self._last_done) / dt
+        if self.avg_rate == 0.0 and self._progress_rate == 0.0:
+            self.avg_rate, self._progress_rate = self.rate, progress_rate
+        else:
+            weight = 1.0 - 0.5 ** (dt / self.half_life)
+            self.avg_rate += weight * (self.rate - self.avg_rate)
+            self._progress_rate += weight * (progress_rate - self._progress_rate)
+        self._last, self._last_done, self._last_written = now, done, written
+        return True
+
+    @property
+    def mean_rate(self) -> float:
+        """Bytes written per second since the first sample."""
+        if self._base_written is None or self.elapsed <= 0:
+            return 0.0
+        return max(0, self.written - self._base_written) / self.elapsed
+
+    @property
+    def eta(self) -> float:
+        """Estimated seconds left; infinity while unknown."""
+        if self.total and self.done >= self.total:
+            return 0.0
+        if self._progress_rate <= 0 or not self.total:
+            return float("inf")
+        return (self.total - self.done) / self._progress_rate
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        Current estimates: "written" (bytes), "done"/"total" (progress
+        units), "elapsed" and "eta" (seconds) and "rate", "avg_rate" and
+        "mean_rate" (bytes/s).
+        """
+        return {
+            "written": self.written,
+            "done": self.done,
+            "total": self.total,
+            "elapsed": self.elapsed,
+            "eta": self.eta,
+            "rate": self.rate,
+            "avg_rate": self.avg_rate,
+            "mean_rate": self.mean_rate,
+        }
+
+
+def describe_telemetry(snapshot: Dict[str, float]) -> str:
+    """One-line summary, e.g. "32.1 MB/s (avg 30.4 MB/s) - 01:12 elapsed - 02:40 left"."""
+    if not snapshot:
+        return ""
+    mb = 1024**2
+    parts = []
+    if snapshot.get("avg_rate"):
+        parts.append(
+            f"{snapshot.get('rate', 0.0) / mb:.1f} MB/s "
+            f"(avg {snapshot['avg_rate'] / mb:.1f} MB/s)"
+        )
+    parts.append(f"{format_time_display(snapshot.get('elapsed', 0.0))} elapsed")
+    parts.append(f"{format_time_display(snapshot.get('eta', float('inf')))} left")
+    return " - ".join(parts)
+
+
+__all__ = [
+    "FlashTelemetry",
+    "describe_telemetry",
+    "DEFAULT_HALF_LIFE",
+    "DEFAULT_MIN_INTERVAL",
+]
@@ -0,0 +1,180 @@
+"""
+Scheduling controls for background flashing.
+
+- `set_io_priority()` sets the I/O scheduling class and level of the calling
+  thread with the `ioprio_set` syscall (there is no libc wrapper), the
+  equivalent of `ionice -c <class> -n <level>`. Threads and processes started
+  afterwards (the engine's reader thread, `pkexec dd`) inherit it.
+- `set_nice()` sets the CPU nice level of the calling thread (on Linux
+  `setpriority` acts on single threads), inherited the same way.
+- `BandwidthLimiter` is a token bucket that the flash engine consults after
+  every write, so a job can be capped to a share of a USB hub.
+
+Usage (example):
+    set_io_priority("idle")
+    limiter = BandwidthLimiter(20 * 1024**2)
+    for block in blocks:
+        write(block)
+        limiter.consume(len(block))
+"""
+
+from __future__ import annotations
+
+import ctypes
+import os
+import platform
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from .blockdev import _get_libc
+
+# I/O scheduling classes, see <linux/ioprio.h>.
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_RT = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IO_CLASSES: Dict[str, int] = {
+    "realtime": IOPRIO_CLASS_RT,
+    "best-effort": IOPRIO_CLASS_BE,
+    "idle": IOPRIO_CLASS_IDLE,
+}
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set/ioprio_get syscall numbers per architecture.
+_NR_IOPRIO = {
+    "x86_64": (251, 252),
+    "i386": (289, 290),
+    "i686": (289, 290),
+    "aarch64": (30, 31),
+    "riscv64": (30, 31),
+    "loongarch64": (30, 31),
+    "armv7l": (314, 315),
+    "ppc64le": (273, 274),
+    "ppc64": (273, 274),
+    "s390x": (282, 283),
+}
+
+# Longest single sleep of the limiter, so cancellation stays responsive.
+_MAX_SLEEP = 0.1
+
+
+def _ioprio_syscall(index: int, *args: int) -> int:
+    numbers = _NR_IOPRIO.get(platform.machine())
+    libc = _get_libc()
+    if numbers is None or libc is None:
+        raise OSError(f"ioprio is not supported on {platform.machine()}")
+    libc.syscall.restype = ctypes.c_long
+    result = libc.syscall(
+        ctypes.c_long(numbers[index]), *(ctypes.c_int(arg) for arg in args)
+    )
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+def set_io_priority(io_class: str, level: int = 4) -> None:
+    """
+    Set the I/O class ("idle", "best-effort" or "realtime") and level (0-7,
+    0 is the highest; ignored for "idle") of the calling thread. Raises
+    ValueError for unknown values and OSError when the kernel refuses
+    (e.g. "realtime" without CAP_SYS_ADMIN).
+    """
+    if io_class not in IO_CLASSES:
+        raise ValueError(f"io_class must be one of {', '.join(IO_CLASSES)}")
+    if not 0 <= level <= 7:
+        raise ValueError("I/O priority level must be between 0 and 7")
+    klass = IO_CLASSES[io_class]
+    value = (klass << _IOPRIO_CLASS_SHIFT) | (
+        0 if klass == IOPRIO_CLASS_IDLE else level
+    )
+    _ioprio_syscall(0, _IOPRIO_WHO_PROCESS, 0, value)
+
+
+def get_io_priority() -> Optional[Dict[str, object]]:
+    """The I/O class and level of the calling thread, None when unknown."""
+    try:
+        value = _ioprio_syscall(1, _IOPRIO_WHO_PROCESS, 0)
+    except OSError:
+        return None
+    klass = value >> _IOPRIO_CLASS_SHIFT
+    names = {v: k for k, v in IO_CLASSES.items()}
+    return {
+        "class": names.get(klass, "none"),
+        "level": value & ((1 << _IOPRIO_CLASS_SHIFT) - 1),
+    }
+
+
+def set_nice(level: int) -> None:
+    """Set the CPU nice level (-20..19) of the calling thread."""
+    if not -20 <= level <= 19:
+        raise ValueError("nice level must be between -20 and 19")
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), level)
+
+
+class BandwidthLimiter:
+    """
+    Token bucket limiting a byte stream to `rate` bytes per second.
+
+    `consume()` is called after the bytes were transferred. The bucket may go
+    into debt by one write and the caller then sleeps until it is repaid, so
+    the long-run rate matches `rate` regardless of the write size, while at
+    most `burst` bytes (default: a quarter of a second's worth) pass at full
+    speed after an idle period (e.g. a writeback stall).
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else self.rate / 4
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # Start empty: a short copy must not run at full speed for `burst` bytes.
+        self._tokens = 0.0
+        self._last = clock()
+        self.waited = 0.0
+
+    def consume(
+        self, nbytes: int, should_stop: Optional[Callable[[], bool]] = None
+    ) -> None:
+        """Account for `nbytes` and sleep as long as the bucket is in debt."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        self.waited += wait
+        while wait > 0:
+            if should_stop is not None and should_stop():
+                return
+            step = min(wait, _MAX_SLEEP)
+            self._sleep(step)
+            wait -= step
+
+
+def describe_rate(rate: float) -> str:
+    """Human readable bandwidth, e.g. "20.0 MB/s"."""
+    return f"{rate / (1024**2):.1f} MB/s"
+
+
+__all__ = [
+    "BandwidthLimiter",
+    "IO_CLASSES",
+    "describe_rate",
+    "get_io_priority",
+    "set_io_priority",
+    "set_nice",
+]
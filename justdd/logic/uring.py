@@ -0,0 +1,311 @@
+"""
+Minimal io_uring bindings for the flash engine.
+
+Only what the engine needs is wrapped: ring setup, buffer registration and
+READ/WRITE (fixed-buffer or plain) submissions, called through the raw
+`io_uring_setup`, `io_uring_enter` and `io_uring_register` syscalls with
+ctypes and the rings mapped with `mmap`. No liburing is required.
+
+Every submission goes through `io_uring_enter`, which orders the ring
+updates with respect to the kernel, so no SQ polling thread and no explicit
+memory barriers are involved.
+
+`uring_available()` reports whether a ring can be created (the kernel may
+lack io_uring, or it may be disabled by sysctl or seccomp); callers fall back
+to plain `pwrite` otherwise.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import mmap
+import os
+import struct
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from .blockdev import _get_libc
+
+# Syscall numbers; io_uring uses the same numbers on every architecture.
+_NR_IO_URING_SETUP = 425
+_NR_IO_URING_ENTER = 426
+_NR_IO_URING_REGISTER = 427
+
+_IORING_OFF_SQ_RING = 0
+_IORING_OFF_CQ_RING = 0x8000000
+_IORING_OFF_SQES = 0x10000000
+
+_IORING_FEAT_SINGLE_MMAP = 1 << 0
+_IORING_ENTER_GETEVENTS = 1 << 0
+_IORING_REGISTER_BUFFERS = 0
+
+IORING_OP_READ_FIXED = 4
+IORING_OP_WRITE_FIXED = 5
+IORING_OP_READ = 22
+IORING_OP_WRITE = 23
+
+_SQE_SIZE = 64
+_CQE_SIZE = 16
+# opcode, flags, ioprio, fd, off, addr, len, rw_flags, user_data, buf_index
+_SQE_FORMAT = "=BBHiQQIIQH"
+_CQE_FORMAT = "=Qi"
+
+
+class IoUringError(OSError):
+    """Raised when a ring cannot be set up or used."""
+
+
+class _SqringOffsets(ctypes.Structure):
+    _fields_ = [
+        ("head", ctypes.c_uint32),
+        ("tail", ctypes.c_uint32),
+        ("ring_mask", ctypes.c_uint32),
+        ("ring_entries", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        ("dropped", ctypes.c_uint32),
+        ("array", ctypes.c_uint32),
+        ("resv1", ctypes.c_uint32),
+        ("user_addr", ctypes.c_uint64),
+    ]
+
+
+class _CqringOffsets(ctypes.Structure):
+    _fields_ = [
+        ("head", ctypes.c_uint32),
+        ("tail", ctypes.c_uint32),
+        ("ring_mask", ctypes.c_uint32),
+        ("ring_entries", ctypes.c_uint32),
+        ("overflow", ctypes.c_uint32),
+        ("cqes", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        ("resv1", ctypes.c_uint32),
+        ("user_addr", ctypes.c_uint64),
+    ]
+
+
+class _Params(ctypes.Structure):
+    _fields_ = [
+        ("sq_entries", ctypes.c_uint32),
+        ("cq_entries", ctypes.c_uint32),
+        ("flags", ctypes.c_uint32),
+        ("sq_thread_cpu", ctypes.c_uint32),
+        ("sq_thread_idle", ctypes.c_uint32),
+        ("features", ctypes.c_uint32),
+        ("wq_fd", ctypes.c_uint32),
+        ("resv", ctypes.c_uint32 * 3),
+        ("sq_off", _SqringOffsets),
+        ("cq_off", _CqringOffsets),
+    ]
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+def _syscall(*args: int) -> int:
+    libc = _get_libc()
+    if libc is None:
+        raise IoUringError("libc is not available")
+    func = libc.syscall
+    func.restype = ctypes.c_long
+    # Pass plain integers as longs: addresses do not fit a C int.
+    result = func(*(ctypes.c_long(a) if isinstance(a, int) else a for a in args))
+    if result < 0:
+        err = ctypes.get_errno()
+        raise IoUringError(err, os.strerror(err))
+    return result
+
+
+def buffer_address(buf: mmap.mmap) -> Tuple[int, ctypes.Array]:
+    """
+    Return the address of an mmap buffer plus the ctypes view that pins it;
+    keep the view alive while the address is in use and delete it before
+    closing the buffer.
+    """
+    pin = (ctypes.c_char * len(buf)).from_buffer(buf)
+    return ctypes.addressof(pin), pin
+
+
+class IoUring:
+    """A single io_uring instance (submission and completion queues)."""
+
+    def __init__(self, entries: int):
+        params = _Params()
+        self.fd = _syscall(
+            _NR_IO_URING_SETUP, ctypes.c_uint(entries), ctypes.byref(params)
+        )
+        self._maps: List[mmap.mmap] = []
+        try:
+            self._setup(params)
+        except Exception:
+            self.close()
+            raise
+        self.fixed_buffers = False
+        self._iovecs: Optional[ctypes.Array] = None
+
+    def _setup(self, p: _Params) -> None:
+        sq_size = p.sq_off.array + p.sq_entries * 4
+        cq_size = p.cq_off.cqes + p.cq_entries * _CQE_SIZE
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+        if p.features & _IORING_FEAT_SINGLE_MMAP:
+            size = max(sq_size, cq_size)
+            sq_ring = mmap.mmap(
+                self.fd, size, mmap.MAP_SHARED, prot, offset=_IORING_OFF_SQ_RING
+            )
+            cq_ring = sq_ring
+            self._maps.append(sq_ring)
+        else:
+            sq_ring = mmap.mmap(
+                self.fd, sq_size, mmap.MAP_SHARED, prot, offset=_IORING_OFF_SQ_RING
+            )
+            self._maps.append(sq_ring)
+            cq_ring = mmap.mmap(
+                self.fd, cq_size, mmap.MAP_SHARED, prot, offset=_IORING_OFF_CQ_RING
+            )
+            self._maps.append(cq_ring)
+        sqes = mmap.mmap(
+            self.fd,
+            p.sq_entries * _SQE_SIZE,
+            mmap.MAP_SHARED,
+            prot,
+            offset=_IORING_OFF_SQES,
+        )
+        self._maps.append(sqes)
+
+        self._sq_ring = sq_ring
+        self._cq_ring = cq_ring
+        self._sqes = sqes
+        self.sq_entries = p.sq_entries
+        self.cq_entries = p.cq_entries
+        self._sq_head = p.sq_off.head
+        self._sq_tail = p.sq_off.tail
+        self._sq_mask = self._u32(sq_ring, p.sq_off.ring_mask)
+        self._sq_array = p.sq_off.array
+        self._cq_head = p.cq_off.head
+        self._cq_tail = p.cq_off.tail
+        self._cq_mask = self._u32(cq_ring, p.cq_off.ring_mask)
+        self._cqes = p.cq_off.cqes
+        self._pending = 0
+
+    @staticmethod
+    def _u32(buf: mmap.mmap, offset: int) -> int:
+        return struct.unpack_from("=I", buf, offset)[0]
+
+    def register_buffers(self, buffers: Sequence[Tuple[int, int]]) -> None:
+        """Register (address, length) buffers for READ_FIXED/WRITE_FIXED."""
+        iovecs = (_Iovec * len(buffers))(*(_Iovec(a, n) for a, n in buffers))
+        _syscall(
+            _NR_IO_URING_REGISTER,
+            self.fd,
+            _IORING_REGISTER_BUFFERS,
+            ctypes.addressof(iovecs),
+            len(buffers),
+        )
+        self._iovecs = iovecs
+        self.fixed_buffers = True
+
+    @property
+    def space(self) -> int:
+        """Free submission queue entries."""
+        head = self._u32(self._sq_ring, self._sq_head)
+        tail = self._u32(self._sq_ring, self._sq_tail)
+        return self.sq_entries - ((tail - head) & 0xFFFFFFFF)
+
+    def prep_rw(
+        self,
+        opcode: int,
+        fd: int,
+        addr: int,
+        length: int,
+        offset: int,
+        user_data: int,
+        buf_index: int = 0,
+    ) -> None:
+        """Queue one read or write; raises IoUringError when the queue is full."""
+        if self.space <= 0:
+            raise IoUringError("io_uring submission queue is full")
+        tail = self._u32(self._sq_ring, self._sq_tail)
+        index = tail & self._sq_mask
+        struct.pack_into(
+            _SQE_FORMAT,
+            self._sqes,
+            index * _SQE_SIZE,
+            opcode,
+            0,
+            0,
+            fd,
+            offset,
+            addr,
+            length,
+            0,
+            user_data,
+            buf_index,
+        )
+        # Clear the remaining fields (personality, splice_fd_in, addr3, pad).
+        used = struct.calcsize(_SQE_FORMAT)
+        self._sqes[index * _SQE_SIZE + used : (index + 1) * _SQE_SIZE] = bytes(
+            _SQE_SIZE - used
+        )
+        struct.pack_into("=I", self._sq_ring, self._sq_array + index * 4, index)
+        struct.pack_into("=I", self._sq_ring, self._sq_tail, (tail + 1) & 0xFFFFFFFF)
+        self._pending += 1
+
+    def submit(self, wait_for: int = 0) -> int:
+        """Submit queued entries and wait for at least `wait_for` completions."""
+        flags = _IORING_ENTER_GETEVENTS if wait_for else 0
+        submitted = _syscall(
+            _NR_IO_URING_ENTER, self.fd, self._pending, wait_for, flags, 0, 0
+        )
+        self._pending -= submitted
+        return submitted
+
+    def completions(self) -> Iterator[Tuple[int, int]]:
+        """Yield (user_data, result) for every available completion."""
+        head = self._u32(self._cq_ring, self._cq_head)
+        tail = self._u32(self._cq_ring, self._cq_tail)
+        while head != tail:
+            offset = self._cqes + (head & self._cq_mask) * _CQE_SIZE
+            user_data, result = struct.unpack_from(_CQE_FORMAT, self._cq_ring, offset)
+            head = (head + 1) & 0xFFFFFFFF
+            struct.pack_into("=I", self._cq_ring, self._cq_head, head)
+            yield user_data, result
+
+    def close(self) -> None:
+        for buf in self._maps:
+            try:
+                buf.close()
+            except Exception:
+                pass
+        self._maps = []
+        if self.fd is not None and self.fd >= 0:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = -1
+
+
+_available: Optional[bool] = None
+
+
+def uring_available() -> bool:
+    """Whether io_uring rings can be created in this process."""
+    global _available
+    if _available is None:
+        try:
+            IoUring(2).close()
+            _available = True
+        except (IoUringError, OSError, ValueError):
+            _available = False
+    return _available
+
+
+__all__ = [
+    "IoUring",
+    "IoUringError",
+    "IORING_OP_READ",
+    "IORING_OP_READ_FIXED",
+    "IORING_OP_WRITE",
+    "IORING_OP_WRITE_FIXED",
+    "buffer_address",
+    "uring_available",
+]
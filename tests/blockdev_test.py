@@ -0,0 +1,49 @@
+import os
+
+from justdd.logic import blockdev
+
+
+def _fake_bdi(tmp_path, monkeypatch, name="8:16"):
+    root = tmp_path / "bdi"
+    (root / name).mkdir(parents=True)
+    (root / name / "max_ratio").write_text("100\n")
+    (root / name / "strict_limit").write_text("0\n")
+    monkeypatch.setattr(blockdev, "_SYS_CLASS_BDI", str(root))
+    return root / name
+
+
+def test_bdi_dirty_limit_is_restored(tmp_path, monkeypatch):
+    bdi = _fake_bdi(tmp_path, monkeypatch)
+
+    with blockdev.BdiDirtyLimit("8:16", 5):
+        assert (bdi / "max_ratio").read_text() == "5"
+        assert (bdi / "strict_limit").read_text() == "1"
+
+    assert (bdi / "max_ratio").read_text() == "100"
+    assert (bdi / "strict_limit").read_text() == "0"
+
+
+def test_flash_job_logs_dirty_cap(tmp_path, monkeypatch):
+    from justdd.logic import flash_job
+
+    bdi = _fake_bdi(tmp_path, monkeypatch)
+    monkeypatch.setattr(flash_job, "bdi_name", lambda path: "8:16")
+    monkeypatch.setattr(blockdev, "dirty_threshold_bytes", lambda: 100 * 1024**2)
+    src = tmp_path / "src.img"
+    src.write_bytes(os.urandom(4 * 1024 * 1024))
+
+    job = flash_job.FlashJob(
+        str(src),
+        str(tmp_path / "dst.img"),
+        buffer_size=1024 * 1024,
+        flush_window=0,
+        dirty_limit_ratio=2,
+    )
+    job.start()
+    assert job.wait(30) and job.was_successful()
+
+    logs = "\n".join(job.get_logs())
+    assert "BDI 8:16 capped at 2% of the dirty threshold (2 MiB)" in logs
+    assert "exceeds the cap (2 MiB)" in logs
+    assert "restored the limits of BDI 8:16" in logs
+    assert (bdi / "max_ratio").read_text() == "100"
@@ -0,0 +1,42 @@
+import os
+
+from justdd.logic.dd_progress import DdProgressParser, follow_dd_output
+
+
+def test_parser_splits_carriage_returns():
+    parser = DdProgressParser()
+    records, messages = parser.feed(
+        b"1048576 bytes (1.0 MB, 1.0 MiB) copied, 1.5 s, 699 kB/s\r2097152 by"
+    )
+    assert [(r.bytes_copied, r.seconds) for r in records] == [(1048576, 1.5)]
+    assert messages == []
+
+    records, messages = parser.feed(
+        b"tes (2.1 MB, 2.0 MiB) copied, 2,0 s, 1,0 MB/s\r\n"
+        b"4+0 records in\n4+0 records out\n"
+        b"4194304 bytes (4.2 MB, 4.0 MiB) copied, 4.0 s, 1.0 MB/s\n"
+    )
+    assert [(r.bytes_copied, r.final) for r in records] == [
+        (2097152, False),
+        (4194304, True),
+    ]
+    assert records[-1].rate == 1048576.0
+    assert messages[:2] == ["4+0 records in", "4+0 records out"]
+    assert messages[-1].startswith("4194304 bytes")
+
+
+def test_follow_dd_output_reports_latest_record():
+    read_fd, write_fd = os.pipe()
+    os.write(
+        write_fd,
+        b"512 bytes copied, 0.5 s, 1.0 kB/s\r1024 bytes copied, 1 s, 1.0 kB/s\r"
+        b"dd: error writing '/dev/sdz': No space left on device",
+    )
+    os.close(write_fd)
+    records, messages = [], []
+    try:
+        assert follow_dd_output(read_fd, records.append, messages.append)
+    finally:
+        os.close(read_fd)
+    assert [r.bytes_copied for r in records] == [1024]
+    assert messages == ["dd: error writing '/dev/sdz': No space left on device"]
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import shutil
+import sys
+
+import pytest
+
+from justdd.logic.flash_backup import BackupEngine
+from justdd.logic.flash_engine import FlashEngine
+from justdd.logic.flash_job import BackupJob
+from justdd.logic.image_source import zstd_content_size
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def stick(tmp_path):
+    # Data at both ends with zeros in between, like a mostly empty stick.
+    path = tmp_path / "stick.img"
+    data = os.urandom(3 * MiB) + bytes(10 * MiB) + os.urandom(MiB + 512)
+    path.write_bytes(data)
+    return path, data
+
+
+def test_raw_backup_keeps_zero_runs_as_holes(stick, tmp_path):
+    source, data = stick
+    image = tmp_path / "backup.img"
+
+    with BackupEngine(
+        str(source), str(image), hash_algorithms=["sha256"], buffer_size=MiB
+    ) as engine:
+        assert engine.run() == len(data)
+
+    assert image.read_bytes() == data
+    assert engine.bytes_sparse == 10 * MiB
+    assert os.stat(image).st_blocks * 512 < 6 * MiB
+    assert engine.digests["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def test_zstd_backup_restores(stick, tmp_path):
+    source, data = stick
+    image = tmp_path / "backup.img.zst"
+
+    with BackupEngine(str(source), str(image), threads=2) as engine:
+        engine.run()
+
+    assert engine.compression == "zstd"
+    assert engine.bytes_written < 5 * MiB
+    assert zstd_content_size(str(image)) == len(data)
+    restored = tmp_path / "restored.img"
+    with FlashEngine(str(image), str(restored)) as flash:
+        flash.copy()
+    assert restored.read_bytes() == data
+
+
+@pytest.mark.skipif(shutil.which("zstd") is None, reason="needs the zstd CLI")
+def test_zstd_cli_fallback(stick, tmp_path, monkeypatch):
+    source, data = stick
+    image = tmp_path / "backup.img.zst"
+    # A None entry makes `import zstandard` raise ImportError.
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+
+    with BackupEngine(str(source), str(image), threads=2) as engine:
+        engine.run()
+
+    restored = tmp_path / "restored.img"
+    with FlashEngine(str(image), str(restored)) as flash:
+        flash.copy()
+    assert restored.read_bytes() == data
+
+
+def test_backup_job(stick, tmp_path):
+    source, data = stick
+    image = tmp_path / "backup.img.zst"
+    progress = []
+
+    job = BackupJob(
+        str(source), str(image), hash_algorithms=["md5"], on_progress=progress.append
+    )
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert progress[-1] == 100
+    counts = job.get_byte_counts()
+    assert counts["done"] == len(data) and counts["written"] == os.path.getsize(image)
+    assert job.get_digests() == {"md5": hashlib.md5(data).hexdigest()}
+
+    cancelled = BackupJob(str(source), str(tmp_path / "partial.img"))
+    cancelled.cancel()
+    cancelled.start()
+    assert cancelled.wait(30) and not cancelled.was_successful()
+    assert not (tmp_path / "partial.img").exists()
+    assert not (tmp_path / "partial.img.partial").exists()
+
+
+def test_failed_backup_keeps_the_existing_image(stick, tmp_path):
+    source, _data = stick
+    golden = tmp_path / "golden.img"
+    golden.write_bytes(b"golden" * 1000)
+    golden_bmap = tmp_path / "golden.img.bmap"
+    golden_bmap.write_text("<bmap/>")
+
+    job = BackupJob(str(tmp_path / "missing-dev"), str(golden))
+    job.start()
+    assert job.wait(30) and not job.was_successful()
+    assert any("Cannot open source" in line for line in job.get_logs())
+
+    cancelled = BackupJob(str(source), str(golden))
+    cancelled.cancel()
+    cancelled.start()
+    assert cancelled.wait(30) and not cancelled.was_successful()
+
+    assert golden.read_bytes() == b"golden" * 1000
+    assert golden_bmap.read_text() == "<bmap/>"
+    assert sorted(os.listdir(tmp_path)) == [
+        "golden.img",
+        "golden.img.bmap",
+        "stick.img",
+    ]
+
+    # A complete backup replaces the image, and drops its stale block map.
+    job = BackupJob(str(source), str(golden))
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert golden.read_bytes() == source.read_bytes()
+    assert not golden_bmap.exists()
+
+
+def test_backup_job_reads_through_helper(stick, tmp_path, monkeypatch):
+    from justdd.logic import flash_job
+    from justdd.logic.priv_helper import PrivilegedHelper
+
+    source, data = stick
+    image = tmp_path / "backup.img"
+    # The device is not readable by the user, only by the helper.
+    access = os.access
+    monkeypatch.setattr(
+        flash_job.os,
+        "access",
+        lambda path, mode: mode != os.R_OK and access(path, mode),
+    )
+    opened = []
+    helper = PrivilegedHelper(privileged=False)
+    helper.start()
+    open_read = helper.open_read
+    monkeypatch.setattr(
+        helper,
+        "open_read",
+        lambda path, direct=False: opened.append(path) or open_read(path, direct),
+    )
+    try:
+        job = BackupJob(str(source), str(image), helper=helper)
+        job.start()
+        assert job.wait(30) and job.was_successful()
+    finally:
+        helper.stop()
+
+    assert "Reading the device through the privileged helper" in job.get_logs()
+    assert opened and set(opened) == {str(source)}
+    assert image.read_bytes() == data
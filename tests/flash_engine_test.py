@@ -0,0 +1,398 @@
+import os
+
+import pytest
+
+from justdd.logic.flash_engine import FlashCancelled, FlashEngine
+
+
+def _make_image(path, size):
+    data = os.urandom(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+def test_copy_to_regular_file(tmp_path):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 3 * 1024 * 1024 + 123)
+    seen = []
+
+    with FlashEngine(
+        str(src),
+        str(dst),
+        buffer_size=1024 * 1024,
+        ring_depth=3,
+        on_progress=lambda done, total: seen.append((done, total)),
+    ) as engine:
+        assert engine.copy() == len(data)
+        engine.sync()
+
+    assert dst.read_bytes() == data
+    assert seen[-1] == (len(data), len(data))
+
+
+def test_copy_truncates_larger_file_target(tmp_path):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 4096)
+    dst.write_bytes(b"\xff" * 8192)
+
+    with FlashEngine(str(src), str(dst)) as engine:
+        engine.copy()
+
+    assert dst.read_bytes() == data
+
+
+def test_copy_cancelled(tmp_path):
+    src = tmp_path / "src.img"
+    _make_image(src, 4096)
+
+    with FlashEngine(
+        str(src), str(tmp_path / "dst.img"), should_stop=lambda: True
+    ) as engine:
+        with pytest.raises(FlashCancelled):
+            engine.copy()
+
+
+def test_autotune_block_size(tmp_path):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 2 * 1024 * 1024)
+
+    with FlashEngine(str(src), str(dst), block_size="auto") as engine:
+        engine.copy()
+        assert engine.tuner is not None and engine.tuner.done
+        assert engine.block_size in engine.tuner.candidates
+
+    assert dst.read_bytes() == data
+
+
+def test_autotune_times_writes_and_shrinks_buffers(tmp_path, monkeypatch):
+    import time
+
+    from justdd.logic import flash_engine
+    from justdd.logic.flash_engine import DEFAULT_BUFFER_SIZE
+
+    MiB = 1024 * 1024
+    monkeypatch.setattr(flash_engine, "TUNE_CANDIDATES", (MiB, 8 * MiB))
+    # Whatever was measured, settle on the smallest size.
+    monkeypatch.setattr(
+        flash_engine.BlockSizeTuner,
+        "_choose",
+        lambda tuner: setattr(tuner, "chosen", tuner.candidates[0]),
+    )
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 128 * MiB)
+
+    with FlashEngine(str(src), str(dst), block_size="auto") as engine:
+        assert engine.buffer_size == 8 * MiB
+        engine.begin_writes()
+        # Filling the first buffer is not part of the first trial.
+        started = time.monotonic()
+        engine.write_buffer(memoryview(data)[:MiB], 0)
+        assert engine.tuner._trial_start >= started
+        engine.bytes_done = 0
+        engine.copy()
+
+        assert engine.block_size == MiB
+        # Refilled buffers gave their pages past 4 MiB back.
+        assert engine.buffer_size == DEFAULT_BUFFER_SIZE
+        assert min(engine._buffer_kept) == DEFAULT_BUFFER_SIZE
+
+    assert dst.read_bytes() == data
+
+
+@pytest.mark.parametrize("mode", ["zeroout", "unclean"])
+def test_zero_blocks_are_skipped(tmp_path, mode):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    chunk = 256 * 1024
+    data = os.urandom(chunk) + bytes(4 * chunk) + os.urandom(chunk) + bytes(100)
+    src.write_bytes(data)
+
+    with FlashEngine(str(src), str(dst), zero_mode=mode) as engine:
+        assert engine.copy() == len(data)
+
+    assert dst.read_bytes() == data
+    assert engine.bytes_skipped == 4 * chunk + 100
+    assert engine.bytes_written == 2 * chunk
+
+
+def test_delta_rewrites_only_differences(tmp_path):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    unit = 1024 * 1024
+    old = os.urandom(6 * unit)
+    new = bytearray(old)
+    new[2 * unit + 10] ^= 0xFF
+    new += os.urandom(unit // 2)
+    dst.write_bytes(old)
+    src.write_bytes(bytes(new))
+
+    with FlashEngine(str(src), str(dst), delta=True) as engine:
+        engine.copy()
+
+    assert dst.read_bytes() == bytes(new)
+    assert engine.bytes_compared == len(new)
+    assert engine.bytes_rewritten == unit + unit // 2
+
+
+@pytest.mark.parametrize("suffix", ["xz", "gz", "bz2"])
+def test_copy_compressed_image(tmp_path, suffix):
+    import bz2
+    import gzip
+    import lzma
+
+    compress = {"xz": lzma.compress, "gz": gzip.compress, "bz2": bz2.compress}
+    data = os.urandom(1024 * 1024) + bytes(1024 * 1024)
+    src = tmp_path / f"src.img.{suffix}"
+    dst = tmp_path / "dst.img"
+    src.write_bytes(compress[suffix](data))
+    seen = []
+
+    with FlashEngine(
+        str(src), str(dst), on_progress=lambda done, total: seen.append((done, total))
+    ) as engine:
+        assert engine.copy() == len(data)
+
+    assert dst.read_bytes() == data
+    assert seen[-1][0] == seen[-1][1]
+
+
+def test_copy_zipped_image(tmp_path):
+    import zipfile
+
+    data = os.urandom(1024 * 1024) + bytes(512 * 1024)
+    src = tmp_path / "src.zip"
+    dst = tmp_path / "dst.img"
+    with zipfile.ZipFile(src, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("README.txt", "not the image")
+        archive.writestr("disk.img", data)
+
+    with FlashEngine(str(src), str(dst)) as engine:
+        assert engine.source_size == len(data)
+        assert engine.copy() == len(data)
+
+    assert dst.read_bytes() == data
+
+
+def test_verify_reports_first_mismatch(tmp_path):
+    from justdd.logic.flash_verify import FlashVerifier, VerifyMismatch
+
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 3 * 1024 * 1024 + 77)
+    dst.write_bytes(data)
+    assert FlashVerifier(str(src), str(dst)).run() == len(data)
+
+    corrupted = bytearray(data)
+    corrupted[2 * 1024 * 1024 + 5] ^= 0x01
+    dst.write_bytes(bytes(corrupted))
+    with pytest.raises(VerifyMismatch) as excinfo:
+        FlashVerifier(str(src), str(dst)).run()
+    assert excinfo.value.offset == 2 * 1024 * 1024 + 5
+
+    dst.write_bytes(data[:-10])
+    with pytest.raises(VerifyMismatch) as excinfo:
+        FlashVerifier(str(src), str(dst)).run()
+    assert excinfo.value.offset == len(data) - 10
+
+
+def test_digests_computed_while_writing(tmp_path):
+    import hashlib
+
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 5 * 1024 * 1024 + 3)
+
+    with FlashEngine(
+        str(src), str(dst), buffer_size=1024 * 1024, hash_algorithms=["sha256", "md5"]
+    ) as engine:
+        engine.copy()
+
+    assert dst.read_bytes() == data
+    assert engine.digests == {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "md5": hashlib.md5(data).hexdigest(),
+    }
+
+
+def test_resume_from_journal(tmp_path, monkeypatch):
+    from justdd.logic.flash_job import FlashJob
+
+    monkeypatch.setenv("XDG_STATE_HOME", str(tmp_path / "state"))
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 12 * 1024 * 1024)
+    calls = []
+
+    def stop_halfway():
+        calls.append(1)
+        return len(calls) > 8
+
+    job = FlashJob(
+        str(src),
+        str(dst),
+        buffer_size=1024 * 1024,
+        block_size=1024 * 1024,
+        flush_window=1024 * 1024,
+    )
+    job._should_stop = stop_halfway
+    job._flash_linux_native()
+    assert not job.was_successful()
+    offset = job.find_resume_offset()
+    assert 0 < offset < len(data)
+
+    resumed = FlashJob(str(src), str(dst), resume=True)
+    resumed.start()
+    assert resumed.wait(30) and resumed.was_successful()
+    assert f"Resuming from byte {offset}" in "\n".join(resumed.get_logs())
+    assert dst.read_bytes() == data
+    assert resumed.find_resume_offset() == 0
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz"])
+def test_copy_with_io_uring(tmp_path, suffix):
+    import gzip
+    import hashlib
+
+    from justdd.logic.uring import uring_available
+
+    if not uring_available():
+        pytest.skip("io_uring is not available")
+    src = tmp_path / f"src.img{suffix}"
+    dst = tmp_path / "dst.img"
+    data = os.urandom(5 * 1024 * 1024 + 77)
+    src.write_bytes(gzip.compress(data) if suffix else data)
+    logs = []
+
+    with FlashEngine(
+        str(src),
+        str(dst),
+        block_size=1024 * 1024,
+        io_backend="uring",
+        hash_algorithms=["sha256"],
+        on_log=logs.append,
+    ) as engine:
+        assert engine.backend == "uring"
+        assert engine.copy() == len(data)
+        engine.sync()
+
+    assert dst.read_bytes() == data
+    assert engine.digests["sha256"] == hashlib.sha256(data).hexdigest()
+    assert any(line.startswith("I/O backend: io_uring") for line in logs)
+
+
+def test_io_uring_falls_back_when_direct_writes_fail(tmp_path):
+    from justdd.logic.uring import uring_available
+
+    if not uring_available() or not hasattr(os, "eventfd"):
+        pytest.skip("io_uring is not available")
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 3 * 1024 * 1024)
+    logs = []
+
+    with FlashEngine(
+        str(src),
+        str(dst),
+        block_size=1024 * 1024,
+        io_backend="uring",
+        on_log=logs.append,
+    ) as engine:
+        # Stand-in for a target that refuses O_DIRECT: writes of more than
+        # eight bytes to an eventfd fail with EINVAL.
+        engine._direct_fd = os.eventfd(0)
+        engine._direct_align = 4096
+        assert engine.copy() == len(data)
+        engine.sync()
+        assert engine._direct_fd is None
+
+    assert dst.read_bytes() == data
+    assert any("O_DIRECT write rejected" in line for line in logs)
+
+
+@pytest.mark.parametrize("method", ["copy_file_range", "splice", "pwrite"])
+def test_zero_copy_backend(tmp_path, method):
+    if not hasattr(os, method):
+        pytest.skip(f"os.{method} is not available")
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 3 * 1024 * 1024 + 5)
+    seen = []
+
+    with FlashEngine(
+        str(src),
+        str(dst),
+        block_size=1024 * 1024,
+        io_backend="auto",
+        on_progress=lambda done, total: seen.append(done),
+    ) as engine:
+        assert engine.backend == "zerocopy"
+        engine.copy_method = method
+        engine.copy()
+
+    assert dst.read_bytes() == data
+    assert seen == [1024 * 1024, 2 * 1024 * 1024, 3 * 1024 * 1024, len(data)]
+
+
+def test_page_cache_is_bounded(tmp_path, monkeypatch):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = _make_image(src, 48 * 1024 * 1024)
+    calls = []
+    fadvise = os.posix_fadvise
+
+    def record(fd, offset, length, advice):
+        calls.append((fd, advice))
+        fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, "posix_fadvise", record)
+    with FlashEngine(
+        str(src),
+        str(dst),
+        buffer_size=1024 * 1024,
+        ring_depth=2,
+        flush_window=2 * 1024 * 1024,
+        readahead=4 * 1024 * 1024,
+    ) as engine:
+        source_fd = engine._source.fileno()
+        engine.copy()
+        engine.sync()
+
+    assert dst.read_bytes() == data
+    advice = {a for fd, a in calls if fd == source_fd}
+    assert {
+        os.POSIX_FADV_SEQUENTIAL,
+        os.POSIX_FADV_WILLNEED,
+        os.POSIX_FADV_DONTNEED,
+    } <= advice
+    assert 0 < engine.cache_peak <= 32 * 1024 * 1024
+
+
+@pytest.mark.parametrize("options", [{}, {"zero_mode": "zeroout"}, {"delta": True}])
+def test_direct_io_with_buffered_tail(tmp_path, options):
+    src = tmp_path / "src.img"
+    dst = tmp_path / "dst.img"
+    data = os.urandom(1024 * 1024) + bytes(1024 * 1024) + os.urandom(3000)
+    src.write_bytes(data)
+    dst.write_bytes(os.urandom(len(data)))
+    logs = []
+
+    with FlashEngine(
+        str(src),
+        str(dst),
+        buffer_size=1024 * 1024,
+        direct_io=True,
+        on_log=logs.append,
+        **options,
+    ) as engine:
+        if engine._direct_fd is None:
+            pytest.skip("the test filesystem does not support O_DIRECT")
+        engine.copy()
+        engine.sync()
+
+    assert dst.read_bytes() == data
+    assert any(line.startswith("Direct I/O:") for line in logs)
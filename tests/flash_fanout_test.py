@@ -0,0 +1,124 @@
+import gzip
+import os
+import time
+
+from justdd.logic.flash_fanout import TARGET_DONE, TARGET_FAILED, FanOutEngine
+from justdd.logic.flash_job import MultiFlashJob
+
+
+def test_fan_out_isolates_failing_target(tmp_path):
+    src = tmp_path / "src.img"
+    data = os.urandom(5 * 1024 * 1024 + 11)
+    src.write_bytes(data)
+    targets = [tmp_path / f"t{i}.img" for i in range(3)]
+
+    with FanOutEngine(
+        str(src),
+        [str(t) for t in targets],
+        buffer_size=1024 * 1024,
+        block_size=1024 * 1024,
+        pool_depth=3,
+    ) as fan_out:
+        broken = fan_out.targets[1].engine
+        write_buffer = broken.write_buffer
+
+        def fail_after_first(view, offset):
+            if offset:
+                raise OSError(5, "Input/output error")
+            write_buffer(view, offset)
+
+        broken.write_buffer = fail_after_first
+        assert fan_out.run() == 2
+
+    states = [t.state for t in fan_out.targets]
+    assert states == [TARGET_DONE, TARGET_FAILED, TARGET_DONE]
+    assert "byte 1048576" in fan_out.targets[1].error
+    assert targets[0].read_bytes() == data
+    assert targets[2].read_bytes() == data
+
+
+def test_multi_flash_job(tmp_path):
+    src = tmp_path / "src.img"
+    data = os.urandom(3 * 1024 * 1024)
+    src.write_bytes(data)
+    targets = [str(tmp_path / f"t{i}.img") for i in range(2)]
+    targets.append(str(tmp_path / "missing" / "t.img"))
+
+    job = MultiFlashJob(str(src), targets, hash_algorithms=["sha256"])
+    job.start()
+    assert job.wait(30)
+
+    results = job.get_target_progress()
+    assert [r["state"] for r in results] == ["done", "done", "failed"]
+    assert not job.was_successful()
+    assert "2 of 3 targets written" in job.get_finished_message()
+    assert "sha256" in job.get_digests()
+    for path in targets[:2]:
+        with open(path, "rb") as f:
+            assert f.read() == data
+
+
+def test_compressed_progress_is_per_target(tmp_path):
+    src = tmp_path / "src.img.gz"
+    src.write_bytes(gzip.compress(os.urandom(8 * 1024 * 1024)))
+    targets = [str(tmp_path / f"t{i}.img") for i in range(2)]
+    reports = {0: [], 1: []}
+
+    with FanOutEngine(
+        str(src),
+        targets,
+        buffer_size=1024 * 1024,
+        block_size=1024 * 1024,
+        pool_depth=10,
+        on_progress=lambda index, done, total: reports[index].append((done, total)),
+    ) as fan_out:
+        slow = fan_out.targets[1].engine
+        write_buffer = slow.write_buffer
+
+        def after_the_other_target(view, offset):
+            deadline = time.monotonic() + 10
+            while fan_out.targets[0].state != TARGET_DONE:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            write_buffer(view, offset)
+
+        slow.write_buffer = after_the_other_target
+        assert fan_out.run() == 2
+
+    # The reader was done long before the slow target wrote its first buffer.
+    done, total = reports[1][0]
+    assert done < total // 4
+    assert reports[1][-1][0] == reports[0][-1][0] == total
+
+
+def test_fan_out_pool_stays_small_around_autotuning(tmp_path, monkeypatch):
+    from justdd.logic import flash_engine, flash_fanout
+
+    MiB = 1024 * 1024
+    monkeypatch.setattr(flash_engine, "TUNE_CANDIDATES", (MiB, 8 * MiB))
+    monkeypatch.setattr(
+        flash_engine.BlockSizeTuner,
+        "_choose",
+        lambda tuner: setattr(tuner, "chosen", tuner.candidates[0]),
+    )
+    monkeypatch.setattr(flash_fanout, "_TUNING_POOL_BYTES", 16 * MiB)
+    src = tmp_path / "src.img"
+    data = os.urandom(96 * MiB)
+    src.write_bytes(data)
+    targets = [tmp_path / f"t{i}.img" for i in range(2)]
+
+    with FanOutEngine(
+        str(src),
+        [str(t) for t in targets],
+        buffer_size=2 * MiB,
+        block_size="auto",
+        pool_depth=6,
+    ) as fan_out:
+        assert fan_out.buffer_size == 8 * MiB
+        assert fan_out.run() == 2
+        # Two 8 MiB buffers while tuning, then all six at 2 MiB.
+        assert fan_out._held == []
+        assert fan_out._buffer_kept == [2 * MiB] * 6
+
+    for target in targets:
+        assert target.read_bytes() == data
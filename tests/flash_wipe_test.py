@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from justdd.logic import flash_wipe
+from justdd.logic.flash_engine import FlashCancelled
+from justdd.logic.flash_job import WipeJob
+from justdd.logic.flash_wipe import WIPE_WRITE, WIPE_ZEROOUT, WipeEngine
+
+MiB = 1024 * 1024
+
+
+def test_threaded_zero_writer(tmp_path):
+    target = tmp_path / "stick.img"
+    size = 9 * MiB + 1536
+    target.write_bytes(os.urandom(size))
+    seen = []
+
+    with WipeEngine(
+        str(target),
+        method=WIPE_WRITE,
+        threads=3,
+        chunk_size=MiB,
+        block_size=256 * 1024,
+        on_progress=lambda done, total: seen.append((done, total)),
+    ) as engine:
+        assert engine.wipe() == size
+        engine.sync()
+
+    assert engine.methods_used == [WIPE_WRITE]
+    assert seen[-1] == (size, size)
+    assert target.read_bytes() == bytes(size)
+
+
+def test_auto_punches_holes_in_files(tmp_path):
+    target = tmp_path / "stick.img"
+    target.write_bytes(os.urandom(4 * MiB))
+
+    with WipeEngine(str(target), chunk_size=MiB) as engine:
+        engine.wipe()
+
+    assert engine.methods_used == [WIPE_ZEROOUT]
+    assert target.read_bytes() == bytes(4 * MiB)
+    assert os.stat(target).st_blocks * 512 < MiB
+
+
+def test_auto_never_discards(tmp_path, monkeypatch):
+    # A device that only discards gets zeros written, not unmapped blocks.
+    monkeypatch.setattr(
+        flash_wipe, "read_queue_hints", lambda path: {"discard_max_bytes": MiB}
+    )
+    target = tmp_path / "stick.img"
+    target.write_bytes(os.urandom(2 * MiB))
+
+    with WipeEngine(str(target), chunk_size=MiB) as engine:
+        engine._target_is_file = False
+        engine.wipe()
+
+    assert engine.methods_used == [WIPE_WRITE]
+    assert target.read_bytes() == bytes(2 * MiB)
+
+
+def test_wipe_cancels_between_chunks(tmp_path):
+    target = tmp_path / "stick.img"
+    target.write_bytes(b"\xff" * (4 * MiB))
+
+    engine = WipeEngine(
+        str(target),
+        method=WIPE_WRITE,
+        threads=1,
+        chunk_size=MiB,
+        should_stop=lambda: True,
+    )
+    with engine, pytest.raises(FlashCancelled):
+        engine.wipe()
+    assert engine.bytes_done < 4 * MiB
+
+
+def test_wipe_job_reports_progress(tmp_path):
+    target = tmp_path / "stick.img"
+    target.write_bytes(os.urandom(6 * MiB))
+    progress = []
+
+    job = WipeJob(
+        str(target), method=WIPE_WRITE, threads=2, on_progress=progress.append
+    )
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert job.get_progress() == 100 and progress == sorted(progress)
+    assert job.get_byte_counts() == {"done": 6 * MiB}
+    assert target.read_bytes() == bytes(6 * MiB)
@@ -0,0 +1,240 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from justdd.logic.bmap import find_bmap, read_bmap
+from justdd.logic.flash_backup import BackupEngine
+from justdd.logic.flash_job import FlashJob
+from justdd.logic.fs_allocation import read_allocation
+from justdd.logic.priv_helper import PrivilegedHelper
+
+MiB = 1024 * 1024
+
+
+def fat_entries(bits, values):
+    if bits != 12:
+        return struct.pack(f"<{len(values)}{'H' if bits == 16 else 'I'}", *values)
+    table = bytearray(-(-len(values) * 3 // 2))
+    for cluster, value in enumerate(values):
+        pos = cluster * 3 // 2
+        if cluster & 1:
+            table[pos] |= (value << 4) & 0xF0
+            table[pos + 1] = value >> 4
+        else:
+            table[pos] = value & 0xFF
+            table[pos + 1] |= value >> 8
+    return bytes(table)
+
+
+def make_fat(f, start, size, bits, per_cluster, used):
+    """Write a FAT filesystem at `start`; returns the ranges of the used clusters."""
+    sectors = size // 512
+    reserved = 32 if bits == 32 else 1
+    root_entries = 0 if bits == 32 else 512
+    entries = sectors // per_cluster + 2
+    fat_sectors = -(-(entries * bits // 8 + 2) // 512)
+    boot = bytearray(512)
+    boot[0:11] = b"\xeb\x3c\x90MSDOS5.0"
+    small = sectors if bits != 32 and sectors < 65536 else 0
+    struct.pack_into(
+        "<HBHBHHBH",
+        boot,
+        11,
+        512,
+        per_cluster,
+        reserved,
+        2,
+        root_entries,
+        small,
+        0xF8,
+        0 if bits == 32 else fat_sectors,
+    )
+    struct.pack_into("<I", boot, 32, 0 if small else sectors)
+    if bits == 32:
+        struct.pack_into("<I", boot, 36, fat_sectors)
+    boot[510:512] = b"\x55\xaa"
+    values = [0] * entries
+    values[0] = values[1] = (1 << bits) - 1
+    for cluster in used:
+        values[cluster] = (1 << bits) - 1 if bits != 32 else 0x0FFFFFFF
+    f.seek(start)
+    f.write(boot)
+    f.seek(start + reserved * 512)
+    f.write(fat_entries(bits, values))
+    heap = start + (reserved + 2 * fat_sectors + root_entries * 32 // 512) * 512
+    cluster_size = per_cluster * 512
+    offsets = [heap + (cluster - 2) * cluster_size for cluster in used]
+    for offset in offsets:
+        f.seek(offset)
+        f.write(os.urandom(cluster_size))
+    return [(offset, offset + cluster_size) for offset in offsets]
+
+
+def make_exfat(f, size, cluster_shift, used):
+    cluster_size = 512 << cluster_shift
+    fat_offset, heap_offset = 128, 1024
+    clusters = (size // 512 - heap_offset) >> cluster_shift
+    # Cluster 2 holds the allocation bitmap, cluster 3 the root directory.
+    used = [2, 3] + list(used)
+    boot = bytearray(512)
+    boot[3:11] = b"EXFAT   "
+    struct.pack_into(
+        "<QQIIIII", boot, 64, 0, size // 512, fat_offset, 8, heap_offset, clusters, 3
+    )
+    boot[108:111] = bytes([9, cluster_shift, 1])
+    boot[510:512] = b"\x55\xaa"
+    bitmap = bytearray(-(-clusters // 8))
+    for cluster in used:
+        bitmap[(cluster - 2) // 8] |= 1 << ((cluster - 2) % 8)
+    root = bytearray(32)
+    root[0] = 0x81
+    struct.pack_into("<IQ", root, 20, 2, len(bitmap))
+    heap = heap_offset * 512
+    f.seek(0)
+    f.write(boot)
+    f.seek(fat_offset * 512)
+    f.write(struct.pack("<6I", 0xFFFFFFF8, 0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0, 0))
+    f.seek(heap)
+    f.write(bitmap)
+    f.seek(heap + cluster_size)
+    f.write(root)
+    return [
+        (heap + (c - 2) * cluster_size, heap + (c - 1) * cluster_size) for c in used
+    ]
+
+
+def mapped(allocation, start, end):
+    return any(low <= start and end <= high for low, high in allocation.ranges)
+
+
+@pytest.mark.parametrize(
+    "bits,size,per_cluster", [(12, 8 * MiB, 8), (16, 32 * MiB, 4), (32, 48 * MiB, 1)]
+)
+def test_fat_free_clusters(tmp_path, bits, size, per_cluster):
+    image = tmp_path / "fat.img"
+    clusters = size // (per_cluster * 512)
+    used = list(range(2, 300)) + [clusters // 2, clusters - 10]
+    with open(image, "wb") as f:
+        f.truncate(size)
+        runs = make_fat(f, 0, size, bits, per_cluster, used)
+
+    allocation = read_allocation(str(image))
+
+    assert [fs.kind for fs in allocation.filesystems] == [f"fat{bits}"]
+    assert allocation.layout is None
+    assert all(mapped(allocation, start, end) for start, end in runs)
+    assert allocation.unmapped_bytes > size // 2
+
+
+def test_exfat_allocation_bitmap(tmp_path):
+    image = tmp_path / "exfat.img"
+    size = 32 * MiB
+    with open(image, "wb") as f:
+        f.truncate(size)
+        runs = make_exfat(f, size, 3, list(range(10, 200)) + [3000])
+
+    allocation = read_allocation(str(image))
+
+    assert allocation.filesystems[0].kind == "exfat"
+    assert all(mapped(allocation, start, end) for start, end in runs)
+    assert allocation.unmapped_bytes > 24 * MiB
+
+
+@pytest.mark.skipif(
+    not (shutil.which("mkfs.ext4") and shutil.which("e2fsck")),
+    reason="needs e2fsprogs",
+)
+@pytest.mark.parametrize(
+    "options",
+    [
+        # 1 KiB blocks give eight block groups, most of them BLOCK_UNINIT.
+        [],
+        # 64 groups, descriptors spread over four meta groups.
+        ["-O", "meta_bg,^resize_inode", "-g", "1024"],
+    ],
+)
+def test_ext4_keeps_everything_in_use(tmp_path, options):
+    files = tmp_path / "files"
+    files.mkdir()
+    for name in ("a.bin", "b.bin"):
+        (files / name).write_bytes(os.urandom(3 * MiB))
+    image = tmp_path / "ext4.img"
+    with open(image, "wb") as f:
+        f.truncate(64 * MiB)
+    subprocess.run(
+        ["mkfs.ext4", "-q", "-F", "-b", "1024", *options, "-d", str(files), str(image)],
+        check=True,
+    )
+
+    allocation = read_allocation(str(image))
+    assert allocation.filesystems[0].kind == "ext4"
+    assert allocation.unmapped_bytes > 40 * MiB
+
+    # Wiping everything unmapped leaves a clean filesystem with the same files.
+    with open(image, "r+b") as f:
+        offset = 0
+        for start, end in allocation.ranges + [(64 * MiB, 64 * MiB)]:
+            f.seek(offset)
+            f.write(b"\xee" * (start - offset))
+            offset = end
+    subprocess.run(["e2fsck", "-fn", str(image)], check=True, capture_output=True)
+    for name in ("a.bin", "b.bin"):
+        dumped = subprocess.run(
+            ["debugfs", "-R", f"cat /{name}", str(image)],
+            check=True,
+            capture_output=True,
+        ).stdout
+        assert dumped == (files / name).read_bytes()
+
+
+@pytest.mark.parametrize("engine", ["native", "helper"])
+def test_backup_and_restore_skip_free_space(tmp_path, engine):
+    source = tmp_path / "stick.img"
+    size = 64 * MiB
+    with open(source, "wb") as f:
+        f.truncate(size)
+        entry = struct.pack("<B3sB3sII", 0, b"\0" * 3, 0x0C, b"\0" * 3, 2048, 98304)
+        f.seek(446)
+        f.write(entry.ljust(64, b"\0") + b"\x55\xaa")
+        runs = make_fat(f, MiB, 48 * MiB, 32, 1, list(range(2, 2000)) + [50000])
+    data = source.read_bytes()
+    image = tmp_path / "backup.img.zst"
+
+    with BackupEngine(str(source), str(image), skip_free=True) as engine:
+        engine.run()
+
+    assert engine.bmap_path == str(tmp_path / "backup.img.bmap")
+    assert find_bmap(str(image)) == engine.bmap_path
+    bmap = read_bmap(engine.bmap_path)
+    assert bmap.ranges == engine.allocation.ranges and len(bmap.checksums) > 1
+    assert engine.bytes_unmapped == size - bmap.mapped_size > 40 * MiB
+
+    target = tmp_path / "target.img"
+    target.write_bytes(b"\xee" * size)
+    # Stand-in helper: same protocol, started without pkexec.
+    helper = PrivilegedHelper(privileged=False)
+    helper.start()
+    try:
+        job = FlashJob(
+            str(image),
+            str(target),
+            engine=engine,
+            helper=helper,
+            trim=True,
+            verify=True,
+        )
+        job.start()
+        assert job.wait(30) and job.was_successful()
+    finally:
+        helper.stop()
+    assert job.get_byte_counts()["trimmed"] == engine.bytes_unmapped
+
+    written = target.read_bytes()
+    for start, end in bmap.ranges:
+        assert written[start:end] == data[start:end]
+    for start, end in bmap.unmapped_ranges:
+        assert written[start:end] == b"\xee" * (end - start)
+    assert all(written[a:b] == data[a:b] for a, b in runs)
@@ -0,0 +1,39 @@
+import hashlib
+
+from justdd.logic.image_hash import StreamHasher, find_expected_digest
+
+
+def test_stream_hasher_matches_hashlib():
+    chunks = [b"a" * 100000, b"b" * 3, b"c" * 70000]
+    released = []
+    hasher = StreamHasher(["sha256", "SHA-1"])
+    for i, chunk in enumerate(chunks):
+        hasher.submit(memoryview(chunk), lambda i=i: released.append(i))
+
+    digests = hasher.finish()
+
+    assert sorted(released) == [0, 1, 2]
+    assert digests == {
+        "sha256": hashlib.sha256(b"".join(chunks)).hexdigest(),
+        "sha1": hashlib.sha1(b"".join(chunks)).hexdigest(),
+    }
+
+
+def test_find_expected_digest(tmp_path):
+    image = tmp_path / "distro.iso"
+    image.write_bytes(b"image")
+    digest = hashlib.sha256(b"image").hexdigest()
+
+    assert find_expected_digest(str(image)) is None
+
+    sums = tmp_path / "SHA256SUMS"
+    sums.write_text(f"{'0' * 64}  other.iso\n{digest} *distro.iso\n")
+    assert find_expected_digest(str(image)) == (digest, str(sums))
+
+    sums.unlink()
+    (tmp_path / "distro.iso.sha256").write_text(digest + "\n")
+    assert find_expected_digest(str(image))[0] == digest
+
+    (tmp_path / "distro.iso.sha256").unlink()
+    (tmp_path / "CHECKSUM.sha256").write_text(f"SHA256 (distro.iso) = {digest}\n")
+    assert find_expected_digest(str(image))[0] == digest
@@ -0,0 +1,51 @@
+import os
+import zipfile
+
+from justdd.logic.flash_job import FlashJob
+from justdd.logic.iso_detector import ISODetector
+
+
+def _iso_head(volume):
+    pvd = bytearray(2048)
+    pvd[0] = 1
+    pvd[1:6] = b"CD001"
+    pvd[40:72] = volume.encode().ljust(32)
+    return bytes(16 * 2048) + bytes(pvd) + bytes(4096)
+
+
+def test_detects_zipped_iso_from_volume_descriptor(tmp_path):
+    archive_path = tmp_path / "download.zip"
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("image.iso", _iso_head("Ubuntu 24.04 LTS amd64"))
+
+    iso_type, details = ISODetector.detect_iso_type(str(archive_path))
+
+    assert iso_type == "linux"
+    assert details["member"] == "image.iso"
+    assert details["volume"] == "Ubuntu 24.04 LTS amd64"
+    assert details["size"] == "38.0 KB"
+
+
+def test_zipped_windows_iso_is_unpacked_for_the_loop_mount(tmp_path, monkeypatch):
+    iso = _iso_head("CCCOMA_X64FRE_EN-US_DV9") + os.urandom(64 * 1024)
+    archive_path = tmp_path / "Win11.zip"
+    with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("Win11_English_x64.iso", iso)
+    assert ISODetector.detect_iso_type(str(archive_path))[0] == "windows"
+
+    mounted = []
+
+    def execute(self, steps, drive, scheme_name):
+        [source] = [
+            cmd[-2] for _, _, cmd in steps if cmd[:3] == ["mount", "-o", "loop"]
+        ]
+        with open(source, "rb") as f:
+            mounted.append((source, f.read()))
+
+    monkeypatch.setattr(FlashJob, "_execute_windows_script", execute)
+    job = FlashJob(str(archive_path), "/dev/justdd-missing", mode="windows")
+    job._flash_windows()
+
+    [(source, data)] = mounted
+    assert data == iso
+    assert source != str(archive_path) and not os.path.exists(source)
@@ -0,0 +1,170 @@
+import binascii
+import hashlib
+import os
+import struct
+
+import pytest
+
+from justdd.logic.partition_table import (
+    SCHEME_GPT,
+    SCHEME_MBR,
+    PartitionTableError,
+    read_partition_layout,
+)
+
+MiB = 1024 * 1024
+
+
+def mbr_entry(ptype, first, count):
+    return struct.pack("<B3sB3sII", 0, b"\0" * 3, ptype, b"\0" * 3, first, count)
+
+
+def write_mbr(f, entries, lba=0):
+    table = b"".join(mbr_entry(*entry) for entry in entries)
+    f.seek(lba * 512 + 446)
+    f.write(table.ljust(64, b"\0") + b"\x55\xaa")
+
+
+def make_mbr_image(path, size):
+    with open(path, "wb") as f:
+        f.truncate(size)
+        # Primary partition plus an extended one holding two logical partitions.
+        write_mbr(f, [(0x0C, 2048, 2048), (0x05, 4096, 6144)])
+        write_mbr(f, [(0x83, 2048, 1024), (0x05, 3072, 3072)], lba=4096)
+        write_mbr(f, [(0x83, 2048, 1024)], lba=4096 + 3072)
+        f.seek(2048 * 512)
+        f.write(os.urandom(MiB))
+
+
+def make_gpt_image(path, size, parts):
+    sectors = size // 512
+    entries = bytearray(128 * 128)
+    for index, (first, last) in enumerate(parts):
+        struct.pack_into(
+            "<16s16sQQQ",
+            entries,
+            index * 128,
+            os.urandom(16),
+            os.urandom(16),
+            first,
+            last,
+            0,
+        )
+        entries[index * 128 + 56 : index * 128 + 64] = "root".encode("utf-16-le")
+    entries_crc = binascii.crc32(entries)
+
+    def header(current, alternate, entries_lba):
+        raw = bytearray(
+            struct.pack(
+                "<8sIIIIQQQQ16sQIII",
+                b"EFI PART",
+                0x10000,
+                92,
+                0,
+                0,
+                current,
+                alternate,
+                34,
+                sectors - 34,
+                os.urandom(16),
+                entries_lba,
+                128,
+                128,
+                entries_crc,
+            )
+        )
+        struct.pack_into("<I", raw, 16, binascii.crc32(raw))
+        return bytes(raw)
+
+    with open(path, "wb") as f:
+        f.truncate(size)
+        write_mbr(f, [(0xEE, 1, sectors - 1)])
+        f.seek(512)
+        f.write(header(1, sectors - 1, 2))
+        f.seek(1024)
+        f.write(entries)
+        for first, last in parts:
+            f.seek(first * 512)
+            f.write(os.urandom((last - first + 1) * 512))
+        f.seek((sectors - 33) * 512)
+        f.write(entries)
+        f.write(header(sectors - 1, 1, sectors - 33))
+
+
+def test_mbr_with_logical_partitions(tmp_path):
+    image = tmp_path / "mbr.img"
+    make_mbr_image(image, 16 * MiB)
+
+    layout = read_partition_layout(str(image))
+
+    assert layout.scheme == SCHEME_MBR
+    assert [p.number for p in layout.partitions] == [1, 5, 6]
+    assert layout.partitions[2].start == (4096 + 3072 + 2048) * 512
+    assert layout.used_end == 10240 * 512
+    assert layout.slack == (10240 * 512, 16 * MiB)
+    assert layout.describe() == "MBR, 3 partitions, 11.0 MB of slack skipped"
+
+
+def test_gpt_keeps_backup_header(tmp_path):
+    image = tmp_path / "gpt.img"
+    size = 32 * MiB
+    make_gpt_image(image, size, [(2048, 4095), (4096, 8191)])
+
+    layout = read_partition_layout(str(image))
+
+    assert layout.scheme == SCHEME_GPT
+    assert len(layout.partitions) == 2 and layout.partitions[0].name == "root"
+    assert layout.write_ranges == [(0, 8192 * 512), (size - 40 * 512, size)]
+    assert layout.bytes_saved == size - 40 * 512 - 8192 * 512
+
+
+def test_tables_that_do_not_fit(tmp_path):
+    image = tmp_path / "short.img"
+    make_mbr_image(image, 4 * MiB)
+    with pytest.raises(PartitionTableError):
+        read_partition_layout(str(image))
+
+    plain = tmp_path / "plain.img"
+    plain.write_bytes(os.urandom(MiB))
+    assert read_partition_layout(str(plain)) is None
+
+
+@pytest.mark.parametrize("backend", ["pwrite", "zerocopy"])
+def test_engine_skips_slack(tmp_path, backend):
+    from justdd.logic.flash_engine import FlashEngine
+
+    image = tmp_path / "gpt.img"
+    size = 24 * MiB
+    make_gpt_image(image, size, [(2048, 6143)])
+    target = tmp_path / "dst.img"
+    target.write_bytes(b"\xee" * size)
+
+    with FlashEngine(
+        str(image), str(target), block_size=MiB, trim=True, io_backend=backend
+    ) as engine:
+        engine.copy()
+        engine.sync()
+
+    data, written = image.read_bytes(), target.read_bytes()
+    [(low, high)] = engine.trim_ranges
+    assert engine.bytes_done == size
+    assert engine.bytes_trimmed == high - low
+    assert written[:low] == data[:low] and written[high:] == data[high:]
+    assert written[low:high] == b"\xee" * (high - low)
+
+
+def test_flash_job_trims_hashes_and_verifies(tmp_path):
+    from justdd.logic.flash_job import FlashJob
+
+    image = tmp_path / "mbr.img"
+    make_mbr_image(image, 16 * MiB)
+    target = tmp_path / "dst.img"
+
+    job = FlashJob(
+        str(image), str(target), trim=True, verify=True, hash_algorithms=["sha256"]
+    )
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert job.get_byte_counts()["trimmed"] == 16 * MiB - 10240 * 512
+    assert job.get_digests()["sha256"] == hashlib.sha256(image.read_bytes()).hexdigest()
+    assert os.path.getsize(target) == 16 * MiB
@@ -0,0 +1,264 @@
+import errno
+import gzip
+import hashlib
+import os
+import sys
+import time
+
+import pytest
+
+from justdd.logic.priv_helper import HelperError, PrivilegedHelper, write_image
+
+
+@pytest.fixture
+def helper():
+    # Stand-in helper: same protocol, started without pkexec.
+    helper = PrivilegedHelper(privileged=False)
+    helper.start()
+    yield helper
+    helper.stop()
+    assert not helper.alive
+
+
+def test_write_and_copy_file_targets(helper, tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 11)
+    src = tmp_path / "src.img"
+    src.write_bytes(data)
+    dst = tmp_path / "dst.img"
+
+    handle = helper.open(str(dst), create=True)["handle"]
+    assert helper.write(handle, 0, data[:4096]) == 4096
+    seen = []
+    with open(src, "rb") as f:
+        result = helper.copy(
+            handle,
+            f.fileno(),
+            len(data) - 4096,
+            offset=4096,
+            source_offset=4096,
+            on_progress=lambda done, total: seen.append((done, total)),
+        )
+    helper.sync(handle)
+    helper.close(handle)
+
+    assert result["copied"] == len(data) - 4096
+    assert seen[-1] == (len(data) - 4096, len(data) - 4096)
+    assert dst.read_bytes() == data
+
+
+def test_write_image_streams_compressed_images(helper, tmp_path):
+    data = os.urandom(1024 * 1024) + bytes(2 * 1024 * 1024)
+    src = tmp_path / "src.img.gz"
+    src.write_bytes(gzip.compress(data))
+    dst = tmp_path / "dst.img"
+    dst.write_bytes(b"\xff" * (4 * 1024 * 1024))
+
+    digests = write_image(
+        helper, str(src), str(dst), hash_algorithms=["sha256"], chunk_size=512 * 1024
+    )
+
+    assert dst.read_bytes() == data
+    assert digests == {"sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_run_streams_output_and_cancels(helper):
+    lines = []
+    argv = [sys.executable, "-c", "print('Step 1/2: one'); print('two'); exit(3)"]
+    assert helper.run(argv, on_output=lines.append) == 3
+    assert lines == ["Step 1/2: one", "two"]
+
+    started = time.monotonic()
+    helper.run(["sleep", "30"], should_stop=lambda: time.monotonic() - started > 0.2)
+    assert time.monotonic() - started < 10
+
+    with pytest.raises(HelperError):
+        helper.close(helper.open("/nonexistent/dir/file")["handle"])
+
+
+def test_open_never_creates_device_nodes(helper, tmp_path):
+    # An unplugged stick leaves no node behind; nothing may take its place.
+    missing = f"/dev/justdd-test-{os.getpid()}"
+    try:
+        with pytest.raises(HelperError) as raised:
+            helper.open(missing, create=True)
+        assert raised.value.errno == errno.ENOENT
+        src = tmp_path / "src.img"
+        src.write_bytes(b"justdd" * 1000)
+        with pytest.raises(HelperError):
+            write_image(helper, str(src), missing)
+        assert not os.path.exists(missing)
+    finally:
+        if os.path.isfile(missing):
+            os.unlink(missing)
+
+
+def test_helper_closes_descriptors_no_command_takes(helper, tmp_path):
+    stray = tmp_path / "stray.bin"
+    stray.write_bytes(b"x")
+    with open(stray, "rb") as f:
+        helper.request("hello", fds=[f.fileno()])
+    # Requests are served one after the other: once this one is answered,
+    # the previous one is done with.
+    helper.request("hello")
+    proc = f"/proc/{helper._process.pid}/fd"
+    assert str(stray) not in [
+        os.readlink(os.path.join(proc, n)) for n in os.listdir(proc)
+    ]
+
+
+def test_flash_job_uses_helper(helper, tmp_path):
+    from justdd.logic.flash_job import FlashJob
+
+    data = os.urandom(2 * 1024 * 1024 + 5)
+    src = tmp_path / "src.img"
+    src.write_bytes(data)
+    dst = tmp_path / "dst.img"
+
+    job = FlashJob(str(src), str(dst), engine="helper", helper=helper)
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert "Using the privileged helper" in job.get_logs()
+    assert dst.read_bytes() == data
+
+
+def test_open_read_passes_a_read_only_descriptor(helper, tmp_path):
+    src = tmp_path / "src.img"
+    src.write_bytes(b"justdd" * 1000)
+
+    fd = helper.open_read(str(src))
+    try:
+        assert os.pread(fd, 6, 6) == b"justdd"
+        with pytest.raises(OSError):
+            os.write(fd, b"x")
+    finally:
+        os.close(fd)
+
+    with pytest.raises(FileNotFoundError):
+        helper.open_read(str(tmp_path / "missing.img"))
+
+
+def test_flash_job_verifies_through_helper(helper, tmp_path, monkeypatch):
+    from justdd.logic import flash_job
+    from justdd.logic.flash_job import FlashJob
+
+    data = os.urandom(2 * 1024 * 1024 + 5)
+    src = tmp_path / "src.img"
+    src.write_bytes(data)
+    dst = tmp_path / "dst.img"
+    # The target is not readable by the user, only by the helper.
+    access = os.access
+    monkeypatch.setattr(
+        flash_job.os,
+        "access",
+        lambda path, mode: mode != os.R_OK and access(path, mode),
+    )
+
+    job = FlashJob(str(src), str(dst), engine="helper", helper=helper, verify=True)
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert "Reading the target back through the privileged helper" in job.get_logs()
+    assert job.get_verify_result()["verified"] == len(data)
+
+    job = FlashJob(str(src), str(dst), engine="dd", verify=True)
+    job._flash_linux_helper(helper)
+    assert job.was_successful()
+    assert job.get_verify_result() == {
+        "skipped": f"{dst} is not readable without elevated privileges"
+    }
+    assert job.get_status() == (
+        "Flash completed, but not verified: "
+        f"{dst} is not readable without elevated privileges"
+    )
+
+
+@pytest.mark.parametrize(
+    "compressed,algorithms", [(False, []), (False, ["sha256"]), (True, [])]
+)
+def test_write_image_leaves_skip_ranges_alone(helper, tmp_path, compressed, algorithms):
+    MiB = 1024 * 1024
+    data = os.urandom(3 * MiB + 100)
+    src = tmp_path / ("src.img.gz" if compressed else "src.img")
+    src.write_bytes(gzip.compress(data) if compressed else data)
+    dst = tmp_path / "dst.img"
+    dst.write_bytes(b"\xee" * (4 * MiB))
+    skip = [(MiB, 2 * MiB), (3 * MiB, 3 * MiB + 100)]
+    seen = []
+
+    digests = write_image(
+        helper,
+        str(src),
+        str(dst),
+        hash_algorithms=algorithms,
+        skip_ranges=skip,
+        chunk_size=256 * 1024,
+        on_progress=lambda done, total, passed: seen.append(passed),
+    )
+
+    written = dst.read_bytes()
+    assert len(written) == len(data)
+    assert (
+        written[:MiB] == data[:MiB]
+        and written[2 * MiB : 3 * MiB] == data[2 * MiB : 3 * MiB]
+    )
+    assert written[MiB : 2 * MiB] == b"\xee" * MiB
+    assert written[3 * MiB :] == b"\xee" * 100
+    assert seen[-1] == len(data)
+    if algorithms:
+        assert digests == {"sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_helper_caps_dirty_pages_until_the_gui_goes_away(tmp_path, monkeypatch):
+    import socket
+
+    from justdd.logic import helper_server
+
+    bdi = tmp_path / "bdi" / "8:16"
+    bdi.mkdir(parents=True)
+    (bdi / "max_ratio").write_text("100\n")
+    (bdi / "strict_limit").write_text("0\n")
+    monkeypatch.setattr(helper_server, "_SYS_CLASS_BDI", str(tmp_path / "bdi"))
+    gui, helper_end = socket.socketpair()
+    server = helper_server.HelperServer(helper_end)
+
+    server._cmd_bdi_limit({"bdi": "8:16", "max_ratio": 5})
+    assert (bdi / "max_ratio").read_text() == "5"
+    assert (bdi / "strict_limit").read_text() == "1"
+    server._cmd_bdi_restore({"bdi": "8:16"})
+    assert (bdi / "max_ratio").read_text() == "100"
+    assert (bdi / "strict_limit").read_text() == "0"
+    with pytest.raises(ValueError):
+        server._cmd_bdi_limit({"bdi": "../8:16", "max_ratio": 5})
+
+    server._cmd_bdi_limit({"bdi": "8:16", "max_ratio": 5, "strict": False})
+    assert (bdi / "max_ratio").read_text() == "5"
+    gui.close()
+    server.serve()
+    assert (bdi / "max_ratio").read_text() == "100"
+    helper_end.close()
+
+
+def test_flash_job_caps_dirty_pages_through_helper(helper, tmp_path, monkeypatch):
+    from justdd.logic import blockdev, flash_job
+    from justdd.logic.flash_job import FlashJob
+
+    # Writable by the user here, but a job writing through the helper must
+    # ask the helper, which looks in the real sysfs (where this BDI is not).
+    bdi = tmp_path / "bdi" / "justdd-test"
+    bdi.mkdir(parents=True)
+    (bdi / "max_ratio").write_text("100\n")
+    monkeypatch.setattr(blockdev, "_SYS_CLASS_BDI", str(tmp_path / "bdi"))
+    monkeypatch.setattr(flash_job, "bdi_name", lambda path: "justdd-test")
+    src = tmp_path / "src.img"
+    src.write_bytes(os.urandom(1024 * 1024))
+
+    job = FlashJob(
+        str(src),
+        str(tmp_path / "dst.img"),
+        engine="helper",
+        helper=helper,
+        dirty_limit_ratio=5,
+    )
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    assert "Could not cap dirty pages of BDI justdd-test" in "\n".join(job.get_logs())
+    assert (bdi / "max_ratio").read_text() == "100\n"
@@ -0,0 +1,32 @@
+import math
+
+from justdd.logic.telemetry import FlashTelemetry, describe_telemetry
+
+MB = 1024 * 1024
+
+
+def test_rates_and_eta():
+    telemetry = FlashTelemetry(half_life=2.0, min_interval=0.5, clock=lambda: 0.0)
+    telemetry.start(now=100.0)
+    # The first sample is the baseline (e.g. the offset of a resumed flash).
+    assert telemetry.update(50 * MB, 1000 * MB, now=100.0)
+    assert telemetry.rate == 0.0 and math.isinf(telemetry.eta)
+
+    for second in range(1, 11):
+        assert telemetry.update((50 + 10 * second) * MB, 1000 * MB, now=100.0 + second)
+    assert telemetry.rate == 10 * MB
+    assert abs(telemetry.avg_rate - 10 * MB) < 1
+    assert abs(telemetry.mean_rate - 10 * MB) < 1
+    assert abs(telemetry.eta - 85.0) < 1e-6
+
+    # Too close to the previous sample: ignored.
+    assert not telemetry.update(151 * MB, 1000 * MB, now=110.1)
+
+    # A stall only moves the average by the time-weighted share.
+    telemetry.update(151 * MB, 1000 * MB, now=112.0)
+    assert telemetry.rate == MB / 2
+    assert 5 * MB < telemetry.avg_rate < 6 * MB
+
+    snapshot = telemetry.snapshot()
+    assert snapshot["elapsed"] == 12.0
+    assert "00:12 elapsed" in describe_telemetry(snapshot)
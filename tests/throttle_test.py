@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+
+from justdd.logic.throttle import BandwidthLimiter, get_io_priority, set_io_priority
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_limiter_paces_to_rate():
+    clock = FakeClock()
+    limiter = BandwidthLimiter(10 * 1024**2, clock=clock, sleep=clock.sleep)
+    for _ in range(100):
+        limiter.consume(1024**2)
+    assert clock.now == pytest.approx(10.0, rel=0.001)
+
+
+def test_limiter_allows_burst_after_idle():
+    clock = FakeClock()
+    limiter = BandwidthLimiter(1000, burst=500, clock=clock, sleep=clock.sleep)
+    clock.now = 60.0
+    limiter.consume(500)
+    assert clock.now == 60.0
+    limiter.consume(100)
+    assert clock.now == pytest.approx(60.1)
+
+
+def test_engine_bandwidth_cap(tmp_path):
+    from justdd.logic.flash_engine import FlashEngine
+
+    src = tmp_path / "src.img"
+    data = os.urandom(6 * 1024 * 1024)
+    src.write_bytes(data)
+    rate = 16 * 1024 * 1024
+
+    started = time.monotonic()
+    with FlashEngine(
+        str(src), str(tmp_path / "dst.img"), block_size=512 * 1024, bandwidth_limit=rate
+    ) as engine:
+        engine.copy()
+    elapsed = time.monotonic() - started
+
+    assert len(data) / elapsed == pytest.approx(rate, rel=0.05)
+    assert (tmp_path / "dst.img").read_bytes() == data
+
+
+def test_flash_job_logs_scheduling(tmp_path):
+    from justdd.logic.flash_job import FlashJob
+
+    src = tmp_path / "src.img"
+    src.write_bytes(os.urandom(64 * 1024))
+    job = FlashJob(
+        str(src),
+        str(tmp_path / "dst.img"),
+        io_class="idle",
+        nice=5,
+        bandwidth_limit=8 * 1024 * 1024,
+    )
+    job.start()
+    assert job.wait(30) and job.was_successful()
+    logs = job.get_logs()
+    if get_io_priority() is not None:
+        assert "I/O priority: idle" in logs
+    assert "CPU nice level: 5" in logs
+    assert "Bandwidth cap: 8.0 MB/s" in logs
+
+
+def test_set_io_priority_rejects_unknown_class():
+    with pytest.raises(ValueError):
+        set_io_priority("urgent")